@@ -0,0 +1,656 @@
+#!/usr/bin/env python3
+"""Rotation of ii out logs into compressed and indexed archive.
+
+ii opens out file for every line it logs, therefore out is rotated by rename
+and ii creates a new one with the next line. Renamed file is archived only
+after it hasn't been written for a grace period, which gives ii and followers
+of the file time to finish.
+
+Lines are archived next to out into segments, one per day in UTC. Segment is
+a series of gzip members of up to ARCHIVE_BLOCK_LINES lines and sparse index
+maps time of the first line of every member to segment and offset. Reading a
+time range decompresses only members which cover it. Index also maps byte
+offset of the first line of every member in archived file, therefore lines
+indexed by iilog can be read after their out file is gone.
+
+ii's stdout log, '<network>.log', is held open by supervisor, therefore it's
+copied and truncated instead.
+
+  ./iiarchive.py rotate --max-size 1048576 ~/ii
+  ./iiarchive.py read --since '2024-01-01' --until '2024-01-02 12:00' \
+      ~/ii/irc.example.com/#chan
+"""
+import argparse
+import bisect
+import calendar
+import gzip
+import logging
+import os
+import re
+import sys
+import time
+import traceback
+from collections.abc import Iterable
+from collections.abc import Iterator
+from dataclasses import dataclass
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+ARCHIVE_DIR_NAME = "archive"
+INDEX_NAME = "index"
+ROTATING_SUFFIX = ".rotating"
+ARCHIVE_BLOCK_LINES = 1000
+ARCHIVE_MAX_SIZE = 1024 * 1024  # bytes
+# Renamed out is archived once it hasn't been written for this long.
+ARCHIVE_GRACE = 5  # seconds
+# Directories which aren't channels or queries.
+SKIPPED_DIRS = (ARCHIVE_DIR_NAME, "nickserv")
+RE_SOURCE = re.compile(r"^(?P<inode>\d+):(?P<size>\d+):\d+$")
+
+
+@dataclass(frozen=True)
+class IndexEntry:
+    """Class represents gzip member of segment in sparse index.
+
+    Source identifies archived file, so it's never archived twice. Source
+    offset is byte offset of the first line of member in archived file, -1 if
+    it's unknown.
+    """
+
+    nixtime: int
+    segment: str
+    offset: int
+    length: int
+    source: str
+    source_offset: int
+
+
+def get_bucket(nixtime: int) -> str:
+    """Return name of day bucket of nixtime."""
+    return time.strftime("%Y-%m-%d", time.gmtime(nixtime))
+
+
+def get_nixtime(line: bytes) -> Optional[int]:
+    """Return nixtime of ii out line or None."""
+    nixtime, _, _ = line.partition(b" ")
+    if not nixtime.isdigit():
+        return None
+
+    return int(nixtime)
+
+
+def get_source(path: str) -> str:
+    """Return identity of file which changes whenever file does."""
+    fstat = os.stat(path)
+    return "{:d}:{:d}:{:d}".format(
+        fstat.st_ino, fstat.st_size, fstat.st_mtime_ns
+    )
+
+
+def read_index(archive_dir: str) -> List[IndexEntry]:
+    """Return entries of sparse index, empty if there is no archive."""
+    entries = []
+    try:
+        fhandle = open(
+            os.path.join(archive_dir, INDEX_NAME), "r", encoding="utf-8"
+        )
+    except FileNotFoundError:
+        return entries
+
+    with fhandle:
+        for line in fhandle:
+            chunks = line.rstrip("\n").split("\t")
+            if not line.endswith("\n") or len(chunks) not in (5, 6):
+                # Partially written, ie. not committed.
+                continue
+
+            if len(chunks) == 5:
+                # Written before source offsets have been indexed.
+                chunks.append("-1")
+
+            nixtime, segment, offset, length, source, source_offset = chunks
+            entries.append(
+                IndexEntry(
+                    int(nixtime),
+                    segment,
+                    int(offset),
+                    int(length),
+                    source,
+                    int(source_offset),
+                )
+            )
+
+    return entries
+
+
+def get_source_path(archive_dir: str, source: str) -> str:
+    """Return path which stands for archived file in iilog's indexes."""
+    return os.path.join(archive_dir, source)
+
+
+def split_source_path(path: str) -> Optional[Tuple[str, str]]:
+    """Return (archive_dir, source) of path from get_source_path() or None."""
+    archive_dir, source = os.path.split(path)
+    if os.path.basename(archive_dir) != ARCHIVE_DIR_NAME:
+        return None
+
+    if not RE_SOURCE.match(source):
+        return None
+
+    return archive_dir, source
+
+
+def find_source(archive_dir: str, inode: int, size: int) -> Optional[str]:
+    """Return the latest archived file with inode and at least size bytes.
+
+    Inode is reused once archived file is removed, hence the latest one.
+    """
+    found = None
+    for entry in read_index(archive_dir):
+        match = RE_SOURCE.match(entry.source)
+        if (
+            match
+            and int(match.group("inode")) == inode
+            and int(match.group("size")) >= size
+        ):
+            found = entry.source
+
+    return found
+
+
+def read_source(
+    archive_dir: str, source: str, spans: List[Tuple[int, int]]
+) -> List[Optional[bytes]]:
+    """Return lines at (offset, length) spans of archived file.
+
+    Line is None if it isn't in archive. Every member is decompressed at
+    most once.
+    """
+    entries = sorted(
+        (
+            entry
+            for entry in read_index(archive_dir)
+            if entry.source == source and entry.source_offset >= 0
+        ),
+        key=lambda entry: entry.source_offset,
+    )
+    starts = [entry.source_offset for entry in entries]
+    blocks: Dict[int, bytes] = {}
+    lines: List[Optional[bytes]] = []
+    for offset, length in spans:
+        idx = bisect.bisect_right(starts, offset) - 1
+        if idx < 0:
+            lines.append(None)
+            continue
+
+        entry = entries[idx]
+        if idx not in blocks:
+            blocks[idx] = _read_block(
+                os.path.join(archive_dir, entry.segment),
+                entry.offset,
+                entry.length,
+            )
+
+        start = offset - entry.source_offset
+        end = start + length
+        line = blocks[idx][start:end]
+        lines.append(line if len(line) == length else None)
+
+    return lines
+
+
+def _has_out(dirpath: str) -> bool:
+    """Return True if directory has out file, renamed or not."""
+    out_path = os.path.join(dirpath, "out")
+    return os.path.isfile(out_path) or os.path.isfile(
+        out_path + ROTATING_SUFFIX
+    )
+
+
+def iter_log_dirs(ircdir: str) -> Iterator[str]:
+    """Yield directories of networks, channels and queries with out file.
+
+    Directories whose out has been renamed by rotate() are included.
+    """
+    try:
+        networks = sorted(os.listdir(ircdir))
+    except FileNotFoundError:
+        return
+
+    for network in networks:
+        netdir = os.path.join(ircdir, network)
+        if not os.path.isdir(netdir):
+            continue
+
+        if _has_out(netdir):
+            yield netdir
+
+        for name in sorted(os.listdir(netdir)):
+            dirpath = os.path.join(netdir, name)
+            if name.lower() not in SKIPPED_DIRS and _has_out(dirpath):
+                yield dirpath
+
+
+def should_rotate(path: str, now: float, max_size: int) -> bool:
+    """Return True if out is too big or has lines of an earlier day."""
+    try:
+        with open(path, "rb") as fhandle:
+            size = os.fstat(fhandle.fileno()).st_size
+            first_line = fhandle.readline()
+    except FileNotFoundError:
+        return False
+
+    if size == 0:
+        return False
+
+    if size >= max_size:
+        return True
+
+    nixtime = get_nixtime(first_line)
+    return nixtime is not None and get_bucket(nixtime) != get_bucket(int(now))
+
+
+def rotate(
+    dirpath: str,
+    now: Optional[float] = None,
+    max_size: int = ARCHIVE_MAX_SIZE,
+    grace: float = ARCHIVE_GRACE,
+) -> int:
+    """Archive out renamed by the previous call and rename out, if due.
+
+    Returns number of archived lines.
+    """
+    if now is None:
+        now = time.time()
+
+    out_path = os.path.join(dirpath, "out")
+    rotating = out_path + ROTATING_SUFFIX
+    count = 0
+    try:
+        if now - os.stat(rotating).st_mtime >= grace:
+            count = archive_file(
+                rotating, os.path.join(dirpath, ARCHIVE_DIR_NAME)
+            )
+    except FileNotFoundError:
+        pass
+
+    if not os.path.exists(rotating) and should_rotate(out_path, now, max_size):
+        os.rename(out_path, rotating)
+
+    return count
+
+
+def _write_block(
+    archive_dir: str,
+    segment: str,
+    lines: List[bytes],
+    nixtime: int,
+    source: str,
+    source_offset: int,
+    indexed: Dict[str, int],
+    ends: Dict[str, int],
+) -> IndexEntry:
+    """Append lines as gzip member to segment and return its IndexEntry.
+
+    Before the first write, segment is truncated to its indexed part, which
+    drops members written by archive_file() which hasn't finished.
+    """
+    path = os.path.join(archive_dir, segment)
+    with open(path, "ab") as fhandle:
+        if segment not in ends:
+            ends[segment] = indexed.get(segment, 0)
+            fhandle.truncate(ends[segment])
+
+        data = gzip.compress(b"".join(lines), mtime=0)
+        offset = ends[segment]
+        fhandle.write(data)
+        fhandle.flush()
+        os.fsync(fhandle.fileno())
+
+    ends[segment] = offset + len(data)
+    return IndexEntry(
+        nixtime, segment, offset, len(data), source, source_offset
+    )
+
+
+def archive_file(path: str, archive_dir: str) -> int:
+    """Append lines of file to archive and remove the file.
+
+    Index is written at once after all segments, therefore interrupted
+    archiving starts over. Returns number of archived lines.
+    """
+    source = get_source(path)
+    entries = read_index(archive_dir)
+    if any(entry.source == source for entry in entries):
+        # Archived, but not removed.
+        os.unlink(path)
+        return 0
+
+    os.makedirs(archive_dir, exist_ok=True)
+    indexed: Dict[str, int] = {}
+    for entry in entries:
+        indexed[entry.segment] = max(
+            indexed.get(entry.segment, 0), entry.offset + entry.length
+        )
+
+    ends: Dict[str, int] = {}
+    new_entries = []
+    count = 0
+    mtime = int(os.stat(path).st_mtime)
+    with open(path, "rb") as fhandle:
+        block: List[bytes] = []
+        block_bucket = ""
+        block_nixtime = 0
+        block_offset = 0
+        last_nixtime = None
+        source_offset = 0
+        for line in fhandle:
+            line_offset = source_offset
+            source_offset += len(line)
+            if not line.endswith(b"\n"):
+                line += b"\n"
+
+            nixtime = get_nixtime(line)
+            if nixtime is None:
+                # Continuation of the previous line, eg. ii's stdout.
+                nixtime = last_nixtime if last_nixtime is not None else mtime
+
+            last_nixtime = nixtime
+            bucket = get_bucket(nixtime)
+            if block and (
+                bucket != block_bucket or len(block) >= ARCHIVE_BLOCK_LINES
+            ):
+                new_entries.append(
+                    _write_block(
+                        archive_dir,
+                        "{:s}.gz".format(block_bucket),
+                        block,
+                        block_nixtime,
+                        source,
+                        block_offset,
+                        indexed,
+                        ends,
+                    )
+                )
+                block = []
+
+            if not block:
+                block_bucket = bucket
+                block_nixtime = nixtime
+                block_offset = line_offset
+
+            block.append(line)
+            count += 1
+
+        if block:
+            new_entries.append(
+                _write_block(
+                    archive_dir,
+                    "{:s}.gz".format(block_bucket),
+                    block,
+                    block_nixtime,
+                    source,
+                    block_offset,
+                    indexed,
+                    ends,
+                )
+            )
+
+    with open(
+        os.path.join(archive_dir, INDEX_NAME), "a", encoding="utf-8"
+    ) as fhandle:
+        fhandle.write(
+            "".join(
+                "{:d}\t{:s}\t{:d}\t{:d}\t{:s}\t{:d}\n".format(
+                    entry.nixtime,
+                    entry.segment,
+                    entry.offset,
+                    entry.length,
+                    entry.source,
+                    entry.source_offset,
+                )
+                for entry in new_entries
+            )
+        )
+        fhandle.flush()
+        os.fsync(fhandle.fileno())
+
+    os.unlink(path)
+    return count
+
+
+def rotate_log(
+    path: str, now: Optional[float] = None, max_size: int = ARCHIVE_MAX_SIZE
+) -> bool:
+    """Compress log held open by its writer and truncate it, if it's too big.
+
+    Writer must append, eg. open the log with O_APPEND, otherwise it keeps
+    writing at its old offset. Lines written between the last read and
+    truncate are lost. Returns True if log has been rotated.
+    """
+    if now is None:
+        now = time.time()
+
+    try:
+        if os.stat(path).st_size < max_size:
+            return False
+    except FileNotFoundError:
+        return False
+
+    archive_path = "{:s}.{:s}.gz".format(
+        path, time.strftime("%Y%m%dT%H%M%S", time.gmtime(now))
+    )
+    with open(path, "rb") as fhandle, gzip.open(archive_path, "wb") as gzfile:
+        while True:
+            data = fhandle.read(65536)
+            if not data:
+                break
+
+            gzfile.write(data)
+
+        # Catch up with lines written in the meantime.
+        data = fhandle.read()
+        gzfile.write(data)
+        os.truncate(path, 0)
+
+    return True
+
+
+def rotate_all(
+    ircdir: str,
+    now: Optional[float] = None,
+    max_size: int = ARCHIVE_MAX_SIZE,
+    grace: float = ARCHIVE_GRACE,
+) -> int:
+    """Rotate all logs in ii directory and return number of archived lines.
+
+    Errors are logged and don't stop rotation of other logs.
+    """
+    if now is None:
+        now = time.time()
+
+    count = 0
+    for dirpath in iter_log_dirs(ircdir):
+        try:
+            count += rotate(dirpath, now, max_size, grace)
+        except Exception:
+            logging.error(
+                "Failed to rotate '%s': %s", dirpath, traceback.format_exc()
+            )
+
+    try:
+        names = sorted(os.listdir(ircdir))
+    except FileNotFoundError:
+        names = []
+
+    for name in names:
+        path = os.path.join(ircdir, name)
+        if not name.endswith(".log") or not os.path.isfile(path):
+            continue
+
+        try:
+            rotate_log(path, now, max_size)
+        except Exception:
+            logging.error(
+                "Failed to rotate '%s': %s", path, traceback.format_exc()
+            )
+
+    return count
+
+
+def _read_block(path: str, offset: int, length: int) -> bytes:
+    """Return decompressed gzip member at offset of segment."""
+    with open(path, "rb") as fhandle:
+        fhandle.seek(offset)
+        return gzip.decompress(fhandle.read(length))
+
+
+def _filter_lines(
+    lines: Iterable[bytes], start: int, end: int, nixtime: int
+) -> Iterator[bytes]:
+    """Yield lines logged between start and end, both included.
+
+    Line without nixtime belongs to the previous one, nixtime is used for the
+    first line.
+    """
+    for line in lines:
+        line_nixtime = get_nixtime(line)
+        if line_nixtime is not None:
+            nixtime = line_nixtime
+
+        if nixtime > end:
+            break
+
+        if nixtime >= start:
+            yield line
+
+
+def read_range(dirpath: str, start: int, end: int) -> Iterator[bytes]:
+    """Yield lines of channel or query logged between start and end.
+
+    Only gzip members which cover the range are decompressed, followed by
+    lines which haven't been archived yet.
+    """
+    archive_dir = os.path.join(dirpath, ARCHIVE_DIR_NAME)
+    entries = sorted(
+        read_index(archive_dir),
+        key=lambda entry: (entry.nixtime, entry.segment, entry.offset),
+    )
+    for idx, entry in enumerate(entries):
+        next_idx = idx + 1
+        if entry.nixtime > end:
+            break
+
+        if next_idx < len(entries) and entries[next_idx].nixtime < start:
+            continue
+
+        data = _read_block(
+            os.path.join(archive_dir, entry.segment), entry.offset, entry.length
+        )
+        yield from _filter_lines(
+            data.splitlines(keepends=True), start, end, entry.nixtime
+        )
+
+    out_path = os.path.join(dirpath, "out")
+    for path in (out_path + ROTATING_SUFFIX, out_path):
+        try:
+            fhandle = open(path, "rb")
+        except FileNotFoundError:
+            continue
+
+        with fhandle:
+            mtime = int(os.fstat(fhandle.fileno()).st_mtime)
+            yield from _filter_lines(fhandle, start, end, mtime)
+
+
+def parse_time(value: str) -> int:
+    """Return nixtime of nixtime, 'YYYY-mm-dd' or 'YYYY-mm-dd HH:MM' in UTC."""
+    if value.isdigit():
+        return int(value)
+
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return calendar.timegm(time.strptime(value, fmt))
+        except ValueError:
+            continue
+
+    raise argparse.ArgumentTypeError(
+        "Invalid time '{:s}', expected nixtime, 'YYYY-mm-dd' or "
+        "'YYYY-mm-dd HH:MM'.".format(value)
+    )
+
+
+def main():
+    """Rotate logs or read archived lines."""
+    args = parse_args()
+    logging.basicConfig(stream=sys.stderr, encoding="utf-8")
+    if args.action == "rotate":
+        count = rotate_all(
+            args.ircdir, max_size=args.max_size, grace=args.grace
+        )
+        if args.grace > 0:
+            # Give ii time to finish lines of renamed out files.
+            time.sleep(args.grace)
+
+        count += rotate_all(args.ircdir, max_size=args.max_size, grace=0)
+        print("Archived {:d} line(s).".format(count))
+        return
+
+    until = args.until if args.until is not None else int(time.time())
+    for line in read_range(args.dirpath, args.since, until):
+        sys.stdout.buffer.write(line)
+
+    sys.stdout.flush()
+
+
+def parse_args() -> argparse.Namespace:
+    """Return parsed CLI args."""
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    parser_rotate = subparsers.add_parser(
+        "rotate", help="Rotate out files and archive them."
+    )
+    parser_rotate.add_argument(
+        "ircdir",
+        type=str,
+        help="ii directory.",
+    )
+    parser_rotate.add_argument(
+        "--max-size",
+        type=int,
+        default=ARCHIVE_MAX_SIZE,
+        help="Rotate files bigger than this many bytes, or started a day ago.",
+    )
+    parser_rotate.add_argument(
+        "--grace",
+        type=float,
+        default=ARCHIVE_GRACE,
+        help="Seconds to wait between rename and archiving.",
+    )
+    parser_read = subparsers.add_parser(
+        "read", help="Print lines of channel or query in time range."
+    )
+    parser_read.add_argument(
+        "dirpath",
+        type=str,
+        help="Directory of channel or query.",
+    )
+    parser_read.add_argument(
+        "--since",
+        type=parse_time,
+        required=True,
+        help="Nixtime, 'YYYY-mm-dd' or 'YYYY-mm-dd HH:MM' in UTC.",
+    )
+    parser_read.add_argument(
+        "--until",
+        type=parse_time,
+        default=None,
+        help="Nixtime, 'YYYY-mm-dd' or 'YYYY-mm-dd HH:MM', now if unset.",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks of iibot hot paths.
+
+Benchmarks run on generated data - friends files of various sizes with mixed
+hostmask shapes, streams of join messages, commands and synthetic HTML.
+Results are written as JSON and can be compared against a stored baseline,
+in which case exit code is 1 if anything has become slower than threshold.
+
+  ./iibench.py --output results.json --baseline benchmarks/baseline.json
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import timeit
+from collections.abc import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import iicmd  # noqa:I202
+import iifriends
+
+DEFAULT_SIZES = (10, 1000, 10000, 100000)
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.25
+DEFAULT_BASELINE = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "benchmarks", "baseline.json"
+)
+JOIN_STREAM_SIZE = 1000
+HTML_SIZES = (1024, 100 * 1024, 1024 * 1024)
+HTML_ENCODINGS = ("utf-8", "iso-8859-2", "utf-16")
+COMMANDS = ("ping", "list", "echo hello there", "whereami", "unknown")
+RESULTS_VERSION = 1
+
+# Hostmask shapes, "{i}" is replaced with index of the friend.
+HOSTMASK_SHAPES = {
+    "exact": "*!*user{i}@host{i}.example.com",
+    "subdomain": "*!*@*.dom{i}.example.net",
+    "nick": "nick{i}*!*@*",
+    "ident": "*!~ident{i}@*",
+    "ipv4": "*!*@10.{a}.{b}.0/24",
+    "ipv6": "*!*@2001:db8:{a:x}:{b:x}::/64",
+}
+# Joins which match friends of given shape, the rest matches nobody.
+JOIN_SHAPES = {
+    "exact": "someone(~user{i}@host{i}.example.com) has joined #chan{c}",
+    "subdomain": "someone(~x@a.dom{i}.example.net) has joined #chan{c}",
+    "nick": "nick{i}x(~x@example.org) has joined #chan{c}",
+    "ident": "someone(~ident{i}@example.org) has joined #chan{c}",
+    "ipv4": "someone(~x@10.{a}.{b}.7) has joined #chan{c}",
+    "ipv6": "someone(~x@2001:db8:{a:x}:{b:x}::7) has joined #chan{c}",
+    "stranger": "stranger{i}(~x@nowhere.example.org) has joined #chan{c}",
+}
+
+
+def format_shape(shape: str, index: int) -> str:
+    """Return hostmask or join of given shape for friend index."""
+    return shape.format(
+        i=index, a=index // 256 % 256, b=index % 256, c=index % 10
+    )
+
+
+def generate_friends_lines(count: int, seed: int = 0) -> List[str]:
+    """Return lines of friends file with count friends of mixed shapes."""
+    rng = random.Random(seed)
+    shapes = list(HOSTMASK_SHAPES.values())
+    lines = ["# version = 2.4.1 (20021124)"]
+    for index in range(count):
+        hostmask = format_shape(shapes[index % len(shapes)], index)
+        if rng.random() < 0.5:
+            globflags = "av"
+            chanflags = ""
+        else:
+            globflags = ""
+            chanflags = "#chan{:d},ao, #chan{:d},va,".format(
+                index % 10, (index + 1) % 10
+            )
+
+        lines.append(
+            "handle=friend{:d}%hosts={:s}%globflags={:s}%chanflags={:s}"
+            "%password=%comment=%".format(index, hostmask, globflags, chanflags)
+        )
+
+    return lines
+
+
+def generate_joins(count: int, friends: int, seed: int = 0) -> List[str]:
+    """Return join messages, about half of them match some of friends."""
+    rng = random.Random(seed)
+    shapes = list(JOIN_SHAPES.items())
+    joins = []
+    for _ in range(count):
+        name, shape = rng.choice(shapes)
+        index = rng.randrange(max(friends, 1))
+        if name != "stranger":
+            # Pick friend of the same shape.
+            shape_index = list(HOSTMASK_SHAPES.keys()).index(name)
+            index -= index % len(HOSTMASK_SHAPES)
+            index += shape_index
+            if index >= friends:
+                index = shape_index
+
+        joins.append(format_shape(shape, index))
+
+    return joins
+
+
+def generate_html(size: int) -> str:
+    """Return HTML page of roughly given size with title near the end."""
+    body = "<p>Příliš žluťoučký kůň úpěl ďábelské ódy.</p>\n"
+    count = max(size // len(body.encode("utf-8")), 1)
+    return (
+        "<html><head><script>{:s}</script>"
+        "<title>Žluťoučký kůň - benchmark</title></head>"
+        "<body></body></html>".format(body * count)
+    )
+
+
+def extract_title_decoded(data: bytes, encoding: str) -> Optional[str]:
+    """Decode HTML page and return its title, like get_url_title() does."""
+    return iicmd.extract_title(data.decode(encoding))
+
+
+def write_friends_file(directory: str, count: int) -> str:
+    """Write friends file into directory and return its path."""
+    fname = os.path.join(directory, "friends-{:d}.txt".format(count))
+    with open(fname, "w", encoding="utf-8") as fhandle:
+        fhandle.write("\n".join(generate_friends_lines(count)))
+        fhandle.write("\n")
+
+    return fname
+
+
+def cycle_calls(func: Callable, items: List) -> Callable:
+    """Return function which calls func with the next item on every call."""
+    iterator = itertools.cycle(items)
+
+    def call():
+        """Call func with the next item."""
+        return func(next(iterator))
+
+    return call
+
+
+def get_benchmarks(
+    directory: str, sizes: Tuple[int, ...]
+) -> Dict[str, Callable[[], Callable]]:
+    """Return benchmark setups by name.
+
+    Setup prepares data and returns function to be timed.
+    """
+    benchmarks = {}
+
+    def add(name: str):
+        """Register decorated setup under name."""
+
+        def decorator(setup):
+            """Register setup."""
+            benchmarks[name] = setup
+            return setup
+
+        return decorator
+
+    for size in sizes:
+
+        @add("friends.parse_file.{:d}".format(size))
+        def setup_parse_file(size=size):
+            """Parse friends file."""
+            fname = write_friends_file(directory, size)
+            return lambda: iifriends.parse_friends_file(fname)
+
+        @add("friends.find_friends.{:d}".format(size))
+        def setup_find_friends(size=size):
+            """Match a stream of joins against friends database."""
+            fname = write_friends_file(directory, size)
+            database = iifriends.FriendsDatabase.load(fname, cache_size=0)
+            joins = [
+                iifriends.parse_message(join)
+                for join in generate_joins(JOIN_STREAM_SIZE, size)
+            ]
+            return cycle_calls(
+                lambda join: database.find_friends(join[0], join[1]), joins
+            )
+
+    for shape_name, shape in HOSTMASK_SHAPES.items():
+
+        @add("friends.is_friend.{:s}".format(shape_name))
+        def setup_is_friend(shape=shape, shape_name=shape_name):
+            """Match friend of given shape, every other join matches."""
+            friend = iifriends.Friend(
+                handle="friend",
+                hosts=format_shape(shape, 1),
+                globflags="av",
+                chanflags="",
+                password="",
+                comment="",
+            )
+            hit = iifriends.parse_message(
+                format_shape(JOIN_SHAPES[shape_name], 1)
+            )
+            miss = iifriends.parse_message(
+                format_shape(JOIN_SHAPES["stranger"], 1)
+            )
+            return cycle_calls(
+                lambda join: friend.is_friend(join[0], join[1]), [hit, miss]
+            )
+
+    @add("friends.parse_message")
+    def setup_parse_message():
+        """Parse a stream of join messages."""
+        joins = generate_joins(JOIN_STREAM_SIZE, 1000)
+        return cycle_calls(iifriends.parse_message, joins)
+
+    for command in COMMANDS:
+
+        @add("iicmd.dispatch.{:s}".format(command.split(" ")[0]))
+        def setup_dispatch(command=command):
+            """Dispatch command which doesn't need network."""
+            return lambda: iicmd.process_message(
+                "irc_user", command, directory, "network", "#chan", "bot"
+            )
+
+    for size in HTML_SIZES:
+        for encoding in HTML_ENCODINGS:
+
+            @add("iicmd.extract_title.{:d}.{:s}".format(size, encoding))
+            def setup_extract_title(size=size, encoding=encoding):
+                """Decode synthetic HTML page and extract its title."""
+                data = generate_html(size).encode(encoding)
+                return lambda: extract_title_decoded(data, encoding)
+
+    return benchmarks
+
+
+def measure(func: Callable, repeat: int = DEFAULT_REPEAT) -> float:
+    """Return the best time of a single call of func in seconds."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best / number
+
+
+def run_benchmarks(
+    sizes: Tuple[int, ...] = DEFAULT_SIZES,
+    repeat: int = DEFAULT_REPEAT,
+    name_filter: Optional[str] = None,
+) -> Dict[str, float]:
+    """Run benchmarks and return seconds per call by name."""
+    results = {}
+    re_filter = re.compile(name_filter) if name_filter else None
+    with tempfile.TemporaryDirectory(prefix="iibench-") as directory:
+        benchmarks = get_benchmarks(directory, sizes)
+        for name, setup in benchmarks.items():
+            if re_filter is not None and not re_filter.search(name):
+                continue
+
+            results[name] = measure(setup(), repeat)
+            logging.info("%s: %.3g s", name, results[name])
+
+    return results
+
+
+def compare(
+    results: Dict[str, float],
+    baseline: Dict[str, float],
+    threshold: float = DEFAULT_THRESHOLD,
+) -> List[Tuple[str, float, float]]:
+    """Return (name, baseline, result) of benchmarks slower than threshold.
+
+    Benchmarks missing in either of results are skipped.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name, None)
+        if base is None or base <= 0:
+            continue
+
+        if result > base * (1 + threshold):
+            regressions.append((name, base, result))
+
+    return regressions
+
+
+def load_results(fname: str) -> Dict[str, float]:
+    """Return results stored in JSON file."""
+    with open(fname, "r", encoding="utf-8") as fhandle:
+        data = json.load(fhandle)
+
+    if data.get("version", None) != RESULTS_VERSION:
+        raise ValueError("Unsupported version of results in {!r}".format(fname))
+
+    return data["results"]
+
+
+def save_results(fname: str, results: Dict[str, float]) -> None:
+    """Store results in JSON file."""
+    data = {
+        "version": RESULTS_VERSION,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    with open(fname, "w", encoding="utf-8") as fhandle:
+        json.dump(data, fhandle, indent=2, sort_keys=True)
+        fhandle.write("\n")
+
+
+def format_report(
+    results: Dict[str, float], baseline: Optional[Dict[str, float]] = None
+) -> str:
+    """Return human readable table of results."""
+    lines = []
+    for name, result in sorted(results.items()):
+        line = "{:<40s} {:>12.3f} us".format(name, result * 1e6)
+        base = (baseline or {}).get(name, None)
+        if base:
+            line += " {:>+8.1f}%".format((result / base - 1) * 100)
+
+        lines.append(line)
+
+    return "\n".join(lines)
+
+
+def main():
+    """Run benchmarks, store and compare results."""
+    args = parse_args()
+    logging.basicConfig(
+        level=args.log_level,
+        stream=sys.stderr,
+        encoding="utf-8",
+    )
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline):
+        baseline = load_results(args.baseline)
+
+    results = run_benchmarks(args.sizes, args.repeat, args.filter)
+    print(format_report(results, baseline))
+    if args.output:
+        save_results(args.output, results)
+
+    if args.save_baseline:
+        save_results(args.baseline, results)
+        return
+
+    if baseline is None:
+        return
+
+    regressions = compare(results, baseline, args.threshold)
+    for name, base, result in regressions:
+        print(
+            "REGRESSION {:s}: {:.3f} us -> {:.3f} us".format(
+                name, base * 1e6, result * 1e6
+            )
+        )
+
+    if regressions:
+        sys.exit(1)
+
+
+def parse_args() -> argparse.Namespace:
+    """Return parsed CLI args."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        type=lambda value: tuple(int(size) for size in value.split(",")),
+        default=DEFAULT_SIZES,
+        help="Comma separated sizes of generated friends files.",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=DEFAULT_REPEAT,
+        help="Number of repetitions, the best one is taken.",
+    )
+    parser.add_argument(
+        "--filter",
+        type=str,
+        default=None,
+        help="Run only benchmarks whose name matches regular expression.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Write results into JSON file.",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=DEFAULT_BASELINE,
+        help="JSON file with baseline results to compare against.",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="Fail if benchmark is slower than baseline by this fraction.",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        default=False,
+        help="Store results as the new baseline.",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        default=False,
+        help="Log progress.",
+    )
+    args = parser.parse_args()
+
+    if args.repeat < 1:
+        parser.error("Argument 'repeat' must be greater than 0")
+
+    if args.threshold < 0:
+        parser.error("Argument 'threshold' must not be negative")
+
+    args.log_level = logging.INFO if args.verbose is True else logging.ERROR
+    return args
+
+
+if __name__ == "__main__":
+    main()
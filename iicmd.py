@@ -5,41 +5,458 @@
 2024/Mar/14 @ Zdenek Styblik <stybla@turnovfree.net>
 """
 import argparse
+import collections
+import dataclasses
 import json
 import logging
 import os
 import re
 import shutil
+import socket
+import sqlite3
 import subprocess
 import sys
+import threading
 import time
 import traceback
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 import requests
+import urllib3.connection
+import urllib3.connectionpool
+import urllib3.exceptions
+import urllib3.util.connection
+from requests.adapters import HTTPAdapter
+
+import iilog  # noqa:I202
+import iimetrics
+import iiprofile
+import iistate
 
 # List of supported commands and whether command requires user input or not.
 COMMANDS = {
     "calc": True,
     "echo": True,
     "fortune": False,
+    "grep": True,
     "list": False,
     "ping": False,
+    "search": True,
+    "seen": True,
     "slap": False,
+    "stats": False,
     "url": True,
+    "urls": False,
     "whereami": False,
 }
 
 HTTP_MAX_REDIRECTS = 2
 HTTP_TIMEOUT = 30  # seconds
+# Number of hosts whose connections are kept alive and connections per host.
+HTTP_POOL_HOSTS = 32
+HTTP_POOL_SIZE = 4
+# At most this much of response body is read, title is near its beginning.
+HTTP_BODY_MAX = int(os.getenv("IICMD_HTTP_BODY_MAX", "1048576"))  # bytes
+HTTP_BODY_CHUNK_SIZE = 16384  # bytes
+# getaddrinfo() doesn't tell TTL of records, therefore fixed TTL is used.
+DNS_CACHE_SIZE = 256
+DNS_CACHE_TTL = int(os.getenv("IICMD_DNS_CACHE_TTL", "60"))  # seconds
+# RFC 1459/2812 - max length of IRC message including trailing CR-LF.
+IRC_MAX_LINE_BYTES = 512
+# Server relays our messages with ":nick!user@host " prefix. We don't know
+# our user@host, therefore assume the worst case.
+IRC_MAX_USER_LEN = 10
+IRC_MAX_HOST_LEN = 63
+REPLY_MAX_LINES = 6
+# Caches are useless in one-shot process, therefore disabled by default.
+URL_CACHE_SIZE = int(os.getenv("IICMD_URL_CACHE_SIZE", "0"))
+URL_CACHE_TTL = int(os.getenv("IICMD_URL_CACHE_TTL", "3600"))  # seconds
+# Titles in URL history are reused by other channels for this long.
+URL_HISTORY_TTL = int(os.getenv("IICMD_URL_HISTORY_TTL", "86400"))  # seconds
+# URL is a repost if it has been posted into channel within this long.
+URL_REPOST_TTL = int(os.getenv("IICMD_URL_REPOST_TTL", "604800"))  # seconds
+# Batch mode processes many messages, caches pay off there.
+BATCH_URL_CACHE_SIZE = int(os.getenv("IICMD_URL_CACHE_SIZE", "1024"))
+BATCH_WORKERS = 1
+# Max. number of events being processed per worker in batch mode.
+BATCH_QUEUE_FACTOR = 4
+
+RE_HTML_TITLE = re.compile(r"<title>(?P<title>[^<]*)<\/title>")
+# Canonical URL is the key of URL caches and history, URL posted by user is
+# what gets fetched and shown.
+URL_DEFAULT_PORTS = {"http": 80, "https": 443}
+URL_TRACKING_PARAMS = frozenset(
+    (
+        "_hsenc",
+        "_hsmi",
+        "dclid",
+        "fbclid",
+        "gclid",
+        "igshid",
+        "mc_cid",
+        "mc_eid",
+        "msclkid",
+        "yclid",
+    )
+)
+URL_TRACKING_PREFIXES = ("utm_",)
+# Site specific rewrites - (name, pattern, replacement). Rules are applied in
+# order to URL whose scheme and host are lowercase and query sorted.
+URL_REWRITE_RULES = tuple(
+    (name, re.compile(pattern), replacement)
+    for name, pattern, replacement in (
+        (
+            "youtube_host",
+            r"^https?://(?:www\.|m\.)?youtube\.com/",
+            "https://www.youtube.com/",
+        ),
+        (
+            "youtube_short_link",
+            r"^https?://youtu\.be/([\w-]+).*$",
+            r"https://www.youtube.com/watch?v=\1",
+        ),
+        (
+            "youtube_embed",
+            r"^https://www\.youtube\.com/(?:embed|shorts|live)/([\w-]+).*$",
+            r"https://www.youtube.com/watch?v=\1",
+        ),
+        (
+            "youtube_watch",
+            r"^https://www\.youtube\.com/watch\?(?:.*&)?v=([\w-]+).*$",
+            r"https://www.youtube.com/watch?v=\1",
+        ),
+        (
+            "wikipedia_mobile",
+            r"^https?://(\w+)\.m\.wikipedia\.org/",
+            r"https://\1.wikipedia.org/",
+        ),
+        (
+            "reddit_host",
+            r"^https?://(?:old\.|np\.|m\.)?reddit\.com/",
+            "https://www.reddit.com/",
+        ),
+    )
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class Resolver:
+    """Class represents cheaper source of title of URLs matching pattern.
+
+    Kind is one of 'oembed', 'json' or 'og_title'. Endpoint of 'json' is
+    formatted with named groups of pattern. Page bytes is a typical size of
+    page which isn't downloaded, used when the real size isn't known.
+    """
+
+    name: str
+    pattern: re.Pattern
+    kind: str
+    endpoint: str
+    ttl: float
+    page_bytes: int
+
+
+# At most this much of page is read by 'og_title' resolver.
+OG_TITLE_READ_MAX = 32768  # bytes
+# Pattern is matched against canonical URL and the first match wins. Titles
+# are cached for TTL of resolver which has resolved them.
+URL_RESOLVERS = (
+    Resolver(
+        "youtube",
+        re.compile(r"^https://www\.youtube\.com/watch\?v=[\w-]+$"),
+        "oembed",
+        "https://www.youtube.com/oembed",
+        86400,
+        1024 * 1024,
+    ),
+    Resolver(
+        "vimeo",
+        re.compile(r"^https?://(?:www\.)?vimeo\.com/\d+$"),
+        "oembed",
+        "https://vimeo.com/api/oembed.json",
+        86400,
+        256 * 1024,
+    ),
+    Resolver(
+        "wikipedia",
+        re.compile(
+            r"^https://(?P<lang>[\w-]+)\.wikipedia\.org/wiki/"
+            r"(?P<title>[^?#]+)(?:#.*)?$"
+        ),
+        "json",
+        "https://{lang:s}.wikipedia.org/api/rest_v1/page/summary/{title:s}",
+        86400,
+        256 * 1024,
+    ),
+    Resolver(
+        "news",
+        re.compile(
+            r"^https?://(?:[\w-]+\.)*(?:bbc\.co\.uk|bbc\.com|cnn\.com|"
+            r"nytimes\.com|theguardian\.com|idnes\.cz|novinky\.cz)/"
+        ),
+        "og_title",
+        "",
+        URL_CACHE_TTL,
+        512 * 1024,
+    ),
+)
+RE_META_TAG = re.compile(r"<meta\s[^>]*>", re.IGNORECASE)
+RE_HTML_ATTR = re.compile(
+    r"(?P<name>[\w:-]+)\s*=\s*(?:\"(?P<dquoted>[^\"]*)\"|'(?P<squoted>[^']*)')"
+)
+
+COMMAND_SECONDS = iimetrics.REGISTRY.histogram(
+    "iibot_command_seconds", "Time spent processing command."
+)
+HTTP_SECONDS = iimetrics.REGISTRY.histogram(
+    "iibot_http_seconds", "Time spent in HTTP requests."
+)
+HTTP_ERRORS = iimetrics.REGISTRY.counter(
+    "iibot_http_errors_total", "Number of failed HTTP requests."
+)
+CACHE_REQUESTS = iimetrics.REGISTRY.counter(
+    "iibot_cache_requests_total", "Number of cache lookups by result."
+)
+CACHE_ENTRIES = iimetrics.REGISTRY.gauge(
+    "iibot_cache_entries", "Number of entries in cache."
+)
+PROCESSES_SPAWNED = iimetrics.REGISTRY.counter(
+    "iibot_processes_spawned_total", "Number of spawned processes."
+)
+URL_REWRITES = iimetrics.REGISTRY.counter(
+    "iibot_url_rewrites_total", "Number of URLs changed by rule."
+)
+RESOLVER_REQUESTS = iimetrics.REGISTRY.counter(
+    "iibot_resolver_requests_total", "Number of resolved titles by result."
+)
+RESOLVER_BYTES_READ = iimetrics.REGISTRY.counter(
+    "iibot_resolver_bytes_read_total", "Bytes downloaded by resolver."
+)
+RESOLVER_BYTES_SAVED = iimetrics.REGISTRY.counter(
+    "iibot_resolver_bytes_saved_total",
+    "Bytes of pages which haven't been downloaded thanks to resolver.",
+)
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ttl seconds.
+
+    Cache with capacity 0 stores nothing. Lookups of named cache are
+    counted in metrics.
+    """
+
+    def __init__(self, capacity: int, ttl: float, name: str = ""):
+        """Initialize TTLCache."""
+        self.capacity = capacity
+        self.ttl = ttl
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Return number of entries in the cache."""
+        return len(self._data)
+
+    def get(self, key):
+        """Return cached value or None."""
+        with self._lock:
+            entry = self._data.get(key, None)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+
+                self.misses += 1
+                if self.name:
+                    CACHE_REQUESTS.inc(cache=self.name, result="miss")
+
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            if self.name:
+                CACHE_REQUESTS.inc(cache=self.name, result="hit")
+
+            return entry[1]
+
+    def set(self, key, value, ttl: Optional[float] = None) -> None:
+        """Store value in the cache, evict the least recently used entry.
+
+        Entry expires after ttl seconds, cache's ttl if not given.
+        """
+        with self._lock:
+            if self.capacity <= 0:
+                return
+
+            if ttl is None:
+                ttl = self.ttl
+
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+
+    def delete(self, key) -> None:
+        """Remove entry from the cache, if present."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def resize(self, capacity: int) -> None:
+        """Change capacity and evict entries which don't fit anymore."""
+        with self._lock:
+            self.capacity = capacity
+            while len(self._data) > max(capacity, 0):
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+
+
+URL_TITLE_CACHE = TTLCache(URL_CACHE_SIZE, URL_CACHE_TTL, "url_title")
+URL_SHORT_CACHE = TTLCache(URL_CACHE_SIZE, URL_CACHE_TTL, "url_short")
+CACHE_ENTRIES.set_function(lambda: len(URL_TITLE_CACHE), cache="url_title")
+CACHE_ENTRIES.set_function(lambda: len(URL_SHORT_CACHE), cache="url_short")
+DNS_CACHE = TTLCache(DNS_CACHE_SIZE, DNS_CACHE_TTL, "dns")
+CACHE_ENTRIES.set_function(lambda: len(DNS_CACHE), cache="dns")
+_HTTP_SESSION = None
+_HTTP_SESSION_LOCK = threading.Lock()
+# Lowered under memory pressure, see set_http_body_limit().
+_HTTP_BODY_LIMIT = HTTP_BODY_MAX
+
+
+def resolve_host(host, port):
+    """Return addresses of host from DNS cache or resolve them."""
+    family = urllib3.util.connection.allowed_gai_family()
+    addresses = DNS_CACHE.get((host, port, family))
+    if addresses is None:
+        addresses = [
+            sockaddr[0]
+            for _, _, _, _, sockaddr in socket.getaddrinfo(
+                host, port, family, socket.SOCK_STREAM
+            )
+        ]
+        DNS_CACHE.set((host, port, family), addresses)
+
+    return addresses
+
+
+class CachedDNSMixin:
+    """Mixin connects urllib3's connection to host resolved via DNS cache.
+
+    Only the address connected to changes, TLS still verifies host name.
+    """
+
+    def _new_conn(self):
+        """Connect to the first address of host which accepts connection."""
+        host = self._dns_host
+        port = self.port
+        try:
+            addresses = resolve_host(host.strip("[]"), port)
+            if not addresses:
+                raise socket.gaierror("getaddrinfo returns an empty list")
+        except socket.gaierror as exception:
+            raise urllib3.exceptions.NameResolutionError(
+                self.host, self, exception
+            ) from exception
+
+        error = None
+        try:
+            for ip_address in addresses:
+                self._dns_host = ip_address
+                try:
+                    return super()._new_conn()
+                except urllib3.exceptions.ConnectTimeoutError as exception:
+                    error = exception
+        finally:
+            self._dns_host = host
+
+        # Addresses might have changed meanwhile.
+        DNS_CACHE.delete(
+            (
+                host.strip("[]"),
+                port,
+                urllib3.util.connection.allowed_gai_family(),
+            )
+        )
+        raise error
+
+
+class CachedDNSHTTPConnection(
+    CachedDNSMixin, urllib3.connection.HTTPConnection
+):
+    """Class is HTTP connection to host resolved via DNS cache."""
+
+
+class CachedDNSHTTPSConnection(
+    CachedDNSMixin, urllib3.connection.HTTPSConnection
+):
+    """Class is HTTPS connection to host resolved via DNS cache."""
+
+
+class CachedDNSHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    """Class is pool of HTTP connections to host resolved via DNS cache."""
+
+    ConnectionCls = CachedDNSHTTPConnection
+
+
+class CachedDNSHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+    """Class is pool of HTTPS connections to host resolved via DNS cache."""
+
+    ConnectionCls = CachedDNSHTTPSConnection
+
+
+class CachedDNSAdapter(HTTPAdapter):
+    """Class is requests' adapter whose connections use DNS cache.
+
+    Other users of urllib3 in the process aren't affected.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        """Initialize pool manager with pools of DNS cached connections."""
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CachedDNSHTTPConnectionPool,
+            "https": CachedDNSHTTPSConnectionPool,
+        }
+
+
+def get_http_session():
+    """Return HTTP session shared by all commands.
+
+    Session keeps up to HTTP_POOL_SIZE connections alive to each of the last
+    HTTP_POOL_HOSTS hosts, therefore repeated requests to the same host skip
+    DNS, TCP and TLS handshakes. Hosts of new connections are resolved
+    through DNS cache.
+    """
+    global _HTTP_SESSION
+    with _HTTP_SESSION_LOCK:
+        if _HTTP_SESSION is None:
+            session = requests.Session()
+            session.max_redirects = HTTP_MAX_REDIRECTS
+            adapter = CachedDNSAdapter(
+                pool_connections=HTTP_POOL_HOSTS,
+                pool_maxsize=HTTP_POOL_SIZE,
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _HTTP_SESSION = session
+
+        return _HTTP_SESSION
 
 
 def cmd_fortune():
-    """Try to get a fortune cookie."""
+    """Try to get a fortune cookie and return it."""
     fortune_fpath = shutil.which("fortune", mode=os.F_OK | os.X_OK)
     if not fortune_fpath:
-        print("Damn, I'm out of fortune cookies! :(")
-        return
+        return "Damn, I'm out of fortune cookies! :("
 
+    PROCESSES_SPAWNED.inc(command="fortune")
     with subprocess.Popen(
         [fortune_fpath, "-osea"], stdout=subprocess.PIPE, stderr=subprocess.PIPE
     ) as fortune_proc:
@@ -49,10 +466,109 @@ def cmd_fortune():
         logging.error("fortune RC: %s", fortune_proc.returncode)
         logging.error("fortune STDOUT: '%s'", fortune_out)
         logging.error("fortune STDERR: '%s'", fortune_err)
-        print("Oh no, I've dropped my fortune cookie! :(")
-        return
+        return "Oh no, I've dropped my fortune cookie! :("
 
-    print("{:s}".format(fortune_out.decode("utf-8").rstrip("\n")))
+    return "{:s}".format(fortune_out.decode("utf-8").rstrip("\n"))
+
+
+def cmd_stats():
+    """Return summary of metrics of this process."""
+    registry = iimetrics.REGISTRY
+    uptime = int(time.time() - registry.started)
+    chunks = [
+        "up {:d}h{:02d}m".format(uptime // 3600, uptime % 3600 // 60),
+        "commands {:d}".format(COMMAND_SECONDS.count()),
+    ]
+    p95 = COMMAND_SECONDS.quantile(0.95)
+    if p95 is not None:
+        chunks.append("p95 <= {:g}s".format(p95))
+
+    hits = CACHE_REQUESTS.get(cache="url_title", result="hit")
+    misses = CACHE_REQUESTS.get(cache="url_title", result="miss")
+    if hits + misses:
+        chunks.append(
+            "title cache hit {:d}%".format(int(100 * hits / (hits + misses)))
+        )
+
+    saved = int(RESOLVER_BYTES_SAVED.total())
+    if saved:
+        chunks.append("resolvers saved {:d}KiB".format(saved // 1024))
+
+    chunks.append("HTTP errors {:d}".format(int(HTTP_ERRORS.total())))
+    # Metrics below are provided by iisupervisor.
+    for name, fmt, aggregate in (
+        ("iibot_worker_queue_depth", "queue {:g}", sum),
+        ("iibot_dropped_events_total", "dropped {:g}", sum),
+        ("iibot_link_lag_seconds", "lag {:.1f}s", max),
+    ):
+        metric = registry.get(name)
+        if metric is None:
+            continue
+
+        values = [value for _, _, value in metric.samples()]
+        if values:
+            chunks.append(fmt.format(aggregate(values)))
+
+    return ", ".join(chunks)
+
+
+def cmd_seen(extra, nick, ircd, network):
+    """Return when nick in extra has been seen the last time."""
+    seen_nick = extra.split(" ")[0]
+    if iistate.irc_lower(seen_nick) == iistate.irc_lower(nick):
+        return "{:s}: have you lost yourself?".format(nick)
+
+    try:
+        with iilog.SeenIndex(os.path.join(ircd, iilog.SEEN_DB_NAME)) as index:
+            # Catch up with lines logged since the last update.
+            index.update(ircd, network)
+            records = index.lookup(network, seen_nick)
+    except (OSError, sqlite3.Error):
+        logging.error(
+            "Failed to look up '%s': %s", seen_nick, traceback.format_exc()
+        )
+        return "{:s}: my memory fails me right now.".format(nick)
+
+    if not records:
+        return "{:s}: I haven't seen {:s}.".format(nick, seen_nick)
+
+    return "{:s}: {:s}".format(nick, iilog.format_seen(records[0]))
+
+
+def cmd_search(extra, nick, ircd, network, channel, self_nick=""):
+    """Return the latest messages in channel containing terms in extra.
+
+    Searches are rate-limited per channel and number of messages is bounded
+    in order to keep channel readable.
+    """
+    if not channel.startswith(iilog.CHANNEL_PREFIXES):
+        return "{:s}: search works in channels only.".format(nick)
+
+    try:
+        with iilog.SearchIndex(
+            os.path.join(ircd, iilog.SEARCH_DB_NAME)
+        ) as index:
+            key = "{:s} {:s}".format(
+                network.lower(), iistate.irc_lower(channel)
+            )
+            if not index.allow(key):
+                return "{:s}: slow down, search again later.".format(nick)
+
+            # Catch up with lines logged since the last update.
+            index.update(ircd, network)
+            hits = index.search(network, channel, extra, exclude_nick=self_nick)
+    except (OSError, sqlite3.Error):
+        logging.error(
+            "Failed to search for '%s': %s", extra, traceback.format_exc()
+        )
+        return "{:s}: my memory fails me right now.".format(nick)
+
+    if not hits:
+        return "{:s}: nothing found.".format(nick)
+
+    return "\n".join(
+        "{:s}: {:s}".format(nick, iilog.format_hit(hit)) for hit in hits
+    )
 
 
 def get_url_short(url, bitly_gid, bitly_token):
@@ -74,18 +590,21 @@ def get_url_short(url, bitly_gid, bitly_token):
             "group_guid": bitly_gid,
         }
 
-        rsp_short = requests.post(
-            "https://api-ssl.bitly.com/v4/shorten",
-            headers=headers,
-            data=json.dumps(data),
-            timeout=HTTP_TIMEOUT,
-        )
+        with HTTP_SECONDS.time(op="short"):
+            rsp_short = get_http_session().post(
+                "https://api-ssl.bitly.com/v4/shorten",
+                headers=headers,
+                data=json.dumps(data),
+                timeout=HTTP_TIMEOUT,
+            )
+
         rsp_short.raise_for_status()
         if "link" not in rsp_short.json():
             raise KeyError("Expected key 'link' not found in rsp from bit.ly")
 
         short_url = rsp_short.json()["link"]
     except Exception:
+        HTTP_ERRORS.inc(op="short")
         # NOTE: this isn't exactly great, but it simplifies the code.
         logging.error(
             "Failed to get short URL of '%s' due to: %s",
@@ -96,23 +615,72 @@ def get_url_short(url, bitly_gid, bitly_token):
     return short_url
 
 
+def set_http_body_limit(limit):
+    """Set how many bytes of response body are read at most."""
+    global _HTTP_BODY_LIMIT
+    _HTTP_BODY_LIMIT = limit
+
+
+def get_http_body_limit():
+    """Return how many bytes of response body are read at most."""
+    return _HTTP_BODY_LIMIT
+
+
+def read_body(rsp, limit):
+    """Return up to limit bytes of streamed response body decoded as text.
+
+    Response is closed, the rest of the body is never downloaded.
+    """
+    data = read_body_bytes(rsp, limit)
+    return data.decode(rsp.encoding or "utf-8", errors="replace")
+
+
+def read_body_bytes(rsp, limit):
+    """Return up to limit bytes of streamed response body and close it."""
+    chunks = []
+    size = 0
+    try:
+        for chunk in rsp.iter_content(HTTP_BODY_CHUNK_SIZE):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= limit:
+                break
+    finally:
+        rsp.close()
+
+    return b"".join(chunks)[:limit]
+
+
+def extract_title(text):
+    """Return content of HTML title tag or None."""
+    match = RE_HTML_TITLE.search(text)
+    if not match:
+        return None
+
+    return match.group("title")
+
+
 def get_url_title(url):
     """Try to get and return title of given URL."""
-    url_title = "No title"
+    url_title = iilog.NO_TITLE
     try:
-        session = requests.Session()
-        session.max_redirects = HTTP_MAX_REDIRECTS
+        session = get_http_session()
         user_agent = "iicmd_{:d}".format(int(time.time()))
         headers = {"User-Agent": user_agent}
-        rsp_title = session.get(url, headers=headers, timeout=HTTP_TIMEOUT)
-        rsp_title.raise_for_status()
+        with HTTP_SECONDS.time(op="title"):
+            with session.get(
+                url, headers=headers, timeout=HTTP_TIMEOUT, stream=True
+            ) as rsp_title:
+                rsp_title.raise_for_status()
+                text = read_body(rsp_title, get_http_body_limit())
 
-        match = re.search(r"<title>(?P<title>[^<]*)<\/title>", rsp_title.text)
-        if match:
-            url_title = match.group("title")
+        title = extract_title(text)
+        if title is not None:
+            url_title = title
         else:
             logging.debug("No title for '{:s}'".format(url))
     except Exception:
+        HTTP_ERRORS.inc(op="title")
         # NOTE: this isn't exactly great, but it simplifies the code.
         # No title then.
         logging.error(
@@ -122,12 +690,148 @@ def get_url_title(url):
     return url_title
 
 
-def cmd_url(extra):
-    """Process URL and print-out the result."""
+def get_json(url, params=None):
+    """Return decoded JSON response of URL and its size in bytes."""
+    session = get_http_session()
+    headers = {"User-Agent": "iicmd_{:d}".format(int(time.time()))}
+    with HTTP_SECONDS.time(op="resolver"):
+        with session.get(
+            url,
+            params=params,
+            headers=headers,
+            timeout=HTTP_TIMEOUT,
+            stream=True,
+        ) as rsp:
+            rsp.raise_for_status()
+            data = read_body_bytes(rsp, get_http_body_limit())
+
+    return json.loads(data), len(data)
+
+
+def extract_og_title(text):
+    """Return content of og:title meta tag or None."""
+    for tag in RE_META_TAG.findall(text):
+        attrs = {}
+        for match in RE_HTML_ATTR.finditer(tag):
+            value = match.group("dquoted")
+            if value is None:
+                value = match.group("squoted")
+
+            attrs[match.group("name").lower()] = value
+
+        if attrs.get("property") == "og:title" and attrs.get("content"):
+            return attrs["content"]
+
+    return None
+
+
+def get_og_title(url):
+    """Return (title or None, bytes read, size of page or None).
+
+    Only the beginning of page is read, og:title is preferred over title.
+    """
+    session = get_http_session()
+    headers = {"User-Agent": "iicmd_{:d}".format(int(time.time()))}
+    limit = min(OG_TITLE_READ_MAX, get_http_body_limit())
+    with HTTP_SECONDS.time(op="resolver"):
+        with session.get(
+            url, headers=headers, timeout=HTTP_TIMEOUT, stream=True
+        ) as rsp:
+            rsp.raise_for_status()
+            content_length = rsp.headers.get("Content-Length", "")
+            data = read_body_bytes(rsp, limit)
+            text = data.decode(rsp.encoding or "utf-8", errors="replace")
+
+    page_bytes = None
+    if content_length.isdigit():
+        page_bytes = int(content_length)
+    elif len(data) < limit:
+        # The whole page.
+        page_bytes = len(data)
+
+    title = extract_og_title(text)
+    if title is None:
+        title = extract_title(text)
+
+    return title, len(data), page_bytes
+
+
+def run_resolver(resolver, url, match):
+    """Return (title or None, bytes read, size of page or None).
+
+    Match is of resolver's pattern against canonical URL.
+    """
+    if resolver.kind == "oembed":
+        data, size = get_json(
+            resolver.endpoint, {"url": match.string, "format": "json"}
+        )
+        return data.get("title"), size, None
+
+    if resolver.kind == "json":
+        # Groups are single segments of endpoint path, '/' included.
+        params = {
+            name: urllib.parse.quote(urllib.parse.unquote(value), safe="")
+            for name, value in match.groupdict().items()
+        }
+        data, size = get_json(resolver.endpoint.format(**params))
+        return data.get("title"), size, None
+
+    if resolver.kind == "og_title":
+        return get_og_title(url)
+
+    raise ValueError("Unknown kind of resolver {!r}".format(resolver.kind))
+
+
+def resolve_title(url, url_key):
+    """Return (title, TTL or None) of URL from resolver or its page.
+
+    Page is fetched when there is no resolver for URL or it fails. Bytes
+    which haven't been downloaded thanks to resolvers are counted in metrics.
+    """
+    for resolver in URL_RESOLVERS:
+        match = resolver.pattern.search(url_key)
+        if not match:
+            continue
+
+        try:
+            title, size, page_bytes = run_resolver(resolver, url, match)
+        except Exception:
+            HTTP_ERRORS.inc(op="resolver")
+            logging.error(
+                "Resolver '%s' has failed for '%s': %s",
+                resolver.name,
+                url,
+                traceback.format_exc(),
+            )
+            title, size, page_bytes = None, 0, None
+
+        RESOLVER_BYTES_READ.inc(size, resolver=resolver.name)
+        if not title:
+            RESOLVER_REQUESTS.inc(resolver=resolver.name, result="fallback")
+            break
+
+        RESOLVER_REQUESTS.inc(resolver=resolver.name, result="hit")
+        if page_bytes is None:
+            page_bytes = resolver.page_bytes
+
+        # Generic path wouldn't read more than body limit.
+        saved = min(page_bytes, get_http_body_limit()) - size
+        RESOLVER_BYTES_SAVED.inc(max(saved, 0), resolver=resolver.name)
+        return title, resolver.ttl
+
+    return get_url_title(url), None
+
+
+def cmd_url(extra, nick="", channel="", network="", ircd=""):
+    """Process URL and return the result.
+
+    URL already posted into the channel is answered from URL history, if
+    there is ii directory.
+    """
     match = re.search(r".*(?P<url>http[^ ]*).*", extra)
     if not match:
         logging.debug("No URL detected in '%s'", extra)
-        return
+        return None
 
     url = match.group("url")
     # Convert YouTube URLs
@@ -140,62 +844,472 @@ def cmd_url(extra):
         r"https://www.youtube.com/watch?v=\1",
         url,
     )
+    url_key = get_url_key(url)
+    now = int(time.time())
+    posted, known = find_url(ircd, network, channel, url_key, now)
+    if posted is not None:
+        record_url(ircd, dataclasses.replace(posted, last_nixtime=now))
+        return "{:s} was already posted by {:s} {:s} ago - {:s}".format(
+            posted.short_url or posted.url,
+            posted.nick,
+            iilog.format_age(now - posted.nixtime),
+            posted.title,
+        )
+
     # Try to get URL's title
-    url_title = get_url_title(url)
+    url_title = URL_TITLE_CACHE.get(url_key)
+    if url_title is None and known is not None:
+        url_title = known[0]
+        URL_TITLE_CACHE.set(url_key, url_title)
+
+    if url_title is None:
+        url_title, ttl = resolve_title(url, url_key)
+        if url_title != iilog.NO_TITLE:
+            # Failure is neither cached nor recorded, the next post retries.
+            URL_TITLE_CACHE.set(url_key, url_title, ttl)
+
+    long_url = url
     bitly_gid = os.getenv("IICMD_BITLY_GROUP_ID", None)
     bitly_token = os.getenv("IICMD_BITLY_API_TOKEN", None)
     if len(url) > 80 and bitly_gid and bitly_token:
-        url = get_url_short(url, bitly_gid, bitly_token)
+        short_url = URL_SHORT_CACHE.get(url_key)
+        if short_url is None and known is not None and known[1]:
+            short_url = known[1]
+            URL_SHORT_CACHE.set(url_key, short_url)
+
+        if short_url is None:
+            short_url = get_url_short(url, bitly_gid, bitly_token)
+            if short_url != url:
+                URL_SHORT_CACHE.set(url_key, short_url)
+
+        url = short_url
+
+    if url_title != iilog.NO_TITLE:
+        record_url(
+            ircd,
+            iilog.PostedUrl(
+                network,
+                channel,
+                url_key,
+                long_url,
+                url_title,
+                url if url != long_url else "",
+                nick,
+                now,
+            ),
+        )
+
+    return "Title for {:s} - {:s}".format(url, url_title)
+
+
+def canonicalize_url(url):
+    """Return (canonical URL, names of rules which changed it).
+
+    Scheme and host are lowercase, default port, fragment and tracking
+    parameters are removed, query is sorted and URL_REWRITE_RULES applied.
+    """
+    try:
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port
+    except ValueError:
+        # Invalid port.
+        return url, []
+
+    rules = []
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if scheme != parts.scheme or netloc != parts.netloc:
+        rules.append("lowercase")
+
+    if port is not None and URL_DEFAULT_PORTS.get(scheme) == port:
+        netloc = netloc.rsplit(":", 1)[0]
+        rules.append("default_port")
+
+    params = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+    kept = [
+        (name, value)
+        for name, value in params
+        if name.lower() not in URL_TRACKING_PARAMS
+        and not name.lower().startswith(URL_TRACKING_PREFIXES)
+    ]
+    if len(kept) != len(params):
+        rules.append("tracking_params")
+
+    if kept != sorted(kept):
+        rules.append("query_order")
+        kept.sort()
+
+    if parts.fragment:
+        rules.append("fragment")
+
+    canonical = urllib.parse.urlunsplit(
+        (
+            scheme,
+            netloc,
+            parts.path or "/",
+            urllib.parse.urlencode(kept),
+            "",
+        )
+    )
+    for name, regexp, replacement in URL_REWRITE_RULES:
+        rewritten = regexp.sub(replacement, canonical)
+        if rewritten != canonical:
+            rules.append(name)
+            canonical = rewritten
+
+    return canonical, rules
+
+
+def get_url_key(url):
+    """Return canonical URL as key of caches and URL history.
+
+    Rewrites are counted per rule.
+    """
+    canonical, rules = canonicalize_url(url)
+    for rule in rules:
+        URL_REWRITES.inc(rule=rule)
+
+    return canonical
+
+
+def find_url(ircd, network, channel, url_key, now):
+    """Return (URL posted into channel, (title, short URL)) from history.
+
+    Either might be None. URL counts as posted into channel only if it has
+    been posted within URL_REPOST_TTL. Title is of URL posted anywhere,
+    recently enough.
+    """
+    if not ircd or not os.path.isdir(ircd):
+        return None, None
+
+    try:
+        with iilog.UrlHistory(os.path.join(ircd, iilog.URLS_DB_NAME)) as urls:
+            posted = urls.lookup(
+                network, channel, url_key, now - URL_REPOST_TTL
+            )
+            known = urls.get_title(url_key, now - URL_HISTORY_TTL)
+    except (OSError, sqlite3.Error):
+        logging.error(
+            "Failed to look up '%s': %s", url_key, traceback.format_exc()
+        )
+        return None, None
+
+    return posted, known
+
+
+def record_url(ircd, posted):
+    """Record URL posted into channel in URL history, if there is one."""
+    if not ircd or not os.path.isdir(ircd) or not posted.channel:
+        return
+
+    try:
+        with iilog.UrlHistory(os.path.join(ircd, iilog.URLS_DB_NAME)) as urls:
+            urls.add(posted)
+    except (OSError, sqlite3.Error):
+        logging.error(
+            "Failed to record '%s': %s", posted.url, traceback.format_exc()
+        )
+
+
+def cmd_urls(extra, nick, ircd, network, channel):
+    """Return the latest URLs posted into channel matching extra, if any."""
+    try:
+        with iilog.UrlHistory(os.path.join(ircd, iilog.URLS_DB_NAME)) as urls:
+            records = urls.recent(network, channel, extra)
+    except (OSError, sqlite3.Error):
+        logging.error(
+            "Failed to list URLs in '%s': %s", channel, traceback.format_exc()
+        )
+        return "{:s}: my memory fails me right now.".format(nick)
+
+    if not records:
+        return "{:s}: no URLs found.".format(nick)
+
+    return "\n".join(
+        "{:s}: {:s}".format(nick, iilog.format_posted_url(posted))
+        for posted in records
+    )
+
+
+def get_reply_budget(self_nick, channel):
+    """Return number of bytes available for text of a single reply line.
+
+    Message as relayed by the server to other users looks like:
+
+      :nick!user@host PRIVMSG #channel :text<CR><LF>
+    """
+    prefix = ":{:s}!{:s}@{:s} PRIVMSG {:s} :\r\n".format(
+        self_nick, "u" * IRC_MAX_USER_LEN, "h" * IRC_MAX_HOST_LEN, channel
+    )
+    return IRC_MAX_LINE_BYTES - len(prefix.encode("utf-8"))
+
+
+def _split_word(word, budget):
+    """Split a word longer than budget at UTF-8 character boundaries."""
+    chunks = []
+    encoded = word.encode("utf-8")
+    while len(encoded) > budget:
+        # Cut and drop incomplete multibyte character at the end, if any.
+        chunk = encoded[:budget].decode("utf-8", errors="ignore")
+        chunks.append(chunk)
+        chunk_len = len(chunk.encode("utf-8"))
+        encoded = encoded[chunk_len:]
+
+    if encoded:
+        chunks.append(encoded.decode("utf-8"))
+
+    return chunks
+
+
+def split_reply(message, budget, max_lines=REPLY_MAX_LINES):
+    """Split message into lines which fit into given budget in bytes.
+
+    Lines are split at word boundaries where possible. Words which don't fit
+    into the budget on their own are split at UTF-8 character boundaries.
+    Leading "/" is stripped from every line, because ii would execute such
+    line as a command. At most max_lines lines are returned.
+    """
+    if budget < 4:
+        # Budget must fit at least one UTF-8 character.
+        raise ValueError("Budget {:d} is too small".format(budget))
+
+    lines = []
+    for msg_line in message.split("\n"):
+        line = ""
+        line_len = 0
+        for word in msg_line.split(" "):
+            word_len = len(word.encode("utf-8"))
+            if line_len + 1 + word_len <= budget and line:
+                line = "{:s} {:s}".format(line, word)
+                line_len += 1 + word_len
+                continue
+
+            if line:
+                lines.append(line)
+
+            chunks = _split_word(word, budget)
+            lines.extend(chunks[:-1])
+            line = chunks[-1] if chunks else ""
+            line_len = len(line.encode("utf-8"))
+
+        if line:
+            lines.append(line)
+
+    lines = [line.lstrip("/") for line in lines]
+    lines = [line for line in lines if line]
+    if len(lines) > max_lines:
+        logging.debug(
+            "Reply has %i lines, truncating to %i.", len(lines), max_lines
+        )
+        lines = lines[:max_lines]
+
+    return lines
+
+
+def parse_event(line):
+    """Parse JSON event of batch mode and return it or None.
+
+    Event must have 'nick', 'channel' and 'message' keys, 'nixtime',
+    'network' and other keys are optional and passed through to reply.
+    """
+    try:
+        event = json.loads(line)
+    except ValueError:
+        logging.error("Failed to parse event %r.", line)
+        return None
+
+    if not isinstance(event, dict):
+        logging.error("Event %r isn't an object.", line)
+        return None
+
+    for key in ("nick", "channel", "message"):
+        if not isinstance(event.get(key, None), str):
+            logging.error("Event %r is missing key '%s'.", line, key)
+            return None
+
+    return event
+
+
+def process_event(event, args):
+    """Process event of batch mode and return reply or None."""
+    try:
+        lines = process_message(
+            event["nick"] or "unknown.stranger",
+            event["message"],
+            args.ircd,
+            event.get("network", args.network),
+            event["channel"],
+            args.self,
+        )
+    except Exception:
+        logging.error(
+            "Failed to process event %r: %s", event, traceback.format_exc()
+        )
+        return None
+
+    if not lines:
+        return None
+
+    reply = dict(event)
+    reply.pop("message")
+    reply["lines"] = lines
+    return reply
+
+
+def run_batch(args, infile, outfile):
+    """Process JSON-lines events from infile and write replies to outfile.
+
+    Events are processed by a pool of workers. Replies in the same channel
+    are written in the order of events as soon as they're ready, replies in
+    different channels may overtake each other. Returns number of processed
+    events.
+    """
+    URL_TITLE_CACHE.resize(BATCH_URL_CACHE_SIZE)
+    URL_SHORT_CACHE.resize(BATCH_URL_CACHE_SIZE)
+    channels = {}
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(args.workers * BATCH_QUEUE_FACTOR)
+    count = 0
+
+    def on_done(channel):
+        """Write replies at the head of channel's queue which are done."""
+        with lock:
+            futures = channels.get(channel, None)
+            while futures and futures[0].done():
+                reply = futures.popleft().result()
+                if reply is not None:
+                    outfile.write(json.dumps(reply, ensure_ascii=False))
+                    outfile.write("\n")
+                    outfile.flush()
+
+            if futures is not None and not futures:
+                del channels[channel]
+
+        slots.release()
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for line in infile:
+            if not line.strip():
+                continue
+
+            event = parse_event(line)
+            if event is None:
+                continue
+
+            slots.acquire()
+            channel = event["channel"]
+            with lock:
+                future = executor.submit(process_event, event, args)
+                channels.setdefault(channel, collections.deque()).append(future)
+
+            future.add_done_callback(
+                lambda _, channel=channel: on_done(channel)
+            )
+            count += 1
 
-    print("Title for {:s} - {:s}".format(url, url_title))
+    return count
 
 
 def main():
     """Run iibot command."""
     logging.basicConfig(stream=sys.stderr, encoding="utf-8")
     args = parse_args()
+    if args.batch:
+        if args.input == "-":
+            run_batch(args, sys.stdin, sys.stdout)
+        else:
+            with open(args.input, "r", encoding="utf-8") as fhandle:
+                run_batch(args, fhandle, sys.stdout)
 
-    if args.nick == args.self:
-        # Message by ourself? Ignore it.
         return
 
-    cmd = args.message.split(" ")[0]
-    extra = " ".join(args.message.split(" ")[1:])
+    lines = process_message(
+        args.nick,
+        args.message,
+        args.ircd,
+        args.network,
+        args.channel,
+        args.self,
+    )
+    for line in lines:
+        print(line)
+
+
+def process_message(nick, message, ircd, network, channel, self_nick):
+    """Process iibot command and return lines of reply."""
+    if nick == self_nick:
+        # Message by ourself? Ignore it.
+        return []
+
+    cmd = message.split(" ")[0]
+    extra = " ".join(message.split(" ")[1:])
     # Strip leading/trailing whitespace and check, if we have any "extra" left
     # TODO: what about newlines?
     extra = extra.strip(" ")
     if not extra and cmd in COMMANDS and COMMANDS[cmd] is True:
         cmd = "invalid"
 
+    label = cmd if cmd in COMMANDS else "invalid"
+    with (
+        iiprofile.profile("iicmd-{:s}".format(label)),
+        COMMAND_SECONDS.time(command=label),
+    ):
+        reply = dispatch_command(
+            cmd,
+            extra,
+            nick,
+            channel,
+            network=network,
+            ircd=ircd,
+            self_nick=self_nick,
+        )
+
+    if reply is None:
+        return []
+
+    budget = get_reply_budget(self_nick, channel)
+    return split_reply(reply, budget)
+
+
+def dispatch_command(
+    cmd, extra, nick, channel, network="", ircd="", self_nick=""
+):
+    """Run command and return its reply or None."""
     if cmd == "list":
-        print(
-            "{:s}: supported commands are - {:s}".format(
-                args.nick, ", ".join(sorted(list(COMMANDS.keys())))
-            )
+        reply = "{:s}: supported commands are - {:s}".format(
+            nick, ", ".join(sorted(list(COMMANDS.keys())))
         )
     elif cmd == "calc":
         # TODO: this will be big pain and huge amount of LOC to implement
         # See https://stackoverflow.com/a/11952343
-        print("{:s}: my ALU is b0rked - does not compute.".format(args.nick))
+        reply = "{:s}: my ALU is b0rked - does not compute.".format(nick)
     elif cmd == "echo":
-        print("{:s}".format(extra.lstrip("/")))
+        reply = "{:s}".format(extra.lstrip("/"))
     elif cmd == "fortune":
-        cmd_fortune()
+        reply = cmd_fortune()
+    elif cmd in ("grep", "search"):
+        reply = cmd_search(extra, nick, ircd, network, channel, self_nick)
     elif cmd == "ping":
-        print("{:s}: pong! Ping-pong, get it?".format(args.nick))
+        reply = "{:s}: pong! Ping-pong, get it?".format(nick)
+    elif cmd == "seen":
+        reply = cmd_seen(extra, nick, ircd, network)
     elif cmd == "slap":
-        print("{:s}: I'll slap your butt!".format(args.nick))
+        reply = "{:s}: I'll slap your butt!".format(nick)
+    elif cmd == "stats":
+        reply = cmd_stats()
     elif cmd == "url":
-        cmd_url(extra)
+        reply = cmd_url(extra, nick, channel, network, ircd)
+    elif cmd == "urls":
+        reply = cmd_urls(extra, nick, ircd, network, channel)
     elif cmd == "whereami":
-        print("{:s}: this! is!! {:s}!!!".format(args.nick, args.channel))
+        reply = "{:s}: this! is!! {:s}!!!".format(nick, channel)
     else:
-        print(
-            "{:s}: what are you on about? Me not understanding.".format(
-                args.nick
-            )
+        reply = "{:s}: what are you on about? Me not understanding.".format(
+            nick
         )
 
+    return reply
+
 
 def parse_args():
     """Return parsed CLI args."""
@@ -203,13 +1317,13 @@ def parse_args():
     parser.add_argument(
         "--nick",
         type=str,
-        required=True,
+        default=None,
         help="Nickname of user who sent the message.",
     )
     parser.add_argument(
         "--message",
         type=str,
-        required=True,
+        default=None,
         help="ii message to be processed.",
     )
     parser.add_argument(
@@ -227,7 +1341,7 @@ def parse_args():
     parser.add_argument(
         "--channel",
         type=str,
-        required=True,
+        default=None,
         help="Name of channel message came from.",
     )
     parser.add_argument(
@@ -236,8 +1350,37 @@ def parse_args():
         required=True,
         help="Bot's nickname.",
     )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        default=False,
+        help=(
+            "Read JSON-lines events with nick, channel and message from input"
+            " and write JSON-lines replies to stdout."
+        ),
+    )
+    parser.add_argument(
+        "--input",
+        type=str,
+        default="-",
+        help="File with events in batch mode, '-' is stdin.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=BATCH_WORKERS,
+        help="Number of events processed concurrently in batch mode.",
+    )
     args = parser.parse_args()
 
+    if args.workers < 1:
+        parser.error("Argument 'workers' must be greater than 0")
+
+    if not args.batch:
+        for arg in ("nick", "message", "channel"):
+            if getattr(args, arg) is None:
+                parser.error("Argument '{:s}' is required".format(arg))
+
     if not args.nick:
         args.nick = "unknown.stranger"
 
@@ -247,7 +1390,7 @@ def parse_args():
     if not args.network:
         parser.error("Argument 'network' must not be empty")
 
-    if not args.channel:
+    if not args.batch and not args.channel:
         parser.error("Argument 'channel' must not be empty")
 
     return args
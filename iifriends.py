@@ -7,66 +7,168 @@ currently implemented and supported.
 2025/Jul/14 @ Zdenek Styblik <stybla@turnovfree.net>
 """
 import argparse
+import dataclasses
+import errno
+import functools
+import heapq
+import ipaddress
+import itertools
 import logging
 import os
 import re
+import select
 import signal
 import stat
 import sys
+import threading
 import time
 import traceback
+from collections.abc import Mapping
 from dataclasses import dataclass
-from typing import BinaryIO
+from dataclasses import field
+from types import MappingProxyType
 from typing import Dict
+from typing import FrozenSet
 from typing import List
+from typing import Optional
+from typing import Set
+
+import iimetrics  # noqa:I202
+import iiprofile
+import iistate
 
 SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
 DEFAULT_FRIENDS_FILE = os.path.join(SCRIPT_PATH, "friends.txt")
+# Nick can't start with '.', so it doesn't collide with ii's query directory.
+DEFAULT_EVENTS_FIFO = ".iifriends"
+FRIENDS_CACHE_SIZE = 4096
+FRIENDS_RELOAD_INTERVAL = 5  # seconds
+SERVICE_PIPE_OPEN_TIMEOUT = 0.5  # seconds
+SERVICE_RETRY_MAX = 30  # seconds
 PIPE_OPEN_TIMEOUT = 60  # seconds
+PIPE_OPEN_RETRY_INTERVAL = 0.5  # seconds
+MODE_INTERVAL = 1  # seconds
+# One-shot process sleeps through delays up to this long.
+ONESHOT_DELAY_MAX = 30  # seconds
 PIPE_WRITE_TIMEOUT = 5  # seconds
 RE_LINE_COMMENT = re.compile(r"^#")
 
 
-@dataclass
+# Friend flags as bits of a bitmask.
+FLAG_AUTO = 1
+FLAG_OP = 2
+FLAG_DEOP = 4
+FLAG_VOICE = 8
+FLAG_MUTE = 16
+FLAGS = {
+    "a": FLAG_AUTO,
+    "o": FLAG_OP,
+    "d": FLAG_DEOP,
+    "v": FLAG_VOICE,
+    "m": FLAG_MUTE,
+}
+
+
+# Shared by friends without chanflags, never modified.
+NO_CHANMASKS = MappingProxyType({})
+FRIENDS_MATCH_SECONDS = iimetrics.REGISTRY.histogram(
+    "iibot_friends_match_seconds", "Time spent matching joins to friends."
+)
+FRIENDS_CANDIDATES = iimetrics.REGISTRY.histogram(
+    "iibot_friends_candidates",
+    "Number of friends a join had to be matched against.",
+    buckets=iimetrics.COUNT_BUCKETS,
+)
+
+
+@dataclass(slots=True)
 class Friend:
-    """Class represents IRC friend and related data."""
+    """Class represents IRC friend and related data.
+
+    Hostmasks and flags are parsed when Friend is created and only their
+    compiled form is kept.
+    """
 
     handle: str
-    hosts: str
-    globflags: str
-    chanflags: str
+    hosts: dataclasses.InitVar[str]
+    globflags: dataclasses.InitVar[str]
+    chanflags: dataclasses.InitVar[str]
     password: str
     comment: str
+    _hostmasks: tuple = field(init=False, repr=False, compare=False)
+    _ipmasks: tuple = field(init=False, repr=False, compare=False)
+    _globmask: int = field(init=False, repr=False, compare=False)
+    _chanmasks: Mapping[str, tuple[int, int]] = field(
+        init=False, repr=False, compare=False
+    )
+
+    def __post_init__(self, hosts: str, globflags: str, chanflags: str):
+        """Compile hostmasks and build per-channel flag table."""
+        hostmasks = []
+        ipmasks = []
+        for hostmask in hosts.split(" ") if hosts else []:
+            ipmask = parse_ipmask(hostmask)
+            if ipmask is not None:
+                ipmasks.append(ipmask)
+                continue
+
+            re_hostmask = compile_hostmask(hostmask)
+            if re_hostmask is not None:
+                hostmasks.append(re_hostmask)
+
+        self._hostmasks = tuple(hostmasks)
+        self._ipmasks = tuple(ipmasks)
+        self._globmask = self._parse_flags(globflags)
+        if not chanflags:
+            self._chanmasks = NO_CHANMASKS
+            return
+
+        chanmasks = {}
+        for chanflags_entry in chanflags.split(" "):
+            channel, flags, delay = self._parse_chanflags(chanflags_entry)
+            # First entry for the channel wins.
+            chanmasks.setdefault(channel, (self._parse_flags(flags), delay))
+
+        self._chanmasks = chanmasks
 
     def is_friend(self, user_nick: str, user_hostmask: str) -> bool:
         """Check whether given nick and hostmask matches any of hostmasks.
 
         Return True, if at least one match is found, otherwise return False.
         """
-        if not self.hosts:
+        if not self._hostmasks and not self._ipmasks:
             return False
 
         user_ident = "{:s}!{:s}".format(user_nick, user_hostmask)
         logging.debug("Ident for nick '%s' is '%s'.", user_nick, user_ident)
-        for hostmask in self.hosts.split(" "):
-            hostmask = re.escape(hostmask)
-            hostmask = hostmask.replace("\\*", ".*")
-            hostmask = hostmask.replace("\\?", ".?")
-            logging.debug("Try to match '%s' to '%s'.", user_ident, hostmask)
-            try:
-                re_hostmask = r"^{}$".format(hostmask)
-                match = re.search(re_hostmask, user_ident)
-                if match:
-                    return True
-            except re.error as exception:
-                logging.error(
-                    "Regexp %r failed due to: %s",
-                    re_hostmask,
-                    exception,
-                )
+        for re_hostmask in self._hostmasks:
+            logging.debug(
+                "Try to match '%s' to '%s'.", user_ident, re_hostmask.pattern
+            )
+            if re_hostmask.search(user_ident):
+                return True
+
+        if not self._ipmasks:
+            return False
+
+        ident, user_ip = split_ident(user_ident)
+        if user_ip is None:
+            return False
+
+        for re_ident, network in self._ipmasks:
+            if user_ip in network and re_ident.search(ident):
+                return True
 
         return False
 
+    def has_globmasks(self) -> bool:
+        """Return True if Friend has any glob, ie. non-IP, hostmask."""
+        return bool(self._hostmasks)
+
+    def get_ipmasks(self) -> tuple:
+        """Return tuple of (compiled nick!user glob, IP network) pairs."""
+        return self._ipmasks
+
     @staticmethod
     def _parse_chanflags(chanflags: str) -> List:
         """Parse chanflags and return triplet of channel, flags and delay.
@@ -84,7 +186,7 @@ class Friend:
 
         if len(splitted) > 2:
             try:
-                delay = splitted[2]
+                delay = int(splitted[2])
             except (TypeError, ValueError):
                 delay = -1
         else:
@@ -94,49 +196,677 @@ class Friend:
         return channel, flags, delay
 
     @staticmethod
-    def _eval_flag(flags: str, good_flag: str, bad_flag: str) -> bool:
+    def _parse_flags(flags: str) -> int:
+        """Convert string of flags into a bitmask."""
+        mask = 0
+        for flag in flags:
+            mask |= FLAGS.get(flag, 0)
+
+        return mask
+
+    @staticmethod
+    def _eval_mask(mask: int, good_flag: int, bad_flag: int) -> bool:
         """Determine whether a good_flag should be granted or not."""
-        if bad_flag is None:
-            bad_flag = "dont_match_this"
+        return bool(
+            mask & FLAG_AUTO and mask & good_flag and not mask & bad_flag
+        )
 
-        if good_flag in flags and bad_flag not in flags:
-            return True
+    def _get_mask(self, channel: str) -> tuple[int, int]:
+        """Return flags bitmask and delay for given channel."""
+        chanmask = self._chanmasks.get(channel, None)
+        if chanmask is not None:
+            return chanmask
 
-        return False
+        return self._globmask, -1
 
     def give_op(self, channel: str) -> tuple[bool, int]:
         """Determine whether +o should be granted in given channel."""
-        if self.chanflags:
-            for chanflags in self.chanflags.split(" "):
-                chan, flags, delay = self._parse_chanflags(chanflags)
-                if channel != chan:
-                    continue
-                # +auto, +op, -deop
-                auto_ops = self._eval_flag(flags, "a", None)
-                give_ops = self._eval_flag(flags, "o", "d")
-                return (auto_ops and give_ops), delay
-
+        mask, delay = self._get_mask(channel)
         # +auto, +op, -deop
-        auto_ops = self._eval_flag(self.globflags, "a", None)
-        give_ops = self._eval_flag(self.globflags, "o", "d")
-        return (auto_ops and give_ops), -1
+        return self._eval_mask(mask, FLAG_OP, FLAG_DEOP), delay
 
     def give_voice(self, channel: str) -> tuple[bool, int]:
         """Determine whether +v should be granted in given channel."""
-        if self.chanflags:
-            for chanflags in self.chanflags.split(" "):
-                chan, flags, delay = self._parse_chanflags(chanflags)
-                if channel != chan:
+        mask, delay = self._get_mask(channel)
+        # +auto, +voice, -mute
+        return self._eval_mask(mask, FLAG_VOICE, FLAG_MUTE), delay
+
+
+@dataclass(frozen=True, slots=True, order=True)
+class Mode:
+    """Class represents mode to be set for a nick in a channel."""
+
+    channel: str
+    nick: str
+    mode: str
+
+    def format(self) -> str:
+        """Return mode as ii command."""
+        return "/mode {:s} {:s} {:s}\n".format(
+            self.channel, self.mode, self.nick
+        )
+
+
+class ModeScheduler:
+    """Class schedules delayed modes using a single heap.
+
+    Pending modes of a nick can be cancelled, eg. when user parts, quits or
+    changes nick before mode is due. Cancelled entries are left in the heap
+    and skipped when popped, heap is compacted when they prevail. Modes are
+    paced by interval in order not to flood the server.
+    """
+
+    def __init__(self, interval: float = MODE_INTERVAL):
+        """Initialize ModeScheduler."""
+        self.interval = interval
+        self._heap = []
+        self._pending = {}
+        self._cancelled = 0
+        self._counter = itertools.count()
+        self._next_send = 0.0
+
+    def __len__(self) -> int:
+        """Return number of pending modes."""
+        return len(self._heap) - self._cancelled
+
+    def schedule(
+        self, mode: Mode, delay: int, now: Optional[float] = None
+    ) -> bool:
+        """Schedule mode to be set after delay seconds.
+
+        Returns False if the same mode is already pending.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        pending = self._pending.setdefault(mode.nick, {})
+        if mode in pending:
+            return False
+
+        # [due, seq, mode, cancelled]
+        entry = [now + max(delay, 0), next(self._counter), mode, False]
+        pending[mode] = entry
+        heapq.heappush(self._heap, entry)
+        return True
+
+    def cancel(self, nick: str, channel: Optional[str] = None) -> int:
+        """Cancel pending modes of nick in channel or in all channels.
+
+        Returns number of cancelled modes.
+        """
+        pending = self._pending.get(nick, None)
+        if not pending:
+            return 0
+
+        cancelled = 0
+        for mode in list(pending.keys()):
+            if channel is not None and mode.channel != channel:
+                continue
+
+            entry = pending.pop(mode)
+            entry[3] = True
+            cancelled += 1
+
+        if not pending:
+            del self._pending[nick]
+
+        self._cancelled += cancelled
+        if self._cancelled > len(self._heap) // 2:
+            self._heap = [entry for entry in self._heap if not entry[3]]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+        return cancelled
+
+    def next_timeout(self, now: Optional[float] = None) -> Optional[float]:
+        """Return seconds until next mode is due or None if none is pending."""
+        if now is None:
+            now = time.monotonic()
+
+        while self._heap and self._heap[0][3]:
+            heapq.heappop(self._heap)
+            self._cancelled -= 1
+
+        if not self._heap:
+            return None
+
+        return max(self._heap[0][0], self._next_send, now) - now
+
+    def pop(self, now: Optional[float] = None) -> Optional[Mode]:
+        """Return mode which is due or None."""
+        if now is None:
+            now = time.monotonic()
+
+        timeout = self.next_timeout(now)
+        if timeout is None or timeout > 0:
+            return None
+
+        _, _, mode, _ = heapq.heappop(self._heap)
+        pending = self._pending[mode.nick]
+        del pending[mode]
+        if not pending:
+            del self._pending[mode.nick]
+
+        self._next_send = now + self.interval
+        return mode
+
+
+class IPIndex:
+    """Class indexes IP networks for lookup of addresses.
+
+    Networks are kept in one hash table per prefix length, keyed by network
+    bits. Lookup masks the address for each prefix length in use, therefore
+    it costs at most 33 (IPv4) or 129 (IPv6) dict lookups regardless of how
+    many networks are indexed.
+    """
+
+    def __init__(self):
+        """Initialize IPIndex."""
+        self._tables = {4: {}, 6: {}}
+        self._prefixes = {4: [], 6: []}
+
+    def __len__(self) -> int:
+        """Return number of indexed networks."""
+        return sum(
+            len(table)
+            for tables in self._tables.values()
+            for table in tables.values()
+        )
+
+    def add(self, network, value) -> None:
+        """Add value to be returned for addresses within network."""
+        tables = self._tables[network.version]
+        if network.prefixlen not in tables:
+            tables[network.prefixlen] = {}
+            # Longest prefix first
+            self._prefixes[network.version] = sorted(tables, reverse=True)
+
+        key = int(network.network_address) >> (
+            network.max_prefixlen - network.prefixlen
+        )
+        tables[network.prefixlen].setdefault(key, []).append(value)
+
+    def lookup(self, address) -> List:
+        """Return values of all networks which contain given address."""
+        tables = self._tables[address.version]
+        address_int = int(address)
+        values = []
+        for prefixlen in self._prefixes[address.version]:
+            key = address_int >> (address.max_prefixlen - prefixlen)
+            values.extend(tables[prefixlen].get(key, []))
+
+        return values
+
+
+class FriendsDatabase:
+    """Class holds parsed friends file and memoizes decisions.
+
+    Instances are never modified after they're loaded. Reload means loading
+    a new instance and swapping it in place of the old one.
+    """
+
+    def __init__(
+        self,
+        friends: Dict[str, Friend],
+        signature: Optional[tuple] = None,
+        cache_size: int = FRIENDS_CACHE_SIZE,
+    ):
+        """Initialize FriendsDatabase."""
+        self.friends = friends
+        self.signature = signature
+        # Friends with glob hostmasks are matched one by one, IP based
+        # hostmasks are looked up in the index.
+        self.glob_friends = [
+            handle
+            for handle, friend in friends.items()
+            if friend.has_globmasks()
+        ]
+        self.ip_index = IPIndex()
+        for handle, friend in friends.items():
+            for re_ident, network in friend.get_ipmasks():
+                self.ip_index.add(network, (handle, re_ident))
+
+        self.get_modes = functools.lru_cache(maxsize=cache_size)(
+            self._get_modes
+        )
+
+    @classmethod
+    def load(
+        cls,
+        fname: str,
+        cache_size: int = FRIENDS_CACHE_SIZE,
+        strict: bool = False,
+    ):
+        """Parse friends file and return new FriendsDatabase."""
+        signature = get_file_signature(fname)
+        friends = parse_friends_file(fname, strict)
+        return cls(friends, signature, cache_size)
+
+    def _get_modes(
+        self, nick: str, hostmask: str, channel: str
+    ) -> FrozenSet[tuple[Mode, int]]:
+        """Return modes and their delays for nick, hostmask and channel."""
+        friends_found = self.find_friends(nick, hostmask)
+        modes = get_modes(self.friends, nick, hostmask, channel, friends_found)
+        return frozenset(modes.items())
+
+    def find_friends(self, nick: str, hostmask: str) -> Set[str]:
+        """Return handles of friends which match given nick and hostmask."""
+        friends_found = set([])
+        for handle in self.glob_friends:
+            if self.friends[handle].is_friend(nick, hostmask):
+                friends_found.add(handle)
+
+        ident, user_ip = split_ident("{:s}!{:s}".format(nick, hostmask))
+        if user_ip is None or not len(self.ip_index):
+            FRIENDS_CANDIDATES.observe(len(self.glob_friends))
+            return friends_found
+
+        candidates = self.ip_index.lookup(user_ip)
+        FRIENDS_CANDIDATES.observe(len(self.glob_friends) + len(candidates))
+        for handle, re_ident in candidates:
+            if re_ident.search(ident):
+                friends_found.add(handle)
+
+        return friends_found
+
+
+class FriendsService:
+    """Class represents long-lived iifriends service.
+
+    Service keeps friends database in memory and reloads it when friends file
+    changes or when reload is requested, eg. by SIGHUP.
+    """
+
+    def __init__(
+        self,
+        friends_file: str,
+        self_nick: str,
+        cache_size: int = FRIENDS_CACHE_SIZE,
+        reload_interval: float = FRIENDS_RELOAD_INTERVAL,
+    ):
+        """Initialize FriendsService and load friends file."""
+        self.friends_file = friends_file
+        self.self_nick = self_nick
+        self.cache_size = cache_size
+        self.reload_interval = reload_interval
+        self.reload_requested = threading.Event()
+        self.stop_requested = threading.Event()
+        self.scheduler = ModeScheduler()
+        self.state = iistate.ChannelState(self_nick)
+        self.database = FriendsDatabase.load(friends_file, cache_size)
+        self._last_check = time.monotonic()
+        self._failed_signature = None
+        self._output_backoff = 0
+        self._output_retry_at = 0.0
+
+    def handle_message(
+        self,
+        message: str,
+        now: Optional[float] = None,
+        channel: Optional[str] = None,
+    ) -> Dict[Mode, int]:
+        """Process ii message and return modes scheduled due to it.
+
+        Every message updates channel state. Joins schedule modes, parts,
+        quits, kicks and nick changes cancel pending modes of the nick.
+        Channel should be given for messages from channel's out.
+        """
+        event = self.state.apply_message(message, channel)
+        if event is None:
+            logging.debug("Unable to parse message '%s'.", message)
+            return {}
+
+        if event.kind in ("part", "kick"):
+            self.scheduler.cancel(event.nick, event.channel or None)
+            return {}
+
+        if event.kind in ("quit", "nick"):
+            self.scheduler.cancel(event.nick)
+            return {}
+
+        if event.kind != "join":
+            return {}
+
+        if event.nick == self.self_nick:
+            # Don't act on yourself.
+            return {}
+
+        # Take reference once, reload might swap the database meanwhile.
+        database = self.database
+        with (
+            iiprofile.profile("iifriends-service-join"),
+            FRIENDS_MATCH_SECONDS.time(),
+        ):
+            modes = dict(
+                database.get_modes(event.nick, event.hostmask, event.channel)
+            )
+
+        for mode, delay in modes.items():
+            self.scheduler.schedule(mode, delay, now)
+
+        return modes
+
+    def is_mode_needed(self, mode: Mode) -> bool:
+        """Check channel state whether setting mode makes any sense.
+
+        Mode isn't needed if nick already has it, isn't in the channel or if
+        we don't have op there. If channel state isn't known, assume it is.
+        """
+        state = self.state
+        if not state.is_synced(mode.channel):
+            return True
+
+        if not state.self_has_op(mode.channel):
+            logging.debug("No op in '%s', skip %r.", mode.channel, mode)
+            return False
+
+        if not state.is_member(mode.channel, mode.nick):
+            logging.debug("Nick isn't in channel, skip %r.", mode)
+            return False
+
+        flag = iistate.MODE_FLAGS[mode.mode[1]]
+        return not state.has_flag(mode.channel, mode.nick, flag)
+
+    def is_reload_due(self, now: Optional[float] = None) -> bool:
+        """Return True if reload is requested or friends file is due a check."""
+        if now is None:
+            now = time.monotonic()
+
+        return (
+            self.reload_requested.is_set()
+            or now - self._last_check >= self.reload_interval
+        )
+
+    def maybe_reload(self) -> bool:
+        """Reload friends database if requested or if friends file changed.
+
+        Returns True if database has been reloaded.
+        """
+        now = time.monotonic()
+        if not self.reload_requested.is_set():
+            if not self.is_reload_due(now):
+                return False
+
+            self._last_check = now
+            signature = get_file_signature(self.friends_file)
+            if signature in (
+                None,
+                self.database.signature,
+                self._failed_signature,
+            ):
+                return False
+
+        self.reload_requested.clear()
+        self._last_check = now
+        return self.reload()
+
+    def reload(self) -> bool:
+        """Load friends file and swap database atomically.
+
+        Previous database is kept if friends file cannot be parsed, is empty
+        or changes while it's being loaded. Returns True on swap.
+        """
+        logging.debug("Reloading friends file '%s'.", self.friends_file)
+        try:
+            database = FriendsDatabase.load(
+                self.friends_file, self.cache_size, strict=True
+            )
+        except Exception:
+            self._failed_signature = get_file_signature(self.friends_file)
+            logging.error(
+                "Failed to reload friends file '%s', keeping previous one.",
+                self.friends_file,
+            )
+            return False
+
+        if not database.friends:
+            self._failed_signature = database.signature
+            logging.error(
+                "Friends file '%s' is empty, keeping previous one.",
+                self.friends_file,
+            )
+            return False
+
+        if database.signature != get_file_signature(self.friends_file):
+            # File is being written, try again next time.
+            logging.debug(
+                "Friends file '%s' has changed meanwhile.", self.friends_file
+            )
+            return False
+
+        self._failed_signature = None
+        self.database = database
+        return True
+
+    def serve(self, events_path: str, output: str) -> None:
+        """Read ii messages from FIFO and write modes into ii FIFO.
+
+        Runs until stop is requested.
+        """
+        if not os.path.exists(events_path):
+            os.mkfifo(events_path, mode=0o600)
+
+        # NOTE: FIFO is opened for reading and writing in order to prevent
+        # EOF when the last writer goes away.
+        events_fd = os.open(events_path, os.O_RDWR | os.O_NONBLOCK)
+        poller = select.poll()
+        poller.register(events_fd, select.POLLIN)
+        writer = FifoWriter(output, open_timeout=SERVICE_PIPE_OPEN_TIMEOUT)
+        buf = b""
+        try:
+            while not self.stop_requested.is_set():
+                now = time.monotonic()
+                timeout = self.scheduler.next_timeout(now)
+                if timeout is None or timeout > 1:
+                    timeout = 1
+
+                timeout = max(timeout, self._output_retry_at - now)
+                timeout = min(timeout, 1)
+
+                events = poller.poll(timeout * 1000)
+                self.maybe_reload()
+                if events:
+                    try:
+                        data = os.read(events_fd, 65536)
+                    except BlockingIOError:
+                        data = b""
+
+                    buf += data
+                    *lines, buf = buf.split(b"\n")
+                    for line in lines:
+                        message = line.decode("utf-8", errors="replace")
+                        # Optional channel prefix, ie. "#chan<TAB>message"
+                        channel = None
+                        if "\t" in message:
+                            channel, _, message = message.partition("\t")
+
+                        self.handle_message(message, channel=channel or None)
+
+                self.write_modes(writer)
+        finally:
+            writer.close()
+            os.close(events_fd)
+            # Nobody is going to read events FIFO anymore.
+            try:
+                os.unlink(events_path)
+            except OSError:
+                pass
+
+    def write_modes(
+        self, writer: "FifoWriter", now: Optional[float] = None
+    ) -> int:
+        """Write modes which are due and return their count.
+
+        If ii FIFO cannot be opened or written to, mode is put back into
+        scheduler and next attempt is postponed with exponential backoff.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        if now < self._output_retry_at:
+            return 0
+
+        written = 0
+        while (mode := self.scheduler.pop(now)) is not None:
+            if not self.is_mode_needed(mode):
+                continue
+
+            message = mode.format()
+            try:
+                writer.open()
+                writer.write(message)
+            except (TimeoutError, OSError, ValueError):
+                logging.error(
+                    "Failed to write %r: %s", message, traceback.format_exc()
+                )
+                writer.close()
+                # Mode still can be cancelled until the next attempt.
+                self.scheduler.schedule(mode, 0, now)
+                self._output_backoff = min(
+                    max(self._output_backoff * 2, 1), SERVICE_RETRY_MAX
+                )
+                self._output_retry_at = now + self._output_backoff
+                return written
+
+            self._output_backoff = 0
+            written += 1
+
+        return written
+
+
+class FifoWriter:
+    """Class writes messages into ii FIFO pipe without blocking.
+
+    FIFO is opened with O_NONBLOCK and readiness is awaited with poll() and
+    an explicit deadline. Signals aren't used, therefore FifoWriter can be
+    used from any thread. File descriptor is kept open across writes.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        open_timeout: float = PIPE_OPEN_TIMEOUT,
+        write_timeout: float = PIPE_WRITE_TIMEOUT,
+    ):
+        """Initialize FifoWriter, FIFO isn't opened yet."""
+        self.path = path
+        self.open_timeout = open_timeout
+        self.write_timeout = write_timeout
+        self.fd = None
+        self._lock = threading.Lock()
+        self._poller = None
+
+    def __enter__(self):
+        """Open FIFO, unless already open, and return self."""
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        """Close FIFO."""
+        self.close()
+
+    def open(self) -> None:
+        """Open FIFO for writing.
+
+        Raises `TimeoutError` if FIFO doesn't exist or has no reader before
+        open_timeout expires and `ValueError` if path isn't a FIFO. Does
+        nothing if FIFO is already open.
+        """
+        with self._lock:
+            if self.fd is not None:
+                return
+
+            deadline = time.monotonic() + self.open_timeout
+            while True:
+                try:
+                    fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+                    break
+                except OSError as exception:
+                    # ENXIO - no reader on the other end yet, ENOENT - ii hasn't
+                    # created the FIFO yet.
+                    if exception.errno not in (errno.ENXIO, errno.ENOENT):
+                        raise
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(
+                            "Failed to open {!r} in time".format(self.path)
+                        ) from exception
+
+                    time.sleep(min(PIPE_OPEN_RETRY_INTERVAL, remaining))
+
+            try:
+                fd_stat = os.fstat(fd)
+                if not stat.S_ISFIFO(fd_stat.st_mode):
+                    raise ValueError(
+                        "{!r} is expected to be a FIFO pipe".format(self.path)
+                    )
+            except Exception:
+                os.close(fd)
+                raise
+
+            poller = select.poll()
+            poller.register(fd, select.POLLOUT)
+            self.fd = fd
+            self._poller = poller
+
+    def close(self) -> None:
+        """Close FIFO, if open."""
+        with self._lock:
+            if self.fd is None:
+                return
+
+            os.close(self.fd)
+            self.fd = None
+            self._poller = None
+
+    def write(self, message: str) -> None:
+        """Write message into FIFO.
+
+        Raises `TimeoutError` if message couldn't be written before
+        write_timeout expires and `BrokenPipeError` if reader went away.
+        Write is attempted once without waiting if write_timeout is 0.
+        """
+        data = message.encode("utf-8")
+        with self._lock:
+            if self.fd is None:
+                raise ValueError("FIFO {!r} is not open".format(self.path))
+
+            logging.debug("Will write %r.", message)
+            deadline = time.monotonic() + self.write_timeout
+            while data:
+                remaining = max(deadline - time.monotonic(), 0)
+                events = self._poller.poll(remaining * 1000)
+                if not events:
+                    if remaining <= 0:
+                        raise TimeoutError(
+                            "Failed to write into {!r} in time".format(
+                                self.path
+                            )
+                        )
+
                     continue
-                # +auto, +voice, -mute
-                auto_voice = self._eval_flag(flags, "a", None)
-                give_voice = self._eval_flag(flags, "v", "m")
-                return (auto_voice and give_voice), delay
 
-        # +auto, +voice, -mute
-        auto_voice = self._eval_flag(self.globflags, "a", None)
-        give_voice = self._eval_flag(self.globflags, "v", "m")
-        return (auto_voice and give_voice), -1
+                for _, event in events:
+                    if event & (select.POLLERR | select.POLLHUP):
+                        raise BrokenPipeError(
+                            "FIFO {!r} has no reader".format(self.path)
+                        )
+
+                try:
+                    written = os.write(self.fd, data)
+                except BlockingIOError:
+                    if remaining <= 0:
+                        raise TimeoutError(
+                            "Failed to write into {!r} in time".format(
+                                self.path
+                            )
+                        )
+
+                    continue
+
+                data = data[written:]
 
 
 def find_friends(friends, nick: str, hostmask: str):
@@ -152,6 +882,108 @@ def find_friends(friends, nick: str, hostmask: str):
     return friends_found
 
 
+def compile_hostmask(hostmask: str) -> Optional[re.Pattern]:
+    """Compile hostmask glob into regexp.
+
+    Returns None, if hostmask cannot be compiled.
+    """
+    re_hostmask = re.escape(hostmask)
+    re_hostmask = re_hostmask.replace("\\*", ".*")
+    re_hostmask = re_hostmask.replace("\\?", ".?")
+    re_hostmask = r"^{}$".format(re_hostmask)
+    try:
+        return re.compile(re_hostmask)
+    except re.error as exception:
+        logging.error(
+            "Regexp %r failed due to: %s",
+            re_hostmask,
+            exception,
+        )
+
+    return None
+
+
+def parse_ipmask(hostmask: str) -> Optional[tuple]:
+    """Parse hostmask with CIDR host part, eg. *!*@192.0.2.0/24.
+
+    Returns tuple of compiled nick!user glob and IP network or None, if host
+    part isn't CIDR.
+    """
+    ident, sep, host = hostmask.rpartition("@")
+    if not sep or "/" not in host:
+        return None
+
+    try:
+        network = ipaddress.ip_network(host, strict=False)
+    except ValueError:
+        return None
+
+    re_ident = compile_hostmask(ident)
+    if re_ident is None:
+        return None
+
+    return re_ident, network
+
+
+def split_ident(user_ident: str) -> tuple:
+    """Split nick!user@host into nick!user and IP address of host.
+
+    IP address is None, if host isn't an IP address.
+    """
+    ident, _, host = user_ident.rpartition("@")
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return ident, None
+
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+
+    return ident, address
+
+
+def get_file_signature(fname: str) -> Optional[tuple]:
+    """Return tuple which changes when file changes or None on error."""
+    try:
+        fstat = os.stat(fname)
+    except OSError:
+        return None
+
+    return (fstat.st_ino, fstat.st_size, fstat.st_mtime_ns)
+
+
+def get_modes(
+    friends: Dict[str, Friend],
+    nick: str,
+    hostmask: str,
+    channel: str,
+    friends_found: Optional[Set[str]] = None,
+) -> Dict[Mode, int]:
+    """Return modes and their delays for given nick, hostmask and channel.
+
+    If more friends grant the same mode, the shortest delay wins. Matching
+    friends are looked up unless friends_found is given.
+    """
+    if friends_found is None:
+        friends_found = find_friends(friends, nick, hostmask)
+
+    logging.debug("Friends found: '%s'.", friends_found)
+    modes = {}
+    for handle in friends_found:
+        for mode_str, give_mode in (
+            ("+o", friends[handle].give_op),
+            ("+v", friends[handle].give_voice),
+        ):
+            retval, delay = give_mode(channel)
+            if retval is not True:
+                continue
+
+            mode = Mode(channel, nick, mode_str)
+            modes[mode] = min(delay, modes.get(mode, delay))
+
+    return modes
+
+
 def main():
     """Run iifriends and set mode if appropriate."""
     args = parse_args()
@@ -160,6 +992,10 @@ def main():
         stream=sys.stderr,
         encoding="utf-8",
     )
+    if args.daemon:
+        run_service(args)
+        return
+
     logging.debug("Message %r.", args.message)
     message_chunks = parse_message(args.message)
     if len(message_chunks) != 3:
@@ -171,21 +1007,26 @@ def main():
         # Don't act on yourself.
         return
 
+    with iiprofile.profile("iifriends-join"):
+        process_join(args, nick, hostmask, channel)
+
+
+def process_join(
+    args: argparse.Namespace, nick: str, hostmask: str, channel: str
+) -> None:
+    """Match joined user against friends file and write modes."""
     logging.debug("Friends file '%s'.", args.friends_file)
     friends = parse_friends_file(args.friends_file)
-    friends_found = find_friends(friends, nick, hostmask)
-    logging.debug("Friends found: '%s'.", friends_found)
-    modes = set([])
-    for handle in friends_found:
-        retval, _ = friends[handle].give_op(channel)
-        if retval is True:
-            mode = "/mode {:s} +o {:s}\n".format(channel, nick)
-            modes.add(mode)
+    with FRIENDS_MATCH_SECONDS.time():
+        modes = get_modes(friends, nick, hostmask, channel)
 
-        retval, _ = friends[handle].give_voice(channel)
-        if retval is True:
-            mode = "/mode {:s} +v {:s}\n".format(channel, nick)
-            modes.add(mode)
+    # NOTE: one-shot process can't cancel delayed modes when user leaves,
+    # only the service can. Long delays would keep process sleeping, so such
+    # modes are given right away like before delays have been honoured.
+    for mode, delay in modes.items():
+        if delay > ONESHOT_DELAY_MAX:
+            logging.debug("Delay of %r requires --daemon, give it now.", mode)
+            modes[mode] = -1
 
     if not modes:
         logging.debug("No modes to be set - quit.")
@@ -215,9 +1056,25 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--message",
         type=str,
-        required=True,
+        required=False,
         help="ii message to be processed.",
     )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        default=False,
+        help="Run as a service and read join messages from events FIFO.",
+    )
+    parser.add_argument(
+        "--events",
+        type=str,
+        default=None,
+        required=False,
+        help=(
+            "FIFO to read join messages from in daemon mode. Defaults to "
+            "'<ircd>/<network>/{:s}'.".format(DEFAULT_EVENTS_FIFO)
+        ),
+    )
     parser.add_argument(
         "--network",
         type=str,
@@ -245,12 +1102,22 @@ def parse_args() -> argparse.Namespace:
     if not args.network:
         parser.error("Argument 'network' must not be empty")
 
+    if not args.daemon and not args.message:
+        parser.error("Argument 'message' is required unless in daemon mode")
+
+    if args.daemon and not args.events:
+        args.events = os.path.join(args.ircd, args.network, DEFAULT_EVENTS_FIFO)
+
     args.log_level = logging.DEBUG if args.verbose is True else logging.ERROR
     return args
 
 
-def parse_friends_file(fname: str):
-    """Parse and return data in friends file."""
+def parse_friends_file(fname: str, strict: bool = False):
+    """Parse and return data in friends file.
+
+    Errors are logged and whatever has been parsed is returned, unless strict
+    is True in which case exception is re-raised.
+    """
     friends = {}
     try:
         with open(fname, mode="r", encoding="utf-8") as fhandle:
@@ -284,6 +1151,8 @@ def parse_friends_file(fname: str):
             fname,
             exception,
         )
+        if strict:
+            raise
 
     return friends
 
@@ -336,47 +1205,54 @@ def parse_message(message: str) -> List[str]:
     return nick, hostmask, channel
 
 
-def signal_handler(signum, frame):
-    """Handle SIGALRM signal."""
-    raise TimeoutError
+def run_service(args: argparse.Namespace) -> None:
+    """Run iifriends as a long-lived service."""
+    service = FriendsService(args.friends_file, args.self)
 
+    def reload_handler(signum, frame):
+        """Request reload of friends file on SIGHUP."""
+        service.reload_requested.set()
 
-def write_messages(output: str, messages: List, sleep: int = 2) -> None:
-    """Send modes into the ii pipe."""
-    signal.signal(signal.SIGALRM, signal_handler)
-    signal.alarm(PIPE_OPEN_TIMEOUT)
-    with open(output, "wb") as fhandle:
-        signal.alarm(0)
-        for message in messages:
-            try:
-                write_message(fhandle, message)
-                time.sleep(sleep)
-            except (TimeoutError, ValueError):
-                logging.debug(
-                    "Failed to write %r: %s", message, traceback.format_exc()
-                )
+    def stop_handler(signum, frame):
+        """Request stop of the service."""
+        service.stop_requested.set()
 
+    signal.signal(signal.SIGHUP, reload_handler)
+    signal.signal(signal.SIGTERM, stop_handler)
+    output = os.path.join(args.ircd, args.network, "in")
+    logging.debug("Events FIFO '%s', output '%s'.", args.events, output)
+    service.serve(args.events, output)
 
-def write_message(fhandle: BinaryIO, message: str) -> None:
-    """Write message into file handle.
 
-    Sets up SIGALRM and raises `TimeoutError` if alarm is due.
-    """
-    signal.signal(signal.SIGALRM, signal_handler)
-    signal.alarm(PIPE_WRITE_TIMEOUT)
+def write_messages(
+    output: str, modes: Dict[Mode, int], interval: float = MODE_INTERVAL
+) -> None:
+    """Send modes into the ii pipe, paced by interval."""
+    scheduler = ModeScheduler(interval)
+    for mode, delay in modes.items():
+        scheduler.schedule(mode, delay)
+
+    writer = FifoWriter(output)
     try:
-        fhandle_stat = os.fstat(fhandle.fileno())
-        is_fifo = stat.S_ISFIFO(fhandle_stat.st_mode)
-        if not is_fifo:
-            raise ValueError("fhandle is expected to be a FIFO pipe")
-
-        logging.debug("Will write %r.", message)
-        fhandle.write(message.encode("utf-8"))
-        signal.alarm(0)
-    except Exception as exception:
-        raise exception
-    finally:
-        signal.alarm(0)
+        writer.open()
+    except (TimeoutError, OSError, ValueError):
+        logging.error("Failed to open %r: %s", output, traceback.format_exc())
+        return
+
+    with writer:
+        while (timeout := scheduler.next_timeout()) is not None:
+            time.sleep(timeout)
+            mode = scheduler.pop()
+            if mode is None:
+                continue
+
+            message = mode.format()
+            try:
+                writer.write(message)
+            except (TimeoutError, OSError):
+                logging.debug(
+                    "Failed to write %r: %s", message, traceback.format_exc()
+                )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""Memory governor which keeps the bot within a memory budget.
+
+RSS of the process and of its child processes, eg. ii, is measured
+periodically and compared against the budget. When usage nears the budget,
+capacity of caches, number of concurrently running workers and how much of
+HTTP response bodies is read are lowered step by step and child processes
+which are too big are recycled. Limits are restored once usage drops well
+below the threshold again.
+"""
+import gc
+import logging
+import os
+import threading
+import time
+from collections.abc import Iterable
+from dataclasses import dataclass
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import iicmd  # noqa:I202
+import iimetrics
+
+MEMORY_CHECK_INTERVAL = 5  # seconds
+# Usage relative to budget at which every level of pressure starts.
+PRESSURE_THRESHOLDS = (0.7, 0.85, 0.95)
+# Level of pressure is lowered once usage drops this much below threshold.
+PRESSURE_HYSTERESIS = 0.1
+# Child process bigger than this share of budget is recycled under pressure.
+WORKER_RSS_SHARE = 0.25
+# At most one child process is recycled per interval.
+RECYCLE_INTERVAL = 60  # seconds
+SELF_NAME = "self"
+
+MEMORY_RSS = iimetrics.REGISTRY.gauge(
+    "iibot_memory_rss_bytes", "Resident set size by process."
+)
+MEMORY_BUDGET = iimetrics.REGISTRY.gauge(
+    "iibot_memory_budget_bytes", "Memory budget of the bot."
+)
+MEMORY_PRESSURE = iimetrics.REGISTRY.gauge(
+    "iibot_memory_pressure_level", "Level of memory pressure, 0 is none."
+)
+WORKER_RECYCLES = iimetrics.REGISTRY.counter(
+    "iibot_worker_recycles_total", "Number of processes recycled due to size."
+)
+
+
+@dataclass(frozen=True)
+class Limits:
+    """Class represents limits in effect at a level of memory pressure.
+
+    Factors are applied to configured capacity of caches and number of
+    workers.
+    """
+
+    cache_factor: float
+    worker_factor: float
+    body_max: int
+
+
+# Limits by level of pressure, the first one is without pressure.
+PRESSURE_LIMITS = (
+    Limits(1.0, 1.0, iicmd.HTTP_BODY_MAX),
+    Limits(0.5, 1.0, min(iicmd.HTTP_BODY_MAX, 256 * 1024)),
+    Limits(0.1, 0.5, min(iicmd.HTTP_BODY_MAX, 64 * 1024)),
+    Limits(0.0, 0.0, min(iicmd.HTTP_BODY_MAX, 16 * 1024)),
+)
+
+
+class ConcurrencyLimiter:
+    """Class limits number of concurrently running workers.
+
+    Limit can be changed at any time, workers above a lowered limit finish
+    what they're doing and the others wait.
+    """
+
+    def __init__(self, limit: int):
+        """Initialize ConcurrencyLimiter."""
+        self.limit = limit
+        self.running = 0
+        self._cond = threading.Condition()
+
+    def set_limit(self, limit: int) -> None:
+        """Change limit, at least one worker is always allowed to run."""
+        with self._cond:
+            self.limit = max(limit, 1)
+            self._cond.notify_all()
+
+    def __enter__(self):
+        """Wait until worker is allowed to run."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.running < self.limit)
+            self.running += 1
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        """Let the next worker run."""
+        with self._cond:
+            self.running -= 1
+            self._cond.notify()
+
+
+def get_rss(pid: Optional[int] = None) -> int:
+    """Return resident set size of process in bytes, 0 if it's unknown."""
+    if pid is None:
+        pid = os.getpid()
+
+    try:
+        with open(
+            "/proc/{:d}/statm".format(pid), "r", encoding="utf-8"
+        ) as fhandle:
+            chunks = fhandle.read().split()
+    except OSError:
+        return 0
+
+    if len(chunks) < 2 or not chunks[1].isdigit():
+        return 0
+
+    return int(chunks[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class MemoryGovernor:
+    """Class adapts limits of the bot to its memory usage.
+
+    Budget is in bytes. Caches are scaled from their capacity at the time
+    governor is created.
+    """
+
+    def __init__(
+        self,
+        budget: int,
+        caches: Iterable[iicmd.TTLCache],
+        limiter: ConcurrencyLimiter,
+    ):
+        """Initialize MemoryGovernor."""
+        self.budget = budget
+        self.caches = [(cache, cache.capacity) for cache in caches]
+        self.limiter = limiter
+        self.workers = limiter.limit
+        self.level = 0
+        self.usage = 0
+        self._recycled = None
+        self._names = set()
+        MEMORY_BUDGET.set(budget)
+        MEMORY_PRESSURE.set(0)
+
+    def get_level(self, usage: int) -> int:
+        """Return level of pressure for usage.
+
+        Level is lowered only once usage drops well below its threshold.
+        """
+        ratio = usage / self.budget if self.budget > 0 else 0.0
+        level = sum(
+            1 for threshold in PRESSURE_THRESHOLDS if ratio >= threshold
+        )
+        if level >= self.level:
+            return level
+
+        lowered = sum(
+            1
+            for threshold in PRESSURE_THRESHOLDS
+            if ratio >= threshold - PRESSURE_HYSTERESIS
+        )
+        return min(lowered, self.level)
+
+    def set_level(self, level: int) -> None:
+        """Apply limits of level of pressure."""
+        limits = PRESSURE_LIMITS[level]
+        for cache, capacity in self.caches:
+            cache.resize(int(capacity * limits.cache_factor))
+
+        self.limiter.set_limit(int(self.workers * limits.worker_factor))
+        iicmd.set_http_body_limit(limits.body_max)
+        if level > self.level:
+            logging.warning(
+                "Memory usage %d of %d bytes, pressure level %d.",
+                self.usage,
+                self.budget,
+                level,
+            )
+            # Free what shrunk caches have left behind.
+            gc.collect()
+        else:
+            logging.info("Memory pressure level lowered to %d.", level)
+
+        self.level = level
+        MEMORY_PRESSURE.set(level)
+
+    def check(
+        self, pids: Dict[str, int], now: Optional[float] = None
+    ) -> List[str]:
+        """Measure usage, adapt limits and return names of bloated children.
+
+        Pids are of child processes by their name.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        sizes = {SELF_NAME: get_rss()}
+        for name, pid in pids.items():
+            sizes[name] = get_rss(pid)
+
+        for name in self._names - set(sizes):
+            MEMORY_RSS.remove(process=name)
+
+        self._names = set(sizes)
+        for name, size in sizes.items():
+            MEMORY_RSS.set(size, process=name)
+
+        self.usage = sum(sizes.values())
+        level = self.get_level(self.usage)
+        if level != self.level:
+            self.set_level(level)
+
+        if self.level == 0:
+            return []
+
+        if (
+            self._recycled is not None
+            and now - self._recycled < RECYCLE_INTERVAL
+        ):
+            return []
+
+        bloated = sorted(
+            (size, name)
+            for name, size in sizes.items()
+            if name != SELF_NAME and size > self.budget * WORKER_RSS_SHARE
+        )
+        if not bloated:
+            return []
+
+        self._recycled = now
+        _, name = bloated[-1]
+        WORKER_RECYCLES.inc()
+        logging.warning(
+            "Recycle '%s' whose RSS is %d bytes.", name, sizes[name]
+        )
+        return [name]
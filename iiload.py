@@ -0,0 +1,777 @@
+#!/usr/bin/env python3
+"""End-to-end load harness of iibot supervisor.
+
+Supervisor is run against fake ii, see tests/files/fake_ii.py, and ii out
+files of its channels are fed with synthetic or recorded lines at a given
+rate. URLs point to a local HTTP stand-in whose latency, page size and
+failures are configurable. Every injected line carries a token, eg. nick
+'lt42', which is looked up in lines sent by the bot in order to measure
+reply latency.
+
+  ./iiload.py --scenario url-flood --output results.json
+  ./iiload.py --scenario replay --replay ~/irc/net/#chan/out --rate 100
+"""
+import argparse
+import dataclasses
+import http.server
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import re
+import shlex
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+
+import iisupervisor  # noqa:I202
+
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+DEFAULT_II_COMMAND = "{:s} {:s}".format(
+    shlex.quote(sys.executable),
+    shlex.quote(os.path.join(SCRIPT_PATH, "tests", "files", "fake_ii.py")),
+)
+NETWORK = "irc.load.example"
+NICKNAME = "loadbot"
+FRIEND_HOST = "friend.load.example"
+TOKEN_PREFIX = "lt"
+RE_TOKEN = re.compile(r"\b{:s}(?P<seq>\d+)\b".format(TOKEN_PREFIX))
+RE_OUT_LINE = re.compile(r"^(?P<nixtime>\d+) (?P<nick>\S+) (?P<message>.*)$")
+RE_JOIN = re.compile(r"^(?P<nick>[^(]+)\((?P<hostmask>[^)]+)\) has joined ")
+RE_URL = re.compile(r"https?://[^ ]+")
+# Replies of commands must contain "{token}" or the nick.
+COMMANDS = ("!ping", "!whereami", "!echo hello {token}", "!list", "!slap")
+FAILURE_MODES = ("error", "reset", "slow", "notitle")
+SAMPLE_INTERVAL = 0.1  # seconds
+POLL_INTERVAL = 0.01  # seconds
+READY_TIMEOUT = 30  # seconds
+DRAIN_TIMEOUT = 10  # seconds
+
+
+@dataclass
+class Scenario:
+    """Class represents load scenario.
+
+    Lines are written in bursts of `burst` lines, `rate` lines per second
+    in total, and their kinds are picked by weights in `mix`.
+    """
+
+    name: str
+    duration: float = 10.0
+    rate: float = 50.0
+    burst: int = 1
+    channels: int = 4
+    mix: Dict[str, float] = field(default_factory=lambda: {"command": 1.0})
+    http_latency: float = 0.0
+    http_size: int = 1024
+    http_failure_rate: float = 0.0
+    http_failure_mode: str = "error"
+
+
+SCENARIOS = {
+    "commands": Scenario("commands", rate=50.0),
+    "join-burst": Scenario(
+        "join-burst", rate=100.0, burst=100, mix={"join": 1.0}
+    ),
+    "url-flood": Scenario(
+        "url-flood",
+        rate=50.0,
+        mix={"url": 1.0},
+        http_latency=0.05,
+        http_size=100 * 1024,
+        http_failure_rate=0.1,
+    ),
+    "mixed": Scenario(
+        "mixed",
+        rate=50.0,
+        burst=5,
+        mix={"chatter": 6.0, "command": 2.0, "url": 1.0, "join": 1.0},
+        http_latency=0.1,
+    ),
+    "replay": Scenario("replay", rate=50.0),
+}
+
+
+class PageHandler(http.server.BaseHTTPRequestHandler):
+    """Class serves generated pages whose title is the requested path."""
+
+    def do_GET(self):
+        """Serve page, or fail, according to scenario of the server."""
+        scenario = self.server.scenario
+        token = self.path.strip("/").split("?")[0] or "index"
+        mode = None
+        if self.server.rng.random() < scenario.http_failure_rate:
+            mode = scenario.http_failure_mode
+
+        latency = scenario.http_latency
+        if mode == "slow":
+            latency = max(latency * 10, 1.0)
+
+        if latency > 0:
+            time.sleep(latency)
+
+        if mode == "reset":
+            self.close_connection = True
+            self.connection.close()
+            return
+
+        if mode == "error":
+            self.send_error(500)
+            return
+
+        title = (
+            ""
+            if mode == "notitle"
+            else "<title>Page {:s}</title>".format(token)
+        )
+        body = "<html><head>{:s}</head><body>".format(title)
+        padding = max(scenario.http_size - len(body) - len("</body>"), 0)
+        body = "{:s}{:s}</body>".format(body, "x" * padding).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Don't log requests."""
+
+
+class PageServer(http.server.ThreadingHTTPServer):
+    """Class is a local HTTP stand-in run in a thread."""
+
+    daemon_threads = True
+
+    def __init__(self, scenario: Scenario, seed: int = 0):
+        """Initialize PageServer on a random port of localhost."""
+        super().__init__(("127.0.0.1", 0), PageHandler)
+        self.scenario = scenario
+        self.rng = random.Random(seed)
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        """Return base URL of the server."""
+        return "http://127.0.0.1:{:d}".format(self.server_address[1])
+
+    def start(self) -> None:
+        """Start serving in a thread."""
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop serving."""
+        self.shutdown()
+        self.server_close()
+
+
+class LineGenerator:
+    """Class generates ii out lines carrying tokens.
+
+    Returns (channel, line, token) where token is None if no reply is
+    expected.
+    """
+
+    def __init__(
+        self,
+        scenario: Scenario,
+        base_url: str,
+        recorded: Optional[List[str]] = None,
+        seed: int = 0,
+    ):
+        """Initialize LineGenerator."""
+        self.scenario = scenario
+        self.base_url = base_url
+        self.channels = get_channels(scenario)
+        self.rng = random.Random(seed)
+        self.kinds = list(scenario.mix.keys())
+        self.weights = list(scenario.mix.values())
+        self.recorded = itertools.cycle(recorded) if recorded else None
+        self.seq = 0
+
+    def next(self) -> tuple:
+        """Return the next line."""
+        self.seq += 1
+        token = "{:s}{:d}".format(TOKEN_PREFIX, self.seq)
+        channel = self.channels[self.seq % len(self.channels)]
+        now = int(time.time())
+        if self.recorded is not None:
+            line, expected = rewrite_line(next(self.recorded), token, self)
+            return (
+                channel,
+                "{:d} {:s}".format(now, line),
+                (token if expected else None),
+            )
+
+        kind = self.rng.choices(self.kinds, self.weights)[0]
+        if kind == "join":
+            line = "-!- {:s}(~bot@{:s}) has joined {:s}".format(
+                token, FRIEND_HOST, channel
+            )
+        elif kind == "url":
+            line = "<{:s}> look at {:s}".format(token, self.get_url(token))
+        elif kind == "command":
+            line = "<{:s}> {:s}".format(
+                token, self.rng.choice(COMMANDS).format(token=token)
+            )
+        else:
+            line = "<{:s}> just chatting, nothing to see here".format(token)
+            token = None
+
+        return channel, "{:d} {:s}".format(now, line), token
+
+    def get_url(self, token: str) -> str:
+        """Return URL of page at the local HTTP stand-in."""
+        return "{:s}/{:s}".format(self.base_url, token)
+
+
+class ReplyTracker:
+    """Class follows lines sent by the bot and matches them to tokens."""
+
+    def __init__(self, fname: str):
+        """Initialize ReplyTracker."""
+        self.fname = fname
+        self.injected: Dict[str, float] = {}
+        self.latencies: Dict[str, float] = {}
+        self.unexpected: Set[str] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def expect(self, token: str, injected: float) -> None:
+        """Record time when line with token has been injected."""
+        with self._lock:
+            self.injected[token] = injected
+
+    @property
+    def pending(self) -> int:
+        """Return number of tokens which haven't been replied to."""
+        with self._lock:
+            return len(self.injected) - len(self.latencies)
+
+    def start(self) -> None:
+        """Start following sent lines in a thread."""
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop following."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def on_line(self, line: str, now: float) -> None:
+        """Match tokens in line sent by the bot."""
+        for match in RE_TOKEN.finditer(line):
+            token = match.group(0)
+            with self._lock:
+                injected = self.injected.get(token, None)
+                if injected is None:
+                    self.unexpected.add(token)
+                elif token not in self.latencies:
+                    self.latencies[token] = now - injected
+
+    def _run(self) -> None:
+        """Read new lines of sent file until stopped."""
+        position = 0
+        buffer = ""
+        while not self._stop.wait(POLL_INTERVAL):
+            try:
+                with open(self.fname, "r", encoding="utf-8") as fhandle:
+                    fhandle.seek(position)
+                    data = fhandle.read()
+                    position = fhandle.tell()
+            except FileNotFoundError:
+                continue
+
+            if not data:
+                continue
+
+            now = time.monotonic()
+            *lines, buffer = (buffer + data).split("\n")
+            for line in lines:
+                self.on_line(line, now)
+
+
+class ProcessSampler:
+    """Class samples number and memory of processes in a process tree."""
+
+    def __init__(self, pid: int, interval: float = SAMPLE_INTERVAL):
+        """Initialize ProcessSampler."""
+        self.pid = pid
+        self.interval = interval
+        self.seen: Set[int] = set()
+        self.peak_processes = 0
+        self.peak_rss_kb = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        """Start sampling in a thread."""
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop sampling."""
+        self._stop.set()
+        self._thread.join()
+
+    def sample(self) -> None:
+        """Record processes in the tree and their memory."""
+        pids = get_process_tree(self.pid)
+        self.seen.update(pids)
+        self.peak_processes = max(self.peak_processes, len(pids))
+        self.peak_rss_kb = max(
+            self.peak_rss_kb, sum(get_rss_kb(pid) for pid in pids)
+        )
+
+    def _run(self) -> None:
+        """Sample until stopped."""
+        while True:
+            self.sample()
+            if self._stop.wait(self.interval):
+                break
+
+
+def get_channels(scenario: Scenario) -> List[str]:
+    """Return channels of scenario."""
+    return ["#load{:d}".format(index) for index in range(scenario.channels)]
+
+
+def rewrite_line(line: str, token: str, generator: LineGenerator) -> tuple:
+    """Return recorded out line without nixtime, and whether to expect reply.
+
+    Nick is replaced with token and URLs point to the local HTTP stand-in.
+    Messages of the bot itself are replayed as chatter.
+    """
+    match = RE_OUT_LINE.match(line.rstrip("\n"))
+    if not match:
+        return "<{:s}> {:s}".format(token, line.strip()), False
+
+    nick = match.group("nick")
+    message = match.group("message")
+    if nick == "-!-":
+        join = RE_JOIN.match(message)
+        if not join:
+            return "-!- {:s}".format(message), False
+
+        channel = message.split(" ")[-1]
+        return (
+            "-!- {:s}(~bot@{:s}) has joined {:s}".format(
+                token, FRIEND_HOST, channel
+            ),
+            True,
+        )
+
+    message, count = RE_URL.subn(generator.get_url(token), message)
+    expected = count > 0 or message.startswith("!")
+    return "<{:s}> {:s}".format(token, message), expected
+
+
+def get_process_tree(pid: int) -> List[int]:
+    """Return pid and pids of all its descendants."""
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+
+        try:
+            with open(
+                os.path.join("/proc", entry, "stat"), "r", encoding="utf-8"
+            ) as fhandle:
+                stat = fhandle.read()
+        except OSError:
+            continue
+
+        # Name of process is in parentheses and can contain spaces.
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids = []
+    queue = [pid]
+    while queue:
+        current = queue.pop()
+        pids.append(current)
+        queue.extend(children.get(current, []))
+
+    return pids
+
+
+def get_rss_kb(pid: int) -> int:
+    """Return resident memory of process in kB or 0."""
+    try:
+        with open(
+            os.path.join("/proc", str(pid), "statm"), "r", encoding="utf-8"
+        ) as fhandle:
+            resident = int(fhandle.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return 0
+
+    return resident * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def percentile(values: List[float], quantile: float) -> Optional[float]:
+    """Return quantile of values by nearest rank or None."""
+    if not values:
+        return None
+
+    ordered = sorted(values)
+    index = max(math.ceil(quantile * len(ordered)) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def read_metric(fname: str, name: str) -> float:
+    """Return sum of samples of metric in Prometheus text file."""
+    total = 0.0
+    try:
+        with open(fname, "r", encoding="utf-8") as fhandle:
+            for line in fhandle:
+                if line.startswith(name + " ") or line.startswith(name + "{"):
+                    total += float(line.rsplit(" ", 1)[1])
+    except OSError:
+        pass
+
+    return total
+
+
+def write_config(workdir: str, scenario: Scenario) -> str:
+    """Write supervisor config and friends file, return path to config."""
+    friends_file = os.path.join(workdir, "friends.txt")
+    with open(friends_file, "w", encoding="utf-8") as fhandle:
+        fhandle.write(
+            "handle=loadfriend%hosts=*!*@{:s}%globflags=ao%chanflags="
+            "%password=%comment=%\n".format(FRIEND_HOST)
+        )
+
+    # Supervisor's lock is named after config file.
+    config_file = os.path.join(
+        workdir, "iiload-{:d}-{:s}.cfg".format(os.getpid(), scenario.name)
+    )
+    with open(config_file, "w", encoding="utf-8") as fhandle:
+        fhandle.write(
+            "net:{:s}:{:s}\n"
+            "nickname:{:s}\n"
+            "ircdir:{:s}\n"
+            "friends_file:{:s}\n"
+            "metrics_file:{:s}\n".format(
+                NETWORK,
+                " ".join(get_channels(scenario)),
+                NICKNAME,
+                os.path.join(workdir, "ii"),
+                friends_file,
+                os.path.join(workdir, "metrics.prom"),
+            )
+        )
+
+    return config_file
+
+
+def wait_for(predicate, timeout: float) -> bool:
+    """Wait until predicate is true or timeout expires."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+
+        time.sleep(POLL_INTERVAL)
+
+    return False
+
+
+def run_scenario(
+    scenario: Scenario,
+    workdir: str,
+    ii_command: str = DEFAULT_II_COMMAND,
+    recorded: Optional[List[str]] = None,
+    drain_timeout: float = DRAIN_TIMEOUT,
+) -> dict:
+    """Run supervisor under scenario and return measured results."""
+    config_file = write_config(workdir, scenario)
+    netdir = os.path.join(workdir, "ii", NETWORK)
+    channels = get_channels(scenario)
+    server = PageServer(scenario)
+    server.start()
+    env = dict(os.environ)
+    env["NO_PROXY"] = env["no_proxy"] = "127.0.0.1,localhost"
+    with open(os.path.join(workdir, "supervisor.log"), "wb") as log_file:
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(SCRIPT_PATH, "iisupervisor.py"),
+                config_file,
+                "--ii",
+                ii_command,
+            ],
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            env=env,
+        )
+
+    sampler = ProcessSampler(process.pid)
+    sampler.start()
+    tracker = ReplyTracker(os.path.join(netdir, "sent"))
+    try:
+        ready = wait_for(
+            lambda: all(
+                os.path.exists(os.path.join(netdir, channel, "in"))
+                for channel in channels
+            ),
+            READY_TIMEOUT,
+        )
+        if not ready:
+            raise TimeoutError("Supervisor hasn't joined channels in time.")
+
+        tracker.start()
+        generator = LineGenerator(scenario, server.url, recorded)
+        handles = {
+            channel: open(
+                os.path.join(netdir, channel, "out"), "a", encoding="utf-8"
+            )
+            for channel in channels
+        }
+        injected = 0
+        interval = scenario.burst / scenario.rate
+        started = time.monotonic()
+        deadline = started + scenario.duration
+        next_burst = started
+        while next_burst < deadline:
+            time.sleep(max(next_burst - time.monotonic(), 0))
+            touched = set()
+            for _ in range(scenario.burst):
+                channel, line, token = generator.next()
+                handles[channel].write(line + "\n")
+                touched.add(channel)
+                if token is not None:
+                    tracker.expect(token, time.monotonic())
+
+                injected += 1
+
+            for channel in touched:
+                handles[channel].flush()
+
+            next_burst += interval
+
+        injecting = time.monotonic() - started
+        wait_for(lambda: tracker.pending == 0, drain_timeout)
+        elapsed = time.monotonic() - started
+        for fhandle in handles.values():
+            fhandle.close()
+    finally:
+        tracker.stop()
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=iisupervisor.II_STOP_TIMEOUT * 2)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+        sampler.stop()
+        server.stop()
+
+    latencies = list(tracker.latencies.values())
+    return {
+        "scenario": dataclasses.asdict(scenario),
+        "injected": injected,
+        "injected_per_second": injected / injecting if injecting else 0,
+        "expected_replies": len(tracker.injected),
+        "replies": len(latencies),
+        "replies_per_second": len(latencies) / elapsed if elapsed else 0,
+        "lost_replies": len(tracker.injected) - len(latencies),
+        "latency_seconds": {
+            "p50": percentile(latencies, 0.5),
+            "p90": percentile(latencies, 0.9),
+            "p99": percentile(latencies, 0.99),
+            "max": max(latencies) if latencies else None,
+        },
+        "dropped_events": read_metric(
+            os.path.join(workdir, "metrics.prom"), "iibot_dropped_events_total"
+        ),
+        "peak_processes": sampler.peak_processes,
+        "spawned_processes": len(sampler.seen),
+        "peak_rss_kb": sampler.peak_rss_kb,
+    }
+
+
+def format_result(result: dict) -> str:
+    """Return human readable summary of scenario's result."""
+    latency = result["latency_seconds"]
+    return (
+        "{:s}: {:d} lines ({:.1f}/s), {:d}/{:d} replies ({:.1f}/s), "
+        "latency p50={:s} p90={:s} p99={:s}, dropped={:.0f}, "
+        "processes peak={:d} total={:d}, peak RSS={:d} kB".format(
+            result["scenario"]["name"],
+            result["injected"],
+            result["injected_per_second"],
+            result["replies"],
+            result["expected_replies"],
+            result["replies_per_second"],
+            *[
+                "-" if latency[key] is None else "{:.3f}s".format(latency[key])
+                for key in ("p50", "p90", "p99")
+            ],
+            result["dropped_events"],
+            result["peak_processes"],
+            result["spawned_processes"],
+            result["peak_rss_kb"],
+        )
+    )
+
+
+def main():
+    """Run load scenarios against iibot supervisor."""
+    args = parse_args()
+    logging.basicConfig(
+        level=args.log_level,
+        stream=sys.stderr,
+        encoding="utf-8",
+    )
+    recorded = None
+    if args.replay:
+        with open(args.replay, "r", encoding="utf-8") as fhandle:
+            recorded = [line for line in fhandle if line.strip()]
+
+        if not recorded:
+            logging.error("No lines to replay in '%s'.", args.replay)
+            sys.exit(2)
+
+    results = []
+    for name in args.scenario:
+        overrides = {
+            key: value
+            for key, value in (
+                ("duration", args.duration),
+                ("rate", args.rate),
+                ("burst", args.burst),
+                ("http_latency", args.http_latency),
+                ("http_size", args.http_size),
+                ("http_failure_rate", args.http_failure_rate),
+                ("http_failure_mode", args.http_failure_mode),
+            )
+            if value is not None
+        }
+        scenario = dataclasses.replace(SCENARIOS[name], **overrides)
+        with tempfile.TemporaryDirectory(prefix="iiload-") as workdir:
+            try:
+                result = run_scenario(
+                    scenario,
+                    workdir,
+                    args.ii,
+                    recorded if name == "replay" else None,
+                )
+            except TimeoutError as exception:
+                logging.error("Scenario '%s' has failed: %s", name, exception)
+                sys.exit(1)
+
+        print(format_result(result))
+        results.append(result)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fhandle:
+            json.dump(results, fhandle, indent=2, sort_keys=True)
+            fhandle.write("\n")
+
+
+def parse_args() -> argparse.Namespace:
+    """Return parsed CLI args."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--scenario",
+        type=str,
+        action="append",
+        choices=sorted(SCENARIOS.keys()),
+        help="Scenario to run, can be given multiple times.",
+    )
+    parser.add_argument(
+        "--replay",
+        type=str,
+        default=None,
+        help="ii out file to replay in 'replay' scenario.",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=None,
+        help="Override how long lines are injected, in seconds.",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=None,
+        help="Override number of lines injected per second.",
+    )
+    parser.add_argument(
+        "--burst",
+        type=int,
+        default=None,
+        help="Override number of lines injected at once.",
+    )
+    parser.add_argument(
+        "--http-latency",
+        type=float,
+        default=None,
+        help="Override latency of HTTP stand-in, in seconds.",
+    )
+    parser.add_argument(
+        "--http-size",
+        type=int,
+        default=None,
+        help="Override size of pages served by HTTP stand-in, in bytes.",
+    )
+    parser.add_argument(
+        "--http-failure-rate",
+        type=float,
+        default=None,
+        help="Override fraction of failed HTTP requests.",
+    )
+    parser.add_argument(
+        "--http-failure-mode",
+        type=str,
+        default=None,
+        choices=FAILURE_MODES,
+        help="Override how HTTP requests fail.",
+    )
+    parser.add_argument(
+        "--ii",
+        type=str,
+        default=DEFAULT_II_COMMAND,
+        help="Command to run fake ii.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Write results into JSON file.",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        default=False,
+        help="Set log level to DEBUG.",
+    )
+    args = parser.parse_args()
+
+    args.scenario = args.scenario or ["commands"]
+    if "replay" in args.scenario and not args.replay:
+        parser.error("Scenario 'replay' requires argument 'replay'")
+
+    if args.rate is not None and args.rate <= 0:
+        parser.error("Argument 'rate' must be greater than 0")
+
+    if args.burst is not None and args.burst < 1:
+        parser.error("Argument 'burst' must be greater than 0")
+
+    args.log_level = logging.DEBUG if args.verbose is True else logging.ERROR
+    return args
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1333 @@
+#!/usr/bin/env python3
+"""Indexes of ii out logs and history of URLs.
+
+Indexes are SQLite databases next to ii's directories and they're brought up
+to date incrementally - every out file is read from where the previous update
+has stopped, therefore lookups don't depend on size of logs.
+
+Seen index keeps the last message, join, part, quit and nick change of every
+nick in every channel.
+
+Search index maps terms of messages to byte offsets of lines in out files.
+Matching lines are read through mmap, logs are never scanned. Lines of out
+files which have been archived by iiarchive are read from archive until they're
+older than SEARCH_RETENTION.
+
+URL history keeps URLs posted into channels along with their titles. It's
+written by iicmd as URLs are resolved.
+
+  ./iilog.py seen-update ~/ii
+  ./iilog.py seen ~/ii irc.example.com joe
+  ./iilog.py search-update ~/ii
+  ./iilog.py search ~/ii irc.example.com '#chan' some words
+"""
+import abc
+import argparse
+import logging
+import mmap
+import os
+import re
+import sqlite3
+import sys
+import time
+import traceback
+import zlib
+from collections.abc import Iterator
+from dataclasses import dataclass
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import iiarchive  # noqa:I202
+import iistate
+
+SEEN_DB_NAME = "seen.db"
+SEEN_DETAIL_MAX_LEN = 200
+INDEX_BATCH_SIZE = 5000  # lines per transaction
+SQLITE_TIMEOUT = 5  # seconds
+CHANNEL_PREFIXES = ("#", "&", "+", "!")
+
+SEARCH_DB_NAME = "search.db"
+SEARCH_MAX_RESULTS = 3
+SEARCH_MAX_TERMS = 5
+SEARCH_HIT_MAX_LEN = 150
+SEARCH_TIMEOUT = 2.0  # seconds
+# Query is checked against SEARCH_TIMEOUT every N SQLite VM instructions.
+SEARCH_PROGRESS_STEPS = 1000
+# Token bucket per channel - burst of searches, then one per interval.
+SEARCH_RATE_BURST = 3
+SEARCH_RATE_INTERVAL = 20  # seconds
+# Lines are dropped from search index by prune() once they're this old.
+SEARCH_RETENTION = 365 * 86400  # seconds
+TERM_MIN_LEN = 2
+TERM_MAX_LEN = 32
+URLS_DB_NAME = "urls.db"
+URLS_MAX_RESULTS = 3
+# Title of URL whose page couldn't be fetched or has none.
+NO_TITLE = "No title"
+
+RE_OUT_LINE = re.compile(r"^(?P<nixtime>\d+) (?P<nick>\S+) (?P<message>.*)$")
+RE_TERM = re.compile(r"\w+")
+
+SEEN_SCHEMA = """
+CREATE TABLE IF NOT EXISTS seen (
+    network TEXT NOT NULL,
+    nick_key TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    nick TEXT NOT NULL,
+    nixtime INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    detail TEXT NOT NULL,
+    PRIMARY KEY (network, nick_key, channel)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS seen_files (
+    path TEXT PRIMARY KEY,
+    inode INTEGER NOT NULL,
+    offset INTEGER NOT NULL
+);
+"""
+SEEN_UPSERT = """
+INSERT INTO seen (network, nick_key, channel, nick, nixtime, kind, detail)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (network, nick_key, channel) DO UPDATE SET
+    nick = excluded.nick,
+    nixtime = excluded.nixtime,
+    kind = excluded.kind,
+    detail = excluded.detail
+WHERE excluded.nixtime >= seen.nixtime
+"""
+# Line IDs are AUTOINCREMENT, therefore IDs of dropped lines aren't reused by
+# new lines and postings left behind can't point to them.
+SEARCH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    inode INTEGER NOT NULL,
+    network TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    UNIQUE (path, inode)
+);
+CREATE TABLE IF NOT EXISTS lines (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    file_id INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    nixtime INTEGER NOT NULL,
+    nick_key TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS lines_file_id ON lines (file_id);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    line_id INTEGER NOT NULL,
+    PRIMARY KEY (term, line_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS terms (
+    term TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rate_limits (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+# Repost is a primary key lookup, titles are looked up by URL in any channel.
+URLS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS urls (
+    network TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    url_key TEXT NOT NULL,
+    url TEXT NOT NULL,
+    title TEXT NOT NULL,
+    short_url TEXT NOT NULL,
+    nick TEXT NOT NULL,
+    nixtime INTEGER NOT NULL,
+    fetched INTEGER NOT NULL,
+    last_nixtime INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (network, channel, url_key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS urls_recent ON urls (network, channel, last_nixtime);
+CREATE INDEX IF NOT EXISTS urls_url_key ON urls (url_key, fetched);
+"""
+URLS_UPSERT = """
+INSERT INTO urls (
+    network, channel, url_key, url, title, short_url, nick, nixtime, fetched,
+    last_nixtime, count
+)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+ON CONFLICT (network, channel, url_key) DO UPDATE SET
+    title = CASE WHEN title IN ('', 'No title') THEN excluded.title
+        ELSE title END,
+    fetched = CASE WHEN title IN ('', 'No title') THEN excluded.fetched
+        ELSE fetched END,
+    short_url = CASE WHEN short_url = '' THEN excluded.short_url
+        ELSE short_url END,
+    last_nixtime = MAX(last_nixtime, excluded.last_nixtime),
+    count = count + 1
+"""
+
+
+@dataclass(frozen=True)
+class Seen:
+    """Class represents the last activity of nick in a channel.
+
+    Channel is empty for quits and nick changes, because ii logs them into
+    network's out.
+    """
+
+    network: str
+    channel: str
+    nick: str
+    nixtime: int
+    kind: str
+    detail: str = ""
+
+
+@dataclass(frozen=True)
+class Hit:
+    """Class represents message found by search."""
+
+    channel: str
+    nick: str
+    nixtime: int
+    message: str
+
+
+@dataclass(frozen=True)
+class PostedUrl:
+    """Class represents URL posted into a channel.
+
+    Nick and nixtime are of the first post, fetched is when title has been
+    fetched.
+    """
+
+    network: str
+    channel: str
+    url_key: str
+    url: str
+    title: str
+    short_url: str
+    nick: str
+    nixtime: int
+    fetched: int = 0
+    last_nixtime: int = 0
+    count: int = 1
+
+
+def parse_seen(line: str, network: str, channel: str = "") -> Optional[Seen]:
+    """Parse ii out line and return activity it records or None."""
+    match = RE_OUT_LINE.match(line.rstrip("\n"))
+    if not match:
+        return None
+
+    nixtime = int(match.group("nixtime"))
+    nick = match.group("nick")
+    message = match.group("message")
+    if nick.startswith("<") and nick.endswith(">") and channel:
+        return Seen(
+            network,
+            channel,
+            nick[1:-1],
+            nixtime,
+            "message",
+            message[:SEEN_DETAIL_MAX_LEN],
+        )
+
+    if nick != "-!-":
+        return None
+
+    for kind, regexp in (
+        ("join", iistate.RE_EVENT_JOIN),
+        ("part", iistate.RE_EVENT_PART),
+        ("quit", iistate.RE_EVENT_QUIT),
+    ):
+        event = regexp.search(message)
+        if not event:
+            continue
+
+        # Reason is what follows the event, eg. 'has quit (Ping timeout)'.
+        end = event.end()
+        detail = message[end:].strip(" ()")
+        return Seen(
+            network,
+            event.group("channel") if kind != "quit" else "",
+            event.group("nick"),
+            nixtime,
+            kind,
+            detail[:SEEN_DETAIL_MAX_LEN],
+        )
+
+    event = iistate.RE_EVENT_NICK.search(message)
+    if event:
+        return Seen(
+            network,
+            "",
+            event.group("nick"),
+            nixtime,
+            "nick",
+            event.group("new_nick"),
+        )
+
+    return None
+
+
+class Database:
+    """Class is a base of SQLite databases with SCHEMA provided by subclass.
+
+    WAL allows readers to go on while a writer is busy.
+    """
+
+    SCHEMA = ""
+
+    def __init__(self, path: str):
+        """Initialize Database, database is created if it doesn't exist."""
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=SQLITE_TIMEOUT)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    def close(self) -> None:
+        """Close database."""
+        self.conn.close()
+
+    def __enter__(self):
+        """Return self."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        """Close database."""
+        self.close()
+
+
+class LogIndex(Database, abc.ABC):
+    """Class is a base of on-disk indexes built incrementally from out files.
+
+    Subclass provides schema, indexes batches of lines and remembers how far
+    every file has been read in FILES_TABLE.
+    """
+
+    FILES_TABLE = ""
+
+    def update(self, ircdir: str, network: Optional[str] = None) -> int:
+        """Index lines added to out files since the last update.
+
+        Only given network is updated, if set. Returns number of lines read.
+        """
+        count = 0
+        for path, net, channel in iter_out_files(ircdir, network):
+            # Lines logged before out has been renamed for rotation.
+            count += self.update_file(
+                path, net, channel, path + iiarchive.ROTATING_SUFFIX
+            )
+            count += self.update_file(path, net, channel)
+
+        return count
+
+    def update_file(
+        self,
+        path: str,
+        network: str,
+        channel: str,
+        read_path: Optional[str] = None,
+    ) -> int:
+        """Index lines added to out file since the last update.
+
+        File which has been replaced or truncated is read from the start.
+        Out renamed to read_path is indexed under path, but only if it has
+        been indexed before. Returns number of lines read.
+        """
+        try:
+            fhandle = open(read_path or path, "rb")
+        except FileNotFoundError:
+            return 0
+
+        with fhandle:
+            stat = os.fstat(fhandle.fileno())
+            offset = self.get_offset(path, stat.st_ino)
+            if read_path is not None and offset == 0:
+                return 0
+
+            if offset > stat.st_size:
+                # Truncated.
+                with self.conn:
+                    self.conn.execute("BEGIN IMMEDIATE")
+                    if self.get_offset(path, stat.st_ino) > stat.st_size:
+                        self.forget_file(path, stat.st_ino)
+                        self.conn.execute(
+                            "UPDATE {:s} SET offset = 0 WHERE path = ? "
+                            "AND inode = ?".format(self.FILES_TABLE),
+                            (path, stat.st_ino),
+                        )
+
+                offset = 0
+
+            if offset == stat.st_size:
+                return 0
+
+            fhandle.seek(offset)
+            count = 0
+            batch: List[Tuple[int, bytes]] = []
+            for line in fhandle:
+                if not line.endswith(b"\n"):
+                    # Incomplete line, ii is writing it right now.
+                    break
+
+                batch.append((offset, line))
+                offset += len(line)
+                if len(batch) >= INDEX_BATCH_SIZE:
+                    if not self._commit(
+                        path, network, channel, stat.st_ino, batch
+                    ):
+                        return count
+
+                    count += len(batch)
+                    batch = []
+
+            if self._commit(path, network, channel, stat.st_ino, batch):
+                count += len(batch)
+
+        return count
+
+    def get_offset(self, path: str, inode: int) -> int:
+        """Return offset up to which the file has been indexed."""
+        row = self.conn.execute(
+            "SELECT offset FROM {:s} WHERE path = ? AND inode = ?".format(
+                self.FILES_TABLE
+            ),
+            (path, inode),
+        ).fetchone()
+        return row[0] if row is not None else 0
+
+    def _commit(
+        self,
+        path: str,
+        network: str,
+        channel: str,
+        inode: int,
+        batch: List[Tuple[int, bytes]],
+    ) -> bool:
+        """Index batch of lines and store file offset in one transaction.
+
+        Batch is skipped if another indexer has moved the offset since the
+        file has been read, eg. supervisor and a command at the same time.
+        Returns False if batch has been skipped.
+        """
+        if not batch:
+            return True
+
+        offset = batch[-1][0] + len(batch[-1][1])
+        with self.conn:
+            # Write lock is taken before the offset is checked.
+            self.conn.execute("BEGIN IMMEDIATE")
+            if self.get_offset(path, inode) != batch[0][0]:
+                return False
+
+            self.index_lines(path, network, channel, inode, batch)
+            self.set_offset(path, network, channel, inode, offset)
+
+        return True
+
+    @abc.abstractmethod
+    def index_lines(
+        self,
+        path: str,
+        network: str,
+        channel: str,
+        inode: int,
+        batch: List[Tuple[int, bytes]],
+    ) -> None:
+        """Index batch of (offset, line) read from out file."""
+
+    @abc.abstractmethod
+    def set_offset(
+        self, path: str, network: str, channel: str, inode: int, offset: int
+    ) -> None:
+        """Remember offset up to which the file has been indexed."""
+
+    def forget_file(self, path: str, inode: int) -> None:
+        """Drop what has been indexed from truncated file."""
+
+    def rebuild(self, ircdir: str) -> int:
+        """Drop index and build it again from all logs."""
+        with self.conn:
+            for (table,) in self.conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            ).fetchall():
+                self.conn.execute("DELETE FROM {:s}".format(table))
+
+        return self.update(ircdir)
+
+
+class SeenIndex(LogIndex):
+    """Class represents on-disk index of the last activity of nicks."""
+
+    SCHEMA = SEEN_SCHEMA
+    FILES_TABLE = "seen_files"
+
+    def store(self, records: List[Seen]) -> None:
+        """Store records, older activity doesn't overwrite newer one."""
+        self.conn.executemany(
+            SEEN_UPSERT,
+            [
+                (
+                    record.network.lower(),
+                    iistate.irc_lower(record.nick),
+                    iistate.irc_lower(record.channel),
+                    record.nick,
+                    record.nixtime,
+                    record.kind,
+                    record.detail,
+                )
+                for record in records
+            ],
+        )
+
+    def prune(self) -> int:
+        """Forget out files which are gone or have been replaced.
+
+        Returns number of forgotten files.
+        """
+        stale = [
+            (path, inode)
+            for path, inode in self.conn.execute(
+                "SELECT path, inode FROM seen_files"
+            ).fetchall()
+            if not is_live(path, inode)
+        ]
+
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM seen_files WHERE path = ? AND inode = ?", stale
+            )
+
+        return len(stale)
+
+    def lookup(self, network: str, nick: str) -> List[Seen]:
+        """Return activity of nick in all channels, the latest first."""
+        rows = self.conn.execute(
+            "SELECT channel, nick, nixtime, kind, detail FROM seen "
+            "WHERE network = ? AND nick_key = ? ORDER BY nixtime DESC",
+            (network.lower(), iistate.irc_lower(nick)),
+        ).fetchall()
+        return [Seen(network, *row) for row in rows]
+
+    def index_lines(
+        self,
+        path: str,
+        network: str,
+        channel: str,
+        inode: int,
+        batch: List[Tuple[int, bytes]],
+    ) -> None:
+        """Store the latest activity found in batch of lines."""
+        records: Dict[Tuple[str, str], Seen] = {}
+        for _, line in batch:
+            record = parse_seen(
+                line.decode("utf-8", errors="replace"), network, channel
+            )
+            if record is not None:
+                records[(record.nick, record.channel)] = record
+
+        self.store(list(records.values()))
+
+    def set_offset(
+        self, path: str, network: str, channel: str, inode: int, offset: int
+    ) -> None:
+        """Remember offset up to which the file has been indexed."""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO seen_files (path, inode, offset) "
+            "VALUES (?, ?, ?)",
+            (path, inode, offset),
+        )
+
+
+class SearchIndex(LogIndex):
+    """Class represents on-disk inverted index of messages in channels.
+
+    Postings map terms to lines, lines are byte offsets into out files. Out
+    files are left as they are, matching lines are read through mmap.
+    """
+
+    SCHEMA = SEARCH_SCHEMA
+    FILES_TABLE = "search_files"
+
+    def get_file_id(
+        self, path: str, network: str, channel: str, inode: int
+    ) -> int:
+        """Return ID of out file, file is registered if it's new."""
+        row = self.conn.execute(
+            "SELECT id FROM search_files WHERE path = ? AND inode = ?",
+            (path, inode),
+        ).fetchone()
+        if row is not None:
+            return row[0]
+
+        cursor = self.conn.execute(
+            "INSERT INTO search_files (path, inode, network, channel, offset) "
+            "VALUES (?, ?, ?, ?, 0)",
+            (path, inode, network.lower(), iistate.irc_lower(channel)),
+        )
+        return cursor.lastrowid
+
+    def index_lines(
+        self,
+        path: str,
+        network: str,
+        channel: str,
+        inode: int,
+        batch: List[Tuple[int, bytes]],
+    ) -> None:
+        """Add messages in batch of lines to the index.
+
+        Only messages in channels are indexed, commands for bot are skipped.
+        """
+        if not channel:
+            return
+
+        file_id = self.get_file_id(path, network, channel, inode)
+        counts: Dict[str, int] = {}
+        postings = []
+        for offset, line in batch:
+            match = RE_OUT_LINE.match(
+                line.decode("utf-8", errors="replace").rstrip("\n")
+            )
+            if not match:
+                continue
+
+            nick = match.group("nick")
+            message = match.group("message")
+            if not (nick.startswith("<") and nick.endswith(">")):
+                continue
+
+            if message.startswith("!"):
+                continue
+
+            terms = get_terms(message)
+            if not terms:
+                continue
+
+            cursor = self.conn.execute(
+                "INSERT INTO lines (file_id, offset, length, nixtime, "
+                "nick_key) VALUES (?, ?, ?, ?, ?)",
+                (
+                    file_id,
+                    offset,
+                    len(line),
+                    int(match.group("nixtime")),
+                    iistate.irc_lower(nick[1:-1]),
+                ),
+            )
+            for term in terms:
+                postings.append((term, cursor.lastrowid))
+                counts[term] = counts.get(term, 0) + 1
+
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO postings (term, line_id) VALUES (?, ?)",
+            postings,
+        )
+        self.conn.executemany(
+            "INSERT INTO terms (term, count) VALUES (?, ?) "
+            "ON CONFLICT (term) DO UPDATE SET count = count + excluded.count",
+            counts.items(),
+        )
+
+    def set_offset(
+        self, path: str, network: str, channel: str, inode: int, offset: int
+    ) -> None:
+        """Remember offset up to which the file has been indexed."""
+        file_id = self.get_file_id(path, network, channel, inode)
+        self.conn.execute(
+            "UPDATE search_files SET offset = ? WHERE id = ?",
+            (offset, file_id),
+        )
+
+    def forget_file(self, path: str, inode: int) -> None:
+        """Drop lines of truncated file, postings are left to prune()."""
+        row = self.conn.execute(
+            "SELECT id FROM search_files WHERE path = ? AND inode = ?",
+            (path, inode),
+        ).fetchone()
+        if row is None:
+            return
+
+        self.conn.execute("DELETE FROM lines WHERE file_id = ?", (row[0],))
+
+    def prune(
+        self, now: Optional[float] = None, retention: int = SEARCH_RETENTION
+    ) -> int:
+        """Drop lines of out files which are gone or older than retention.
+
+        Out file which has been archived is replaced by its archive, see
+        iiarchive.get_source_path(), and its lines are kept. Returns number
+        of dropped lines.
+        """
+        if now is None:
+            now = time.time()
+
+        stale = []
+        archived = []
+        moved = []
+        for file_id, path, inode, offset in self.conn.execute(
+            "SELECT id, path, inode, offset FROM search_files"
+        ).fetchall():
+            if iiarchive.split_source_path(path) is not None:
+                archived.append((file_id,))
+                continue
+
+            if is_live(path, inode):
+                continue
+
+            archive_dir = os.path.join(
+                os.path.dirname(path), iiarchive.ARCHIVE_DIR_NAME
+            )
+            source = iiarchive.find_source(archive_dir, inode, offset)
+            if source is None:
+                stale.append((file_id,))
+                continue
+
+            archived.append((file_id,))
+            moved.append(
+                (iiarchive.get_source_path(archive_dir, source), file_id)
+            )
+
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE search_files SET path = ? WHERE id = ?", moved
+            )
+            count = self.conn.total_changes
+            self.conn.executemany("DELETE FROM lines WHERE file_id = ?", stale)
+            self.conn.execute(
+                "DELETE FROM lines WHERE nixtime < ?", (int(now - retention),)
+            )
+            count = self.conn.total_changes - count
+            self.conn.executemany(
+                "DELETE FROM search_files WHERE id = ?", stale
+            )
+            # Archived files whose lines have all expired.
+            self.conn.executemany(
+                "DELETE FROM search_files WHERE id = ?1 AND NOT EXISTS "
+                "(SELECT 1 FROM lines WHERE file_id = ?1)",
+                archived,
+            )
+            if count:
+                self.conn.execute(
+                    "DELETE FROM postings WHERE line_id NOT IN "
+                    "(SELECT id FROM lines)"
+                )
+                self.conn.execute("DELETE FROM terms")
+                self.conn.execute(
+                    "INSERT INTO terms (term, count) "
+                    "SELECT term, COUNT(*) FROM postings GROUP BY term"
+                )
+
+        return count
+
+    def search(
+        self,
+        network: str,
+        channel: str,
+        query: str,
+        limit: int = SEARCH_MAX_RESULTS,
+        exclude_nick: str = "",
+        timeout: float = SEARCH_TIMEOUT,
+    ) -> List[Hit]:
+        """Return messages in channel containing all terms of query.
+
+        The latest messages come first. Query which takes longer than timeout
+        returns what has been found so far.
+        """
+        terms = get_terms(query)[:SEARCH_MAX_TERMS]
+        if not terms or limit < 1:
+            return []
+
+        counts = dict(
+            self.conn.execute(
+                "SELECT term, count FROM terms WHERE term IN ({:s})".format(
+                    ", ".join("?" * len(terms))
+                ),
+                terms,
+            ).fetchall()
+        )
+        if len(counts) < len(terms):
+            # Term which isn't anywhere can't be matched.
+            return []
+
+        # Walk postings of the rarest term, check the rest of them per line.
+        terms.sort(key=lambda term: counts[term])
+        sql = (
+            "SELECT f.path, f.inode, l.offset, l.length FROM postings AS p "
+            "JOIN lines AS l ON l.id = p.line_id "
+            "JOIN search_files AS f ON f.id = l.file_id "
+            "WHERE p.term = ? AND f.network = ? AND f.channel = ? "
+            "AND l.nick_key != ?"
+        )
+        sql += (
+            " AND EXISTS (SELECT 1 FROM postings WHERE term = ? "
+            "AND line_id = l.id)"
+        ) * (len(terms) - 1)
+        sql += " ORDER BY p.line_id DESC LIMIT ?"
+        params = [
+            terms[0],
+            network.lower(),
+            iistate.irc_lower(channel),
+            iistate.irc_lower(exclude_nick),
+            *terms[1:],
+            limit,
+        ]
+
+        deadline = time.monotonic() + timeout
+        self.conn.set_progress_handler(
+            lambda: time.monotonic() > deadline, SEARCH_PROGRESS_STEPS
+        )
+        rows = []
+        try:
+            for row in self.conn.execute(sql, params):
+                rows.append(row)
+        except sqlite3.OperationalError as exception:
+            if "interrupted" not in str(exception):
+                raise
+
+            logging.warning(
+                "Search for '%s' in %s/%s timed out", query, network, channel
+            )
+        finally:
+            self.conn.set_progress_handler(None, 0)
+
+        hits = []
+        for line in read_lines(rows):
+            hit = parse_hit(line, channel)
+            # Line could have been replaced since indexing.
+            if hit is not None and set(terms) <= set(get_terms(hit.message)):
+                hits.append(hit)
+
+        return hits
+
+    def allow(
+        self,
+        key: str,
+        now: Optional[float] = None,
+        burst: int = SEARCH_RATE_BURST,
+        interval: float = SEARCH_RATE_INTERVAL,
+    ) -> bool:
+        """Take a token from bucket of key and return whether it was there.
+
+        Buckets are stored in index, because every command might be run by a
+        new process.
+        """
+        if now is None:
+            now = time.time()
+
+        with self.conn:
+            row = self.conn.execute(
+                "SELECT tokens, updated FROM rate_limits WHERE key = ?",
+                (key,),
+            ).fetchone()
+            tokens = float(burst)
+            if row is not None:
+                tokens = min(tokens, row[0] + max(now - row[1], 0) / interval)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            self.conn.execute(
+                "INSERT OR REPLACE INTO rate_limits (key, tokens, updated) "
+                "VALUES (?, ?, ?)",
+                (key, tokens, now),
+            )
+
+        return allowed
+
+
+class UrlHistory(Database):
+    """Class represents on-disk history of URLs posted into channels."""
+
+    SCHEMA = URLS_SCHEMA
+    COLUMNS = (
+        "network, channel, url_key, url, title, short_url, nick, nixtime, "
+        "fetched, last_nixtime, count"
+    )
+
+    def add(self, posted: PostedUrl) -> None:
+        """Record URL, repost updates count and time of the last post.
+
+        Repost also fills in title and short URL, if they're missing.
+        """
+        with self.conn:
+            self.conn.execute(
+                URLS_UPSERT,
+                (
+                    posted.network.lower(),
+                    iistate.irc_lower(posted.channel),
+                    posted.url_key,
+                    posted.url,
+                    posted.title,
+                    posted.short_url,
+                    posted.nick,
+                    posted.nixtime,
+                    posted.fetched or posted.nixtime,
+                    posted.last_nixtime or posted.nixtime,
+                ),
+            )
+
+    def lookup(
+        self, network: str, channel: str, url_key: str, since: float = 0
+    ) -> Optional[PostedUrl]:
+        """Return URL posted into channel, the last time since given time.
+
+        None is returned if URL hasn't been posted since then.
+        """
+        row = self.conn.execute(
+            "SELECT {:s} FROM urls WHERE network = ? AND channel = ? "
+            "AND url_key = ? AND last_nixtime >= ?".format(self.COLUMNS),
+            (network.lower(), iistate.irc_lower(channel), url_key, since),
+        ).fetchone()
+        return PostedUrl(*row) if row is not None else None
+
+    def get_title(
+        self, url_key: str, since: float = 0
+    ) -> Optional[Tuple[str, str]]:
+        """Return (title, short URL) fetched since given time or None.
+
+        URL might have been posted in any channel. Missing titles aren't
+        returned.
+        """
+        return self.conn.execute(
+            "SELECT title, short_url FROM urls WHERE url_key = ? "
+            "AND fetched >= ? AND title NOT IN ('', ?) "
+            "ORDER BY fetched DESC LIMIT 1",
+            (url_key, since, NO_TITLE),
+        ).fetchone()
+
+    def recent(
+        self,
+        network: str,
+        channel: str,
+        query: str = "",
+        limit: int = URLS_MAX_RESULTS,
+    ) -> List[PostedUrl]:
+        """Return URLs posted into channel, the latest first.
+
+        Only URLs whose URL or title contains query are returned, if set.
+        """
+        sql = "SELECT {:s} FROM urls WHERE network = ? AND channel = ?".format(
+            self.COLUMNS
+        )
+        params: List = [network.lower(), iistate.irc_lower(channel)]
+        if query:
+            pattern = "%{:s}%".format(
+                query.replace("\\", "\\\\")
+                .replace("%", "\\%")
+                .replace("_", "\\_")
+            )
+            sql += " AND (url LIKE ? ESCAPE '\\' OR title LIKE ? ESCAPE '\\')"
+            params.extend([pattern, pattern])
+
+        sql += " ORDER BY last_nixtime DESC LIMIT ?"
+        params.append(limit)
+        return [PostedUrl(*row) for row in self.conn.execute(sql, params)]
+
+
+def get_terms(text: str) -> List[str]:
+    """Return unique lowercase terms of text in order of appearance."""
+    terms = {}
+    for match in RE_TERM.finditer(text.lower()):
+        term = match.group(0)
+        if TERM_MIN_LEN <= len(term) <= TERM_MAX_LEN:
+            terms[term] = True
+
+    return list(terms)
+
+
+def is_live(path: str, inode: int) -> bool:
+    """Return True if out file at path is inode, renamed for rotation or not."""
+    for candidate in (path, path + iiarchive.ROTATING_SUFFIX):
+        try:
+            if os.stat(candidate).st_ino == inode:
+                return True
+        except FileNotFoundError:
+            continue
+
+    return False
+
+
+def _map_spans(
+    path: str, inode: int, spans: List[Tuple[int, int]]
+) -> Optional[List[Optional[bytes]]]:
+    """Return lines at (offset, length) spans of file read through mmap.
+
+    None is returned if file is gone or it isn't inode.
+    """
+    try:
+        fhandle = open(path, "rb")
+    except FileNotFoundError:
+        return None
+
+    with fhandle:
+        stat = os.fstat(fhandle.fileno())
+        if stat.st_ino != inode:
+            return None
+
+        if stat.st_size == 0:
+            return [None] * len(spans)
+
+        lines: List[Optional[bytes]] = []
+        with mmap.mmap(fhandle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for offset, length in spans:
+                end = offset + length
+                lines.append(
+                    mapped[offset:end] if end <= stat.st_size else None
+                )
+
+        return lines
+
+
+def _read_spans(
+    path: str, inode: int, spans: List[Tuple[int, int]]
+) -> List[Optional[bytes]]:
+    """Return lines at (offset, length) spans of out file, wherever it is.
+
+    Out file is looked for at path, renamed for rotation and in archive.
+    """
+    archived = iiarchive.split_source_path(path)
+    if archived is None:
+        for candidate in (path, path + iiarchive.ROTATING_SUFFIX):
+            lines = _map_spans(candidate, inode, spans)
+            if lines is not None:
+                return lines
+
+        archive_dir = os.path.join(
+            os.path.dirname(path), iiarchive.ARCHIVE_DIR_NAME
+        )
+        size = max(offset + length for offset, length in spans)
+        source = iiarchive.find_source(archive_dir, inode, size)
+        if source is None:
+            return [None] * len(spans)
+
+        archived = archive_dir, source
+
+    return iiarchive.read_source(*archived, spans)
+
+
+def read_lines(rows: List[Tuple[str, int, int, int]]) -> List[bytes]:
+    """Read lines at (path, inode, offset, length).
+
+    Lines of live files are read through mmap, lines of archived ones from
+    archive. Lines of files which are gone or have been replaced are
+    skipped. Order of rows is kept.
+    """
+    lines: Dict[int, bytes] = {}
+    by_file: Dict[Tuple[str, int], List[int]] = {}
+    for i, (path, inode, _, _) in enumerate(rows):
+        by_file.setdefault((path, inode), []).append(i)
+
+    for (path, inode), indexes in by_file.items():
+        try:
+            found = _read_spans(
+                path, inode, [(rows[i][2], rows[i][3]) for i in indexes]
+            )
+        except (OSError, EOFError, zlib.error):
+            logging.warning(
+                "Failed to read '%s': %s", path, traceback.format_exc()
+            )
+            continue
+
+        for i, line in zip(indexes, found):
+            if line is not None:
+                lines[i] = line
+
+    return [lines[i] for i in sorted(lines)]
+
+
+def parse_hit(line: bytes, channel: str) -> Optional[Hit]:
+    """Parse message read from out file and return it as Hit or None."""
+    match = RE_OUT_LINE.match(line.decode("utf-8", errors="replace").rstrip())
+    if not match:
+        return None
+
+    nick = match.group("nick")
+    if not (nick.startswith("<") and nick.endswith(">")):
+        return None
+
+    return Hit(
+        channel,
+        nick[1:-1],
+        int(match.group("nixtime")),
+        match.group("message"),
+    )
+
+
+def format_nixtime(nixtime: int) -> str:
+    """Return nixtime as 'YYYY-mm-dd HH:MM' in UTC."""
+    return time.strftime("%Y-%m-%d %H:%M", time.gmtime(nixtime))
+
+
+def format_hit(hit: Hit) -> str:
+    """Return message found by search as '[YYYY-mm-dd HH:MM] <nick> text'."""
+    message = hit.message
+    if len(message) > SEARCH_HIT_MAX_LEN:
+        end = SEARCH_HIT_MAX_LEN - 3
+        message = message[:end] + "..."
+
+    return "[{:s}] <{:s}> {:s}".format(
+        format_nixtime(hit.nixtime), hit.nick, message
+    )
+
+
+def format_posted_url(posted: PostedUrl) -> str:
+    """Return URL as '[YYYY-mm-dd HH:MM] <nick> URL - title'."""
+    return "[{:s}] <{:s}> {:s} - {:s}".format(
+        format_nixtime(posted.nixtime),
+        posted.nick,
+        posted.short_url or posted.url,
+        posted.title,
+    )
+
+
+def iter_out_files(
+    ircdir: str, network: Optional[str] = None
+) -> Iterator[Tuple[str, str, str]]:
+    """Yield (path, network, channel) of out files in ii directory.
+
+    Channel is empty for network's out. Queries are skipped.
+    """
+    try:
+        networks = sorted(os.listdir(ircdir))
+    except FileNotFoundError:
+        return
+
+    for net in networks:
+        if network is not None and net.lower() != network.lower():
+            continue
+
+        netdir = os.path.join(ircdir, net)
+        if not os.path.isdir(netdir):
+            continue
+
+        yield os.path.join(netdir, "out"), net, ""
+        for channel in sorted(os.listdir(netdir)):
+            if not channel.startswith(CHANNEL_PREFIXES):
+                continue
+
+            path = os.path.join(netdir, channel, "out")
+            if os.path.isfile(path) or os.path.isfile(
+                path + iiarchive.ROTATING_SUFFIX
+            ):
+                yield path, net, channel
+
+
+def format_age(seconds: float) -> str:
+    """Return age in seconds as eg. '2d 3h', '5m' or 'moments'."""
+    seconds = int(max(seconds, 0))
+    if seconds < 60:
+        return "moments"
+
+    chunks = []
+    for unit, size in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds >= size:
+            chunks.append("{:d}{:s}".format(seconds // size, unit))
+            seconds %= size
+
+        if len(chunks) == 2:
+            break
+
+    return " ".join(chunks)
+
+
+def format_seen(seen: Seen, now: Optional[float] = None) -> str:
+    """Return human readable description of activity."""
+    if now is None:
+        now = time.time()
+
+    where = " in {:s}".format(seen.channel) if seen.channel else ""
+    if seen.kind == "message":
+        doing = "saying: {:s}".format(seen.detail)
+    elif seen.kind == "nick":
+        doing = "changing nick to {:s}".format(seen.detail)
+    else:
+        doing = {
+            "join": "joining",
+            "part": "leaving",
+            "quit": "quitting",
+        }.get(seen.kind, seen.kind)
+        if seen.detail:
+            doing = "{:s} ({:s})".format(doing, seen.detail)
+
+    return "{:s} was last seen{:s} {:s} ago, {:s}".format(
+        seen.nick, where, format_age(now - seen.nixtime), doing
+    )
+
+
+def main():
+    """Update or query seen or search index."""
+    args = parse_args()
+    logging.basicConfig(stream=sys.stderr, encoding="utf-8")
+    if args.action.startswith("search"):
+        index_class, db_name = SearchIndex, SEARCH_DB_NAME
+    else:
+        index_class, db_name = SeenIndex, SEEN_DB_NAME
+
+    db_path = args.db or os.path.join(args.ircdir, db_name)
+    with index_class(db_path) as index:
+        if args.action.endswith("-update"):
+            if args.rebuild:
+                count = index.rebuild(args.ircdir)
+            else:
+                count = index.update(args.ircdir)
+
+            print("Indexed {:d} line(s).".format(count))
+            if args.prune:
+                count = index.prune()
+                print(
+                    "Pruned {:d} {:s}(s).".format(
+                        count, "line" if index_class is SearchIndex else "file"
+                    )
+                )
+
+            return
+
+        index.update(args.ircdir, args.network)
+        if args.action == "search":
+            hits = index.search(
+                args.network,
+                args.channel,
+                " ".join(args.terms),
+                limit=args.limit,
+                timeout=args.timeout,
+            )
+        else:
+            records = index.lookup(args.network, args.nick)
+
+    if args.action == "search":
+        if not hits:
+            print("Nothing found.")
+            sys.exit(1)
+
+        for hit in hits:
+            print(format_hit(hit))
+
+        return
+
+    if not records:
+        print("{:s} hasn't been seen.".format(args.nick))
+        sys.exit(1)
+
+    for record in records:
+        print(format_seen(record))
+
+
+def parse_args() -> argparse.Namespace:
+    """Return parsed CLI args."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--db",
+        type=str,
+        default=None,
+        help="Path to index, '{:s}' or '{:s}' in ii directory.".format(
+            SEEN_DB_NAME, SEARCH_DB_NAME
+        ),
+    )
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    parser_update = subparsers.add_parser(
+        "seen-update", help="Index lines added to ii out files."
+    )
+    parser_update.add_argument(
+        "ircdir",
+        type=str,
+        help="ii directory.",
+    )
+    parser_update.add_argument(
+        "--rebuild",
+        action="store_true",
+        default=False,
+        help="Drop index and build it from all logs again.",
+    )
+    parser_update.add_argument(
+        "--prune",
+        action="store_true",
+        default=False,
+        help="Forget rotated or removed logs.",
+    )
+    parser_seen = subparsers.add_parser(
+        "seen", help="Show when nick has been seen the last time."
+    )
+    parser_seen.add_argument(
+        "ircdir",
+        type=str,
+        help="ii directory.",
+    )
+    parser_seen.add_argument(
+        "network",
+        type=str,
+        help="IRC network.",
+    )
+    parser_seen.add_argument(
+        "nick",
+        type=str,
+        help="Nickname to look up.",
+    )
+    parser_search_update = subparsers.add_parser(
+        "search-update", help="Index messages added to ii out files."
+    )
+    parser_search_update.add_argument(
+        "ircdir",
+        type=str,
+        help="ii directory.",
+    )
+    parser_search_update.add_argument(
+        "--rebuild",
+        action="store_true",
+        default=False,
+        help="Drop index and build it from all logs again.",
+    )
+    parser_search_update.add_argument(
+        "--prune",
+        action="store_true",
+        default=False,
+        help="Drop lines of removed logs or of those older than a year.",
+    )
+    parser_search = subparsers.add_parser(
+        "search", help="Show the latest messages containing all terms."
+    )
+    parser_search.add_argument(
+        "ircdir",
+        type=str,
+        help="ii directory.",
+    )
+    parser_search.add_argument(
+        "network",
+        type=str,
+        help="IRC network.",
+    )
+    parser_search.add_argument(
+        "channel",
+        type=str,
+        help="IRC channel.",
+    )
+    parser_search.add_argument(
+        "terms",
+        type=str,
+        nargs="+",
+        help="Terms to search for.",
+    )
+    parser_search.add_argument(
+        "--limit",
+        type=int,
+        default=20,
+        help="Max. number of messages to show.",
+    )
+    parser_search.add_argument(
+        "--timeout",
+        type=float,
+        default=SEARCH_TIMEOUT,
+        help="Max. seconds spent by query.",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
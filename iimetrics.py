@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""Lightweight metrics for iibot exported in Prometheus text format.
+
+Metrics live in process memory and updating them costs a lock and a dict
+lookup. Registry is rendered into a text file which can be picked up eg. by
+node_exporter's textfile collector.
+"""
+import bisect
+import math
+import os
+import tempfile
+import threading
+import time
+from collections.abc import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+# Upper bounds of latency buckets in seconds.
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    """Return labels formatted as '{key="value",...}' or empty string."""
+    if not labels:
+        return ""
+
+    return "{{{:s}}}".format(
+        ",".join(
+            '{:s}="{:s}"'.format(
+                key,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace("\n", "\\n")
+                .replace('"', '\\"'),
+            )
+            for key, value in labels
+        )
+    )
+
+
+def _format_value(value: float) -> str:
+    """Return value formatted for Prometheus."""
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    if float(value).is_integer():
+        return "{:d}".format(int(value))
+
+    return repr(float(value))
+
+
+class Metric:
+    """Class is a base of metrics, every label set has its own value."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str):
+        """Initialize Metric."""
+        self.name = name
+        self.description = description
+        self._values: Dict[Tuple[Tuple[str, str], ...], object] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+        """Return hashable key of label set."""
+        return tuple(sorted(labels.items()))
+
+    def samples(self) -> List[Tuple[str, tuple, float]]:
+        """Return list of (suffix, labels, value) to be rendered."""
+        with self._lock:
+            return [("", key, value) for key, value in self._values.items()]
+
+    def render(self) -> str:
+        """Return metric in Prometheus text format."""
+        lines = [
+            "# HELP {:s} {:s}".format(self.name, self.description),
+            "# TYPE {:s} {:s}".format(self.name, self.kind),
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(
+                "{:s}{:s}{:s} {:s}".format(
+                    self.name,
+                    suffix,
+                    _format_labels(labels),
+                    _format_value(value),
+                )
+            )
+
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """Class represents value which only goes up."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        """Increase counter."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        """Return value of counter."""
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def total(self) -> float:
+        """Return sum of all label sets."""
+        with self._lock:
+            return sum(self._values.values())
+
+
+class Gauge(Metric):
+    """Class represents value which goes up and down.
+
+    Value can be provided by a function which is called on render.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str):
+        """Initialize Gauge."""
+        super().__init__(name, description)
+        self._functions: Dict[Tuple[Tuple[str, str], ...], Callable] = {}
+
+    def set(self, value: float, **labels) -> None:
+        """Set gauge to value."""
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        """Increase gauge."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        """Decrease gauge."""
+        self.inc(-amount, **labels)
+
+    def set_function(self, func: Callable[[], float], **labels) -> None:
+        """Get value from func whenever gauge is read."""
+        with self._lock:
+            self._functions[self._key(labels)] = func
+
+    def remove(self, **labels) -> None:
+        """Forget value of label set."""
+        key = self._key(labels)
+        with self._lock:
+            self._values.pop(key, None)
+            self._functions.pop(key, None)
+
+    def get(self, **labels) -> Optional[float]:
+        """Return value of gauge or None."""
+        key = self._key(labels)
+        with self._lock:
+            func = self._functions.get(key, None)
+            value = self._values.get(key, None)
+
+        return func() if func is not None else value
+
+    def samples(self) -> List[Tuple[str, tuple, float]]:
+        """Return list of (suffix, labels, value) to be rendered."""
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+
+        for key, func in functions.items():
+            value = func()
+            if value is not None:
+                values[key] = value
+
+        return [("", key, value) for key, value in values.items()]
+
+
+class Histogram(Metric):
+    """Class counts observed values in buckets."""
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, description: str, buckets: tuple = DEFAULT_BUCKETS
+    ):
+        """Initialize Histogram."""
+        super().__init__(name, description)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        """Record observed value."""
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key, None)
+            if entry is None:
+                # [bucket counts..., +Inf count, sum]
+                entry = [0] * (len(self.buckets) + 2)
+                self._values[key] = entry
+
+            entry[index] += 1
+            entry[-1] += value
+
+    def time(self, **labels) -> "Timer":
+        """Return context manager which observes time spent in it."""
+        return Timer(self, labels)
+
+    def count(self, **labels) -> int:
+        """Return number of observations.
+
+        If labels are not given, all label sets are counted.
+        """
+        with self._lock:
+            if labels:
+                entries = [self._values.get(self._key(labels), None)]
+            else:
+                entries = list(self._values.values())
+
+            return sum(sum(entry[:-1]) for entry in entries if entry)
+
+    def quantile(self, quantile: float, **labels) -> Optional[float]:
+        """Return upper bound of bucket where quantile falls or None.
+
+        If labels are not given, all label sets are merged.
+        """
+        with self._lock:
+            if labels:
+                entries = [self._values.get(self._key(labels), None)]
+            else:
+                entries = list(self._values.values())
+
+            entries = [list(entry) for entry in entries if entry]
+
+        if not entries:
+            return None
+
+        counts = [sum(column) for column in zip(*entries)][:-1]
+        total = sum(counts)
+        if total == 0:
+            return None
+
+        rank = quantile * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= rank:
+                if index < len(self.buckets):
+                    return self.buckets[index]
+
+                break
+
+        return math.inf
+
+    def samples(self) -> List[Tuple[str, tuple, float]]:
+        """Return list of (suffix, labels, value) to be rendered."""
+        with self._lock:
+            items = [(key, list(entry)) for key, entry in self._values.items()]
+
+        samples = []
+        for key, entry in items:
+            cumulative = 0
+            for index, bound in enumerate(self.buckets + (math.inf,)):
+                cumulative += entry[index]
+                labels = key + (("le", _format_value(bound)),)
+                samples.append(("_bucket", labels, cumulative))
+
+            samples.append(("_sum", key, entry[-1]))
+            samples.append(("_count", key, cumulative))
+
+        return samples
+
+
+class Timer:
+    """Class is a context manager which observes time spent in it."""
+
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        """Initialize Timer."""
+        self.histogram = histogram
+        self.labels = labels
+        self.started = 0.0
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        """Start timer."""
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        """Stop timer and observe elapsed time."""
+        self.elapsed = time.perf_counter() - self.started
+        self.histogram.observe(self.elapsed, **self.labels)
+
+
+class Registry:
+    """Class holds metrics by name."""
+
+    def __init__(self):
+        """Initialize Registry."""
+        self.started = time.time()
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, description: str, **kwargs):
+        """Return metric of given name, create it if it doesn't exist."""
+        with self._lock:
+            metric = self._metrics.get(name, None)
+            if metric is None:
+                metric = cls(name, description, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError(
+                    "Metric {!r} is a {:s}".format(name, metric.kind)
+                )
+
+            return metric
+
+    def counter(self, name: str, description: str) -> Counter:
+        """Return Counter of given name."""
+        return self._get_or_create(Counter, name, description)
+
+    def gauge(self, name: str, description: str) -> Gauge:
+        """Return Gauge of given name."""
+        return self._get_or_create(Gauge, name, description)
+
+    def histogram(
+        self, name: str, description: str, buckets: tuple = DEFAULT_BUCKETS
+    ) -> Histogram:
+        """Return Histogram of given name."""
+        return self._get_or_create(
+            Histogram, name, description, buckets=buckets
+        )
+
+    def get(self, name: str) -> Optional[Metric]:
+        """Return metric of given name or None."""
+        with self._lock:
+            return self._metrics.get(name, None)
+
+    def render(self) -> str:
+        """Return all metrics in Prometheus text format."""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda x: x.name)
+
+        return "".join(metric.render() for metric in metrics)
+
+    def write(self, fname: str) -> None:
+        """Write metrics into file atomically."""
+        dirname = os.path.dirname(os.path.abspath(fname))
+        fd, tmp_fname = tempfile.mkstemp(
+            dir=dirname, prefix=".{:s}.".format(os.path.basename(fname))
+        )
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as fhandle:
+                fhandle.write(self.render())
+
+            os.chmod(tmp_fname, 0o644)
+            os.replace(tmp_fname, fname)
+        except Exception:
+            os.unlink(tmp_fname)
+            raise
+
+
+REGISTRY = Registry()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""Opt-in profiling of iibot commands and join events.
+
+Profiling is off unless IIBOT_PROFILE_DIR is set. Only a fraction of events,
+given by IIBOT_PROFILE_RATE, is profiled and saved into the directory as
+'<name>-<timestamp>-<pid>.prof'. The oldest profiles are removed once there
+is more than IIBOT_PROFILE_MAX_FILES of them.
+
+Hottest functions across saved profiles can be listed with:
+
+  ./iiprofile.py report /path/to/profiles
+"""
+import argparse
+import contextlib
+import glob
+import logging
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+from cProfile import Profile
+from typing import List
+from typing import Optional
+from typing import Union
+
+PROFILE_SUFFIX = ".prof"
+# Directory is counted again after this many saves, since other processes
+# save profiles into it as well.
+PROFILE_RECOUNT_SAVES = 50
+RE_UNSAFE_CHARS = re.compile(r"[^A-Za-z0-9_.-]+")
+
+
+def get_env_number(
+    name: str,
+    default: Union[int, float],
+    convert: type,
+) -> Union[int, float]:
+    """Return number from environment variable, default if it's invalid.
+
+    Invalid value is logged, it doesn't stop the bot from starting.
+    """
+    value = os.getenv(name, "")
+    if not value:
+        return default
+
+    try:
+        return convert(value)
+    except ValueError:
+        logging.warning(
+            "Invalid value %r of %s, using %r.", value, name, default
+        )
+        return default
+
+
+PROFILE_DIR = os.getenv("IIBOT_PROFILE_DIR", "")
+PROFILE_RATE = get_env_number("IIBOT_PROFILE_RATE", 1.0, float)
+PROFILE_MAX_FILES = get_env_number("IIBOT_PROFILE_MAX_FILES", 200, int)
+
+
+class Profiler:
+    """Class profiles sampled events and keeps profile directory bounded."""
+
+    def __init__(
+        self,
+        directory: str = "",
+        rate: float = 1.0,
+        max_files: int = PROFILE_MAX_FILES,
+    ):
+        """Initialize Profiler, it's disabled if directory is empty."""
+        self.directory = directory
+        self.rate = rate
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Number of profiles in directory as of the last count, if known.
+        self._count: Optional[int] = None
+        self._saves = 0
+
+    @property
+    def enabled(self) -> bool:
+        """Return True if profiling is enabled."""
+        return bool(self.directory) and self.rate > 0
+
+    def should_sample(self) -> bool:
+        """Return True if event should be profiled."""
+        if not self.enabled:
+            return False
+
+        return self.rate >= 1 or random.random() < self.rate
+
+    @contextlib.contextmanager
+    def profile(self, name: str):
+        """Profile code in the context, if sampled, and save the profile."""
+        # Nested profiling isn't possible, the outer one wins.
+        if getattr(self._local, "active", False) or not self.should_sample():
+            yield
+            return
+
+        profiler = Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is active.
+            yield
+            return
+
+        self._local.active = True
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self._local.active = False
+            self.save(profiler, name)
+
+    def save(self, profiler: Profile, name: str) -> Optional[str]:
+        """Save profile into directory and return its path."""
+        fname = os.path.join(
+            self.directory,
+            "{:s}-{:d}-{:d}{:s}".format(
+                RE_UNSAFE_CHARS.sub("_", name) or "unknown",
+                time.time_ns(),
+                os.getpid(),
+                PROFILE_SUFFIX,
+            ),
+        )
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            profiler.dump_stats(fname)
+            self.maybe_prune()
+        except OSError:
+            logging.error(
+                "Failed to save profile '%s': %s",
+                fname,
+                traceback.format_exc(),
+            )
+            return None
+
+        return fname
+
+    def maybe_prune(self) -> int:
+        """Prune directory after save, if it might be over the limit.
+
+        Profiles saved since the last count are added to it, directory is
+        counted again only once the sum exceeds the limit or after
+        PROFILE_RECOUNT_SAVES saves. Returns number of removed profiles.
+        """
+        with self._lock:
+            self._saves += 1
+            if (
+                self._count is not None
+                and self._count + self._saves <= self.max_files
+                and self._saves < PROFILE_RECOUNT_SAVES
+            ):
+                return 0
+
+        return self.prune()
+
+    def prune(self) -> int:
+        """Remove the oldest profiles over the limit, return their count.
+
+        Profiles are sorted by mtime only if there are too many of them.
+        """
+        with self._lock:
+            self._saves = 0
+            self._count = count_profiles(self.directory)
+            if self._count <= self.max_files:
+                return 0
+
+            fnames = list_profiles(self.directory)
+            excess = len(fnames) - self.max_files
+            removed = 0
+            for fname in fnames[: max(excess, 0)]:
+                try:
+                    os.unlink(fname)
+                    removed += 1
+                except FileNotFoundError:
+                    # Removed by another process meanwhile.
+                    pass
+
+            self._count = len(fnames) - removed
+            return removed
+
+
+PROFILER = Profiler(PROFILE_DIR, PROFILE_RATE, PROFILE_MAX_FILES)
+
+
+def configure(
+    directory: str, rate: float = 1.0, max_files: int = PROFILE_MAX_FILES
+) -> None:
+    """Change profiling settings, empty directory disables profiling."""
+    PROFILER.directory = directory
+    PROFILER.rate = rate
+    PROFILER.max_files = max_files
+    PROFILER._count = None
+
+
+def profile(name: str):
+    """Return context manager which profiles sampled events."""
+    return PROFILER.profile(name)
+
+
+def count_profiles(directory: str) -> int:
+    """Return number of profiles in directory, files aren't stat()-ed."""
+    try:
+        with os.scandir(directory) as entries:
+            return sum(
+                1 for entry in entries if entry.name.endswith(PROFILE_SUFFIX)
+            )
+    except FileNotFoundError:
+        return 0
+
+
+def list_profiles(directory: str, prefix: str = "") -> List[str]:
+    """Return profiles in directory, the oldest first."""
+    fnames = glob.glob(
+        os.path.join(
+            glob.escape(directory),
+            "{:s}*{:s}".format(glob.escape(prefix), PROFILE_SUFFIX),
+        )
+    )
+    return sorted(fnames, key=_get_sort_key)
+
+
+def _get_sort_key(fname: str) -> tuple:
+    """Return mtime and name of file, mtime is 0 if file is gone."""
+    try:
+        return (os.stat(fname).st_mtime_ns, fname)
+    except FileNotFoundError:
+        return (0, fname)
+
+
+def report(
+    directory: str,
+    prefix: str = "",
+    sort: str = "cumulative",
+    limit: int = 20,
+    stream=None,
+) -> int:
+    """Print the hottest functions across saved profiles.
+
+    Returns number of profiles which have been aggregated.
+    """
+    stream = stream or sys.stdout
+    fnames = list_profiles(directory, prefix)
+    stats = None
+    count = 0
+    for fname in fnames:
+        try:
+            if stats is None:
+                stats = pstats.Stats(fname, stream=stream)
+            else:
+                stats.add(fname)
+        except (OSError, TypeError, EOFError, ValueError):
+            logging.error("Failed to read profile '%s'.", fname)
+            continue
+
+        count += 1
+
+    if stats is None:
+        stream.write("No profiles found in '{:s}'.\n".format(directory))
+        return 0
+
+    stream.write("Aggregated {:d} profile(s).\n".format(count))
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return count
+
+
+def main():
+    """Print report of saved profiles."""
+    args = parse_args()
+    logging.basicConfig(stream=sys.stderr, encoding="utf-8")
+    if not report(args.directory, args.prefix, args.sort, args.limit):
+        sys.exit(1)
+
+
+def parse_args() -> argparse.Namespace:
+    """Return parsed CLI args."""
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    parser_report = subparsers.add_parser(
+        "report", help="Show the hottest functions across saved profiles."
+    )
+    parser_report.add_argument(
+        "directory",
+        type=str,
+        help="Directory with saved profiles.",
+    )
+    parser_report.add_argument(
+        "--prefix",
+        type=str,
+        default="",
+        help="Only profiles whose name starts with prefix, eg. 'iicmd-url'.",
+    )
+    parser_report.add_argument(
+        "--sort",
+        type=str,
+        default="cumulative",
+        choices=["calls", "cumulative", "tottime", "ncalls"],
+        help="Sort functions by.",
+    )
+    parser_report.add_argument(
+        "--limit",
+        type=int,
+        default=20,
+        help="Number of functions to show.",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""Sharding of events among bots in the same channels.
+
+Bots on the same host share SQLite database where every bot renews its lease
+on channels it's in. Every URL or command event is owned by exactly one bot
+with a live lease, picked by rendezvous hashing of the event. When a bot goes
+away, its lease expires and its share moves to others - every event moves to
+the bot which is the second best for it, the rest doesn't move at all.
+
+Lines are logged by every bot's ii with its own timestamp, therefore time
+isn't part of the event.
+"""
+import hashlib
+import logging
+import threading
+import time
+import traceback
+from collections.abc import Iterable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import iilog  # noqa:I202
+import iistate
+
+# Lease is renewed every interval and expires when not renewed in TTL.
+HEARTBEAT_INTERVAL = 2  # seconds
+LEASE_TTL = 6  # seconds
+
+SHARD_SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    scope TEXT NOT NULL,
+    instance TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (scope, instance)
+) WITHOUT ROWID;
+"""
+
+
+class LeaseTable(iilog.Database):
+    """Class represents leases of bots on channels stored in SQLite."""
+
+    SCHEMA = SHARD_SCHEMA
+
+    def renew(
+        self,
+        instance: str,
+        scopes: Iterable[str],
+        now: Optional[float] = None,
+        ttl: float = LEASE_TTL,
+    ) -> None:
+        """Renew lease of instance on scopes."""
+        if now is None:
+            now = time.time()
+
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO leases (scope, instance, expires) "
+                "VALUES (?, ?, ?)",
+                [(scope, instance, now + ttl) for scope in scopes],
+            )
+
+    def release(self, instance: str) -> None:
+        """Drop all leases of instance."""
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM leases WHERE instance = ?", (instance,)
+            )
+
+    def get_members(
+        self, scopes: Iterable[str], now: Optional[float] = None
+    ) -> Dict[str, List[str]]:
+        """Return sorted instances with live lease by scope.
+
+        Expired leases are removed on the way.
+        """
+        if now is None:
+            now = time.time()
+
+        members: Dict[str, List[str]] = {scope: [] for scope in scopes}
+        with self.conn:
+            self.conn.execute("DELETE FROM leases WHERE expires < ?", (now,))
+            for scope, instance in self.conn.execute(
+                "SELECT scope, instance FROM leases ORDER BY scope, instance"
+            ):
+                if scope in members:
+                    members[scope].append(instance)
+
+        return members
+
+
+class Shard:
+    """Class decides which events belong to this bot.
+
+    View of members is refreshed by heartbeat() which might block, the rest
+    is cheap and can be called from the event loop.
+    """
+
+    def __init__(self, path: str, instance: str, scopes: Iterable[str]):
+        """Initialize Shard, nothing is written until heartbeat()."""
+        self.path = path
+        self.instance = instance
+        self.scopes = sorted(set(scopes))
+        # Until the first heartbeat, this bot is on its own.
+        self.members: Dict[str, List[str]] = {
+            scope: [instance] for scope in self.scopes
+        }
+        self._lock = threading.Lock()
+
+    def heartbeat(self, now: Optional[float] = None) -> None:
+        """Renew leases of this bot and refresh view of members.
+
+        View is kept as it is if database isn't available.
+        """
+        with self._lock:
+            try:
+                with LeaseTable(self.path) as leases:
+                    leases.renew(self.instance, self.scopes, now)
+                    self.members = leases.get_members(self.scopes, now)
+            except Exception:
+                logging.error(
+                    "Failed to renew leases in '%s': %s",
+                    self.path,
+                    traceback.format_exc(),
+                )
+
+    def release(self) -> None:
+        """Drop leases of this bot, so others take over right away."""
+        with self._lock:
+            try:
+                with LeaseTable(self.path) as leases:
+                    leases.release(self.instance)
+            except Exception:
+                logging.error(
+                    "Failed to release leases in '%s': %s",
+                    self.path,
+                    traceback.format_exc(),
+                )
+
+    def get_members(self, scope: str) -> List[str]:
+        """Return instances which share scope, this bot included."""
+        members = self.members.get(scope, [])
+        if self.instance not in members:
+            members = sorted(members + [self.instance])
+
+        return members
+
+    def is_member(self, scope: str, nick: str) -> bool:
+        """Return True if nick is another bot sharing scope."""
+        nick = iistate.irc_lower(nick)
+        return any(
+            iistate.irc_lower(member) == nick
+            for member in self.get_members(scope)
+            if member != self.instance
+        )
+
+    def is_mine(self, scope: str, key: str) -> bool:
+        """Return True if event with given key belongs to this bot."""
+        return get_owner(key, self.get_members(scope)) == self.instance
+
+
+def get_scope(network: str, channel: str) -> str:
+    """Return scope of leases for channel."""
+    return "{:s} {:s}".format(network.lower(), iistate.irc_lower(channel))
+
+
+def get_event_key(nick: str, message: str) -> str:
+    """Return key of event for hashing, the same for every bot."""
+    return "{:s} {:s}".format(iistate.irc_lower(nick), message)
+
+
+def get_owner(key: str, members: List[str]) -> Optional[str]:
+    """Return member with the highest score for key or None.
+
+    See https://en.wikipedia.org/wiki/Rendezvous_hashing
+    """
+    owner = None
+    best = b""
+    for member in members:
+        score = hashlib.blake2b(
+            "{:s}\0{:s}".format(member, key).encode("utf-8"), digest_size=8
+        ).digest()
+        if owner is None or score > best:
+            owner, best = member, score
+
+    return owner
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""In-memory model of IRC channels built from ii out events.
+
+State is fed incrementally by ii messages - joins, parts, quits, kicks, nick
+and mode changes and NAMES replies - and answers who is in a channel and who
+has op or voice with a dict lookup.
+"""
+import re
+import sys
+from dataclasses import dataclass
+from typing import Dict
+from typing import List
+from typing import Optional
+
+MEMBER_OP = 1
+MEMBER_VOICE = 2
+# NAMES prefixes as sent by the server.
+NAMES_PREFIXES = {
+    "@": MEMBER_OP,
+    "+": MEMBER_VOICE,
+}
+MODE_FLAGS = {
+    "o": MEMBER_OP,
+    "v": MEMBER_VOICE,
+}
+# Channel modes which take a parameter when set and when unset.
+MODES_WITH_PARAM = set("beIkovhqa")
+MODES_WITH_PARAM_ON_SET = set("l")
+# RFC 1459 case mapping
+IRC_CASEFOLD = str.maketrans(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~", "abcdefghijklmnopqrstuvwxyz{}|^"
+)
+
+RE_EVENT_JOIN = re.compile(
+    r"^(?P<nick>[^ (]+)\((?P<hostmask>[^)]*)\) has joined (?P<channel>[^ ]+)$"
+)
+RE_EVENT_PART = re.compile(
+    r"^(?P<nick>[^ (]+)\((?P<hostmask>[^)]*)\) has left (?P<channel>[^ ]+)"
+)
+RE_EVENT_QUIT = re.compile(r"^(?P<nick>[^ (]+)\((?P<hostmask>[^)]*)\) has quit")
+RE_EVENT_KICK = re.compile(r"^(?P<kicker>[^ ]+) kicked (?P<nick>[^ ]+) \(")
+RE_EVENT_NICK = re.compile(
+    r"^(?P<nick>[^ ]+) changed nick to (?P<new_nick>[^ ]+)$"
+)
+RE_EVENT_MODE = re.compile(
+    r"^(?P<nick>[^ ]+) changed mode/(?P<channel>[^ ]+) -> "
+    r"(?P<modes>[^ ]+)(?: (?P<params>.*))?$"
+)
+# NOTE: ii logs numeric replies into network's out as they are, therefore
+# RPL_NAMREPLY(353) and RPL_ENDOFNAMES(366) are matched loosely.
+RE_EVENT_NAMES = re.compile(r"^[=*@] (?P<channel>[#&+!][^ ]*) :?(?P<names>.*)$")
+RE_EVENT_NAMES_END = re.compile(
+    r"^(?P<channel>[#&+!][^ ]*) :?End of /?NAMES list"
+)
+
+
+@dataclass(frozen=True, slots=True)
+class Event:
+    """Class represents parsed ii event."""
+
+    kind: str
+    nick: str = ""
+    channel: str = ""
+    hostmask: str = ""
+    target: str = ""
+    args: tuple = ()
+
+
+def irc_lower(name: str) -> str:
+    """Return name lowered according to RFC 1459 case mapping."""
+    return name.translate(IRC_CASEFOLD)
+
+
+def parse_event(message: str, channel: Optional[str] = None) -> Optional[Event]:
+    """Parse ii system message and return Event or None.
+
+    Channel is required for kicks, because ii doesn't log channel with them.
+    """
+    if message.startswith("-!- "):
+        message = message[4:]
+
+    message = message.rstrip("\n")
+    match = RE_EVENT_JOIN.search(message)
+    if match:
+        return Event(
+            "join",
+            nick=match.group("nick"),
+            channel=match.group("channel"),
+            hostmask=match.group("hostmask"),
+        )
+
+    match = RE_EVENT_PART.search(message)
+    if match:
+        return Event(
+            "part",
+            nick=match.group("nick"),
+            channel=match.group("channel"),
+            hostmask=match.group("hostmask"),
+        )
+
+    match = RE_EVENT_QUIT.search(message)
+    if match:
+        return Event(
+            "quit", nick=match.group("nick"), hostmask=match.group("hostmask")
+        )
+
+    match = RE_EVENT_KICK.search(message)
+    if match:
+        return Event(
+            "kick",
+            nick=match.group("nick"),
+            channel=channel or "",
+            target=match.group("kicker"),
+        )
+
+    match = RE_EVENT_NICK.search(message)
+    if match:
+        return Event(
+            "nick", nick=match.group("nick"), target=match.group("new_nick")
+        )
+
+    match = RE_EVENT_MODE.search(message)
+    if match:
+        return Event(
+            "mode",
+            nick=match.group("nick"),
+            channel=match.group("channel"),
+            args=parse_mode_changes(
+                match.group("modes"), (match.group("params") or "").split()
+            ),
+        )
+
+    match = RE_EVENT_NAMES_END.search(message)
+    if match:
+        return Event("names_end", channel=match.group("channel"))
+
+    match = RE_EVENT_NAMES.search(message)
+    if match:
+        return Event(
+            "names",
+            channel=match.group("channel"),
+            args=tuple(match.group("names").split()),
+        )
+
+    return None
+
+
+def parse_mode_changes(modes: str, params: List[str]) -> tuple:
+    """Return tuple of (sign, mode, param) parsed out of MODE arguments."""
+    changes = []
+    sign = "+"
+    params = list(params)
+    for char in modes:
+        if char in "+-":
+            sign = char
+            continue
+
+        param = ""
+        if char in MODES_WITH_PARAM or (
+            sign == "+" and char in MODES_WITH_PARAM_ON_SET
+        ):
+            param = params.pop(0) if params else ""
+
+        changes.append((sign, char, param))
+
+    return tuple(changes)
+
+
+class ChannelState:
+    """Class tracks members of channels and their op/voice status.
+
+    Every channel has a compact table of casefolded nick to bitmask of
+    MEMBER_* flags. Nicks are interned, so a nick present in many channels
+    is stored only once.
+    """
+
+    def __init__(self, self_nick: str):
+        """Initialize ChannelState."""
+        self.self_nick = self_nick
+        self.channels: Dict[str, Dict[str, int]] = {}
+        # Channels with complete member list, ie. NAMES has been received.
+        self.synced = set([])
+        self._names_pending = set([])
+
+    def apply_message(
+        self, message: str, channel: Optional[str] = None
+    ) -> Optional[Event]:
+        """Parse ii system message, apply it and return parsed Event."""
+        event = parse_event(message, channel)
+        if event is not None:
+            self.apply(event)
+
+        return event
+
+    def apply(self, event: Event) -> None:
+        """Update state according to given event."""
+        handler = getattr(self, "_on_{:s}".format(event.kind), None)
+        if handler is not None:
+            handler(event)
+
+    def _is_self(self, nick: str) -> bool:
+        """Return True if nick is the bot itself."""
+        return irc_lower(nick) == irc_lower(self.self_nick)
+
+    def _on_join(self, event: Event) -> None:
+        """Handle JOIN."""
+        channel = irc_lower(event.channel)
+        if self._is_self(event.nick):
+            self.channels[channel] = {}
+            self.synced.discard(channel)
+
+        members = self.channels.setdefault(channel, {})
+        members[sys.intern(irc_lower(event.nick))] = 0
+
+    def _on_part(self, event: Event) -> None:
+        """Handle PART."""
+        self._remove(irc_lower(event.channel), event.nick)
+
+    def _on_kick(self, event: Event) -> None:
+        """Handle KICK."""
+        if not event.channel:
+            return
+
+        self._remove(irc_lower(event.channel), event.nick)
+
+    def _on_quit(self, event: Event) -> None:
+        """Handle QUIT."""
+        nick = irc_lower(event.nick)
+        for members in self.channels.values():
+            members.pop(nick, None)
+
+    def _on_nick(self, event: Event) -> None:
+        """Handle NICK, member keeps its flags."""
+        if self._is_self(event.nick):
+            self.self_nick = event.target
+
+        old_nick = irc_lower(event.nick)
+        new_nick = sys.intern(irc_lower(event.target))
+        for members in self.channels.values():
+            if old_nick in members:
+                members[new_nick] = members.pop(old_nick)
+
+    def _on_mode(self, event: Event) -> None:
+        """Handle MODE, only op and voice are tracked."""
+        members = self.channels.get(irc_lower(event.channel), None)
+        if members is None:
+            return
+
+        for sign, mode, param in event.args:
+            flag = MODE_FLAGS.get(mode, 0)
+            nick = irc_lower(param)
+            if not flag or nick not in members:
+                continue
+
+            if sign == "+":
+                members[nick] |= flag
+            else:
+                members[nick] &= ~flag
+
+    def _on_names(self, event: Event) -> None:
+        """Handle RPL_NAMREPLY, first reply replaces member list."""
+        channel = irc_lower(event.channel)
+        if channel not in self._names_pending:
+            self._names_pending.add(channel)
+            self.channels[channel] = {}
+
+        members = self.channels[channel]
+        for name in event.args:
+            flags = 0
+            while name and name[0] in NAMES_PREFIXES:
+                flags |= NAMES_PREFIXES[name[0]]
+                name = name[1:]
+
+            if name:
+                members[sys.intern(irc_lower(name))] = flags
+
+    def _on_names_end(self, event: Event) -> None:
+        """Handle RPL_ENDOFNAMES, member list is complete."""
+        channel = irc_lower(event.channel)
+        self._names_pending.discard(channel)
+        if channel in self.channels:
+            self.synced.add(channel)
+
+    def _remove(self, channel: str, nick: str) -> None:
+        """Remove nick from channel or forget channel if nick is us."""
+        if self._is_self(nick):
+            self.channels.pop(channel, None)
+            self.synced.discard(channel)
+            return
+
+        members = self.channels.get(channel, None)
+        if members is not None:
+            members.pop(irc_lower(nick), None)
+
+    def is_synced(self, channel: str) -> bool:
+        """Return True if complete member list of channel is known."""
+        return irc_lower(channel) in self.synced
+
+    def is_member(self, channel: str, nick: str) -> bool:
+        """Return True if nick is in channel."""
+        members = self.channels.get(irc_lower(channel), {})
+        return irc_lower(nick) in members
+
+    def has_flag(self, channel: str, nick: str, flag: int) -> bool:
+        """Return True if nick has given MEMBER_* flag in channel."""
+        members = self.channels.get(irc_lower(channel), {})
+        return bool(members.get(irc_lower(nick), 0) & flag)
+
+    def has_op(self, channel: str, nick: str) -> bool:
+        """Return True if nick has op in channel."""
+        return self.has_flag(channel, nick, MEMBER_OP)
+
+    def has_voice(self, channel: str, nick: str) -> bool:
+        """Return True if nick has voice in channel."""
+        return self.has_flag(channel, nick, MEMBER_VOICE)
+
+    def self_has_op(self, channel: str) -> bool:
+        """Return True if the bot has op in channel."""
+        return self.has_op(channel, self.self_nick)
+
+    def members(self, channel: str) -> List[str]:
+        """Return casefolded nicks of channel members."""
+        return list(self.channels.get(irc_lower(channel), {}).keys())
@@ -0,0 +1,1708 @@
+#!/usr/bin/env python3
+"""Supervisor which runs iibot for many networks from a single process.
+
+One ii is started and watched per network. Channel out files of all networks
+are followed from a single event loop, commands are processed by a shared
+pool of worker threads and URL caches are shared by all channels as well.
+Adding a channel costs an open file instead of several processes.
+
+Configuration file is the same as of iibot-ng, except every 'net:' line is
+honoured.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import ctypes.util
+import errno
+import itertools
+import logging
+import os
+import random
+import re
+import shlex
+import signal
+import sqlite3
+import stat
+import struct
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from collections.abc import Callable
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+import iiarchive  # noqa:I202
+import iicmd
+import iifriends
+import iigovernor
+import iilog
+import iimetrics
+import iiprofile
+import iishard
+
+DEFAULT_IRCDIR = os.path.join("~", "tmp", "ii", "ii")
+DEFAULT_NICKNAME = "testme"
+DEFAULT_II_COMMAND = "ii"
+II_START_TIMEOUT = 60  # seconds
+# ii is restarted with jittered exponential backoff between these two.
+II_RESTART_DELAY = 1  # seconds
+II_RESTART_DELAY_MAX = 300  # seconds
+# Backoff is reset if ii has been running for this long.
+II_STABLE_TIME = 120  # seconds
+II_STOP_TIMEOUT = 5  # seconds
+# Time to wait for server's welcome before channels are joined anyway.
+WELCOME_TIMEOUT = 30  # seconds
+# Time given to services to confirm identify before channels are joined.
+IDENTIFY_TIMEOUT = 3  # seconds
+# Out files are polled in this interval if inotify isn't available.
+TAIL_INTERVAL = 0.25  # seconds
+# Out files are polled in this interval even with inotify, just in case.
+INOTIFY_FALLBACK_INTERVAL = 1  # seconds
+CHANNEL_PIPE_OPEN_TIMEOUT = 5  # seconds
+# Lag is probed in this interval, more often if it's above warning.
+LAG_PROBE_INTERVAL = 15  # seconds
+LAG_WARNING = 5  # seconds
+# Link is considered dead if probe isn't answered in time.
+LAG_TIMEOUT = 30  # seconds
+# Unknown command is answered with ERR_UNKNOWNCOMMAND(421) which, unlike PONG,
+# ii logs.
+LAG_PROBE_PREFIX = "IILAG"
+
+QUEUE_DEPTH = iimetrics.REGISTRY.gauge(
+    "iibot_worker_queue_depth", "Number of commands waiting or running."
+)
+DROPPED_EVENTS = iimetrics.REGISTRY.counter(
+    "iibot_dropped_events_total", "Number of events dropped due to overload."
+)
+INGEST_LAG = iimetrics.REGISTRY.histogram(
+    "iibot_ingest_lag_seconds", "Time since ii logged a line until it's read."
+)
+LINK_LAG = iimetrics.REGISTRY.gauge(
+    "iibot_link_lag_seconds", "Round-trip lag of IRC link."
+)
+II_RESTARTS = iimetrics.REGISTRY.counter(
+    "iibot_ii_restarts_total", "Number of ii restarts."
+)
+ACTIVE_QUERIES = iimetrics.REGISTRY.gauge(
+    "iibot_active_queries", "Number of followed queries."
+)
+SHARD_EVENTS = iimetrics.REGISTRY.counter(
+    "iibot_shard_events_total", "Number of sharded events by owner."
+)
+WORKERS = 4
+# Commands are dropped when this many are waiting for a worker.
+WORKER_QUEUE_MAX = 256
+METRICS_INTERVAL = 10  # seconds
+SEEN_UPDATE_INTERVAL = 10  # seconds
+# Logs are checked for rotation this often, if archive is enabled.
+ARCHIVE_INTERVAL = 60  # seconds
+# Network directory is scanned for queries this often, and on inotify event.
+QUERY_SCAN_INTERVAL = 2  # seconds
+# Query which has been idle for this long isn't followed until it grows.
+QUERY_IDLE_TIMEOUT = 300  # seconds
+# The least recently active queries are evicted above this limit.
+QUERY_MAX_ACTIVE = 256
+# Queries of services aren't commands. NickServ's is handled by identify().
+QUERY_IGNORED = ("nickserv", "chanserv")
+URL_CACHE_SIZE = 1024
+RE_URL = re.compile(r"https?://")
+RE_LINK_CLOSED = re.compile(r"Closing Link", re.IGNORECASE)
+# NOTE: ii logs numeric replies loosely, therefore RPL_WELCOME(001) and
+# RPL_LOGGEDIN(900) are matched by their text as well.
+RE_WELCOME = re.compile(r"(?: 001 |Welcome to )", re.IGNORECASE)
+RE_IDENTIFIED = re.compile(
+    r"(?: 900 |You are now (?:identified|logged in)|Password accepted)",
+    re.IGNORECASE,
+)
+# Bytes of IRC line which are left for channels after "JOIN " and CR-LF.
+JOIN_MAX_BYTES = iicmd.IRC_MAX_LINE_BYTES - len("JOIN \r\n")
+
+# See inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+IN_WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+)
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+@dataclass
+class NetworkConfig:
+    """Class represents network and channels to join."""
+
+    name: str
+    channels: List[str] = field(default_factory=list)
+
+
+@dataclass
+class Config:
+    """Class represents supervisor configuration."""
+
+    ircdir: str = DEFAULT_IRCDIR
+    nickname: str = DEFAULT_NICKNAME
+    networks: List[NetworkConfig] = field(default_factory=list)
+    iicmd_enabled: bool = True
+    friends_file: str = iifriends.DEFAULT_FRIENDS_FILE
+    metrics_file: str = ""
+    profile_dir: str = ""
+    profile_rate: float = 1.0
+    bitly_api_token: str = ""
+    bitly_group_id: str = ""
+    shard_db: str = ""
+    # Size of out file in bytes which triggers rotation, 0 disables archive.
+    archive_max_size: int = 0
+    # Memory of supervisor and ii processes in bytes, 0 disables governor.
+    memory_budget: int = 0
+
+
+@dataclass
+class TailedFile:
+    """Class represents file followed by LogTailer."""
+
+    path: str
+    callback: Callable[[str], None]
+    from_end: bool = True
+    fhandle: Optional[object] = None
+    inode: Optional[int] = None
+    buf: bytes = b""
+    # Position to start at when the file is opened, overrides from_end.
+    offset: Optional[int] = None
+
+
+@dataclass
+class QueryState:
+    """Class represents query of network and how far its out has been read."""
+
+    inode: int
+    offset: int
+    active: bool = False
+    last_active: float = 0.0
+
+
+class Inotify:
+    """Class is a minimal binding of Linux inotify(7) through ctypes.
+
+    Raises `OSError` if inotify isn't available.
+    """
+
+    def __init__(self):
+        """Initialize inotify instance."""
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise OSError(errno.ENOSYS, "libc not found")
+
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not supported")
+
+        self._libc.inotify_add_watch.argtypes = [
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_uint32,
+        ]
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        self._wds: Dict[int, str] = {}
+        self._paths: Dict[str, int] = {}
+
+    def fileno(self) -> int:
+        """Return inotify file descriptor."""
+        return self.fd
+
+    def close(self) -> None:
+        """Close inotify file descriptor, watches are removed with it."""
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+        self._wds.clear()
+        self._paths.clear()
+
+    def add_watch(self, path: str, mask: int = IN_WATCH_MASK) -> None:
+        """Watch directory for changes.
+
+        Raises `OSError` if path cannot be watched, eg. doesn't exist.
+        """
+        if path in self._paths:
+            return
+
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+
+        self._wds[wd] = path
+        self._paths[path] = wd
+
+    def remove_watch(self, path: str) -> None:
+        """Stop watching directory."""
+        wd = self._paths.pop(path, None)
+        if wd is None:
+            return
+
+        self._wds.pop(wd, None)
+        # Watch might be gone already along with the directory.
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self) -> List[Tuple[str, str, int]]:
+        """Return pending events as list of (directory, name, mask).
+
+        Directory is empty string if event queue has overflown.
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+            if not data:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_len = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name_end = offset + name_len
+                name = os.fsdecode(data[offset:name_end].rstrip(b"\0"))
+                offset = name_end
+                if mask & IN_Q_OVERFLOW:
+                    events.append(("", "", mask))
+                    continue
+
+                path = self._wds.get(wd, None)
+                if path is None:
+                    continue
+
+                if mask & IN_IGNORED:
+                    # Directory has been removed.
+                    self._wds.pop(wd, None)
+                    self._paths.pop(path, None)
+
+                events.append((path, name, mask))
+
+        return events
+
+
+class LogTailer:
+    """Class follows many append-only log files like 'tail -F' does.
+
+    New data are read whenever poll() is called. Complete lines are passed
+    to callback of the file, incomplete line is kept until it's finished.
+    Files which don't exist yet are picked up once they're created and
+    files which are replaced or truncated are read from the start.
+
+    If Inotify is given, directories of followed files are watched and
+    poll() can be limited to directories which have changed.
+    """
+
+    def __init__(self, inotify: Optional[Inotify] = None):
+        """Initialize LogTailer."""
+        self.inotify = inotify
+        self._files: Dict[str, TailedFile] = {}
+        # Followed files by directory.
+        self._dirs: Dict[str, Set[str]] = {}
+        # Directories which couldn't be watched yet, eg. don't exist.
+        self._unwatched: Set[str] = set()
+
+    def __len__(self) -> int:
+        """Return number of followed files."""
+        return len(self._files)
+
+    def __contains__(self, path: str) -> bool:
+        """Return True if path is followed."""
+        return path in self._files
+
+    def add(
+        self,
+        path: str,
+        callback: Callable[[str], None],
+        from_end: bool = True,
+        offset: Optional[int] = None,
+    ) -> None:
+        """Start following file.
+
+        If from_end is True, data already in the file are skipped. If offset
+        is given, file is read from there unless it's shorter.
+        """
+        self.remove(path)
+        tailed = TailedFile(path, callback, from_end, offset=offset)
+        self._files[path] = tailed
+        dirpath = os.path.dirname(path)
+        self._dirs.setdefault(dirpath, set()).add(path)
+        self._watch(dirpath)
+        self._open(tailed)
+
+    def tell(self, path: str) -> Optional[Tuple[int, int]]:
+        """Return (inode, offset of the first unprocessed byte) or None.
+
+        None is returned if file isn't followed or isn't open yet.
+        """
+        tailed = self._files.get(path, None)
+        if tailed is None or tailed.fhandle is None:
+            return None
+
+        return tailed.inode, tailed.fhandle.tell() - len(tailed.buf)
+
+    def remove(self, path: str) -> None:
+        """Stop following file."""
+        tailed = self._files.pop(path, None)
+        if tailed is None:
+            return
+
+        if tailed.fhandle is not None:
+            tailed.fhandle.close()
+
+        dirpath = os.path.dirname(path)
+        paths = self._dirs.get(dirpath, set())
+        paths.discard(path)
+        if not paths:
+            self._dirs.pop(dirpath, None)
+            self._unwatched.discard(dirpath)
+            if self.inotify is not None:
+                self.inotify.remove_watch(dirpath)
+
+    def _watch(self, dirpath: str) -> None:
+        """Watch directory, if possible, or remember to try it later."""
+        if self.inotify is None:
+            return
+
+        try:
+            self.inotify.add_watch(dirpath)
+        except OSError:
+            self._unwatched.add(dirpath)
+        else:
+            self._unwatched.discard(dirpath)
+
+    def retry_watches(self) -> None:
+        """Try to watch directories which couldn't be watched before."""
+        for dirpath in list(self._unwatched):
+            self._watch(dirpath)
+
+    def close(self) -> None:
+        """Stop following all files."""
+        for path in list(self._files.keys()):
+            self.remove(path)
+
+    def poll(self, dirs: Optional[Set[str]] = None) -> int:
+        """Read new data and return number of lines read.
+
+        All files are read unless dirs is given, in which case only files in
+        these directories are read.
+        """
+        if dirs is None:
+            tailed_files = list(self._files.values())
+        else:
+            tailed_files = [
+                self._files[path]
+                for dirpath in dirs
+                for path in list(self._dirs.get(dirpath, ()))
+                if path in self._files
+            ]
+
+        count = 0
+        for tailed in tailed_files:
+            count += self._read(tailed)
+
+        return count
+
+    @staticmethod
+    def _open(tailed: TailedFile) -> bool:
+        """Open followed file, return False if it doesn't exist yet."""
+        try:
+            fhandle = open(tailed.path, "rb")
+        except FileNotFoundError:
+            return False
+
+        if tailed.offset is not None:
+            if tailed.offset <= os.fstat(fhandle.fileno()).st_size:
+                fhandle.seek(tailed.offset)
+
+            tailed.offset = None
+        elif tailed.from_end:
+            fhandle.seek(0, os.SEEK_END)
+
+        tailed.fhandle = fhandle
+        tailed.inode = os.fstat(fhandle.fileno()).st_ino
+        tailed.buf = b""
+        return True
+
+    def _read(self, tailed: TailedFile) -> int:
+        """Read new data from file and pass complete lines to callback."""
+        if tailed.fhandle is None:
+            # File created after add() is read from the start.
+            tailed.from_end = False
+            if not self._open(tailed):
+                return 0
+
+        data = tailed.fhandle.read()
+        if not data:
+            self._check_rotation(tailed)
+            return 0
+
+        tailed.buf += data
+        *lines, tailed.buf = tailed.buf.split(b"\n")
+        for line in lines:
+            try:
+                tailed.callback(line.decode("utf-8", errors="replace"))
+            except Exception:
+                logging.error(
+                    "Failed to process line from '%s': %s",
+                    tailed.path,
+                    traceback.format_exc(),
+                )
+
+        return len(lines)
+
+    @staticmethod
+    def _check_rotation(tailed: TailedFile) -> None:
+        """Re-open file which has been replaced or truncated."""
+        try:
+            fstat = os.stat(tailed.path)
+        except FileNotFoundError:
+            return
+
+        if fstat.st_ino != tailed.inode:
+            tailed.fhandle.close()
+            tailed.fhandle = None
+            return
+
+        if fstat.st_size < tailed.fhandle.tell():
+            tailed.fhandle.seek(0)
+            tailed.buf = b""
+
+
+class LinkWatchdog:
+    """Class measures lag of IRC link and tells when the link is dead.
+
+    Probe is an unknown command sent to the server. Time until the server
+    complains about it is the round-trip lag. Probe which isn't answered
+    in time means that the link is dead, even if ii hasn't noticed yet.
+    """
+
+    def __init__(
+        self,
+        interval: float = LAG_PROBE_INTERVAL,
+        warning: float = LAG_WARNING,
+        timeout: float = LAG_TIMEOUT,
+    ):
+        """Initialize LinkWatchdog."""
+        self.interval = interval
+        self.warning = warning
+        self.timeout = timeout
+        self.lag: Optional[float] = None
+        self.last_activity = 0.0
+        self._seq = itertools.count(1)
+        self._probe_token: Optional[str] = None
+        self._probe_sent = 0.0
+        self._next_probe = 0.0
+
+    def reset(self, now: Optional[float] = None) -> None:
+        """Forget lag and pending probe, eg. on reconnect."""
+        if now is None:
+            now = time.monotonic()
+
+        self.lag = None
+        self.last_activity = now
+        self._probe_token = None
+        self._next_probe = now + self.interval
+
+    def on_activity(self, message: str, now: Optional[float] = None) -> None:
+        """Record activity on the link and check for probe reply."""
+        if now is None:
+            now = time.monotonic()
+
+        self.last_activity = now
+        if self._probe_token is None or self._probe_token not in message:
+            return
+
+        self.lag = now - self._probe_sent
+        self._probe_token = None
+        if self.lag > self.warning:
+            logging.warning("Lag is %.1fs.", self.lag)
+            self._next_probe = now + self.warning
+        else:
+            self._next_probe = now + self.interval
+
+    def is_lagging(self, now: Optional[float] = None) -> bool:
+        """Return True if lag is above warning or link has been silent."""
+        if now is None:
+            now = time.monotonic()
+
+        if self.lag is not None and self.lag > self.warning:
+            return True
+
+        return self._probe_token is not None and (
+            now - self._probe_sent > self.warning
+        )
+
+    def is_dead(self, now: Optional[float] = None) -> bool:
+        """Return True if probe hasn't been answered in time."""
+        if now is None:
+            now = time.monotonic()
+
+        return self._probe_token is not None and (
+            now - self._probe_sent > self.timeout
+        )
+
+    def next_probe(self, now: Optional[float] = None) -> Optional[str]:
+        """Return probe command if it's time to send one, None otherwise.
+
+        Silent link is probed right away.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        if self._probe_token is not None:
+            return None
+
+        if now < self._next_probe and now - self.last_activity < self.interval:
+            return None
+
+        self._probe_token = "{:s}{:d}".format(LAG_PROBE_PREFIX, next(self._seq))
+        self._probe_sent = now
+        return "/{:s}\n".format(self._probe_token)
+
+
+class NetworkSession:
+    """Class runs and watches ii connected to one network.
+
+    ii is restarted when it exits or when the link is closed. Messages from
+    channels are turned into iicmd commands, system messages are passed to
+    in-process iifriends service.
+    """
+
+    def __init__(self, supervisor: "Supervisor", network: NetworkConfig):
+        """Initialize NetworkSession, ii isn't started yet."""
+        self.supervisor = supervisor
+        self.config = supervisor.config
+        self.name = network.name
+        self.channels = list(network.channels)
+        self.netdir = os.path.join(self.config.ircdir, self.name)
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.connected = False
+        self.welcomed = asyncio.Event()
+        self.identified = asyncio.Event()
+        self.friends = iifriends.FriendsService(
+            self.config.friends_file, self.config.nickname
+        )
+        self.restarts = 0
+        self.failures = 0
+        self.watchdog = LinkWatchdog()
+        LINK_LAG.set_function(lambda: self.watchdog.lag, network=self.name)
+        # Network's in FIFO is written from the event loop, therefore neither
+        # open nor write may wait. Messages are short, so write fails only if
+        # ii doesn't read at all.
+        self._net_writer = iifriends.FifoWriter(
+            os.path.join(self.netdir, "in"), open_timeout=0, write_timeout=0
+        )
+        self._reload_future: Optional[concurrent.futures.Future] = None
+        self._writers: Dict[str, iifriends.FifoWriter] = {}
+        self.queries: Dict[str, QueryState] = {}
+        self._queries_scanned: Optional[float] = None
+
+    def get_writer(self, channel: str) -> iifriends.FifoWriter:
+        """Return FifoWriter of channel's in FIFO."""
+        writer = self._writers.get(channel, None)
+        if writer is None:
+            writer = self._writers.setdefault(
+                channel,
+                iifriends.FifoWriter(
+                    os.path.join(self.netdir, channel, "in"),
+                    open_timeout=CHANNEL_PIPE_OPEN_TIMEOUT,
+                ),
+            )
+
+        return writer
+
+    def get_out_path(self, channel: str = "") -> str:
+        """Return path of network's or channel's out file."""
+        return os.path.join(self.netdir, channel, "out")
+
+    async def run(self) -> None:
+        """Run ii and restart it whenever it exits until stopped."""
+        while not self.supervisor.stopping:
+            started = time.monotonic()
+            try:
+                await self.start()
+                await self.process.wait()
+            except (OSError, TimeoutError):
+                logging.error(
+                    "Failed to start ii for '%s': %s",
+                    self.name,
+                    traceback.format_exc(),
+                )
+            finally:
+                self.detach()
+                await self.terminate()
+
+            if self.supervisor.stopping:
+                break
+
+            if time.monotonic() - started >= II_STABLE_TIME:
+                self.failures = 0
+
+            delay = get_backoff(self.failures)
+            self.failures += 1
+            self.restarts += 1
+            II_RESTARTS.inc(network=self.name)
+            logging.error(
+                "ii for '%s' has exited, restart in %.1fs.", self.name, delay
+            )
+            await self.supervisor.wait_stopped(delay)
+
+    async def start(self) -> None:
+        """Start ii, identify and join channels.
+
+        Every step waits for ii or the server to confirm the previous one,
+        not for a fixed time.
+        """
+        os.makedirs(self.netdir, exist_ok=True)
+        remove_file(os.path.join(self.netdir, "in"))
+        self.welcomed.clear()
+        self.identified.clear()
+        self.watchdog.reset()
+        # Start to follow network's out before ii starts in order not to
+        # miss the welcome.
+        self.supervisor.tailer.add(
+            self.get_out_path(), self.on_network_line, from_end=True
+        )
+        command = self.supervisor.ii_command + [
+            "-i",
+            self.config.ircdir,
+            "-n",
+            self.config.nickname,
+            "-s",
+            self.name,
+            "-f",
+            self.config.nickname,
+        ]
+        log_path = os.path.join(
+            self.config.ircdir, "{:s}.log".format(self.name)
+        )
+        with open(log_path, "ab") as log_file:
+            iicmd.PROCESSES_SPAWNED.inc(command="ii")
+            self.process = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=subprocess.DEVNULL,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+            )
+
+        await self.wait_for_fifo(os.path.join(self.netdir, "in"))
+        self.connected = True
+        if not await self.supervisor.wait_event(self.welcomed, WELCOME_TIMEOUT):
+            logging.error(
+                "No welcome from '%s' in %ss, join anyway.",
+                self.name,
+                WELCOME_TIMEOUT,
+            )
+
+        if self.identify():
+            await self.supervisor.wait_event(self.identified, IDENTIFY_TIMEOUT)
+            self.supervisor.tailer.remove(self.get_out_path("nickserv"))
+            # Clean that up - ident password is in there.
+            remove_file(self.get_out_path("nickserv"))
+
+        self.join()
+
+    async def wait_for_fifo(self, path: str) -> None:
+        """Wait until ii creates FIFO.
+
+        Raises `TimeoutError` if FIFO isn't created in time and `OSError` if
+        ii exits meanwhile.
+        """
+        deadline = time.monotonic() + II_START_TIMEOUT
+        while not is_fifo(path):
+            if self.process.returncode is not None:
+                raise OSError(
+                    "ii has exited with {:d}".format(self.process.returncode)
+                )
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.supervisor.stopping:
+                raise TimeoutError("FIFO {!r} doesn't exist".format(path))
+
+            await self.supervisor.wait_fs_event(min(remaining, TAIL_INTERVAL))
+
+    def identify(self) -> bool:
+        """Identify to NickServ if there is ident file.
+
+        Returns True if identify has been sent.
+        """
+        ident_path = os.path.join(self.netdir, "ident")
+        if not os.path.exists(ident_path):
+            return False
+
+        with open(ident_path, "r", encoding="utf-8") as fhandle:
+            password = fhandle.read().strip()
+
+        # NickServ replies end up in its query.
+        self.supervisor.tailer.add(
+            self.get_out_path("nickserv"), self.on_nickserv_line, from_end=True
+        )
+        return self.send("/j nickserv identify {:s}\n".format(password))
+
+    def join(self) -> None:
+        """Join configured channels and start following them.
+
+        Channels are joined by as few raw JOIN commands as possible. ii's
+        '/j' command would create a directory named after the whole list.
+        """
+        for channel in self.channels:
+            chandir = os.path.join(self.netdir, channel)
+            os.makedirs(chandir, exist_ok=True)
+            remove_file(os.path.join(chandir, "in"))
+            out_path = self.get_out_path(channel)
+            if not os.path.exists(out_path):
+                with open(out_path, "a", encoding="utf-8"):
+                    pass
+
+            self.supervisor.tailer.add(
+                out_path,
+                lambda line, channel=channel: self.on_channel_line(
+                    channel, line
+                ),
+                from_end=True,
+            )
+
+        for channels in pack_channels(self.channels, JOIN_MAX_BYTES):
+            self.send("/JOIN {:s}\n".format(channels))
+
+    def detach(self) -> None:
+        """Stop following out files and close FIFOs of this network."""
+        self.connected = False
+        self.supervisor.tailer.remove(self.get_out_path())
+        self.supervisor.tailer.remove(self.get_out_path("nickserv"))
+        for channel in self.channels:
+            self.supervisor.tailer.remove(self.get_out_path(channel))
+
+        for query in list(self.queries.keys()):
+            self.evict_query(query)
+
+        self._net_writer.close()
+        for writer in self._writers.values():
+            writer.close()
+
+    async def terminate(self) -> None:
+        """Terminate ii, if running, and wait for it."""
+        process = self.process
+        if process is None or process.returncode is not None:
+            return
+
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), II_STOP_TIMEOUT)
+        except TimeoutError:
+            process.kill()
+            await process.wait()
+
+    def send(self, message: str) -> bool:
+        """Write message into network's in FIFO, return False on failure."""
+        try:
+            self._net_writer.open()
+            self._net_writer.write(message)
+        except (TimeoutError, OSError, ValueError):
+            logging.error(
+                "Failed to write into '%s': %s",
+                self._net_writer.path,
+                traceback.format_exc(),
+            )
+            self._net_writer.close()
+            return False
+
+        return True
+
+    def on_network_line(self, line: str) -> None:
+        """Process line from network's out."""
+        # NOTE: ii logs QUIT, NICK and numeric replies, eg. NAMES, into
+        # network's out, not channel's.
+        _, _, message = line.partition(" ")
+        self.watchdog.on_activity(message)
+        if RE_LINK_CLOSED.search(message) or (
+            "ping timeout" in message.lower()
+            and self.config.nickname in message
+        ):
+            logging.error("Link to '%s' has been closed.", self.name)
+            self.kill_link()
+            return
+
+        if not self.welcomed.is_set() and RE_WELCOME.search(message):
+            self.welcomed.set()
+
+        if RE_IDENTIFIED.search(message):
+            self.identified.set()
+
+        self.friends.handle_message(message)
+
+    def on_nickserv_line(self, line: str) -> None:
+        """Process line from NickServ's query."""
+        if RE_IDENTIFIED.search(line):
+            self.identified.set()
+
+    def on_channel_line(self, channel: str, line: str) -> None:
+        """Process line from channel's out."""
+        self.watchdog.on_activity("")
+        chunks = line.split(" ", 2)
+        if len(chunks) != 3:
+            return
+
+        nixtime, nick, message = chunks
+        if nixtime.isdigit():
+            INGEST_LAG.observe(
+                max(time.time() - int(nixtime), 0), network=self.name
+            )
+
+        if nick == "-!-":
+            self.friends.handle_message(message, channel=channel)
+            return
+
+        nick = nick.removeprefix("<").removesuffix(">")
+        if nick == self.config.nickname:
+            return
+
+        # NOTE: if we have two bots in the same channel, iicmd must be
+        # disabled or they must share leases. Why? How about endless loop of
+        # URL titles? That's why.
+        if not self.config.iicmd_enabled:
+            return
+
+        shard = self.supervisor.shard
+        scope = iishard.get_scope(self.name, channel)
+        if shard is not None and shard.is_member(scope, nick):
+            return
+
+        if RE_URL.search(message):
+            message = "url {:s}".format(message.removeprefix("!"))
+        elif message.startswith("!"):
+            message = message[1:]
+        else:
+            return
+
+        if shard is not None:
+            key = iishard.get_event_key(nick, message)
+            if not shard.is_mine(scope, key):
+                SHARD_EVENTS.inc(network=self.name, owner="other")
+                return
+
+            SHARD_EVENTS.inc(network=self.name, owner="self")
+
+        self.queue_command(channel, nick, message)
+
+    def on_query_line(self, query: str, line: str) -> None:
+        """Process line from query's out.
+
+        Unlike in channels, command doesn't need '!' prefix.
+        """
+        state = self.queries.get(query, None)
+        if state is not None:
+            state.last_active = max(state.last_active, time.monotonic())
+
+        chunks = line.split(" ", 2)
+        if len(chunks) != 3 or chunks[1] == "-!-":
+            return
+
+        _, nick, message = chunks
+        nick = nick.removeprefix("<").removesuffix(">")
+        if nick == self.config.nickname or not self.config.iicmd_enabled:
+            return
+
+        if RE_URL.search(message):
+            message = "url {:s}".format(message.removeprefix("!"))
+        else:
+            message = message.removeprefix("!")
+            if message.split(" ")[0] not in iicmd.COMMANDS:
+                return
+
+        self.queue_command(query, nick, message)
+
+    def queue_command(self, channel: str, nick: str, message: str) -> None:
+        """Submit command to workers, unless too many are waiting."""
+        if self.supervisor.pending >= WORKER_QUEUE_MAX:
+            logging.error("Too many pending commands, drop %r.", message)
+            DROPPED_EVENTS.inc(network=self.name, reason="queue_full")
+            return
+
+        self.supervisor.submit(self.run_command, channel, nick, message)
+
+    def scan_queries(self, now: float) -> None:
+        """Follow queries whose out has grown and evict idle ones.
+
+        Queries found by the first scan are followed from their end, those
+        which appear later from the start.
+        """
+        first_scan = self._queries_scanned is None
+        self._queries_scanned = now
+        try:
+            names = sorted(os.listdir(self.netdir))
+        except FileNotFoundError:
+            return
+
+        for name in names:
+            if (
+                name.startswith(iilog.CHANNEL_PREFIXES)
+                or name.lower() in QUERY_IGNORED
+                or name == self.config.nickname
+            ):
+                continue
+
+            try:
+                fstat = os.stat(self.get_out_path(name))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+
+            state = self.queries.get(name, None)
+            if state is None:
+                offset = fstat.st_size if first_scan else 0
+                state = self.queries[name] = QueryState(fstat.st_ino, offset)
+
+            if state.active:
+                continue
+
+            if fstat.st_ino != state.inode or fstat.st_size < state.offset:
+                state.inode, state.offset = fstat.st_ino, 0
+
+            if fstat.st_size > state.offset:
+                self.follow_query(name, now)
+
+        active = sorted(
+            (state.last_active, query)
+            for query, state in self.queries.items()
+            if state.active
+        )
+        for i, (last_active, query) in enumerate(active):
+            if (
+                now - last_active >= QUERY_IDLE_TIMEOUT
+                or len(active) - i > QUERY_MAX_ACTIVE
+            ):
+                self.evict_query(query)
+
+    def follow_query(self, query: str, now: float) -> None:
+        """Start following query's out from where it's been left."""
+        state = self.queries[query]
+        state.active = True
+        state.last_active = now
+        ACTIVE_QUERIES.inc(network=self.name)
+        self.supervisor.tailer.add(
+            self.get_out_path(query),
+            lambda line, query=query: self.on_query_line(query, line),
+            from_end=False,
+            offset=state.offset,
+        )
+        # Its directory wasn't watched until now.
+        self.supervisor.tailer.poll({os.path.dirname(self.get_out_path(query))})
+
+    def evict_query(self, query: str) -> None:
+        """Stop following query, but remember where it's been left."""
+        state = self.queries.get(query, None)
+        if state is None or not state.active:
+            return
+
+        path = self.get_out_path(query)
+        position = self.supervisor.tailer.tell(path)
+        if position is not None:
+            state.inode, state.offset = position
+
+        state.active = False
+        ACTIVE_QUERIES.dec(network=self.name)
+        self.supervisor.tailer.remove(path)
+        writer = self._writers.pop(query, None)
+        if writer is not None:
+            writer.close()
+
+    def run_command(self, channel: str, nick: str, message: str) -> None:
+        """Process command by iicmd and write reply into channel's in FIFO.
+
+        Called from worker thread.
+        """
+        lines = iicmd.process_message(
+            nick,
+            message,
+            self.config.ircdir,
+            self.name,
+            channel,
+            self.config.nickname,
+        )
+        if not lines:
+            return
+
+        writer = self.get_writer(channel)
+        try:
+            writer.open()
+            for line in lines:
+                writer.write("{:s}\n".format(line))
+        except (TimeoutError, OSError, ValueError):
+            logging.error(
+                "Failed to write reply into '%s': %s",
+                writer.path,
+                traceback.format_exc(),
+            )
+            writer.close()
+
+    def kill_link(self) -> None:
+        """Terminate ii, it's restarted by run()."""
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+
+    def tick(self, now: float) -> None:
+        """Run periodic tasks.
+
+        Friends file is reloaded in a worker if needed, modes which are due
+        are written and the link is probed for lag.
+        """
+        if self.friends.is_reload_due(now) and (
+            self._reload_future is None or self._reload_future.done()
+        ):
+            self._reload_future = self.supervisor.submit(
+                self.friends.maybe_reload
+            )
+
+        if not self.connected:
+            return
+
+        if (
+            self._queries_scanned is None
+            or now - self._queries_scanned >= QUERY_SCAN_INTERVAL
+        ):
+            self.scan_queries(now)
+
+        self.friends.write_modes(self._net_writer, now)
+        if not self.welcomed.is_set():
+            return
+
+        if self.watchdog.is_dead(now):
+            logging.error(
+                "Link to '%s' hasn't answered in %ss, restart ii.",
+                self.name,
+                self.watchdog.timeout,
+            )
+            self.kill_link()
+            return
+
+        probe = self.watchdog.next_probe(now)
+        if probe is not None:
+            self.send(probe)
+
+
+class Supervisor:
+    """Class runs NetworkSession for every configured network."""
+
+    def __init__(
+        self,
+        config: Config,
+        ii_command: Optional[List[str]] = None,
+        workers: int = WORKERS,
+    ):
+        """Initialize Supervisor."""
+        self.config = config
+        self.ii_command = list(ii_command or [DEFAULT_II_COMMAND])
+        try:
+            self.inotify = Inotify()
+        except OSError as exception:
+            logging.error("inotify isn't available, will poll: %s", exception)
+            self.inotify = None
+
+        self.tailer = LogTailer(self.inotify)
+        self._friends_dir = os.path.dirname(
+            os.path.abspath(config.friends_file)
+        )
+        if self.inotify is not None:
+            # Friends file is reloaded as soon as it changes, stat() of it
+            # every FRIENDS_RELOAD_INTERVAL is only a fallback.
+            try:
+                self.inotify.add_watch(self._friends_dir)
+            except OSError as exception:
+                logging.warning(
+                    "Failed to watch friends file, will poll: %s", exception
+                )
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="iicmd"
+        )
+        self.limiter = iigovernor.ConcurrencyLimiter(workers)
+        self.governor: Optional[iigovernor.MemoryGovernor] = None
+        if config.memory_budget > 0:
+            self.governor = iigovernor.MemoryGovernor(
+                config.memory_budget,
+                [iicmd.URL_TITLE_CACHE, iicmd.URL_SHORT_CACHE, iicmd.DNS_CACHE],
+                self.limiter,
+            )
+
+        self._memory_checked = 0.0
+        self.sessions = [
+            NetworkSession(self, network) for network in config.networks
+        ]
+        self.stopping = False
+        # Number of submitted functions which haven't finished yet.
+        self.pending = 0
+        self._pending_lock = threading.Lock()
+        self._metrics_written = 0.0
+        self._seen_updated = 0.0
+        self._seen_future: Optional[concurrent.futures.Future] = None
+        self._archive_updated = 0.0
+        self.shard: Optional[iishard.Shard] = None
+        if config.shard_db and config.iicmd_enabled:
+            self.shard = iishard.Shard(
+                config.shard_db,
+                config.nickname,
+                [
+                    iishard.get_scope(network.name, channel)
+                    for network in config.networks
+                    for channel in network.channels
+                ],
+            )
+
+        self._shard_updated = 0.0
+        # Leases are renewed by a thread of their own, so busy workers don't
+        # let them expire.
+        self._shard_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="iishard"
+        )
+        self._shard_future: Optional[concurrent.futures.Future] = None
+        self._stop_event: Optional[asyncio.Event] = None
+        # Replaced by a new one every time it's set, so it can be awaited
+        # by many.
+        self._fs_event: Optional[asyncio.Event] = None
+
+    def stop(self) -> None:
+        """Request stop of all sessions."""
+        self.stopping = True
+        if self._stop_event is not None:
+            self._stop_event.set()
+
+    async def wait_stopped(self, timeout: float) -> bool:
+        """Sleep up to timeout seconds, return True if stop is requested."""
+        try:
+            await asyncio.wait_for(self._stop_event.wait(), timeout)
+        except TimeoutError:
+            pass
+
+        return self.stopping
+
+    async def wait_event(self, event: asyncio.Event, timeout: float) -> bool:
+        """Wait up to timeout seconds for event, return True if it's set."""
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except TimeoutError:
+            pass
+
+        return event.is_set()
+
+    async def wait_fs_event(self, timeout: float) -> None:
+        """Wait up to timeout seconds for change in watched directories."""
+        await self.wait_event(self._fs_event, timeout)
+
+    def on_inotify(self) -> None:
+        """Read inotify events and new lines of changed files."""
+        events = self.inotify.read()
+        if not events:
+            return
+
+        dirs = set(dirpath for dirpath, _, _ in events)
+        friends_name = os.path.basename(self.config.friends_file)
+        if "" in dirs or (self._friends_dir, friends_name) in set(
+            (dirpath, name) for dirpath, name, _ in events
+        ):
+            for session in self.sessions:
+                session.friends.reload_requested.set()
+
+        created = set(
+            dirpath
+            for dirpath, _, mask in events
+            if mask & (IN_CREATE | IN_MOVED_TO)
+        )
+        now = time.monotonic()
+        for session in self.sessions:
+            if session.connected and ("" in dirs or session.netdir in created):
+                # New query might have been created.
+                session.scan_queries(now)
+
+        if "" in dirs:
+            # Queue has overflown, anything might have changed.
+            self.tailer.poll()
+        else:
+            self.tailer.poll(dirs)
+
+        self.tailer.retry_watches()
+        fs_event = self._fs_event
+        self._fs_event = asyncio.Event()
+        fs_event.set()
+
+    def submit(self, func: Callable, *args) -> concurrent.futures.Future:
+        """Run function in worker pool."""
+        with self._pending_lock:
+            self.pending += 1
+
+        QUEUE_DEPTH.inc()
+        future = self.executor.submit(self._run_limited, func, *args)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _run_limited(self, func: Callable, *args):
+        """Run function once limiter lets worker in and return its result."""
+        with self.limiter:
+            return func(*args)
+
+    def _on_done(self, future: concurrent.futures.Future) -> None:
+        """Account for finished function and log its failure, if any."""
+        with self._pending_lock:
+            self.pending -= 1
+
+        QUEUE_DEPTH.dec()
+        log_failure(future)
+
+    def write_metrics(self, now: float, force: bool = False) -> None:
+        """Write metrics file if configured and it's time to."""
+        if not self.config.metrics_file:
+            return
+
+        if not force and now - self._metrics_written < METRICS_INTERVAL:
+            return
+
+        self._metrics_written = now
+        try:
+            iimetrics.REGISTRY.write(self.config.metrics_file)
+        except OSError:
+            logging.error(
+                "Failed to write metrics into '%s': %s",
+                self.config.metrics_file,
+                traceback.format_exc(),
+            )
+
+    def update_seen(self, now: float) -> None:
+        """Index new lines of out files in a worker, if it's time to.
+
+        !seen catches up on its own, regular updates keep it quick.
+        """
+        if now - self._seen_updated < SEEN_UPDATE_INTERVAL:
+            return
+
+        if self._seen_future is not None and not self._seen_future.done():
+            return
+
+        self._seen_updated = now
+        self._seen_future = self.submit(self._update_seen)
+
+    def _update_seen(self) -> None:
+        """Index new lines of out files of all networks.
+
+        Called from worker thread.
+        """
+        for index_class, db_name in (
+            (iilog.SeenIndex, iilog.SEEN_DB_NAME),
+            (iilog.SearchIndex, iilog.SEARCH_DB_NAME),
+        ):
+            db_path = os.path.join(self.config.ircdir, db_name)
+            try:
+                with index_class(db_path) as index:
+                    index.update(self.config.ircdir)
+            except (OSError, sqlite3.Error):
+                logging.error(
+                    "Failed to update '%s': %s",
+                    db_path,
+                    traceback.format_exc(),
+                )
+
+    def update_archive(self, now: float) -> None:
+        """Rotate and archive logs in a worker, if it's time to.
+
+        Archiving shares future with index updates, so they never run at once.
+        """
+        if not self.config.archive_max_size:
+            return
+
+        if now - self._archive_updated < ARCHIVE_INTERVAL:
+            return
+
+        if self._seen_future is not None and not self._seen_future.done():
+            return
+
+        self._archive_updated = now
+        self._seen_future = self.submit(self._update_archive)
+
+    def _update_archive(self) -> None:
+        """Catch up indexes, rotate logs and prune indexes.
+
+        Out renamed by the previous call is archived, therefore its lines had
+        time to be indexed. Called from worker thread.
+        """
+        self._update_seen()
+        count = iiarchive.rotate_all(
+            self.config.ircdir,
+            time.time(),
+            self.config.archive_max_size,
+        )
+        if not count:
+            return
+
+        for index_class, db_name in (
+            (iilog.SeenIndex, iilog.SEEN_DB_NAME),
+            (iilog.SearchIndex, iilog.SEARCH_DB_NAME),
+        ):
+            db_path = os.path.join(self.config.ircdir, db_name)
+            try:
+                with index_class(db_path) as index:
+                    index.prune()
+            except (OSError, sqlite3.Error):
+                logging.error(
+                    "Failed to prune '%s': %s",
+                    db_path,
+                    traceback.format_exc(),
+                )
+
+    def update_memory(self, now: float) -> None:
+        """Adapt limits to memory usage and recycle bloated ii, if it's time.
+
+        ii is restarted by run() after it's terminated.
+        """
+        if self.governor is None:
+            return
+
+        if now - self._memory_checked < iigovernor.MEMORY_CHECK_INTERVAL:
+            return
+
+        self._memory_checked = now
+        pids = {
+            session.name: session.process.pid
+            for session in self.sessions
+            if session.process is not None
+            and session.process.returncode is None
+        }
+        for name in self.governor.check(pids, now):
+            for session in self.sessions:
+                if session.name == name:
+                    session.kill_link()
+
+    def update_shard(self, now: float) -> None:
+        """Renew leases and refresh view of other bots, if it's time to."""
+        if self.shard is None:
+            return
+
+        if now - self._shard_updated < iishard.HEARTBEAT_INTERVAL:
+            return
+
+        if self._shard_future is not None and not self._shard_future.done():
+            return
+
+        self._shard_updated = now
+        self._shard_future = self._shard_executor.submit(self.shard.heartbeat)
+        self._shard_future.add_done_callback(log_failure)
+
+    async def run(self) -> None:
+        """Run until stop is requested."""
+        self._stop_event = asyncio.Event()
+        self._fs_event = asyncio.Event()
+        if self.stopping:
+            self._stop_event.set()
+
+        loop = asyncio.get_running_loop()
+        if self.inotify is not None:
+            loop.add_reader(self.inotify.fileno(), self.on_inotify)
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self.stop)
+            except (RuntimeError, ValueError):
+                # Not in the main thread.
+                pass
+
+        tasks = [
+            asyncio.create_task(session.run()) for session in self.sessions
+        ]
+        tail_task = asyncio.create_task(self.follow())
+        try:
+            await self._stop_event.wait()
+            await asyncio.gather(
+                *(session.terminate() for session in self.sessions)
+            )
+            await asyncio.gather(*tasks)
+        finally:
+            self.stop()
+            tail_task.cancel()
+            await asyncio.gather(tail_task, return_exceptions=True)
+            self.tailer.close()
+            if self.inotify is not None:
+                loop.remove_reader(self.inotify.fileno())
+                self.inotify.close()
+
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self._shard_executor.shutdown(wait=True, cancel_futures=True)
+            if self.shard is not None:
+                self.shard.release()
+
+            self.write_metrics(time.monotonic(), force=True)
+
+    async def follow(self) -> None:
+        """Poll followed files and run periodic tasks.
+
+        With inotify, files are read as soon as they change and polling is
+        only a fallback.
+        """
+        interval = TAIL_INTERVAL
+        if self.inotify is not None:
+            interval = INOTIFY_FALLBACK_INTERVAL
+
+        while not self.stopping:
+            self.tailer.poll()
+            self.tailer.retry_watches()
+            now = time.monotonic()
+            timeout = interval
+            for session in self.sessions:
+                session.tick(now)
+                next_timeout = session.friends.scheduler.next_timeout(now)
+                if next_timeout is not None:
+                    timeout = min(timeout, next_timeout)
+
+            self.write_metrics(now)
+            self.update_seen(now)
+            self.update_archive(now)
+            self.update_memory(now)
+            self.update_shard(now)
+            await asyncio.sleep(max(timeout, 0.01))
+
+
+def get_backoff(failures: int) -> float:
+    """Return jittered delay before restart after given number of failures.
+
+    Delay doubles with every failure up to II_RESTART_DELAY_MAX, half of it
+    is random so restarts of many networks don't happen in lockstep.
+    """
+    delay = min(II_RESTART_DELAY * 2 ** min(failures, 32), II_RESTART_DELAY_MAX)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def is_fifo(path: str) -> bool:
+    """Return True if path is an existing FIFO."""
+    try:
+        return stat.S_ISFIFO(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+def pack_channels(channels: List[str], max_bytes: int) -> List[str]:
+    """Return channels joined by comma into as few lists as possible.
+
+    No list is longer than max_bytes, unless a channel on its own is.
+    """
+    packed = []
+    current = ""
+    for channel in channels:
+        candidate = "{:s},{:s}".format(current, channel) if current else channel
+        if current and len(candidate.encode("utf-8")) > max_bytes:
+            packed.append(current)
+            candidate = channel
+
+        current = candidate
+
+    if current:
+        packed.append(current)
+
+    return packed
+
+
+def log_failure(future: concurrent.futures.Future) -> None:
+    """Log exception raised by worker, if any."""
+    if future.cancelled():
+        return
+
+    exception = future.exception()
+    if exception is not None:
+        logging.error(
+            "Worker has failed: %s",
+            "".join(
+                traceback.format_exception(
+                    type(exception), exception, exception.__traceback__
+                )
+            ),
+        )
+
+
+def remove_file(path: str) -> None:
+    """Remove file, if it exists."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def parse_config(fname: str) -> Config:
+    """Parse configuration file and return Config.
+
+    Raises `ValueError` if there is no network in configuration.
+    """
+    config = Config()
+    networks: Dict[str, NetworkConfig] = {}
+    with open(fname, "r", encoding="utf-8") as fhandle:
+        for line in fhandle:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            key, _, value = line.partition(":")
+            value = value.strip()
+            if key == "net":
+                name, _, channels = value.partition(":")
+                if not name:
+                    continue
+
+                network = networks.setdefault(name, NetworkConfig(name))
+                for channel in channels.split():
+                    if channel not in network.channels:
+                        network.channels.append(channel)
+            elif key == "ircdir" and value:
+                config.ircdir = value
+            elif key == "nickname" and value:
+                config.nickname = value
+            elif key == "iicmd_enabled":
+                config.iicmd_enabled = value != "false"
+            elif key == "friends_file" and value:
+                config.friends_file = value
+            elif key == "metrics_file":
+                config.metrics_file = value
+            elif key == "profile_dir":
+                config.profile_dir = value
+            elif key == "profile_rate" and value:
+                config.profile_rate = float(value)
+            elif key == "bitly_api_token":
+                config.bitly_api_token = value
+            elif key == "bitly_group_id":
+                config.bitly_group_id = value
+            elif key == "shard_db":
+                config.shard_db = value
+            elif key == "archive_max_size" and value:
+                config.archive_max_size = int(value)
+            elif key == "memory_budget" and value:
+                config.memory_budget = int(value)
+
+    if not networks:
+        raise ValueError("No network configuration in {!r}".format(fname))
+
+    config.ircdir = os.path.expanduser(os.path.expandvars(config.ircdir))
+    if config.metrics_file:
+        config.metrics_file = os.path.expanduser(
+            os.path.expandvars(config.metrics_file)
+        )
+
+    if config.profile_dir:
+        config.profile_dir = os.path.expanduser(
+            os.path.expandvars(config.profile_dir)
+        )
+
+    if config.shard_db:
+        config.shard_db = os.path.expanduser(
+            os.path.expandvars(config.shard_db)
+        )
+
+    config.networks = list(networks.values())
+    return config
+
+
+def main():
+    """Run iibot supervisor."""
+    args = parse_args()
+    logging.basicConfig(
+        level=args.log_level,
+        stream=sys.stderr,
+        encoding="utf-8",
+    )
+    try:
+        config = parse_config(args.config)
+    except (OSError, ValueError) as exception:
+        logging.error("Failed to read config '%s': %s", args.config, exception)
+        sys.exit(2)
+
+    if config.bitly_api_token and config.bitly_group_id:
+        os.environ["IICMD_BITLY_API_TOKEN"] = config.bitly_api_token
+        os.environ["IICMD_BITLY_GROUP_ID"] = config.bitly_group_id
+
+    if config.profile_dir:
+        iiprofile.configure(config.profile_dir, config.profile_rate)
+
+    # Caches are shared by all networks and channels.
+    iicmd.URL_TITLE_CACHE.resize(URL_CACHE_SIZE)
+    iicmd.URL_SHORT_CACHE.resize(URL_CACHE_SIZE)
+
+    lock_dir = os.path.join(
+        "/tmp", "{:s}.lock".format(os.path.basename(args.config))
+    )
+    try:
+        os.mkdir(lock_dir)
+    except OSError:
+        logging.error("Failed to create lock for '%s'.", args.config)
+        sys.exit(1)
+
+    try:
+        # Some privacy please, thanks.
+        os.makedirs(config.ircdir, exist_ok=True)
+        os.chmod(config.ircdir, 0o700)
+        supervisor = Supervisor(
+            config, ii_command=shlex.split(args.ii), workers=args.workers
+        )
+        asyncio.run(supervisor.run())
+    finally:
+        os.rmdir(lock_dir)
+
+
+def parse_args() -> argparse.Namespace:
+    """Return parsed CLI args."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "config",
+        type=str,
+        help="IRC config to use.",
+    )
+    parser.add_argument(
+        "--ii",
+        type=str,
+        default=DEFAULT_II_COMMAND,
+        help="Command to run ii.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="Number of worker threads which process commands.",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        default=False,
+        help="Set log level to DEBUG.",
+    )
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error("Argument 'workers' must be greater than 0")
+
+    args.log_level = logging.DEBUG if args.verbose is True else logging.ERROR
+    return args
+
+
+if __name__ == "__main__":
+    main()
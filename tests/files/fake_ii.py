@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Fake ii which creates ii directory tree and echoes what it's told.
+
+Supports just enough of ii for tests - network and channel in FIFOs, joins
+and out files. Everything written into FIFOs is also logged into 'sent'
+file in network's directory as it would've been sent to the server.
+"""
+import argparse
+import os
+import select
+import signal
+import sys
+import time
+
+
+def append(fname, line):
+    """Append line into file."""
+    with open(fname, "a", encoding="utf-8") as fhandle:
+        fhandle.write(line + "\n")
+
+
+def make_fifo(path):
+    """Create FIFO and return its descriptor."""
+    if os.path.exists(path):
+        os.unlink(path)
+
+    os.mkfifo(path)
+    return os.open(path, os.O_RDWR | os.O_NONBLOCK)
+
+
+def main():
+    """Run fake ii."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", dest="ircdir", required=True)
+    parser.add_argument("-n", dest="nick", required=True)
+    parser.add_argument("-s", dest="server", required=True)
+    parser.add_argument("-f", dest="fullname", default="")
+    args = parser.parse_args()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    netdir = os.path.join(args.ircdir, args.server)
+    os.makedirs(netdir, exist_ok=True)
+    net_out = os.path.join(netdir, "out")
+    sent = os.path.join(netdir, "sent")
+    fds = {make_fifo(os.path.join(netdir, "in")): ""}
+    append(
+        net_out,
+        "{:d} -!- fake.server 001 {:s} :Welcome to the fake IRC network".format(
+            int(time.time()), args.nick
+        ),
+    )
+    buffers = {}
+    while True:
+        readable, _, _ = select.select(list(fds.keys()), [], [], 1)
+        for fd in readable:
+            data = buffers.get(fd, b"") + os.read(fd, 65536)
+            *lines, buffers[fd] = data.split(b"\n")
+            channel = fds[fd]
+            for raw_line in lines:
+                line = raw_line.decode("utf-8", errors="replace")
+                now = int(time.time())
+                if channel:
+                    append(sent, "PRIVMSG {:s} :{:s}".format(channel, line))
+                    append(
+                        os.path.join(netdir, channel, "out"),
+                        "{:d} <{:s}> {:s}".format(now, args.nick, line),
+                    )
+                    continue
+
+                append(sent, line)
+                command = line.split(" ")[0]
+                if command.startswith("/IILAG"):
+                    # ERR_UNKNOWNCOMMAND
+                    append(
+                        net_out,
+                        "{:d} -!- {:s} {:s} :Unknown command".format(
+                            now, args.nick, command[1:]
+                        ),
+                    )
+                elif command in ("/j", "/JOIN"):
+                    channels = line.split(" ")[1]
+                    for chan in channels.split(","):
+                        if not chan.startswith("#"):
+                            continue
+
+                        chandir = os.path.join(netdir, chan)
+                        os.makedirs(chandir, exist_ok=True)
+                        fds[make_fifo(os.path.join(chandir, "in"))] = chan
+                        append(
+                            os.path.join(chandir, "out"),
+                            "{:d} -!- {:s}(~{:s}@localhost) has joined "
+                            "{:s}".format(now, args.nick, args.nick, chan),
+                        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""Unit tests for iiarchive.py."""
+import argparse
+import gzip
+import os
+import sys
+from unittest.mock import patch
+
+import pytest
+
+import iiarchive  # noqa:I202
+
+DAY1 = 1704067200  # 2024-01-01 00:00:00 UTC
+DAY2 = DAY1 + 86400
+
+
+def _write_out(dirpath, nixtimes):
+    """Write out file with one line per nixtime and return its path."""
+    os.makedirs(dirpath, exist_ok=True)
+    out_path = os.path.join(dirpath, "out")
+    with open(out_path, "w", encoding="utf-8") as fhandle:
+        for nixtime in nixtimes:
+            fhandle.write("{:d} <joe> line {:d}\n".format(nixtime, nixtime))
+
+    return out_path
+
+
+def _expire(path):
+    """Make file look like it hasn't been written for a long time."""
+    os.utime(path, (DAY1, DAY1))
+
+
+def test_should_rotate(tmp_path):
+    """Test that out is rotated when too big or it has lines of older day."""
+    out_path = str(tmp_path / "out")
+    assert iiarchive.should_rotate(out_path, DAY1, 1024) is False
+
+    _write_out(str(tmp_path), [DAY1 + 10])
+    assert iiarchive.should_rotate(out_path, DAY1 + 20, 1024) is False
+    assert iiarchive.should_rotate(out_path, DAY2, 1024) is True
+    assert iiarchive.should_rotate(out_path, DAY1 + 20, 10) is True
+
+    _write_out(str(tmp_path), [])
+    assert iiarchive.should_rotate(out_path, DAY2, 0) is False
+
+
+def test_rotate(tmp_path):
+    """Test that out is renamed first and archived after grace period."""
+    dirpath = str(tmp_path / "irc.example.com" / "#chan")
+    nixtimes = [DAY1 + i for i in range(5)] + [DAY2 + i for i in range(3)]
+    out_path = _write_out(dirpath, nixtimes)
+    rotating = out_path + iiarchive.ROTATING_SUFFIX
+
+    with patch.object(iiarchive, "ARCHIVE_BLOCK_LINES", 2):
+        assert iiarchive.rotate(dirpath, DAY2 + 10, 1024 * 1024) == 0
+        assert not os.path.exists(out_path)
+        assert os.path.exists(rotating)
+
+        # ii logs the next line.
+        _write_out(dirpath, [DAY2 + 20])
+        # Within grace period.
+        assert iiarchive.rotate(dirpath, None, 1024 * 1024, 60) == 0
+        assert os.path.exists(rotating)
+
+        _expire(rotating)
+        assert iiarchive.rotate(dirpath, DAY2 + 30, 1024 * 1024) == 8
+
+    assert not os.path.exists(rotating)
+    assert os.path.exists(out_path)
+    archive_dir = os.path.join(dirpath, iiarchive.ARCHIVE_DIR_NAME)
+    assert sorted(os.listdir(archive_dir)) == [
+        "2024-01-01.gz",
+        "2024-01-02.gz",
+        iiarchive.INDEX_NAME,
+    ]
+    entries = iiarchive.read_index(archive_dir)
+    assert [(entry.nixtime, entry.segment) for entry in entries] == [
+        (DAY1, "2024-01-01.gz"),
+        (DAY1 + 2, "2024-01-01.gz"),
+        (DAY1 + 4, "2024-01-01.gz"),
+        (DAY2, "2024-01-02.gz"),
+        (DAY2 + 2, "2024-01-02.gz"),
+    ]
+    # Segment is a valid gzip file of all its members.
+    with gzip.open(os.path.join(archive_dir, "2024-01-02.gz"), "rb") as gzfile:
+        assert gzfile.read() == b"".join(
+            "{:d} <joe> line {:d}\n".format(nixtime, nixtime).encode("utf-8")
+            for nixtime in nixtimes[5:]
+        )
+
+    lines = list(iiarchive.read_range(dirpath, DAY1, DAY2 + 100))
+    assert len(lines) == 9
+    assert lines[-1] == "{:d} <joe> line {:d}\n".format(
+        DAY2 + 20, DAY2 + 20
+    ).encode("utf-8")
+
+
+def test_archive_file_interrupted(tmp_path):
+    """Test that lines aren't archived twice after crash or repeated call."""
+    dirpath = str(tmp_path / "#chan")
+    archive_dir = os.path.join(dirpath, iiarchive.ARCHIVE_DIR_NAME)
+    out_path = _write_out(dirpath, [DAY1, DAY1 + 1])
+    assert iiarchive.archive_file(out_path, archive_dir) == 2
+
+    out_path = _write_out(dirpath, [DAY1 + 2, DAY1 + 3])
+    with patch.object(iiarchive.os, "unlink", side_effect=OSError("crash")):
+        with pytest.raises(OSError):
+            iiarchive.archive_file(out_path, archive_dir)
+
+    # Archived, but not removed.
+    assert os.path.exists(out_path)
+    assert iiarchive.archive_file(out_path, archive_dir) == 0
+    assert not os.path.exists(out_path)
+
+    # Crash before index is written leaves garbage behind segment.
+    out_path = _write_out(dirpath, [DAY1 + 4])
+    segment_path = os.path.join(archive_dir, "2024-01-01.gz")
+    with open(segment_path, "ab") as fhandle:
+        fhandle.write(b"garbage")
+
+    assert iiarchive.archive_file(out_path, archive_dir) == 1
+    assert [
+        iiarchive.get_nixtime(line)
+        for line in iiarchive.read_range(dirpath, 0, DAY2)
+    ] == [DAY1, DAY1 + 1, DAY1 + 2, DAY1 + 3, DAY1 + 4]
+    with gzip.open(segment_path, "rb") as gzfile:
+        assert len(gzfile.read().splitlines()) == 5
+
+
+def test_read_range(tmp_path):
+    """Test that only members covering time range are decompressed."""
+    dirpath = str(tmp_path / "#chan")
+    archive_dir = os.path.join(dirpath, iiarchive.ARCHIVE_DIR_NAME)
+    out_path = _write_out(dirpath, [DAY1 + i * 10 for i in range(10)])
+    with patch.object(iiarchive, "ARCHIVE_BLOCK_LINES", 2):
+        assert iiarchive.archive_file(out_path, archive_dir) == 10
+
+    _write_out(dirpath, [DAY2])
+    with patch.object(
+        iiarchive, "_read_block", wraps=iiarchive._read_block
+    ) as read_block:
+        lines = list(iiarchive.read_range(dirpath, DAY1 + 25, DAY1 + 50))
+
+    assert [iiarchive.get_nixtime(line) for line in lines] == [
+        DAY1 + 30,
+        DAY1 + 40,
+        DAY1 + 50,
+    ]
+    # Members starting at +20 and +40 out of five.
+    assert read_block.call_count == 2
+
+    lines = list(iiarchive.read_range(dirpath, DAY1 + 95, DAY2))
+    assert [iiarchive.get_nixtime(line) for line in lines] == [DAY2]
+
+
+def test_read_source(tmp_path):
+    """Test that lines of archived file are read by their source offsets."""
+    dirpath = str(tmp_path / "#chan")
+    archive_dir = os.path.join(dirpath, iiarchive.ARCHIVE_DIR_NAME)
+    out_path = _write_out(dirpath, [DAY1 + i for i in range(5)])
+    inode = os.stat(out_path).st_ino
+    size = os.stat(out_path).st_size
+    with open(out_path, "rb") as fhandle:
+        data = fhandle.read()
+
+    with patch.object(iiarchive, "ARCHIVE_BLOCK_LINES", 2):
+        assert iiarchive.archive_file(out_path, archive_dir) == 5
+
+    assert iiarchive.find_source(archive_dir, inode, size + 1) is None
+    source = iiarchive.find_source(archive_dir, inode, size)
+    path = iiarchive.get_source_path(archive_dir, source)
+    assert iiarchive.split_source_path(path) == (archive_dir, source)
+    assert iiarchive.split_source_path(out_path) is None
+
+    line_len = len(data) // 5
+    start = line_len * 3
+    end = start + line_len
+    spans = [(line_len * 3, line_len), (0, line_len), (size, line_len)]
+    with patch.object(
+        iiarchive, "_read_block", wraps=iiarchive._read_block
+    ) as read_block:
+        assert iiarchive.read_source(archive_dir, source, spans) == [
+            data[start:end],
+            data[:line_len],
+            None,
+        ]
+
+    # One member per span.
+    assert read_block.call_count == 3
+
+    # Index written before source offsets has been kept.
+    index_path = os.path.join(archive_dir, iiarchive.INDEX_NAME)
+    with open(index_path, "a", encoding="utf-8") as fhandle:
+        fhandle.write("{:d}\t2024-01-01.gz\t0\t1\t1:2:3\n".format(DAY1))
+        fhandle.write("{:d}\t2024-01-01.gz\t0".format(DAY1))
+
+    entries = iiarchive.read_index(archive_dir)
+    assert len(entries) == 4
+    assert entries[-1].source_offset == -1
+
+
+def test_rotate_log(tmp_path):
+    """Test that log held open by writer is compressed and truncated."""
+    log_path = str(tmp_path / "irc.example.com.log")
+    with open(log_path, "ab") as fhandle:
+        fhandle.write(b"x" * 100)
+        fhandle.flush()
+        assert iiarchive.rotate_log(log_path, DAY1, 1000) is False
+        assert iiarchive.rotate_log(log_path, DAY1, 100) is True
+        fhandle.write(b"y\n")
+
+    with open(log_path, "rb") as fhandle:
+        assert fhandle.read() == b"y\n"
+
+    archive_path = log_path + ".20240101T000000.gz"
+    with gzip.open(archive_path, "rb") as gzfile:
+        assert gzfile.read() == b"x" * 100
+
+    assert iiarchive.rotate_log(str(tmp_path / "missing.log"), DAY1) is False
+
+
+def test_rotate_all(tmp_path):
+    """Test that all channels and queries are rotated and archive skipped."""
+    ircdir = str(tmp_path)
+    netdir = os.path.join(ircdir, "irc.example.com")
+    _write_out(netdir, [DAY1])
+    _write_out(os.path.join(netdir, "#chan"), [DAY1, DAY1 + 1])
+    _write_out(os.path.join(netdir, "joe"), [DAY1 + 2])
+    os.makedirs(os.path.join(netdir, "nickserv"))
+    assert iiarchive.rotate_all(ircdir, DAY2, grace=0) == 0
+    for dirpath in iiarchive.iter_log_dirs(ircdir):
+        _expire(os.path.join(dirpath, "out" + iiarchive.ROTATING_SUFFIX))
+
+    assert iiarchive.rotate_all(ircdir, DAY2, grace=0) == 4
+    assert list(iiarchive.iter_log_dirs(ircdir)) == []
+
+
+def test_parse_time():
+    """Test that nixtime and dates in UTC are parsed."""
+    assert iiarchive.parse_time("1704067200") == DAY1
+    assert iiarchive.parse_time("2024-01-02") == DAY2
+    assert iiarchive.parse_time("2024-01-01 01:30") == DAY1 + 5400
+    with pytest.raises(argparse.ArgumentTypeError):
+        iiarchive.parse_time("yesterday")
+
+
+def test_main(tmp_path, capsys):
+    """Test that CLI rotates logs and prints archived lines."""
+    ircdir = str(tmp_path)
+    dirpath = os.path.join(ircdir, "irc.example.com", "#chan")
+    _write_out(dirpath, [DAY1, DAY1 + 60])
+    args = ["./iiarchive.py", "rotate", "--grace", "0", ircdir]
+    with patch.object(sys, "argv", args):
+        iiarchive.main()
+
+    captured = capsys.readouterr()
+    assert captured.out == "Archived 2 line(s).\n"
+    assert os.listdir(dirpath) == [iiarchive.ARCHIVE_DIR_NAME]
+
+    args = [
+        "./iiarchive.py",
+        "read",
+        "--since",
+        "2024-01-01 00:01",
+        "--until",
+        "2024-01-02",
+        dirpath,
+    ]
+    with patch.object(sys, "argv", args):
+        iiarchive.main()
+
+    captured = capsys.readouterr()
+    assert captured.out == "{:d} <joe> line {:d}\n".format(DAY1 + 60, DAY1 + 60)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""Unit tests for iibench.py."""
+import json
+import sys
+from unittest.mock import patch
+
+import pytest
+
+import iibench  # noqa:I202
+import iifriends
+
+
+def test_generate_friends_lines(tmp_path):
+    """Test that generated friends file parses into all friends."""
+    fname = iibench.write_friends_file(str(tmp_path), 60)
+    friends = iifriends.parse_friends_file(fname)
+
+    assert len(friends) == 60
+    assert iibench.generate_friends_lines(60) == iibench.generate_friends_lines(
+        60
+    )
+
+
+def test_generate_joins(tmp_path):
+    """Test that generated joins parse and some of them match friends."""
+    fname = iibench.write_friends_file(str(tmp_path), 60)
+    database = iifriends.FriendsDatabase.load(fname, cache_size=0)
+    joins = [
+        iifriends.parse_message(join)
+        for join in iibench.generate_joins(200, 60)
+    ]
+
+    assert all(len(join) == 3 for join in joins)
+    matched = [join for join in joins if database.find_friends(*join[:2])]
+    assert 0 < len(matched) < len(joins)
+
+
+@pytest.mark.parametrize("encoding", iibench.HTML_ENCODINGS)
+def test_generate_html(encoding):
+    """Test that title can be extracted from generated HTML."""
+    data = iibench.generate_html(1024).encode(encoding)
+
+    assert len(iibench.generate_html(1024).encode("utf-8")) >= 1024
+    assert iibench.extract_title_decoded(data, encoding) == (
+        "Žluťoučký kůň - benchmark"
+    )
+
+
+def test_run_benchmarks():
+    """Test that filtered benchmarks are run and timed."""
+    results = iibench.run_benchmarks(
+        sizes=(10,), repeat=1, name_filter=r"^friends\.(parse_file|find)"
+    )
+
+    assert sorted(results.keys()) == [
+        "friends.find_friends.10",
+        "friends.parse_file.10",
+    ]
+    assert all(value > 0 for value in results.values())
+
+
+def test_compare():
+    """Test that only results slower than threshold are regressions."""
+    baseline = {"a": 1.0, "b": 1.0, "c": 1.0, "gone": 1.0}
+    results = {"a": 1.1, "b": 1.3, "c": 0.5, "new": 5.0}
+
+    assert iibench.compare(results, baseline, 0.25) == [("b", 1.0, 1.3)]
+    assert iibench.compare(results, baseline, 0.05) == [
+        ("a", 1.0, 1.1),
+        ("b", 1.0, 1.3),
+    ]
+
+
+def test_results_roundtrip(tmp_path):
+    """Test that saved results can be loaded back."""
+    fname = str(tmp_path / "results.json")
+    iibench.save_results(fname, {"a": 0.5})
+
+    assert iibench.load_results(fname) == {"a": 0.5}
+
+    with open(fname, "w", encoding="utf-8") as fhandle:
+        json.dump({"version": 0, "results": {}}, fhandle)
+
+    with pytest.raises(ValueError):
+        iibench.load_results(fname)
+
+
+@pytest.mark.parametrize(
+    "baseline,expected_exit",
+    [
+        (1.0, None),
+        (1e-12, 1),
+    ],
+)
+def test_main_baseline(baseline, expected_exit, tmp_path, capsys):
+    """Test that main() fails on regression against baseline."""
+    baseline_fname = str(tmp_path / "baseline.json")
+    output_fname = str(tmp_path / "results.json")
+    iibench.save_results(baseline_fname, {"friends.parse_file.10": baseline})
+    args = [
+        "./iibench.py",
+        "--sizes",
+        "10",
+        "--repeat",
+        "1",
+        "--filter",
+        r"^friends\.parse_file",
+        "--baseline",
+        baseline_fname,
+        "--output",
+        output_fname,
+    ]
+
+    with patch.object(sys, "argv", args):
+        if expected_exit is None:
+            iibench.main()
+        else:
+            with pytest.raises(SystemExit) as excinfo:
+                iibench.main()
+
+            assert excinfo.value.code == expected_exit
+
+    assert list(iibench.load_results(output_fname)) == ["friends.parse_file.10"]
+    captured = capsys.readouterr()
+    assert ("REGRESSION" in captured.out) is (expected_exit is not None)
@@ -1,7 +1,14 @@
 # Workaround https://github.com/psf/black/issues/4175
 """Unit tests for iicmd.py."""
+import http.server
+import io
+import json
 import os
+import socket
 import sys
+import threading
+import time
+from unittest.mock import Mock
 from unittest.mock import patch
 
 import pytest
@@ -43,7 +50,8 @@ SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
             "list",
             (
                 "irc_user: supported commands are - calc, echo, fortune, "
-                "list, ping, slap, url, whereami\n"
+                "grep, list, ping, search, seen, slap, stats, url, urls, "
+                "whereami\n"
             ),
         ),
         # Extra args should be ignored.
@@ -51,7 +59,8 @@ SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
             "list abc efg",
             (
                 "irc_user: supported commands are - calc, echo, fortune, "
-                "list, ping, slap, url, whereami\n"
+                "grep, list, ping, search, seen, slap, stats, url, urls, "
+                "whereami\n"
             ),
         ),
         # Expected invocation
@@ -257,6 +266,8 @@ def test_cmd_url_youtube_link_conversion(
 
     rsp_text = "No title here, just little <title>"
     mock_http_url = fixture_mock_requests.get(expected_url, text=rsp_text)
+    # Page is fetched when resolver fails.
+    fixture_mock_requests.get("https://www.youtube.com/oembed", status_code=404)
 
     args = [
         "./iicmd.py",
@@ -321,6 +332,23 @@ def test_cmd_url_title(rsp_text, expected_title, capsys, fixture_mock_requests):
     assert mock_http_url.called is True
 
 
+def test_get_url_title_body_limit(fixture_mock_requests):
+    """Test that only the beginning of response body is read."""
+    url = "https://www.example.org/big"
+    fixture_mock_requests.get(
+        url,
+        content=b"<html><head><title>Big</title></head>" + b"x" * 1000000,
+    )
+    try:
+        iicmd.set_http_body_limit(32)
+        assert iicmd.get_url_title(url) == "Big"
+
+        iicmd.set_http_body_limit(16)
+        assert iicmd.get_url_title(url) == "No title"
+    finally:
+        iicmd.set_http_body_limit(iicmd.HTTP_BODY_MAX)
+
+
 def test_cmd_url_two_links(capsys, fixture_mock_requests):
     """Test cmd_url() when there are multiple URLs in message.
 
@@ -545,3 +573,788 @@ def test_msg_ourself(capsys):
     captured = capsys.readouterr()
     assert captured.out == ""
     assert captured.err == ""
+
+
+def test_get_reply_budget():
+    """Test that budget accounts for nick, user@host and channel."""
+    budget = iicmd.get_reply_budget("irc_botuser", "#chan")
+    # ":irc_botuser!" + 10 + "@" + 63 + " PRIVMSG #chan :" + "\r\n"
+    assert budget == 512 - (13 + 10 + 1 + 63 + 16 + 2)
+
+
+@pytest.mark.parametrize(
+    "message,budget,expected",
+    [
+        # Fits
+        ("hello there", 20, ["hello there"]),
+        # Split at word boundary
+        ("hello there general", 12, ["hello there", "general"]),
+        # Word longer than budget
+        ("abcdefghij", 4, ["abcd", "efgh", "ij"]),
+        # Multibyte characters must not be cut in half, 3 bytes each.
+        ("☃☃☃", 7, ["☃☃", "☃"]),
+        # Emoji, 4 bytes each.
+        ("a \U0001f600\U0001f600", 6, ["a", "\U0001f600", "\U0001f600"]),
+        # Newlines are kept and empty lines dropped.
+        ("line one\n\nline two", 20, ["line one", "line two"]),
+        # Lines must not start with "/", ii would run them as commands.
+        ("/quit now", 20, ["quit now"]),
+        ("x" * 413 + " /quit pwned", 415, ["x" * 413, "quit pwned"]),
+        ("abc\n//quit\n/", 20, ["abc", "quit"]),
+    ],
+)
+def test_split_reply(message, budget, expected):
+    """Test split_reply() splits at word and character boundaries."""
+    result = iicmd.split_reply(message, budget)
+    assert result == expected
+    for line in result:
+        assert len(line.encode("utf-8")) <= budget
+
+
+def test_split_reply_max_lines():
+    """Test that number of lines in reply is capped."""
+    message = " ".join(["word"] * 100)
+    result = iicmd.split_reply(message, 10, max_lines=3)
+    assert result == ["word word", "word word", "word word"]
+
+
+def test_split_reply_long_echo(capsys):
+    """Test that long reply is split into multiple lines."""
+    msg = " ".join(["žluťoučký"] * 100)
+    args = [
+        "./iicmd.py",
+        "--nick=irc_user",
+        "--message=echo {:s}".format(msg),
+        "--ircd=irc_ircd",
+        "--network=irc_network",
+        "--channel=irc_channel",
+        "--self=irc_botuser",
+    ]
+    with patch.object(sys, "argv", args):
+        iicmd.main()
+
+    captured = capsys.readouterr()
+    lines = captured.out.splitlines()
+    budget = iicmd.get_reply_budget("irc_botuser", "irc_channel")
+    assert len(lines) > 1
+    assert " ".join(lines) == msg
+    for line in lines:
+        assert len(line.encode("utf-8")) <= budget
+
+
+def test_ttl_cache():
+    """Test LRU eviction, expiry and disabled cache."""
+    cache = iicmd.TTLCache(2, 60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    with patch("iicmd.time.monotonic", return_value=time.monotonic() + 61):
+        assert cache.get("a") is None
+
+    assert len(cache) == 1
+    cache.resize(0)
+    cache.set("d", 4)
+    assert len(cache) == 0
+    assert cache.get("d") is None
+
+
+def test_cmd_url_cache(fixture_mock_requests, monkeypatch):
+    """Test that cached title is used instead of HTTP request."""
+    url = "https://cache.example.com"
+    mock_http = fixture_mock_requests.get(
+        url, text="<html><title>cached</title></html>"
+    )
+    monkeypatch.setattr(iicmd, "URL_TITLE_CACHE", iicmd.TTLCache(10, 60))
+
+    for _ in range(2):
+        lines = iicmd.process_message(
+            "irc_user", "url " + url, "ircd", "network", "#chan", "bot"
+        )
+        assert lines == ["Title for {:s} - cached".format(url)]
+
+    assert mock_http.call_count == 1
+
+
+def test_cmd_stats():
+    """Test that stats command summarizes metrics."""
+    iicmd.process_message("irc_user", "ping", "ircd", "network", "#c", "bot")
+    lines = iicmd.process_message(
+        "irc_user", "stats", "ircd", "network", "#c", "bot"
+    )
+
+    assert len(lines) == 1
+    assert lines[0].startswith("up 0h00m, commands ")
+    assert iicmd.COMMAND_SECONDS.count(command="ping") >= 1
+
+
+@pytest.fixture
+def fixture_batch_caches(monkeypatch):
+    """Give batch mode its own caches, so they don't leak into other tests."""
+    monkeypatch.setattr(iicmd, "URL_TITLE_CACHE", iicmd.TTLCache(0, 60))
+    monkeypatch.setattr(iicmd, "URL_SHORT_CACHE", iicmd.TTLCache(0, 60))
+
+
+def test_batch(fixture_batch_caches, capsys, caplog, monkeypatch):
+    """Test that JSON-lines events are answered by JSON-lines replies."""
+    events = [
+        {"nick": "joe", "channel": "#a", "message": "ping", "nixtime": 1},
+        {"nick": "ann", "channel": "#b", "message": "echo hi", "id": 7},
+        {"nick": "irc_botuser", "channel": "#a", "message": "ping"},
+        {"nick": "joe", "channel": "#a"},
+    ]
+    stdin = io.StringIO(
+        "\n".join(json.dumps(event) for event in events) + "\n\n[1]\nbad\n"
+    )
+    monkeypatch.setattr(sys, "stdin", stdin)
+    args = [
+        "./iicmd.py",
+        "--batch",
+        "--ircd=irc_ircd",
+        "--network=irc_network",
+        "--self=irc_botuser",
+    ]
+    with patch.object(sys, "argv", args):
+        iicmd.main()
+
+    captured = capsys.readouterr()
+    replies = [json.loads(line) for line in captured.out.splitlines()]
+    assert replies == [
+        {
+            "nick": "joe",
+            "channel": "#a",
+            "nixtime": 1,
+            "lines": ["joe: pong! Ping-pong, get it?"],
+        },
+        {"nick": "ann", "channel": "#b", "id": 7, "lines": ["hi"]},
+    ]
+    assert len(caplog.records) == 3
+    assert iicmd.URL_TITLE_CACHE.capacity == iicmd.BATCH_URL_CACHE_SIZE
+
+
+def test_batch_order_per_channel(fixture_batch_caches):
+    """Test that replies in a channel keep order of events."""
+    delays = {"slow": 0.2, "fast": 0}
+    original = iicmd.process_message
+
+    def process_message(nick, message, *args):
+        """Delay processing of some messages."""
+        time.sleep(delays.get(message.split(" ")[1], 0))
+        return original(nick, message, *args)
+
+    events = [
+        {"nick": "joe", "channel": "#a", "message": "echo slow 1"},
+        {"nick": "joe", "channel": "#a", "message": "echo fast 2"},
+        {"nick": "joe", "channel": "#b", "message": "echo fast 3"},
+        {"nick": "joe", "channel": "#a", "message": "echo fast 4"},
+    ]
+    infile = io.StringIO("".join(json.dumps(e) + "\n" for e in events))
+    outfile = io.StringIO()
+    args = iicmd.argparse.Namespace(ircd="ircd", network="net", workers=4)
+    setattr(args, "self", "bot")
+    with patch("iicmd.process_message", side_effect=process_message):
+        count = iicmd.run_batch(args, infile, outfile)
+
+    assert count == 4
+    lines = [
+        json.loads(line)["lines"][0] for line in outfile.getvalue().splitlines()
+    ]
+    assert sorted(lines) == ["fast 2", "fast 3", "fast 4", "slow 1"]
+    channel_a = [line for line in lines if line != "fast 3"]
+    assert channel_a == ["slow 1", "fast 2", "fast 4"]
+    # Reply in another channel isn't held back by the slow one.
+    assert lines[0] == "fast 3"
+
+
+def test_args_single_message_required(capsys):
+    """Test that nick, message and channel are required without batch."""
+    args = [
+        "./iicmd.py",
+        "--nick=irc_user",
+        "--ircd=irc_ircd",
+        "--network=irc_network",
+        "--channel=irc_channel",
+        "--self=irc_botuser",
+    ]
+    with patch.object(sys, "argv", args):
+        with pytest.raises(SystemExit):
+            iicmd.main()
+
+    captured = capsys.readouterr()
+    assert "Argument 'message' is required" in captured.err
+
+
+class _KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    """Serve page with title over HTTP/1.1 and remember client ports."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        """Serve page."""
+        self.server.clients.add(self.client_address)
+        body = b"<html><title>kept alive</title></html>"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Don't log requests."""
+
+
+class _BigPageHandler(http.server.BaseHTTPRequestHandler):
+    """Serve big page with og:title."""
+
+    def do_GET(self):
+        """Serve page, client is free to hang up early."""
+        body = self.server.body
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            for idx in range(0, len(body), 4096):
+                end = idx + 4096
+                self.wfile.write(body[idx:end])
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        """Don't log requests."""
+
+
+@pytest.fixture
+def fixture_dns_cache(monkeypatch):
+    """Give test its own DNS cache."""
+    cache = iicmd.TTLCache(10, 60, "dns")
+    monkeypatch.setattr(iicmd, "DNS_CACHE", cache)
+    return cache
+
+
+def test_http_keep_alive(fixture_dns_cache):
+    """Test that requests to the same host reuse connection and DNS."""
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), _KeepAliveHandler
+    )
+    server.clients = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = "http://localhost:{:d}/page".format(server.server_address[1])
+    try:
+        with patch("iicmd.socket.getaddrinfo", wraps=socket.getaddrinfo) as (
+            mock_getaddrinfo
+        ):
+            titles = [iicmd.get_url_title(url + str(i)) for i in range(3)]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert titles == ["kept alive"] * 3
+    assert len(server.clients) == 1
+    # Address of localhost itself and then addresses of localhost's IPs.
+    assert mock_getaddrinfo.call_args_list[0].args[:2] == (
+        "localhost",
+        server.server_address[1],
+    )
+
+
+def test_resolve_host_cached(fixture_dns_cache):
+    """Test that host is resolved only once while cached."""
+    addrinfo = [
+        (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("192.0.2.1", 80)),
+        (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("192.0.2.2", 80)),
+    ]
+    with patch("iicmd.socket.getaddrinfo", return_value=addrinfo) as mock_gai:
+        for _ in range(3):
+            addresses = iicmd.resolve_host("example.com", 80)
+
+    assert addresses == ["192.0.2.1", "192.0.2.2"]
+    assert mock_gai.call_count == 1
+
+
+def test_cached_dns_connection_fallback(fixture_dns_cache):
+    """Test that the next address is tried and cache dropped on failure."""
+    sock = Mock()
+    conn = iicmd.CachedDNSHTTPConnection("example.com", 80, timeout=5)
+    with (
+        patch("iicmd.resolve_host", return_value=["192.0.2.1", "192.0.2.2"]),
+        patch(
+            "urllib3.util.connection.create_connection",
+            side_effect=[ConnectionRefusedError(), sock],
+        ) as mock_connect,
+    ):
+        assert conn._new_conn() is sock
+
+    assert [call.args[0] for call in mock_connect.call_args_list] == [
+        ("192.0.2.1", 80),
+        ("192.0.2.2", 80),
+    ]
+    assert conn._dns_host == "example.com"
+
+    key = (
+        "example.com",
+        80,
+        iicmd.urllib3.util.connection.allowed_gai_family(),
+    )
+    fixture_dns_cache.set(key, ["192.0.2.1"])
+    with (
+        patch(
+            "urllib3.util.connection.create_connection",
+            side_effect=ConnectionRefusedError(),
+        ),
+        pytest.raises(iicmd.urllib3.exceptions.NewConnectionError),
+    ):
+        conn._new_conn()
+
+    assert fixture_dns_cache.get(key) is None
+
+    fixture_dns_cache.set(key, [])
+    with pytest.raises(iicmd.urllib3.exceptions.NameResolutionError):
+        conn._new_conn()
+
+
+def test_http_session_pools():
+    """Test that shared session keeps connections of many hosts."""
+    session = iicmd.get_http_session()
+
+    assert session is iicmd.get_http_session()
+    assert session.max_redirects == iicmd.HTTP_MAX_REDIRECTS
+    adapter = session.get_adapter("https://example.com")
+    assert adapter._pool_connections == iicmd.HTTP_POOL_HOSTS
+    assert adapter._pool_maxsize == iicmd.HTTP_POOL_SIZE
+    pool = adapter.poolmanager.connection_from_url("https://example.com")
+    assert pool.ConnectionCls is iicmd.CachedDNSHTTPSConnection
+    # urllib3 isn't patched for the rest of the process.
+    assert iicmd.urllib3.util.connection.create_connection.__module__ == (
+        "urllib3.util.connection"
+    )
+
+
+def test_cmd_seen(tmp_path):
+    """Test that !seen catches up with logs and finds the latest activity."""
+    ircd = str(tmp_path)
+    chandir = tmp_path / "irc_network" / "#chan"
+    chandir.mkdir(parents=True)
+    now = int(time.time())
+    (chandir / "out").write_text(
+        "{:d} <Joe> hello there\n{:d} -!- ann(~a@h) has joined #chan\n".format(
+            now - 7200, now - 60
+        )
+    )
+
+    def seen(nick):
+        """Return reply of !seen nick."""
+        return iicmd.process_message(
+            "irc_user", "seen " + nick, ircd, "irc_network", "#chan", "bot"
+        )
+
+    assert seen("joe") == [
+        "irc_user: Joe was last seen in #chan 2h ago, saying: hello there"
+    ]
+    assert seen("ann") == [
+        "irc_user: ann was last seen in #chan 1m ago, joining"
+    ]
+    assert seen("bob") == ["irc_user: I haven't seen bob."]
+    assert seen("IRC_user") == ["irc_user: have you lost yourself?"]
+
+
+def test_cmd_seen_error(tmp_path):
+    """Test reply when index can't be opened."""
+    lines = iicmd.process_message(
+        "irc_user",
+        "seen joe",
+        str(tmp_path / "missing"),
+        "irc_network",
+        "#chan",
+        "bot",
+    )
+
+    assert lines == ["irc_user: my memory fails me right now."]
+
+
+def test_cmd_search(tmp_path):
+    """Test that !grep finds the latest messages and is rate-limited."""
+    ircd = str(tmp_path)
+    chandir = tmp_path / "irc_network" / "#chan"
+    chandir.mkdir(parents=True)
+    (chandir / "out").write_text(
+        "0 <Joe> deploy is broken again\n"
+        "60 <ann> who broke the deploy?\n"
+        "120 <bot> irc_user: [1970-01-01 00:00] <Joe> deploy is broken\n"
+        "180 <ann> lunch\n"
+    )
+
+    def search(query):
+        """Return reply of !grep query."""
+        return iicmd.process_message(
+            "irc_user", "grep " + query, ircd, "irc_network", "#chan", "bot"
+        )
+
+    # Bot's own replies aren't found.
+    assert search("Deploy BROKEN") == [
+        "irc_user: [1970-01-01 00:00] <Joe> deploy is broken again"
+    ]
+    assert search("the deploy") == [
+        "irc_user: [1970-01-01 00:01] <ann> who broke the deploy?"
+    ]
+    assert search("nonexistent") == ["irc_user: nothing found."]
+    assert search("lunch") == ["irc_user: slow down, search again later."]
+
+
+def test_cmd_search_query(tmp_path):
+    """Test that search isn't available in queries."""
+    lines = iicmd.process_message(
+        "irc_user", "search joe", str(tmp_path), "irc_network", "joe", "bot"
+    )
+
+    assert lines == ["irc_user: search works in channels only."]
+
+
+def test_cmd_url_history(tmp_path, fixture_mock_requests, monkeypatch):
+    """Test that reposts are answered from URL history without fetching."""
+    ircd = str(tmp_path)
+    url = "https://history.example.com/page"
+    mock_http = fixture_mock_requests.get(
+        url, text="<html><title>Remember me</title></html>"
+    )
+    monkeypatch.setattr(iicmd, "URL_TITLE_CACHE", iicmd.TTLCache(0, 60))
+
+    def post(nick, channel, message):
+        """Return reply to message with URL."""
+        return iicmd.process_message(
+            nick, "url " + message, ircd, "irc_network", channel, "bot"
+        )
+
+    assert post("joe", "#chan", url) == [
+        "Title for {:s} - Remember me".format(url)
+    ]
+    assert post("ann", "#chan", "see https://History.Example.com/page") == [
+        "{:s} was already posted by joe moments ago - Remember me".format(url)
+    ]
+    # Title is reused by other channels.
+    assert post("ann", "#other", url) == [
+        "Title for {:s} - Remember me".format(url)
+    ]
+    assert mock_http.call_count == 1
+
+    lines = iicmd.process_message(
+        "irc_user", "urls", ircd, "irc_network", "#CHAN", "bot"
+    )
+    assert len(lines) == 1
+    assert lines[0].endswith("<joe> {:s} - Remember me".format(url))
+
+    lines = iicmd.process_message(
+        "irc_user", "urls forget", ircd, "irc_network", "#chan", "bot"
+    )
+    assert lines == ["irc_user: no URLs found."]
+
+
+def test_cmd_url_history_failure(tmp_path, fixture_mock_requests, monkeypatch):
+    """Test that failed fetch is neither cached nor recorded."""
+    ircd = str(tmp_path)
+    url = "https://flaky.example.com/page"
+    mock_http = fixture_mock_requests.get(
+        url,
+        [
+            {"status_code": 503},
+            {"text": "<html><title>Back again</title></html>"},
+        ],
+    )
+    monkeypatch.setattr(iicmd, "URL_TITLE_CACHE", iicmd.TTLCache(10, 60))
+
+    for title in (iicmd.iilog.NO_TITLE, "Back again"):
+        lines = iicmd.process_message(
+            "joe", "url " + url, ircd, "irc_network", "#chan", "bot"
+        )
+        assert lines == ["Title for {:s} - {:s}".format(url, title)]
+
+    assert mock_http.call_count == 2
+    with iicmd.iilog.UrlHistory(
+        os.path.join(ircd, iicmd.iilog.URLS_DB_NAME)
+    ) as urls:
+        posted = urls.lookup("irc_network", "#chan", iicmd.get_url_key(url))
+
+    assert (posted.title, posted.count) == ("Back again", 1)
+
+
+def test_cmd_url_repost_ttl(tmp_path, fixture_mock_requests, monkeypatch):
+    """Test that URL posted long ago isn't a repost."""
+    ircd = str(tmp_path)
+    url = "https://old.example.com/page"
+    fixture_mock_requests.get(url, text="<title>Old news</title>")
+    monkeypatch.setattr(iicmd, "URL_TITLE_CACHE", iicmd.TTLCache(0, 60))
+    monkeypatch.setattr(iicmd, "URL_REPOST_TTL", 60)
+    for nixtime in (1000, 1030, 1100):
+        with patch("iicmd.time.time", return_value=nixtime):
+            lines = iicmd.process_message(
+                "joe", "url " + url, ircd, "irc_network", "#chan", "bot"
+            )
+
+        if nixtime == 1030:
+            assert lines[0].endswith(
+                "already posted by joe moments ago - Old news"
+            )
+        else:
+            assert lines == ["Title for {:s} - Old news".format(url)]
+
+
+def test_cmd_url_history_error(tmp_path, fixture_mock_requests, monkeypatch):
+    """Test that title is fetched when URL history is broken."""
+    url = "https://broken.example.com"
+    fixture_mock_requests.get(url, text="<title>still works</title>")
+    monkeypatch.setattr(iicmd, "URL_TITLE_CACHE", iicmd.TTLCache(0, 60))
+    (tmp_path / iicmd.iilog.URLS_DB_NAME).write_text("not a database")
+
+    lines = iicmd.process_message(
+        "irc_user", "url " + url, str(tmp_path), "irc_network", "#c", "bot"
+    )
+
+    assert lines == ["Title for {:s} - still works".format(url)]
+
+
+@pytest.mark.parametrize(
+    "url,expected_url,expected_rules",
+    [
+        ("https://example.com/a?b=1", "https://example.com/a?b=1", []),
+        (
+            "HTTPS://Example.COM:443",
+            "https://example.com/",
+            ["lowercase", "default_port"],
+        ),
+        ("http://example.com:8080/", "http://example.com:8080/", []),
+        (
+            "https://example.com/?utm_source=x&z=1&a=2&fbclid=y#top",
+            "https://example.com/?a=2&z=1",
+            ["tracking_params", "query_order", "fragment"],
+        ),
+        (
+            "https://youtu.be/9G-fg6G738c?si=KD5OpJ_F2yTPIK4E&t=5",
+            "https://www.youtube.com/watch?v=9G-fg6G738c",
+            ["youtube_short_link"],
+        ),
+        (
+            "https://m.youtube.com/watch?v=9G-fg6G738c&t=5",
+            "https://www.youtube.com/watch?v=9G-fg6G738c",
+            ["query_order", "youtube_host", "youtube_watch"],
+        ),
+        (
+            "https://youtube.com/embed/9G-fg6G738c?si=KD5OpJ_F2yTPIK4E",
+            "https://www.youtube.com/watch?v=9G-fg6G738c",
+            ["youtube_host", "youtube_embed"],
+        ),
+        (
+            "https://en.m.wikipedia.org/wiki/IRC",
+            "https://en.wikipedia.org/wiki/IRC",
+            ["wikipedia_mobile"],
+        ),
+        ("https://example.com:bad/", "https://example.com:bad/", []),
+    ],
+)
+def test_canonicalize_url(url, expected_url, expected_rules):
+    """Test that URL is canonicalized by rules."""
+    assert iicmd.canonicalize_url(url) == (expected_url, expected_rules)
+
+
+def test_cmd_url_canonical_cache(fixture_mock_requests, monkeypatch):
+    """Test that variants of URL share cached title and rewrites count."""
+    mock_http = fixture_mock_requests.get(
+        "https://www.youtube.com/oembed", json={"title": "Video"}
+    )
+    monkeypatch.setattr(iicmd, "URL_TITLE_CACHE", iicmd.TTLCache(10, 60))
+    rewrites = iicmd.URL_REWRITES.get(rule="youtube_short_link")
+
+    for url in (
+        "https://youtu.be/9G-fg6G738c",
+        "https://m.youtube.com/watch?v=9G-fg6G738c&t=5",
+        "https://www.youtube.com/watch?v=9G-fg6G738c#t=5",
+    ):
+        lines = iicmd.process_message(
+            "irc_user", "url " + url, "ircd", "network", "#chan", "bot"
+        )
+        # URL is shown as it was posted.
+        assert lines == ["Title for {:s} - Video".format(url)]
+
+    assert mock_http.call_count == 1
+    assert iicmd.URL_REWRITES.get(rule="youtube_short_link") == rewrites + 1
+
+
+@pytest.mark.parametrize(
+    "text,expected_title",
+    [
+        (
+            '<meta property="og:title" content="Headline">',
+            "Headline",
+        ),
+        (
+            "<META content='Headline' name=x property='og:title'/>",
+            "Headline",
+        ),
+        (
+            '<meta property="og:description" content="Text">',
+            None,
+        ),
+        (
+            '<meta property="og:title" content="">',
+            None,
+        ),
+    ],
+)
+def test_extract_og_title(text, expected_title):
+    """Test that og:title is found regardless of order of attributes."""
+    assert iicmd.extract_og_title(text) == expected_title
+
+
+def test_ttl_cache_entry_ttl():
+    """Test that entry can expire sooner than the rest of cache."""
+    cache = iicmd.TTLCache(10, 60)
+    with patch("iicmd.time.monotonic", return_value=100):
+        cache.set("short", 1, 5)
+        cache.set("long", 2)
+
+    with patch("iicmd.time.monotonic", return_value=110):
+        assert cache.get("short") is None
+        assert cache.get("long") == 2
+
+
+def test_resolve_title_oembed(fixture_mock_requests):
+    """Test that YouTube title comes from oEmbed instead of the page."""
+    mock_page = fixture_mock_requests.get(
+        "https://youtu.be/9G-fg6G738c", text="<title>Page</title>"
+    )
+    mock_oembed = fixture_mock_requests.get(
+        "https://www.youtube.com/oembed", json={"title": "Video"}
+    )
+    read = iicmd.RESOLVER_BYTES_READ.get(resolver="youtube")
+    saved = iicmd.RESOLVER_BYTES_SAVED.get(resolver="youtube")
+    hits = iicmd.RESOLVER_REQUESTS.get(resolver="youtube", result="hit")
+
+    url = "https://youtu.be/9G-fg6G738c"
+    assert iicmd.resolve_title(url, iicmd.get_url_key(url)) == (
+        "Video",
+        86400,
+    )
+
+    assert mock_page.called is False
+    # NOTE: requests_mock lowercases query string.
+    assert mock_oembed.last_request.qs == {
+        "url": ["https://www.youtube.com/watch?v=9g-fg6g738c"],
+        "format": ["json"],
+    }
+    size = len(json.dumps({"title": "Video"}))
+    assert iicmd.RESOLVER_BYTES_READ.get(resolver="youtube") == read + size
+    assert iicmd.RESOLVER_BYTES_SAVED.get(resolver="youtube") == (
+        saved + 1024 * 1024 - size
+    )
+    assert (
+        iicmd.RESOLVER_REQUESTS.get(resolver="youtube", result="hit")
+        == hits + 1
+    )
+
+
+def test_resolve_title_fallback(fixture_mock_requests, caplog):
+    """Test that page is fetched when resolver fails."""
+    mock_page = fixture_mock_requests.get(
+        "https://vimeo.com/123", text="<title>Page</title>"
+    )
+    fixture_mock_requests.get(
+        "https://vimeo.com/api/oembed.json", status_code=500
+    )
+    fallbacks = iicmd.RESOLVER_REQUESTS.get(resolver="vimeo", result="fallback")
+
+    url = "https://vimeo.com/123"
+    assert iicmd.resolve_title(url, iicmd.get_url_key(url)) == ("Page", None)
+
+    assert mock_page.called is True
+    assert "Resolver 'vimeo' has failed" in caplog.text
+    assert (
+        iicmd.RESOLVER_REQUESTS.get(resolver="vimeo", result="fallback")
+        == fallbacks + 1
+    )
+
+
+def test_resolve_title_json(fixture_mock_requests):
+    """Test that Wikipedia title comes from its API."""
+    mock_api = fixture_mock_requests.get(
+        "https://en.wikipedia.org/api/rest_v1/page/summary/Internet_Relay_Chat",
+        json={"title": "Internet Relay Chat", "extract": "..."},
+    )
+
+    url = "https://en.m.wikipedia.org/wiki/Internet_Relay_Chat"
+    lines = iicmd.process_message(
+        "irc_user", "url " + url, "ircd", "network", "#chan", "bot"
+    )
+
+    assert lines == ["Title for {:s} - Internet Relay Chat".format(url)]
+    assert mock_api.call_count == 1
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "https://en.wikipedia.org/wiki/AC/DC",
+        "https://en.wikipedia.org/wiki/AC%2FDC#History",
+    ],
+)
+def test_resolve_title_json_quoted(url, fixture_mock_requests):
+    """Test that Wikipedia title is a single segment of API path."""
+    mock_api = fixture_mock_requests.get(
+        "https://en.wikipedia.org/api/rest_v1/page/summary/AC%2FDC",
+        json={"title": "AC/DC"},
+    )
+
+    (resolver,) = [
+        resolver
+        for resolver in iicmd.URL_RESOLVERS
+        if resolver.name == "wikipedia"
+    ]
+    match = resolver.pattern.search(url)
+    assert iicmd.run_resolver(resolver, url, match)[0] == "AC/DC"
+    assert mock_api.call_count == 1
+
+
+def test_resolve_title_og_title(monkeypatch):
+    """Test that only the beginning of page is read for og:title."""
+    monkeypatch.setattr(
+        iicmd,
+        "URL_RESOLVERS",
+        (
+            iicmd.Resolver(
+                "local",
+                iicmd.re.compile(r"^http://127\.0\.0\.1:\d+/"),
+                "og_title",
+                "",
+                120,
+                0,
+            ),
+        ),
+    )
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _BigPageHandler)
+    server.body = (
+        b"<html><head><title>Site - Headline</title>"
+        b'<meta property="og:title" content="Headline"></head>'
+        + b"x" * 4 * 1024 * 1024
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = "http://127.0.0.1:{:d}/article".format(server.server_address[1])
+    read = iicmd.RESOLVER_BYTES_READ.get(resolver="local")
+    saved = iicmd.RESOLVER_BYTES_SAVED.get(resolver="local")
+    try:
+        title = iicmd.resolve_title(url, iicmd.get_url_key(url))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert title == ("Headline", 120)
+    assert iicmd.RESOLVER_BYTES_READ.get(resolver="local") == (
+        read + iicmd.OG_TITLE_READ_MAX
+    )
+    # Generic path would read up to body limit.
+    assert iicmd.RESOLVER_BYTES_SAVED.get(resolver="local") == (
+        saved + iicmd.HTTP_BODY_MAX - iicmd.OG_TITLE_READ_MAX
+    )
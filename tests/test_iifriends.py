@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 """Unit tests for iifriends.py."""
+import ipaddress
 import os
 import sys
+import threading
+import time
 from unittest.mock import call
 from unittest.mock import patch
 
@@ -17,19 +20,19 @@ SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
     [
         (
             "tester1(~test1@example.com) has joined #chan1",
-            {"/mode #chan1 +o tester1\n"},
+            {iifriends.Mode("#chan1", "tester1", "+o"): -1},
         ),
         (
             "tester1(~test1@example.com) has joined #chan2",
-            {"/mode #chan2 +v tester1\n"},
+            {iifriends.Mode("#chan2", "tester1", "+v"): -1},
         ),
         (
             "tester2(~test2@foo.example.com) has joined #chan1",
-            {"/mode #chan1 +v tester2\n"},
+            {iifriends.Mode("#chan1", "tester2", "+v"): -1},
         ),
         (
             "tester3(~test3@test3.example.com) has joined #chan1",
-            {"/mode #chan1 +v tester3\n"},
+            {iifriends.Mode("#chan1", "tester3", "+v"): -1},
         ),
     ],
 )
@@ -78,3 +81,677 @@ def test_iifriends_no_match(mock_write_messages, message):
         iifriends.main()
 
     assert mock_write_messages.mock_calls == []
+
+
+def _read_fifo(path, result):
+    """Read everything from FIFO until writer closes it."""
+    with open(path, "rb") as fhandle:
+        result.append(fhandle.read())
+
+
+def test_fifo_writer(tmp_path):
+    """Test that FifoWriter writes messages over one open descriptor."""
+    fifo_path = str(tmp_path / "in")
+    os.mkfifo(fifo_path)
+    result = []
+    reader = threading.Thread(target=_read_fifo, args=(fifo_path, result))
+    reader.start()
+
+    with iifriends.FifoWriter(fifo_path, open_timeout=5) as writer:
+        fd = writer.fd
+        writer.write("/mode #chan1 +o tester1\n")
+        assert writer.fd == fd
+        writer.write("/mode #chan1 +v tester1\n")
+
+    reader.join(5)
+    assert writer.fd is None
+    assert result == [b"/mode #chan1 +o tester1\n/mode #chan1 +v tester1\n"]
+
+
+def test_fifo_writer_in_thread(tmp_path):
+    """Test that FifoWriter works outside of the main thread."""
+    fifo_path = str(tmp_path / "in")
+    os.mkfifo(fifo_path)
+    result = []
+    reader = threading.Thread(target=_read_fifo, args=(fifo_path, result))
+    reader.start()
+
+    modes = {iifriends.Mode("#chan1", "tester1", "+o"): -1}
+    writer = threading.Thread(
+        target=iifriends.write_messages,
+        args=(fifo_path, modes),
+        kwargs={"interval": 0},
+    )
+    writer.start()
+    writer.join(5)
+    reader.join(5)
+    assert result == [b"/mode #chan1 +o tester1\n"]
+
+
+def test_fifo_writer_no_reader(tmp_path):
+    """Test that open times out when there is nobody reading."""
+    fifo_path = str(tmp_path / "in")
+    os.mkfifo(fifo_path)
+
+    writer = iifriends.FifoWriter(fifo_path, open_timeout=0.1)
+    with pytest.raises(TimeoutError):
+        writer.open()
+
+    assert writer.fd is None
+
+
+def test_fifo_writer_no_wait(tmp_path):
+    """Test that write with zero timeout fails at once if FIFO is full."""
+    fifo_path = str(tmp_path / "in")
+    os.mkfifo(fifo_path)
+    reader_fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        writer = iifriends.FifoWriter(
+            fifo_path, open_timeout=0, write_timeout=0
+        )
+        writer.open()
+        writer.write("/mode #chan1 +o tester1\n")
+        assert os.read(reader_fd, 1024) == b"/mode #chan1 +o tester1\n"
+
+        # Fill the pipe up.
+        with pytest.raises(TimeoutError):
+            while True:
+                writer.write("x" * 512)
+
+        started = time.monotonic()
+        with pytest.raises(TimeoutError):
+            writer.write("/mode #chan1 +v tester1\n")
+
+        assert time.monotonic() - started < 1
+        writer.close()
+    finally:
+        os.close(reader_fd)
+
+
+def test_fifo_writer_not_fifo(tmp_path):
+    """Test that regular file is refused."""
+    fpath = tmp_path / "in"
+    fpath.write_text("")
+
+    writer = iifriends.FifoWriter(str(fpath), open_timeout=0.1)
+    with pytest.raises(ValueError):
+        writer.open()
+
+    assert writer.fd is None
+
+
+def test_friends_service_handle_message():
+    """Test that FriendsService matches joins and memoizes decisions."""
+    friends_file = os.path.join(SCRIPT_PATH, "files", "friends.txt")
+    service = iifriends.FriendsService(friends_file, "irc_botuser")
+
+    message = "tester1(~test1@example.com) has joined #chan1"
+    expected = {iifriends.Mode("#chan1", "tester1", "+o"): -1}
+    assert service.handle_message(message) == expected
+    assert service.handle_message(message) == expected
+    cache_info = service.database.get_modes.cache_info()
+    assert cache_info.hits == 1
+    assert cache_info.misses == 1
+
+    # Don't act on ourselves and on garbage.
+    message = "irc_botuser(~test1@example.com) has joined #chan1"
+    assert service.handle_message(message) == {}
+    assert service.handle_message("garbage") == {}
+
+
+def test_friends_service_reload(tmp_path):
+    """Test that FriendsService reloads friends file when it changes."""
+    friends_file = tmp_path / "friends.txt"
+    friends_file.write_text(
+        "handle=tester1%hosts=*!*test1@example.com%globflags=av%chanflags=%\n"
+    )
+    service = iifriends.FriendsService(
+        str(friends_file), "irc_botuser", reload_interval=0
+    )
+    message = "tester1(~test1@example.com) has joined #chan1"
+    expected = {iifriends.Mode("#chan1", "tester1", "+v"): -1}
+    assert service.handle_message(message) == expected
+    old_database = service.database
+
+    # Nothing has changed.
+    assert service.maybe_reload() is False
+    assert service.database is old_database
+
+    friends_file.write_text(
+        "handle=tester1%hosts=*!*test1@example.com%globflags=ao%chanflags=%"
+        "password=%comment=%\n"
+    )
+    assert service.maybe_reload() is True
+    assert service.database is not old_database
+    expected = {iifriends.Mode("#chan1", "tester1", "+o"): -1}
+    assert service.handle_message(message) == expected
+
+
+def test_friends_service_reload_requested():
+    """Test that reload is done on request, eg. after SIGHUP."""
+    friends_file = os.path.join(SCRIPT_PATH, "files", "friends.txt")
+    service = iifriends.FriendsService(friends_file, "irc_botuser")
+    old_database = service.database
+
+    assert service.maybe_reload() is False
+    service.reload_requested.set()
+    assert service.maybe_reload() is True
+    assert service.database is not old_database
+    assert service.reload_requested.is_set() is False
+
+
+def test_friends_service_serve(tmp_path):
+    """Test that FriendsService reads events FIFO and writes into ii FIFO."""
+    friends_file = os.path.join(SCRIPT_PATH, "files", "friends.txt")
+    events_path = str(tmp_path / "iifriends")
+    output = str(tmp_path / "in")
+    os.mkfifo(output)
+    result = []
+    reader = threading.Thread(target=_read_fifo, args=(output, result))
+    reader.start()
+
+    service = iifriends.FriendsService(friends_file, "irc_botuser")
+    server = threading.Thread(target=service.serve, args=(events_path, output))
+    server.start()
+    while not os.path.exists(events_path):
+        time.sleep(0.01)
+
+    with open(events_path, "w", encoding="utf-8") as fhandle:
+        fhandle.write("tester1(~test1@example.com) has joined #chan2\n")
+
+    for _ in range(500):
+        if service.database.get_modes.cache_info().misses:
+            break
+
+        time.sleep(0.01)
+
+    service.stop_requested.set()
+    server.join(5)
+    reader.join(5)
+    assert server.is_alive() is False
+    assert result == [b"/mode #chan2 +v tester1\n"]
+    # Events FIFO is removed once service is gone.
+    assert os.path.exists(events_path) is False
+
+
+@pytest.mark.parametrize(
+    "globflags,chanflags,channel,expected_op,expected_voice",
+    [
+        # Global flags apply to any channel.
+        ("aov", "", "#chan1", (True, -1), (True, -1)),
+        # Deop and mute win.
+        ("aodvm", "", "#chan1", (False, -1), (False, -1)),
+        # Without auto there is nothing to do.
+        ("ov", "", "#chan1", (False, -1), (False, -1)),
+        # Channel flags take precedence over global ones, delay is kept.
+        ("av", "#chan1,ao,10 #chan2,av,", "#chan1", (True, 10), (False, 10)),
+        ("av", "#chan1,ao,10 #chan2,av,", "#chan2", (False, -1), (True, -1)),
+        ("av", "#chan1,ao,10 #chan2,av,", "#chan3", (False, -1), (True, -1)),
+        # Invalid delay
+        ("", "#chan1,ao,abc", "#chan1", (True, -1), (False, -1)),
+        # First entry for the channel wins.
+        ("", "#chan1,ao,5 #chan1,av,", "#chan1", (True, 5), (False, 5)),
+    ],
+)
+def test_friend_flags(
+    globflags, chanflags, channel, expected_op, expected_voice
+):
+    """Test evaluation of precomputed flags in Friend."""
+    friend = iifriends.Friend(
+        handle="tester",
+        hosts="*!*@example.com",
+        globflags=globflags,
+        chanflags=chanflags,
+        password="",
+        comment="",
+    )
+    assert friend.give_op(channel) == expected_op
+    assert friend.give_voice(channel) == expected_voice
+    # Friend is slotted in order to keep memory footprint small.
+    assert not hasattr(friend, "__dict__")
+
+
+def test_mode_scheduler_order():
+    """Test that modes are popped in order of their delay."""
+    scheduler = iifriends.ModeScheduler(interval=0)
+    mode_late = iifriends.Mode("#chan1", "tester1", "+o")
+    mode_now = iifriends.Mode("#chan1", "tester2", "+v")
+    mode_soon = iifriends.Mode("#chan2", "tester3", "+o")
+    scheduler.schedule(mode_late, 30, now=100)
+    scheduler.schedule(mode_now, -1, now=100)
+    scheduler.schedule(mode_soon, 10, now=100)
+    assert len(scheduler) == 3
+
+    assert scheduler.pop(now=100) == mode_now
+    assert scheduler.pop(now=100) is None
+    assert scheduler.next_timeout(now=100) == 10
+    assert scheduler.pop(now=110) == mode_soon
+    assert scheduler.pop(now=129) is None
+    assert scheduler.pop(now=130) == mode_late
+    assert scheduler.next_timeout(now=130) is None
+    assert len(scheduler) == 0
+
+
+def test_mode_scheduler_interval():
+    """Test that modes which are due are paced by interval."""
+    scheduler = iifriends.ModeScheduler(interval=2)
+    mode1 = iifriends.Mode("#chan1", "tester1", "+o")
+    mode2 = iifriends.Mode("#chan1", "tester2", "+o")
+    scheduler.schedule(mode1, 0, now=100)
+    scheduler.schedule(mode2, 0, now=100)
+
+    assert scheduler.pop(now=100) == mode1
+    assert scheduler.pop(now=100) is None
+    assert scheduler.next_timeout(now=101) == 1
+    assert scheduler.pop(now=102) == mode2
+
+
+def test_mode_scheduler_duplicate():
+    """Test that the same mode is scheduled only once."""
+    scheduler = iifriends.ModeScheduler(interval=0)
+    mode = iifriends.Mode("#chan1", "tester1", "+o")
+    assert scheduler.schedule(mode, 5, now=100) is True
+    assert scheduler.schedule(mode, 0, now=101) is False
+    assert len(scheduler) == 1
+    assert scheduler.pop(now=104) is None
+    assert scheduler.pop(now=105) == mode
+    assert scheduler.pop(now=105) is None
+
+
+def test_mode_scheduler_cancel():
+    """Test cancellation in one channel and in all channels."""
+    scheduler = iifriends.ModeScheduler(interval=0)
+    mode1 = iifriends.Mode("#chan1", "tester1", "+o")
+    mode2 = iifriends.Mode("#chan2", "tester1", "+v")
+    mode3 = iifriends.Mode("#chan3", "tester1", "+v")
+    mode4 = iifriends.Mode("#chan1", "tester2", "+o")
+    for mode in (mode1, mode2, mode3, mode4):
+        scheduler.schedule(mode, 5, now=100)
+
+    assert scheduler.cancel("tester1", "#chan2") == 1
+    assert len(scheduler) == 3
+    assert scheduler.cancel("tester1") == 2
+    assert len(scheduler) == 1
+    assert scheduler.cancel("tester1") == 0
+    assert scheduler.cancel("nobody") == 0
+    assert scheduler.pop(now=105) == mode4
+    assert scheduler.pop(now=105) is None
+
+
+def test_mode_scheduler_compaction():
+    """Test that heap is compacted when cancelled entries prevail."""
+    scheduler = iifriends.ModeScheduler(interval=0)
+    for idx in range(10):
+        mode = iifriends.Mode("#chan1", "tester{:d}".format(idx), "+o")
+        scheduler.schedule(mode, 5, now=100)
+
+    for idx in range(5):
+        scheduler.cancel("tester{:d}".format(idx))
+
+    # Half is cancelled, nothing happens yet.
+    assert len(scheduler._heap) == 10
+    scheduler.cancel("tester5")
+    assert len(scheduler._heap) == 4
+    assert len(scheduler) == 4
+    popped = [scheduler.pop(now=105) for _ in range(5)]
+    assert [mode.nick for mode in popped[:4]] == [
+        "tester6",
+        "tester7",
+        "tester8",
+        "tester9",
+    ]
+    assert popped[4] is None
+
+
+@pytest.mark.parametrize(
+    "message,expected_pending",
+    [
+        ("tester1(~test1@example.com) has left #chan1", 1),
+        ("tester1(~test1@example.com) has left #chan9", 2),
+        ('tester1(~test1@example.com) has quit "bye"', 0),
+        ('op_user kicked tester1 ("go away")', 0),
+        ("tester1 changed nick to tester1_away", 0),
+        ("tester2 changed nick to tester1", 2),
+    ],
+)
+def test_friends_service_cancel(tmp_path, message, expected_pending):
+    """Test that leaving users have their pending modes cancelled."""
+    friends_file = tmp_path / "friends.txt"
+    friends_file.write_text(
+        "handle=tester1%hosts=*!*test1@example.com%globflags="
+        "%chanflags=#chan1,ao,30 #chan2,av,30%password=%comment=%\n"
+    )
+    service = iifriends.FriendsService(str(friends_file), "irc_botuser")
+    for channel in ("#chan1", "#chan2"):
+        service.handle_message(
+            "tester1(~test1@example.com) has joined {:s}".format(channel),
+            now=100,
+        )
+
+    assert len(service.scheduler) == 2
+    service.handle_message(message, now=110)
+    assert len(service.scheduler) == expected_pending
+
+
+@pytest.mark.parametrize(
+    "delay,expected_delay",
+    [
+        (10, 10),
+        (iifriends.ONESHOT_DELAY_MAX, iifriends.ONESHOT_DELAY_MAX),
+        (iifriends.ONESHOT_DELAY_MAX + 1, -1),
+    ],
+)
+@patch("iifriends.write_messages")
+def test_iifriends_delayed_modes(
+    mock_write_messages, delay, expected_delay, tmp_path
+):
+    """Test that one-shot mode sleeps through short delays only."""
+    friends_file = tmp_path / "friends.txt"
+    friends_file.write_text(
+        "handle=tester1%hosts=*!*test1@example.com%globflags="
+        "%chanflags=#chan1,aov,{:d}%password=%comment=%\n".format(delay)
+    )
+    args = [
+        "./iifriends.py",
+        "--message=tester1(~test1@example.com) has joined #chan1",
+        "--ircd=irc_ircd",
+        "--network=irc_network",
+        "--self=irc_botuser",
+        "--friends-file={:s}".format(str(friends_file)),
+    ]
+    with patch.object(sys, "argv", args):
+        iifriends.main()
+
+    assert mock_write_messages.mock_calls == [
+        call(
+            "irc_ircd/irc_network/in",
+            {
+                iifriends.Mode("#chan1", "tester1", "+o"): expected_delay,
+                iifriends.Mode("#chan1", "tester1", "+v"): expected_delay,
+            },
+        )
+    ]
+
+
+def test_friends_service_serve_cancel(tmp_path):
+    """Test that part read from events FIFO cancels delayed mode."""
+    friends_file = tmp_path / "friends.txt"
+    friends_file.write_text(
+        "handle=tester1%hosts=*!*test1@example.com%globflags="
+        "%chanflags=#chan1,ao,30%password=%comment=%\n"
+    )
+    events_path = str(tmp_path / "iifriends")
+    output = str(tmp_path / "in")
+    os.mkfifo(output)
+    result = []
+    reader = threading.Thread(target=_read_fifo, args=(output, result))
+    reader.start()
+
+    service = iifriends.FriendsService(str(friends_file), "irc_botuser")
+    server = threading.Thread(target=service.serve, args=(events_path, output))
+    server.start()
+    while not os.path.exists(events_path):
+        time.sleep(0.01)
+
+    def wait_for_pending(count):
+        """Wait until scheduler has count pending modes."""
+        for _ in range(500):
+            if len(service.scheduler) == count:
+                return
+
+            time.sleep(0.01)
+
+    with open(events_path, "w", encoding="utf-8") as fhandle:
+        fhandle.write("tester1(~test1@example.com) has joined #chan1\n")
+
+    wait_for_pending(1)
+    assert len(service.scheduler) == 1
+    with open(events_path, "w", encoding="utf-8") as fhandle:
+        fhandle.write("tester1(~test1@example.com) has left #chan1\n")
+
+    wait_for_pending(0)
+    service.stop_requested.set()
+    server.join(5)
+    assert len(service.scheduler) == 0
+
+    # Nothing has been written, unblock the reader.
+    fd = os.open(output, os.O_WRONLY)
+    os.close(fd)
+    reader.join(5)
+    assert result == [b""]
+
+
+def test_fifo_writer_open_twice(tmp_path):
+    """Test that opening already open FifoWriter doesn't leak descriptor."""
+    fifo_path = str(tmp_path / "in")
+    os.mkfifo(fifo_path)
+    reader_fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        writer = iifriends.FifoWriter(fifo_path, open_timeout=1)
+        writer.open()
+        fd = writer.fd
+        writer.open()
+        assert writer.fd == fd
+        writer.close()
+        assert writer.fd is None
+    finally:
+        os.close(reader_fd)
+
+
+def test_write_messages_not_fifo(tmp_path, caplog):
+    """Test that write_messages() logs, not raises, if output isn't FIFO."""
+    fpath = tmp_path / "in"
+    fpath.write_text("")
+    modes = {iifriends.Mode("#chan1", "tester1", "+o"): -1}
+
+    iifriends.write_messages(str(fpath), modes, interval=0)
+
+    assert fpath.read_text() == ""
+    assert "is expected to be a FIFO pipe" in caplog.text
+
+
+@pytest.mark.parametrize(
+    "new_content",
+    [
+        # Truncated, eg. by non-atomic save of an editor.
+        "",
+        # Nothing but comments.
+        "# version = 2.4.1 (20021124)\n",
+        # Not even UTF-8.
+        b"\xff\xfe\xfa",
+    ],
+)
+def test_friends_service_reload_keeps_database(tmp_path, new_content):
+    """Test that database isn't swapped when friends file fails to load."""
+    friends_file = tmp_path / "friends.txt"
+    friends_file.write_text(
+        "handle=tester1%hosts=*!*test1@example.com%globflags=av%chanflags=%\n"
+    )
+    service = iifriends.FriendsService(
+        str(friends_file), "irc_botuser", reload_interval=0
+    )
+    old_database = service.database
+
+    if isinstance(new_content, bytes):
+        friends_file.write_bytes(new_content)
+    else:
+        friends_file.write_text(new_content)
+
+    assert service.maybe_reload() is False
+    assert service.database is old_database
+    # Failed file isn't retried until it changes again.
+    assert service.maybe_reload() is False
+
+
+def test_friends_service_write_modes_backoff(tmp_path):
+    """Test that missing ii FIFO doesn't block and is retried later."""
+    friends_file = os.path.join(SCRIPT_PATH, "files", "friends.txt")
+    service = iifriends.FriendsService(friends_file, "irc_botuser")
+    service.scheduler.interval = 0
+    output = str(tmp_path / "in")
+    writer = iifriends.FifoWriter(output, open_timeout=0)
+    service.handle_message(
+        "tester1(~test1@example.com) has joined #chan1", now=100
+    )
+
+    assert service.write_modes(writer, now=100) == 0
+    assert len(service.scheduler) == 1
+    # Backing off
+    assert service.write_modes(writer, now=100.5) == 0
+    assert service.write_modes(writer, now=101) == 0
+    assert len(service.scheduler) == 1
+    assert service._output_retry_at == 103
+
+    os.mkfifo(output)
+    reader_fd = os.open(output, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        assert service.write_modes(writer, now=103) == 1
+        assert len(service.scheduler) == 0
+        assert os.read(reader_fd, 1024) == b"/mode #chan1 +o tester1\n"
+    finally:
+        writer.close()
+        os.close(reader_fd)
+
+
+def test_friend_compact():
+    """Test that Friend keeps only parsed form of hosts and flags."""
+    friends = [
+        iifriends.Friend(
+            handle="tester{:d}".format(idx),
+            hosts="*!*@example.com",
+            globflags="av",
+            chanflags="",
+            password="",
+            comment="",
+        )
+        for idx in range(2)
+    ]
+    for friend in friends:
+        assert not hasattr(friend, "chanflags")
+        assert not hasattr(friend, "globflags")
+        assert not hasattr(friend, "hosts")
+
+    # Friends without chanflags share one empty table.
+    assert friends[0]._chanmasks is friends[1]._chanmasks
+
+
+@pytest.mark.parametrize(
+    "hosts,nick,hostmask,expected",
+    [
+        ("*!*@192.0.2.0/24", "tester", "~test@192.0.2.10", True),
+        ("*!*@192.0.2.0/24", "tester", "~test@192.0.3.10", False),
+        ("*!*test@192.0.2.0/24", "tester", "~test@192.0.2.10", True),
+        ("*!*test@192.0.2.0/24", "tester", "~other@192.0.2.10", False),
+        ("tester!*@10.0.0.0/8", "other", "~test@10.1.2.3", False),
+        ("*!*@2001:db8::/32", "tester", "~test@2001:db8:1::1", True),
+        ("*!*@2001:db8::/32", "tester", "~test@2001:db9::1", False),
+        # IPv4 mapped IPv6 address
+        ("*!*@192.0.2.0/24", "tester", "~test@::ffff:192.0.2.1", True),
+        # Hostname doesn't match CIDR
+        ("*!*@192.0.2.0/24", "tester", "~test@host.example.com", False),
+        # Mixed with globs
+        (
+            "*!*@*.example.com *!*@192.0.2.0/24",
+            "tester",
+            "~test@host.example.com",
+            True,
+        ),
+    ],
+)
+def test_friend_cidr(hosts, nick, hostmask, expected):
+    """Test matching of CIDR hostmasks by Friend and by the index."""
+    friend = iifriends.Friend(
+        handle="tester",
+        hosts=hosts,
+        globflags="av",
+        chanflags="",
+        password="",
+        comment="",
+    )
+    assert friend.is_friend(nick, hostmask) is expected
+
+    database = iifriends.FriendsDatabase({"tester": friend})
+    expected_found = {"tester"} if expected else set([])
+    assert database.find_friends(nick, hostmask) == expected_found
+
+
+def test_ip_index():
+    """Test lookup of many overlapping networks in IPIndex."""
+    ip_index = iifriends.IPIndex()
+    for idx in range(256):
+        network = ipaddress.ip_network("10.{:d}.0.0/16".format(idx))
+        ip_index.add(network, "net{:d}".format(idx))
+
+    ip_index.add(ipaddress.ip_network("10.0.0.0/8"), "big")
+    ip_index.add(ipaddress.ip_network("10.5.5.5/32"), "host")
+    ip_index.add(ipaddress.ip_network("2001:db8::/32"), "v6")
+    assert len(ip_index) == 259
+
+    result = ip_index.lookup(ipaddress.ip_address("10.5.5.5"))
+    assert sorted(result) == ["big", "host", "net5"]
+    result = ip_index.lookup(ipaddress.ip_address("10.7.0.1"))
+    assert sorted(result) == ["big", "net7"]
+    assert ip_index.lookup(ipaddress.ip_address("11.0.0.1")) == []
+    result = ip_index.lookup(ipaddress.ip_address("2001:db8::5"))
+    assert result == ["v6"]
+
+
+def test_friends_database_cidr(tmp_path):
+    """Test that CIDR friends are matched through FriendsService."""
+    friends_file = tmp_path / "friends.txt"
+    friends_file.write_text(
+        "handle=lan%hosts=*!*@192.0.2.0/24%globflags=ao%chanflags=%\n"
+        "handle=web%hosts=*!*@*.example.com%globflags=av%chanflags=%\n"
+    )
+    service = iifriends.FriendsService(str(friends_file), "irc_botuser")
+    message = "tester(~test@192.0.2.77) has joined #chan1"
+    expected = {iifriends.Mode("#chan1", "tester", "+o"): -1}
+    assert service.handle_message(message) == expected
+    assert service.database.glob_friends == ["web"]
+
+
+@pytest.mark.parametrize(
+    "names,mode,expected",
+    [
+        # Channel state not known, mode is sent.
+        (None, "+o", True),
+        # Already opped
+        ("@irc_botuser @tester1", "+o", False),
+        # Already voiced
+        ("@irc_botuser +tester1", "+v", False),
+        ("@irc_botuser +tester1", "+o", True),
+        # We don't have op
+        ("irc_botuser tester1", "+o", False),
+        # Nick isn't in the channel anymore
+        ("@irc_botuser", "+o", False),
+    ],
+)
+def test_friends_service_is_mode_needed(names, mode, expected):
+    """Test that redundant modes are skipped according to channel state."""
+    friends_file = os.path.join(SCRIPT_PATH, "files", "friends.txt")
+    service = iifriends.FriendsService(friends_file, "irc_botuser")
+    if names is not None:
+        service.handle_message("= #chan1 :{:s}".format(names))
+        service.handle_message("#chan1 :End of /NAMES list.")
+
+    mode = iifriends.Mode("#chan1", "tester1", mode)
+    assert service.is_mode_needed(mode) is expected
+
+
+def test_friends_service_kick_with_channel(tmp_path):
+    """Test that kick cancels pending modes in its channel only."""
+    friends_file = tmp_path / "friends.txt"
+    friends_file.write_text(
+        "handle=tester1%hosts=*!*test1@example.com%globflags="
+        "%chanflags=#chan1,ao,30 #chan2,av,30%password=%comment=%\n"
+    )
+    service = iifriends.FriendsService(str(friends_file), "irc_botuser")
+    for channel in ("#chan1", "#chan2"):
+        service.handle_message(
+            "tester1(~test1@example.com) has joined {:s}".format(channel),
+            now=100,
+        )
+
+    service.handle_message('op kicked tester1 ("bye")', channel="#chan1")
+    assert len(service.scheduler) == 1
+    assert service.scheduler.pop(now=130).channel == "#chan2"
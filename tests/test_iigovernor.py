@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Unit tests for iigovernor.py."""
+import os
+import threading
+import time
+from unittest.mock import patch
+
+import iicmd  # noqa:I202
+import iigovernor
+
+MIB = 1024 * 1024
+
+
+def _get_rss(sizes):
+    """Return fake get_rss() which returns RSS from sizes by pid."""
+
+    def get_rss(pid=None):
+        """Return fake RSS of process."""
+        return sizes[pid]
+
+    return get_rss
+
+
+def test_get_rss():
+    """Test that RSS of this process is known and of missing one isn't."""
+    assert iigovernor.get_rss() > 0
+    assert iigovernor.get_rss(os.getpid()) > 0
+    with patch("builtins.open", side_effect=FileNotFoundError):
+        assert iigovernor.get_rss(1) == 0
+
+
+def test_concurrency_limiter():
+    """Test that lowered limit lets only so many workers run at once."""
+    limiter = iigovernor.ConcurrencyLimiter(4)
+    limiter.set_limit(0)
+    assert limiter.limit == 1
+
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def work():
+        """Count concurrently running workers."""
+        with limiter:
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+
+            time.sleep(0.01)
+            with lock:
+                running.pop()
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert max(peak) == 1
+    assert limiter.running == 0
+
+
+def test_memory_governor():
+    """Test that limits follow memory pressure with hysteresis."""
+    cache = iicmd.TTLCache(100, 60)
+    for idx in range(100):
+        cache.set(idx, idx)
+
+    limiter = iigovernor.ConcurrencyLimiter(4)
+    governor = iigovernor.MemoryGovernor(100 * MIB, [cache], limiter)
+    sizes = {None: 50 * MIB, 10: MIB}
+    try:
+        with patch.object(iigovernor, "get_rss", _get_rss(sizes)):
+            assert governor.check({"irc.example.com": 10}, 0) == []
+            assert governor.level == 0
+            assert cache.capacity == 100
+            assert iigovernor.MEMORY_RSS.get(process="irc.example.com") == MIB
+
+            sizes[None] = 90 * MIB
+            assert governor.check({}, 5) == []
+            assert governor.level == 2
+            assert cache.capacity == 10
+            assert len(cache) == 10
+            assert limiter.limit == 2
+            assert iicmd.get_http_body_limit() == 64 * 1024
+            assert iigovernor.MEMORY_RSS.get(process="irc.example.com") is None
+
+            # Within hysteresis.
+            sizes[None] = 80 * MIB
+            governor.check({}, 10)
+            assert governor.level == 2
+
+            sizes[None] = 70 * MIB
+            governor.check({}, 15)
+            assert governor.level == 1
+            assert cache.capacity == 50
+            assert limiter.limit == 4
+
+            sizes[None] = 10 * MIB
+            governor.check({}, 20)
+            assert governor.level == 0
+            assert cache.capacity == 100
+            assert iicmd.get_http_body_limit() == iicmd.HTTP_BODY_MAX
+    finally:
+        iicmd.set_http_body_limit(iicmd.HTTP_BODY_MAX)
+
+
+def test_memory_governor_recycle():
+    """Test that the biggest child is recycled under pressure only."""
+    limiter = iigovernor.ConcurrencyLimiter(4)
+    governor = iigovernor.MemoryGovernor(100 * MIB, [], limiter)
+    sizes = {None: 40 * MIB, 10: 30 * MIB, 11: 40 * MIB, 12: MIB}
+    pids = {"one": 10, "two": 11, "three": 12}
+    recycles = iigovernor.WORKER_RECYCLES.total()
+    try:
+        with patch.object(iigovernor, "get_rss", _get_rss(sizes)):
+            assert governor.check(pids, 0) == ["two"]
+            assert governor.level == 3
+            # Too soon.
+            assert governor.check(pids, 1) == []
+
+            sizes[11] = MIB
+            assert governor.check(pids, 1 + iigovernor.RECYCLE_INTERVAL) == [
+                "one"
+            ]
+
+            sizes[10] = MIB
+            interval = 2 * iigovernor.RECYCLE_INTERVAL
+            assert governor.check(pids, 2 + interval) == []
+            assert governor.level == 0
+    finally:
+        iicmd.set_http_body_limit(iicmd.HTTP_BODY_MAX)
+
+    assert iigovernor.WORKER_RECYCLES.total() == recycles + 2
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""Unit tests for iiload.py."""
+import dataclasses
+import os
+
+import pytest
+import requests
+
+import iiload  # noqa:I202
+
+
+@pytest.mark.parametrize(
+    "quantile,expected",
+    [
+        (0.5, 5),
+        (0.9, 9),
+        (0.99, 10),
+        (0.0, 1),
+    ],
+)
+def test_percentile(quantile, expected):
+    """Test nearest rank percentile."""
+    assert iiload.percentile(list(range(10, 0, -1)), quantile) == expected
+
+
+def test_percentile_empty():
+    """Test that percentile of nothing is None."""
+    assert iiload.percentile([], 0.5) is None
+
+
+@pytest.mark.parametrize(
+    "line,expected",
+    [
+        (
+            "1700000000 <joe> see https://example.com/page?a=b now",
+            ("<lt7> see http://127.0.0.1:1/lt7 now", True),
+        ),
+        ("1700000000 <joe> !ping", ("<lt7> !ping", True)),
+        ("1700000000 <joe> hello", ("<lt7> hello", False)),
+        (
+            "1700000000 -!- joe(~joe@example.com) has joined #chan",
+            ("-!- lt7(~bot@friend.load.example) has joined #chan", True),
+        ),
+        (
+            "1700000000 -!- joe has quit (bye)",
+            ("-!- joe has quit (bye)", False),
+        ),
+        ("garbage", ("<lt7> garbage", False)),
+    ],
+)
+def test_rewrite_line(line, expected):
+    """Test that recorded lines get token and local URLs."""
+    generator = iiload.LineGenerator(
+        iiload.SCENARIOS["replay"], "http://127.0.0.1:1"
+    )
+
+    assert iiload.rewrite_line(line, "lt7", generator) == expected
+
+
+def test_line_generator():
+    """Test that every generated line, but chatter, carries its token."""
+    scenario = dataclasses.replace(
+        iiload.SCENARIOS["mixed"], mix={"chatter": 1, "join": 1, "url": 1}
+    )
+    generator = iiload.LineGenerator(scenario, "http://127.0.0.1:1")
+
+    lines = [generator.next() for _ in range(30)]
+
+    assert {channel for channel, _, _ in lines} == set(
+        iiload.get_channels(scenario)
+    )
+    for _, line, token in lines:
+        if "chatting" in line:
+            assert token is None
+        else:
+            assert token in line
+
+
+def test_reply_tracker():
+    """Test that replies are matched to injected tokens once."""
+    tracker = iiload.ReplyTracker("/nonexistent")
+    tracker.expect("lt1", 10.0)
+    tracker.expect("lt2", 10.0)
+
+    tracker.on_line("PRIVMSG #a :lt1: pong!", 10.5)
+    tracker.on_line("/mode #a +o lt1", 12.0)
+    tracker.on_line("/mode #a +o lt3", 12.0)
+
+    assert tracker.latencies == {"lt1": 0.5}
+    assert tracker.unexpected == {"lt3"}
+    assert tracker.pending == 1
+
+
+@pytest.mark.parametrize(
+    "mode,expected_status",
+    [
+        (None, 200),
+        ("error", 500),
+        ("notitle", 200),
+    ],
+)
+def test_page_server(mode, expected_status):
+    """Test that HTTP stand-in serves pages of given size or fails."""
+    scenario = dataclasses.replace(
+        iiload.SCENARIOS["url-flood"],
+        http_latency=0,
+        http_size=2048,
+        http_failure_rate=1.0 if mode else 0.0,
+        http_failure_mode=mode or "error",
+    )
+    server = iiload.PageServer(scenario)
+    server.start()
+    try:
+        rsp = requests.get(
+            "{:s}/lt5".format(server.url),
+            timeout=5,
+            proxies={"http": None},
+        )
+    finally:
+        server.stop()
+
+    assert rsp.status_code == expected_status
+    if expected_status == 200:
+        assert len(rsp.content) == 2048
+        assert ("<title>Page lt5</title>" in rsp.text) is (mode is None)
+
+
+def test_process_tree():
+    """Test that process tree contains at least the process itself."""
+    pids = iiload.get_process_tree(os.getpid())
+
+    assert pids[0] == os.getpid()
+    assert iiload.get_rss_kb(os.getpid()) > 0
+
+
+def test_run_scenario(tmp_path):
+    """Test that replies to injected lines are measured end-to-end."""
+    scenario = dataclasses.replace(
+        iiload.SCENARIOS["mixed"],
+        duration=1,
+        rate=10,
+        channels=2,
+        mix={"command": 1, "url": 1, "join": 1},
+        http_latency=0,
+    )
+
+    result = iiload.run_scenario(scenario, str(tmp_path), drain_timeout=5)
+
+    assert result["injected"] in (10, 11)
+    assert result["expected_replies"] == result["injected"]
+    assert result["replies"] > 0
+    assert result["latency_seconds"]["p50"] is not None
+    assert result["peak_processes"] >= 2
+    assert result["peak_rss_kb"] > 0
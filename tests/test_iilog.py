@@ -0,0 +1,604 @@
+#!/usr/bin/env python3
+"""Unit tests for iilog.py."""
+import os
+import sys
+from unittest.mock import patch
+
+import pytest
+
+import iiarchive  # noqa:I202
+import iilog
+
+
+def _write_out(ircdir, network, channel, lines, mode="a"):
+    """Append lines into out file of channel, or network if channel is ''."""
+    dirname = os.path.join(ircdir, network, channel)
+    os.makedirs(dirname, exist_ok=True)
+    path = os.path.join(dirname, "out")
+    with open(path, mode, encoding="utf-8") as fhandle:
+        for line in lines:
+            fhandle.write(line + "\n")
+
+    return path
+
+
+@pytest.fixture
+def fixture_ircdir(tmp_path):
+    """Return ii directory with logs of one network."""
+    ircdir = str(tmp_path / "ii")
+    _write_out(
+        ircdir,
+        "irc.example.com",
+        "#chan",
+        [
+            "100 -!- Joe(~joe@example.com) has joined #chan",
+            "200 <Joe> hello there",
+            "300 <ann> hi",
+            "350 -!- ann(~ann@example.com) has left #chan",
+        ],
+    )
+    _write_out(
+        ircdir,
+        "irc.example.com",
+        "#other",
+        ["150 <joe> elsewhere"],
+    )
+    _write_out(
+        ircdir,
+        "irc.example.com",
+        "",
+        [
+            "50 -!- irc.example.com 001 bot :Welcome",
+            "400 -!- Joe(~joe@example.com) has quit (Ping timeout)",
+        ],
+    )
+    # Queries aren't indexed.
+    _write_out(ircdir, "irc.example.com", "joe", ["500 <joe> psst"])
+    return ircdir
+
+
+@pytest.mark.parametrize(
+    "line,channel,expected",
+    [
+        (
+            "100 <joe> hello",
+            "#chan",
+            iilog.Seen("net", "#chan", "joe", 100, "message", "hello"),
+        ),
+        (
+            "100 -!- joe(~j@h) has joined #chan",
+            "#chan",
+            iilog.Seen("net", "#chan", "joe", 100, "join"),
+        ),
+        (
+            "100 -!- joe(~j@h) has left #chan (bye all)",
+            "#chan",
+            iilog.Seen("net", "#chan", "joe", 100, "part", "bye all"),
+        ),
+        (
+            "100 -!- joe(~j@h) has quit (Quit: zzz)",
+            "",
+            iilog.Seen("net", "", "joe", 100, "quit", "Quit: zzz"),
+        ),
+        (
+            "100 -!- joe changed nick to jim",
+            "",
+            iilog.Seen("net", "", "joe", 100, "nick", "jim"),
+        ),
+        ("100 <joe> hello", "", None),
+        ("100 -!- bot changed mode/#chan -> +o joe", "#chan", None),
+        ("garbage", "#chan", None),
+    ],
+)
+def test_parse_seen(line, channel, expected):
+    """Test parsing of activity out of ii lines."""
+    assert iilog.parse_seen(line, "net", channel) == expected
+
+
+def test_seen_index_update(fixture_ircdir):
+    """Test that the latest activity in every channel is found."""
+    db_path = os.path.join(fixture_ircdir, iilog.SEEN_DB_NAME)
+    with iilog.SeenIndex(db_path) as index:
+        assert index.update(fixture_ircdir) == 7
+
+        assert index.lookup("IRC.example.com", "JOE") == [
+            iilog.Seen(
+                "IRC.example.com", "", "Joe", 400, "quit", "Ping timeout"
+            ),
+            iilog.Seen(
+                "IRC.example.com", "#chan", "Joe", 200, "message", "hello there"
+            ),
+            iilog.Seen(
+                "IRC.example.com", "#other", "joe", 150, "message", "elsewhere"
+            ),
+        ]
+        assert index.lookup("irc.example.com", "nobody") == []
+
+        # Nothing new, nothing is read.
+        assert index.update(fixture_ircdir) == 0
+
+        _write_out(
+            fixture_ircdir, "irc.example.com", "#chan", ["600 <ann> back"]
+        )
+        assert index.update(fixture_ircdir) == 1
+        assert index.lookup("irc.example.com", "ann")[0].nixtime == 600
+
+
+def test_seen_index_partial_line(fixture_ircdir):
+    """Test that incomplete line is left for the next update."""
+    path = os.path.join(fixture_ircdir, "irc.example.com", "#chan", "out")
+    db_path = os.path.join(fixture_ircdir, iilog.SEEN_DB_NAME)
+    with iilog.SeenIndex(db_path) as index:
+        index.update(fixture_ircdir)
+        with open(path, "a", encoding="utf-8") as fhandle:
+            fhandle.write("700 <ann> half")
+
+        assert index.update(fixture_ircdir) == 0
+        with open(path, "a", encoding="utf-8") as fhandle:
+            fhandle.write(" a line\n")
+
+        assert index.update(fixture_ircdir) == 1
+        assert index.lookup("irc.example.com", "ann")[0].detail == (
+            "half a line"
+        )
+
+
+def test_seen_index_rotation(fixture_ircdir):
+    """Test that replaced or truncated out file is read from the start."""
+    db_path = os.path.join(fixture_ircdir, iilog.SEEN_DB_NAME)
+    with iilog.SeenIndex(db_path) as index:
+        index.update(fixture_ircdir)
+        path = _write_out(
+            fixture_ircdir, "irc.example.com", "#chan", ["800 <ann> new"], "w"
+        )
+        assert index.update(fixture_ircdir) == 1
+
+        os.rename(path, path + ".1")
+        _write_out(
+            fixture_ircdir, "irc.example.com", "#chan", ["900 <ann> newer"]
+        )
+        assert index.update(fixture_ircdir) == 1
+        assert index.lookup("irc.example.com", "ann")[0].nixtime == 900
+
+        # Older activity doesn't overwrite newer one.
+        assert index.rebuild(fixture_ircdir) == 4
+        assert index.lookup("irc.example.com", "ann")[0].nixtime == 900
+
+        # Row of the renamed file is forgotten.
+        assert index.conn.execute(
+            "SELECT COUNT(*) FROM seen_files"
+        ).fetchone() == (3,)
+        os.unlink(path + ".1")
+        assert index.prune() == 0
+        os.unlink(os.path.join(fixture_ircdir, "irc.example.com", "out"))
+        assert index.prune() == 1
+        assert index.conn.execute(
+            "SELECT COUNT(*) FROM seen_files"
+        ).fetchone() == (2,)
+
+
+def test_seen_index_batches(fixture_ircdir):
+    """Test that long logs are committed in batches."""
+    _write_out(
+        fixture_ircdir,
+        "irc.example.com",
+        "#big",
+        ["{:d} <user{:d}> msg".format(1000 + i, i % 7) for i in range(25)],
+    )
+    db_path = os.path.join(fixture_ircdir, iilog.SEEN_DB_NAME)
+    with (
+        patch("iilog.INDEX_BATCH_SIZE", 10),
+        iilog.SeenIndex(db_path) as index,
+    ):
+        assert index.update(fixture_ircdir, "irc.example.com") == 32
+        assert index.lookup("irc.example.com", "user3")[0].nixtime == 1024
+
+
+def test_log_index_abstract(tmp_path):
+    """Test that LogIndex must be subclassed with both methods defined."""
+
+    class PartialIndex(iilog.LogIndex):
+        """LogIndex which doesn't remember offsets."""
+
+        SCHEMA = iilog.SEEN_SCHEMA
+
+        def index_lines(self, path, network, channel, inode, batch):
+            """Ignore batch of lines."""
+
+    with pytest.raises(TypeError):
+        PartialIndex(str(tmp_path / "partial.db"))
+
+
+@pytest.mark.parametrize(
+    "seconds,expected",
+    [
+        (5, "moments"),
+        (65, "1m"),
+        (3600 * 5 + 120, "5h 2m"),
+        (86400 * 3 + 3600 * 4 + 60, "3d 4h"),
+    ],
+)
+def test_format_age(seconds, expected):
+    """Test formatting of age."""
+    assert iilog.format_age(seconds) == expected
+
+
+@pytest.mark.parametrize(
+    "seen,expected",
+    [
+        (
+            iilog.Seen("net", "#chan", "joe", 1000, "message", "hi"),
+            "joe was last seen in #chan 5m ago, saying: hi",
+        ),
+        (
+            iilog.Seen("net", "", "joe", 1000, "quit", ""),
+            "joe was last seen 5m ago, quitting",
+        ),
+        (
+            iilog.Seen("net", "#chan", "joe", 1000, "part", "bye"),
+            "joe was last seen in #chan 5m ago, leaving (bye)",
+        ),
+        (
+            iilog.Seen("net", "", "joe", 1000, "nick", "jim"),
+            "joe was last seen 5m ago, changing nick to jim",
+        ),
+    ],
+)
+def test_format_seen(seen, expected):
+    """Test description of activity."""
+    assert iilog.format_seen(seen, now=1300) == expected
+
+
+def test_main_seen(fixture_ircdir, capsys):
+    """Test that CLI updates index and looks nick up."""
+    args = ["./iilog.py", "seen", fixture_ircdir, "irc.example.com", "ann"]
+    with patch.object(sys, "argv", args):
+        iilog.main()
+
+    captured = capsys.readouterr()
+    assert captured.out.splitlines()[0].startswith(
+        "ann was last seen in #chan "
+    )
+
+    args = ["./iilog.py", "seen", fixture_ircdir, "irc.example.com", "bob"]
+    with patch.object(sys, "argv", args):
+        with pytest.raises(SystemExit) as excinfo:
+            iilog.main()
+
+    assert excinfo.value.code == 1
+    capsys.readouterr()
+
+    args = ["./iilog.py", "seen-update", "--rebuild", fixture_ircdir]
+    with patch.object(sys, "argv", args):
+        iilog.main()
+
+    captured = capsys.readouterr()
+    assert captured.out == "Indexed 7 line(s).\n"
+
+    args = ["./iilog.py", "seen-update", "--prune", fixture_ircdir]
+    with patch.object(sys, "argv", args):
+        iilog.main()
+
+    captured = capsys.readouterr()
+    assert captured.out == "Indexed 0 line(s).\nPruned 0 file(s).\n"
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        ("Hello, hello WORLD!", ["hello", "world"]),
+        ("a b cd", ["cd"]),
+        ("x" * 33 + " ok", ["ok"]),
+        ("Ünïcode wörds", ["ünïcode", "wörds"]),
+        ("", []),
+    ],
+)
+def test_get_terms(text, expected):
+    """Test that text is split into unique terms."""
+    assert iilog.get_terms(text) == expected
+
+
+def test_search_index(fixture_ircdir):
+    """Test that messages are found in the right channel, latest first."""
+    _write_out(
+        fixture_ircdir,
+        "irc.example.com",
+        "#chan",
+        ["500 <ann> Hello again", "600 <bot> joe: hello", "700 <joe> !grep hi"],
+    )
+    db_path = os.path.join(fixture_ircdir, iilog.SEARCH_DB_NAME)
+    with iilog.SearchIndex(db_path) as index:
+        assert index.update(fixture_ircdir) == 10
+
+        assert index.search("IRC.example.com", "#CHAN", "hello") == [
+            iilog.Hit("#CHAN", "bot", 600, "joe: hello"),
+            iilog.Hit("#CHAN", "ann", 500, "Hello again"),
+            iilog.Hit("#CHAN", "Joe", 200, "hello there"),
+        ]
+        assert index.search(
+            "irc.example.com", "#chan", "hello", limit=1, exclude_nick="Bot"
+        ) == [iilog.Hit("#chan", "ann", 500, "Hello again")]
+        assert index.search("irc.example.com", "#chan", "there hello") == [
+            iilog.Hit("#chan", "Joe", 200, "hello there")
+        ]
+        # Terms must be in the same line and channel.
+        assert index.search("irc.example.com", "#chan", "again there") == []
+        assert index.search("irc.example.com", "#chan", "elsewhere") == []
+        # Commands aren't indexed.
+        assert index.search("irc.example.com", "#chan", "grep") == []
+        assert index.search("irc.example.com", "#chan", "! ?") == []
+
+
+def test_search_index_stale(fixture_ircdir):
+    """Test that lines of replaced files aren't returned and get pruned."""
+    db_path = os.path.join(fixture_ircdir, iilog.SEARCH_DB_NAME)
+    with iilog.SearchIndex(db_path) as index:
+        index.update(fixture_ircdir)
+        path = os.path.join(fixture_ircdir, "irc.example.com", "#chan", "out")
+        os.rename(path, path + ".1")
+        _write_out(
+            fixture_ircdir, "irc.example.com", "#chan", ["900 <ann> hello"]
+        )
+        # Lines are read from where they were indexed, or not at all.
+        assert index.search("irc.example.com", "#chan", "hello") == []
+
+        index.update(fixture_ircdir)
+        assert [
+            hit.nixtime
+            for hit in index.search("irc.example.com", "#chan", "hello")
+        ] == [900]
+        assert index.prune(1000) == 2
+        assert index.conn.execute(
+            "SELECT count FROM terms WHERE term = 'hello'"
+        ).fetchone() == (1,)
+
+        # Truncated file is indexed again.
+        _write_out(
+            fixture_ircdir, "irc.example.com", "#chan", ["1 <a> hi"], "w"
+        )
+        assert index.update(fixture_ircdir) == 1
+        assert index.search("irc.example.com", "#chan", "hello") == []
+        assert len(index.search("irc.example.com", "#chan", "hi")) == 1
+
+
+def test_search_index_archived(fixture_ircdir):
+    """Test that lines are found after their out file is archived."""
+    db_path = os.path.join(fixture_ircdir, iilog.SEARCH_DB_NAME)
+    dirpath = os.path.join(fixture_ircdir, "irc.example.com", "#chan")
+    with iilog.SearchIndex(db_path) as index:
+        index.update(fixture_ircdir)
+        assert iiarchive.rotate_all(fixture_ircdir, 1000, max_size=1) == 0
+        # ii logs a line before it notices that out has been renamed.
+        rotating = os.path.join(dirpath, "out" + iiarchive.ROTATING_SUFFIX)
+        with open(rotating, "a", encoding="utf-8") as fhandle:
+            fhandle.write("360 <ann> hello late\n")
+
+        # Renamed out is caught up and read.
+        assert index.update(fixture_ircdir) == 1
+        assert [
+            hit.nixtime
+            for hit in index.search("irc.example.com", "#chan", "hello")
+        ] == [360, 200]
+
+        assert iiarchive.rotate_all(fixture_ircdir, grace=0) == 9
+        assert not os.path.exists(rotating)
+        assert [
+            hit.nixtime
+            for hit in index.search("irc.example.com", "#chan", "hello")
+        ] == [360, 200]
+
+        assert index.prune(1000) == 0
+        (path,) = index.conn.execute(
+            "SELECT path FROM search_files WHERE channel = '#chan'"
+        ).fetchone()
+        assert iiarchive.split_source_path(path) is not None
+        assert [
+            hit.nixtime
+            for hit in index.search("irc.example.com", "#chan", "hello")
+        ] == [360, 200]
+
+        # Archived lines are dropped once they're past retention.
+        assert index.prune(300 + iilog.SEARCH_RETENTION) == 2
+        assert [
+            hit.nixtime
+            for hit in index.search("irc.example.com", "#chan", "hello")
+        ] == [360]
+        assert index.prune(1000 + iilog.SEARCH_RETENTION) == 2
+        assert index.conn.execute(
+            "SELECT COUNT(*) FROM search_files"
+        ).fetchone() == (0,)
+
+
+def test_search_index_concurrent(fixture_ircdir):
+    """Test that lines indexed by another indexer meanwhile are skipped."""
+    db_path = os.path.join(fixture_ircdir, iilog.SEARCH_DB_NAME)
+    path = os.path.join(fixture_ircdir, "irc.example.com", "#chan", "out")
+    with (
+        iilog.SearchIndex(db_path) as index,
+        iilog.SearchIndex(db_path) as other,
+    ):
+        commit = index._commit
+
+        def racing_commit(*args):
+            """Let the other indexer index the file first."""
+            assert other.update_file(path, "irc.example.com", "#chan") == 4
+            return commit(*args)
+
+        with patch.object(index, "_commit", side_effect=racing_commit):
+            assert index.update_file(path, "irc.example.com", "#chan") == 0
+
+        assert index.conn.execute("SELECT COUNT(*) FROM lines").fetchone() == (
+            2,
+        )
+        assert index.conn.execute(
+            "SELECT count FROM terms WHERE term = 'hello'"
+        ).fetchone() == (1,)
+        assert len(index.search("irc.example.com", "#chan", "hello")) == 1
+
+
+def test_search_index_timeout(fixture_ircdir):
+    """Test that slow query is interrupted."""
+    db_path = os.path.join(fixture_ircdir, iilog.SEARCH_DB_NAME)
+    with (
+        patch("iilog.SEARCH_PROGRESS_STEPS", 1),
+        iilog.SearchIndex(db_path) as index,
+    ):
+        index.update(fixture_ircdir)
+        assert index.search("irc.example.com", "#chan", "hi", timeout=-1) == []
+        assert index.search("irc.example.com", "#chan", "hi") == [
+            iilog.Hit("#chan", "ann", 300, "hi")
+        ]
+
+
+def test_search_index_allow(tmp_path):
+    """Test token bucket of searches."""
+    with iilog.SearchIndex(str(tmp_path / "search.db")) as index:
+        assert [
+            index.allow("key", now=100, burst=2, interval=10) for _ in range(3)
+        ] == [True, True, False]
+        assert index.allow("other", now=100, burst=2, interval=10) is True
+        assert index.allow("key", now=105, burst=2, interval=10) is False
+        assert index.allow("key", now=110, burst=2, interval=10) is True
+
+
+def test_format_hit():
+    """Test that long messages are shortened."""
+    hit = iilog.Hit("#chan", "joe", 86400 + 3600 + 120, "x" * 200)
+
+    formatted = iilog.format_hit(hit)
+
+    assert formatted.startswith("[1970-01-02 01:02] <joe> xxx")
+    assert formatted.endswith("xx...")
+    assert len(formatted) == len("[1970-01-02 01:02] <joe> ") + 150
+
+
+def test_main_search(fixture_ircdir, capsys):
+    """Test that CLI updates search index and searches it."""
+    args = [
+        "./iilog.py",
+        "search",
+        fixture_ircdir,
+        "irc.example.com",
+        "#chan",
+        "hello",
+    ]
+    with patch.object(sys, "argv", args):
+        iilog.main()
+
+    captured = capsys.readouterr()
+    assert captured.out == "[1970-01-01 00:03] <Joe> hello there\n"
+
+    args = [
+        "./iilog.py",
+        "search",
+        fixture_ircdir,
+        "irc.example.com",
+        "#a",
+        "x",
+    ]
+    with patch.object(sys, "argv", args):
+        with pytest.raises(SystemExit) as excinfo:
+            iilog.main()
+
+    assert excinfo.value.code == 1
+    capsys.readouterr()
+
+    args = ["./iilog.py", "search-update", "--prune", fixture_ircdir]
+    with patch.object(sys, "argv", args):
+        iilog.main()
+
+    # Lines of 1970 are past retention.
+    captured = capsys.readouterr()
+    assert captured.out == "Indexed 0 line(s).\nPruned 3 line(s).\n"
+
+
+def test_url_history(tmp_path):
+    """Test recording, reposts and listing of URLs."""
+    with iilog.UrlHistory(str(tmp_path / iilog.URLS_DB_NAME)) as urls:
+        urls.add(
+            iilog.PostedUrl(
+                "Net", "#Chan", "https://a/", "https://a", "A", "", "joe", 100
+            )
+        )
+        urls.add(
+            iilog.PostedUrl(
+                "net", "#chan", "https://b/", "https://b", "B_%", "", "ann", 200
+            )
+        )
+        urls.add(
+            iilog.PostedUrl(
+                "net", "#chan", "https://a/", "https://a", "A", "", "bob", 300
+            )
+        )
+
+        posted = urls.lookup("NET", "#CHAN", "https://a/")
+        assert (posted.nick, posted.nixtime, posted.fetched) == (
+            "joe",
+            100,
+            100,
+        )
+        assert (posted.last_nixtime, posted.count) == (300, 2)
+        assert urls.lookup("net", "#other", "https://a/") is None
+        assert urls.get_title("https://b/") == ("B_%", "")
+        assert urls.get_title("https://b/", since=201) is None
+
+        assert [posted.url for posted in urls.recent("net", "#chan")] == [
+            "https://a",
+            "https://b",
+        ]
+        assert [posted.url for posted in urls.recent("net", "#chan", "_%")] == [
+            "https://b"
+        ]
+        assert urls.recent("net", "#chan", "a%") == []
+        assert len(urls.recent("net", "#chan", limit=1)) == 1
+
+        # Repost is detected since the given time only.
+        assert urls.lookup("net", "#chan", "https://a/", since=301) is None
+
+        # Missing title is filled in by repost, known one is kept.
+        urls.add(
+            iilog.PostedUrl(
+                "net",
+                "#c",
+                "https://c/",
+                "https://c",
+                iilog.NO_TITLE,
+                "",
+                "joe",
+                400,
+            )
+        )
+        assert urls.get_title("https://c/") is None
+        for title in ("C", "D"):
+            urls.add(
+                iilog.PostedUrl(
+                    "net",
+                    "#c",
+                    "https://c/",
+                    "https://c",
+                    title,
+                    "https://s",
+                    "ann",
+                    500,
+                )
+            )
+
+        posted = urls.lookup("net", "#c", "https://c/")
+        assert (posted.title, posted.short_url, posted.fetched) == (
+            "C",
+            "https://s",
+            500,
+        )
+        assert (posted.nick, posted.count) == ("joe", 3)
+        assert urls.get_title("https://c/") == ("C", "https://s")
+
+
+def test_format_posted_url():
+    """Test formatting of URL from history."""
+    posted = iilog.PostedUrl(
+        "net", "#chan", "k", "https://long", "T", "https://s", "joe", 60
+    )
+
+    assert iilog.format_posted_url(posted) == (
+        "[1970-01-01 00:01] <joe> https://s - T"
+    )
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Unit tests for iimetrics.py."""
+import math
+
+import pytest
+
+import iimetrics  # noqa:I202
+
+
+def test_counter():
+    """Test that counter is increased per label set."""
+    registry = iimetrics.Registry()
+    counter = registry.counter("test_total", "Test counter.")
+    counter.inc(command="ping")
+    counter.inc(2, command="ping")
+    counter.inc(command="url")
+
+    assert registry.counter("test_total", "Test counter.") is counter
+    assert counter.get(command="ping") == 3
+    assert counter.total() == 4
+    assert registry.render() == (
+        "# HELP test_total Test counter.\n"
+        "# TYPE test_total counter\n"
+        'test_total{command="ping"} 3\n'
+        'test_total{command="url"} 1\n'
+    )
+
+
+def test_gauge():
+    """Test that gauge can be set or provided by function."""
+    registry = iimetrics.Registry()
+    gauge = registry.gauge("test_gauge", "Test gauge.")
+    gauge.set(5)
+    gauge.dec()
+    gauge.set_function(lambda: 0.5, name='a"b')
+    gauge.set_function(lambda: None, name="none")
+
+    assert gauge.get() == 4
+    assert gauge.get(name='a"b') == 0.5
+    assert registry.render() == (
+        "# HELP test_gauge Test gauge.\n"
+        "# TYPE test_gauge gauge\n"
+        "test_gauge 4\n"
+        'test_gauge{name="a\\"b"} 0.5\n'
+    )
+    gauge.remove(name='a"b')
+    assert gauge.get(name='a"b') is None
+
+
+def test_histogram():
+    """Test that histogram buckets are cumulative."""
+    registry = iimetrics.Registry()
+    histogram = registry.histogram("test_seconds", "Test.", buckets=(1, 5))
+    for value in (0.5, 1, 3, 10):
+        histogram.observe(value, op="get")
+
+    assert histogram.count(op="get") == 4
+    assert histogram.count() == 4
+    assert histogram.quantile(0.5) == 1
+    assert histogram.quantile(0.75) == 5
+    assert histogram.quantile(1) == math.inf
+    assert histogram.quantile(0.5, op="post") is None
+    assert registry.render() == (
+        "# HELP test_seconds Test.\n"
+        "# TYPE test_seconds histogram\n"
+        'test_seconds_bucket{op="get",le="1"} 2\n'
+        'test_seconds_bucket{op="get",le="5"} 3\n'
+        'test_seconds_bucket{op="get",le="+Inf"} 4\n'
+        'test_seconds_sum{op="get"} 14.5\n'
+        'test_seconds_count{op="get"} 4\n'
+    )
+
+
+def test_histogram_time():
+    """Test that timer observes elapsed time."""
+    histogram = iimetrics.Histogram("test_seconds", "Test.")
+    with histogram.time(op="sleep") as timer:
+        pass
+
+    assert timer.elapsed >= 0
+    assert histogram.count(op="sleep") == 1
+
+
+def test_registry_type_mismatch():
+    """Test that metric name cannot be reused by another type."""
+    registry = iimetrics.Registry()
+    registry.counter("test", "Test.")
+
+    with pytest.raises(ValueError):
+        registry.gauge("test", "Test.")
+
+
+def test_registry_write(tmp_path):
+    """Test that metrics are written into file."""
+    registry = iimetrics.Registry()
+    registry.counter("test_total", "Test.").inc()
+    fname = tmp_path / "iibot.prom"
+
+    registry.write(str(fname))
+
+    assert fname.read_text() == registry.render()
+    assert [path.name for path in tmp_path.iterdir()] == ["iibot.prom"]
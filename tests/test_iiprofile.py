@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""Unit tests for iiprofile.py."""
+import io
+import os
+import sys
+from unittest.mock import patch
+
+import pytest
+
+import iicmd  # noqa:I202
+import iiprofile
+
+
+@pytest.fixture
+def fixture_profiler(tmp_path):
+    """Enable profiling into temporary directory and disable it afterwards."""
+    profile_dir = str(tmp_path / "profiles")
+    iiprofile.configure(profile_dir, 1.0, 3)
+    yield profile_dir
+
+    iiprofile.configure("", 1.0)
+
+
+def _busy():
+    """Do some work to be profiled."""
+    return sum(range(1000))
+
+
+def test_profiler_disabled(tmp_path):
+    """Test that nothing is profiled unless directory is set."""
+    profiler = iiprofile.Profiler("", 1.0)
+    with profiler.profile("test"):
+        _busy()
+
+    profiler = iiprofile.Profiler(str(tmp_path), 0)
+    with profiler.profile("test"):
+        _busy()
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_profiler_sampling(tmp_path):
+    """Test that only sampled events are profiled."""
+    profiler = iiprofile.Profiler(str(tmp_path), 0.5, max_files=10)
+    with patch("iiprofile.random.random", side_effect=[0.7, 0.2]):
+        for _ in range(2):
+            with profiler.profile("test"):
+                _busy()
+
+    assert len(iiprofile.list_profiles(str(tmp_path))) == 1
+
+
+def test_profiler_bounded(fixture_profiler):
+    """Test that the oldest profiles are removed over the limit."""
+    for index in range(5):
+        with iiprofile.profile("iicmd-url/{:d}".format(index)):
+            _busy()
+
+    fnames = iiprofile.list_profiles(fixture_profiler)
+    assert len(fnames) == 3
+    assert os.path.basename(fnames[0]).startswith("iicmd-url_2-")
+
+
+def test_profiler_prune_lazily(tmp_path):
+    """Test that directory is listed and sorted only when it might be full."""
+    profiler = iiprofile.Profiler(str(tmp_path), 1.0, max_files=3)
+    with (
+        patch(
+            "iiprofile.count_profiles", wraps=iiprofile.count_profiles
+        ) as mock_count,
+        patch(
+            "iiprofile.list_profiles", wraps=iiprofile.list_profiles
+        ) as mock_list,
+    ):
+        for _ in range(3):
+            with profiler.profile("test"):
+                _busy()
+
+        assert mock_count.call_count == 1
+        assert mock_list.call_count == 0
+
+        with profiler.profile("test"):
+            _busy()
+
+        assert mock_count.call_count == 2
+        assert mock_list.call_count == 1
+
+    assert len(iiprofile.list_profiles(str(tmp_path))) == 3
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        ("", 200),
+        ("50", 50),
+        ("lots", 200),
+    ],
+)
+def test_get_env_number(value, expected, monkeypatch):
+    """Test that invalid number in environment falls back to default."""
+    monkeypatch.setenv("IIBOT_PROFILE_MAX_FILES", value)
+    assert (
+        iiprofile.get_env_number("IIBOT_PROFILE_MAX_FILES", 200, int)
+        == expected
+    )
+
+
+def test_profiler_nested(fixture_profiler):
+    """Test that nested profiling saves just the outer profile."""
+    with iiprofile.profile("outer"):
+        with iiprofile.profile("inner"):
+            _busy()
+
+    fnames = iiprofile.list_profiles(fixture_profiler)
+    assert [os.path.basename(fname)[:6] for fname in fnames] == ["outer-"]
+
+
+def test_iicmd_profiled(fixture_profiler):
+    """Test that iicmd command is profiled."""
+    iicmd.process_message("irc_user", "ping", "ircd", "network", "#c", "bot")
+
+    assert len(iiprofile.list_profiles(fixture_profiler, "iicmd-ping")) == 1
+
+
+def test_report(fixture_profiler):
+    """Test that report aggregates saved profiles."""
+    for name in ("iicmd-ping", "iicmd-ping", "iicmd-url"):
+        with iiprofile.profile(name):
+            _busy()
+
+    stream = io.StringIO()
+    count = iiprofile.report(fixture_profiler, "iicmd-ping", stream=stream)
+
+    assert count == 2
+    assert "Aggregated 2 profile(s)." in stream.getvalue()
+    assert "_busy" in stream.getvalue()
+
+
+def test_report_cli_no_profiles(tmp_path, capsys):
+    """Test that report fails when there are no profiles."""
+    args = ["./iiprofile.py", "report", str(tmp_path)]
+    with patch.object(sys, "argv", args):
+        with pytest.raises(SystemExit) as exc:
+            iiprofile.main()
+
+    assert exc.value.code == 1
+    assert "No profiles found" in capsys.readouterr().out
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Unit tests for iishard.py."""
+import pytest
+
+import iishard  # noqa:I202
+
+
+def test_get_owner():
+    """Test that events are spread and only share of gone member moves."""
+    members = ["bot1", "bot2", "bot3"]
+    keys = ["joe ping {:d}".format(i) for i in range(300)]
+
+    owners = {key: iishard.get_owner(key, members) for key in keys}
+
+    assert set(owners.values()) == set(members)
+    for member in members:
+        assert 60 < list(owners.values()).count(member) < 140
+
+    remaining = ["bot1", "bot3"]
+    for key in keys:
+        owner = iishard.get_owner(key, remaining)
+        if owners[key] != "bot2":
+            assert owner == owners[key]
+        else:
+            assert owner in remaining
+
+    assert iishard.get_owner("key", []) is None
+
+
+def test_lease_table(tmp_path):
+    """Test that expired and released leases aren't members."""
+    with iishard.LeaseTable(str(tmp_path / "shard.db")) as leases:
+        leases.renew("bot2", ["net #a", "net #b"], now=100, ttl=6)
+        leases.renew("bot1", ["net #a"], now=103, ttl=6)
+
+        assert leases.get_members(["net #a", "net #c"], now=105) == {
+            "net #a": ["bot1", "bot2"],
+            "net #c": [],
+        }
+        assert leases.get_members(["net #a"], now=107) == {"net #a": ["bot1"]}
+
+        leases.release("bot1")
+        assert leases.get_members(["net #a"], now=107) == {"net #a": []}
+
+
+@pytest.mark.parametrize("scope", ["net #a", "net #unknown"])
+def test_shard_alone(tmp_path, scope):
+    """Test that bot owns everything until it learns about others."""
+    shard = iishard.Shard(str(tmp_path / "shard.db"), "bot1", ["net #a"])
+
+    assert all(shard.is_mine(scope, str(i)) for i in range(20))
+    assert shard.is_member(scope, "bot1") is False
+
+
+def test_shard(tmp_path):
+    """Test that every event is owned by exactly one live bot."""
+    path = str(tmp_path / "shard.db")
+    scope = iishard.get_scope("Net", "#A")
+    shards = [iishard.Shard(path, name, [scope]) for name in ("bot1", "bot2")]
+    for shard in shards:
+        shard.heartbeat(now=100)
+
+    # bot1 learns about bot2.
+    shards[0].heartbeat(now=100)
+    keys = [
+        iishard.get_event_key("Joe", "ping {:d}".format(i)) for i in range(50)
+    ]
+    owned = [[shard.is_mine(scope, key) for shard in shards] for key in keys]
+    assert all(sum(owners) == 1 for owners in owned)
+    assert shards[0].is_member(scope, "BOT2") is True
+
+    # bot2 stops renewing its lease.
+    shards[0].heartbeat(now=100 + iishard.LEASE_TTL + 1)
+    assert all(shards[0].is_mine(scope, key) for key in keys)
+    assert shards[0].is_member(scope, "bot2") is False
+
+
+def test_shard_db_error(tmp_path):
+    """Test that view of members is kept when database isn't available."""
+    shard = iishard.Shard(str(tmp_path / "missing" / "db"), "bot1", ["s"])
+
+    shard.heartbeat()
+
+    assert shard.members == {"s": ["bot1"]}
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""Unit tests for iistate.py."""
+import pytest
+
+import iistate  # noqa:I202
+
+
+def _make_state():
+    """Return ChannelState with bot opped in synced #chan1."""
+    state = iistate.ChannelState("irc_botuser")
+    for message in [
+        "irc_botuser(~bot@example.com) has joined #chan1",
+        "= #chan1 :@irc_botuser +voiced @opped plain",
+        "#chan1 :End of /NAMES list.",
+    ]:
+        assert state.apply_message(message) is not None
+
+    return state
+
+
+@pytest.mark.parametrize(
+    "message,channel,expected",
+    [
+        (
+            "tester(~test@example.com) has joined #chan1",
+            None,
+            iistate.Event(
+                "join",
+                nick="tester",
+                channel="#chan1",
+                hostmask="~test@example.com",
+            ),
+        ),
+        (
+            "-!- tester(~test@example.com) has left #chan1",
+            None,
+            iistate.Event(
+                "part",
+                nick="tester",
+                channel="#chan1",
+                hostmask="~test@example.com",
+            ),
+        ),
+        (
+            'tester(~test@example.com) has quit "bye"',
+            None,
+            iistate.Event("quit", nick="tester", hostmask="~test@example.com"),
+        ),
+        (
+            'op kicked tester ("go away")',
+            "#chan1",
+            iistate.Event("kick", nick="tester", channel="#chan1", target="op"),
+        ),
+        (
+            "tester changed nick to tester2",
+            None,
+            iistate.Event("nick", nick="tester", target="tester2"),
+        ),
+        (
+            "op changed mode/#chan1 -> +ol-v tester 10 other",
+            None,
+            iistate.Event(
+                "mode",
+                nick="op",
+                channel="#chan1",
+                args=(
+                    ("+", "o", "tester"),
+                    ("+", "l", "10"),
+                    ("-", "v", "other"),
+                ),
+            ),
+        ),
+        ("<tester> hello there", None, None),
+    ],
+)
+def test_parse_event(message, channel, expected):
+    """Test parsing of ii system messages."""
+    assert iistate.parse_event(message, channel) == expected
+
+
+def test_names():
+    """Test that NAMES reply fills in member list and flags."""
+    state = _make_state()
+    assert state.is_synced("#chan1") is True
+    assert state.is_synced("#CHAN1") is True
+    assert state.self_has_op("#chan1") is True
+    assert state.has_op("#chan1", "opped") is True
+    assert state.has_voice("#chan1", "voiced") is True
+    assert state.has_op("#chan1", "voiced") is False
+    assert state.is_member("#chan1", "PLAIN") is True
+    assert sorted(state.members("#chan1")) == [
+        "irc_botuser",
+        "opped",
+        "plain",
+        "voiced",
+    ]
+
+
+def test_join_part_quit_kick():
+    """Test that members come and go."""
+    state = _make_state()
+    state.apply_message("tester(~test@example.com) has joined #chan1")
+    assert state.is_member("#chan1", "tester") is True
+    assert state.has_op("#chan1", "tester") is False
+
+    state.apply_message("tester(~test@example.com) has left #chan1")
+    assert state.is_member("#chan1", "tester") is False
+
+    state.apply_message('plain(~plain@example.com) has quit "bye"')
+    assert state.is_member("#chan1", "plain") is False
+
+    state.apply_message('opped kicked voiced ("bye")', "#chan1")
+    assert state.is_member("#chan1", "voiced") is False
+
+    # Kick without channel can't be applied.
+    state.apply_message('irc_botuser kicked opped ("bye")')
+    assert state.is_member("#chan1", "opped") is True
+
+
+def test_nick_change_keeps_flags():
+    """Test that nick change is followed and flags are kept."""
+    state = _make_state()
+    state.apply_message("opped changed nick to opped_away")
+    assert state.is_member("#chan1", "opped") is False
+    assert state.has_op("#chan1", "opped_away") is True
+
+    state.apply_message("irc_botuser changed nick to irc_botuser_")
+    assert state.self_nick == "irc_botuser_"
+    assert state.self_has_op("#chan1") is True
+
+
+def test_mode_changes():
+    """Test that op and voice changes are tracked."""
+    state = _make_state()
+    state.apply_message("opped changed mode/#chan1 -> +o-o+v plain opped plain")
+    assert state.has_op("#chan1", "plain") is True
+    assert state.has_voice("#chan1", "plain") is True
+    assert state.has_op("#chan1", "opped") is False
+
+    state.apply_message("opped changed mode/#chan1 -> -o irc_botuser")
+    assert state.self_has_op("#chan1") is False
+
+
+def test_self_part_forgets_channel():
+    """Test that channel is forgotten when we leave it."""
+    state = _make_state()
+    state.apply_message("irc_botuser(~bot@example.com) has left #chan1")
+    assert state.is_synced("#chan1") is False
+    assert state.members("#chan1") == []
+    assert state.channels == {}
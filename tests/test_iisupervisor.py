@@ -0,0 +1,856 @@
+#!/usr/bin/env python3
+"""Unit tests for iisupervisor.py."""
+import asyncio
+import os
+import sys
+import threading
+import time
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import pytest
+
+import iisupervisor  # noqa:I202
+
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+FAKE_II = [sys.executable, os.path.join(SCRIPT_PATH, "files", "fake_ii.py")]
+
+
+def _write_config(tmp_path, extra=""):
+    """Write config with two networks and return its path."""
+    config_path = tmp_path / "iibot.cfg"
+    config_path.write_text(
+        "net:irc.one.example:#a #b\n"
+        "net:irc.two.example:#c\n"
+        "net:irc.one.example:#a #d\n"
+        "nickname:testbot\n"
+        "ircdir:{:s}\n"
+        "friends_file:{:s}\n"
+        "{:s}".format(
+            str(tmp_path / "ii"),
+            os.path.join(SCRIPT_PATH, "files", "friends.txt"),
+            extra,
+        )
+    )
+    return str(config_path)
+
+
+def _wait_for(predicate, timeout=10):
+    """Wait until predicate is true or timeout expires."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+
+        time.sleep(0.05)
+
+    return False
+
+
+def test_parse_config(tmp_path):
+    """Test that all networks are parsed and merged."""
+    config = iisupervisor.parse_config(
+        _write_config(
+            tmp_path,
+            "iicmd_enabled:false\nshard_db:$HOME/shard.db\n"
+            "archive_max_size:4096\nmemory_budget:1048576\n",
+        )
+    )
+
+    assert config.nickname == "testbot"
+    assert config.shard_db == os.path.expanduser("~/shard.db")
+    assert config.archive_max_size == 4096
+    assert config.memory_budget == 1048576
+    assert config.ircdir == str(tmp_path / "ii")
+    assert config.iicmd_enabled is False
+    assert config.networks == [
+        iisupervisor.NetworkConfig("irc.one.example", ["#a", "#b", "#d"]),
+        iisupervisor.NetworkConfig("irc.two.example", ["#c"]),
+    ]
+
+
+def test_parse_config_defaults(tmp_path):
+    """Test defaults of config values which are not given."""
+    config_path = tmp_path / "iibot.cfg"
+    config_path.write_text("# comment\nnet:irc.example.com:#chan\n")
+
+    config = iisupervisor.parse_config(str(config_path))
+
+    assert config.nickname == "testme"
+    assert config.iicmd_enabled is True
+    assert config.ircdir == os.path.expanduser("~/tmp/ii/ii")
+    assert config.shard_db == ""
+    assert config.archive_max_size == 0
+    assert config.memory_budget == 0
+
+
+def test_parse_config_no_network(tmp_path):
+    """Test that config without network is rejected."""
+    config_path = tmp_path / "iibot.cfg"
+    config_path.write_text("nickname:testbot\n")
+
+    with pytest.raises(ValueError):
+        iisupervisor.parse_config(str(config_path))
+
+
+def test_log_tailer(tmp_path):
+    """Test that only new and complete lines are passed to callback."""
+    fname = tmp_path / "out"
+    fname.write_text("old line\n")
+    lines = []
+    tailer = iisupervisor.LogTailer()
+    tailer.add(str(fname), lines.append)
+
+    assert tailer.poll() == 0
+    with open(fname, "a", encoding="utf-8") as fhandle:
+        fhandle.write("line 1\nline")
+
+    assert tailer.poll() == 1
+    with open(fname, "a", encoding="utf-8") as fhandle:
+        fhandle.write(" 2\n")
+
+    assert tailer.poll() == 1
+    assert lines == ["line 1", "line 2"]
+    tailer.close()
+    assert len(tailer) == 0
+
+
+def test_log_tailer_offset(tmp_path):
+    """Test that file is read from given offset and position is told."""
+    fname = tmp_path / "out"
+    fname.write_text("line 1\nline 2\nline")
+    lines = []
+    tailer = iisupervisor.LogTailer()
+    tailer.add(str(fname), lines.append, offset=len("line 1\n"))
+
+    assert tailer.poll() == 1
+    assert lines == ["line 2"]
+    assert tailer.tell(str(fname)) == (
+        os.stat(fname).st_ino,
+        len("line 1\nline 2\n"),
+    )
+    assert tailer.tell(str(tmp_path / "other")) is None
+
+    # Offset beyond the end of file means it has been truncated.
+    tailer.add(str(fname), lines.append, offset=1000)
+    assert tailer.poll() == 2
+    tailer.close()
+
+
+def test_log_tailer_rotation(tmp_path):
+    """Test that created, replaced and truncated files are read from start."""
+    fname = tmp_path / "out"
+    lines = []
+    tailer = iisupervisor.LogTailer()
+    tailer.add(str(fname), lines.append)
+    assert tailer.poll() == 0
+
+    fname.write_text("created\n")
+    tailer.poll()
+    os.rename(fname, tmp_path / "out.1")
+    fname.write_text("replaced\n")
+    tailer.poll()
+    tailer.poll()
+    with open(fname, "w", encoding="utf-8") as fhandle:
+        fhandle.write("")
+
+    tailer.poll()
+    fname.write_text("trunc\n")
+    tailer.poll()
+
+    assert lines == ["created", "replaced", "trunc"]
+    tailer.close()
+
+
+@pytest.mark.parametrize(
+    "line,expected",
+    [
+        ("1 <user> !ping", ("#a", "user", "ping")),
+        (
+            "1 <user> see https://example.com",
+            ("#a", "user", "url see https://example.com"),
+        ),
+        (
+            "1 <user> !https://example.com",
+            ("#a", "user", "url https://example.com"),
+        ),
+        ("1 <user> hello", None),
+        ("1 <testbot> !ping", None),
+        ("garbage", None),
+    ],
+)
+def test_on_channel_line(tmp_path, line, expected):
+    """Test that channel lines are turned into commands."""
+    config = iisupervisor.parse_config(_write_config(tmp_path))
+    supervisor = iisupervisor.Supervisor(config)
+    session = supervisor.sessions[0]
+    with patch.object(supervisor, "submit") as mock_submit:
+        session.on_channel_line("#a", line)
+
+    supervisor.executor.shutdown()
+    if expected is None:
+        mock_submit.assert_not_called()
+    else:
+        mock_submit.assert_called_once_with(session.run_command, *expected)
+
+
+def test_on_channel_line_iicmd_disabled(tmp_path):
+    """Test that commands are ignored when iicmd is disabled."""
+    config = iisupervisor.parse_config(
+        _write_config(tmp_path, "iicmd_enabled:false\n")
+    )
+    supervisor = iisupervisor.Supervisor(config)
+    session = supervisor.sessions[0]
+    with patch.object(supervisor, "submit") as mock_submit:
+        session.on_channel_line("#a", "1 <user> !ping")
+
+    supervisor.executor.shutdown()
+    mock_submit.assert_not_called()
+
+
+def test_on_channel_line_system(tmp_path):
+    """Test that system messages are passed to friends service."""
+    config = iisupervisor.parse_config(_write_config(tmp_path))
+    supervisor = iisupervisor.Supervisor(config)
+    session = supervisor.sessions[0]
+    session.on_channel_line(
+        "#chan1", "1 -!- tester1(~test1@example.com) has joined #chan1"
+    )
+    session.on_network_line("2 -!- tester1(~test1@example.com) has quit")
+
+    supervisor.executor.shutdown()
+    assert session.friends.state.is_member("#chan1", "tester1") is False
+    assert len(session.friends.scheduler) == 0
+
+
+def test_supervisor(tmp_path):
+    """Test that supervisor runs ii for every network and answers commands."""
+    config = iisupervisor.parse_config(_write_config(tmp_path))
+    supervisor = iisupervisor.Supervisor(config, ii_command=FAKE_II)
+    ircdir = config.ircdir
+    sent_one = os.path.join(ircdir, "irc.one.example", "sent")
+    sent_two = os.path.join(ircdir, "irc.two.example", "sent")
+
+    def read(fname):
+        """Return content of file or empty string."""
+        try:
+            with open(fname, "r", encoding="utf-8") as fhandle:
+                return fhandle.read()
+        except FileNotFoundError:
+            return ""
+
+    def say(network, channel, msg):
+        """Append message into channel's out like ii would."""
+        fname = os.path.join(ircdir, network, channel, "out")
+        with open(fname, "a", encoding="utf-8") as fhandle:
+            fhandle.write("{:d} <user> {:s}\n".format(int(time.time()), msg))
+
+    async def drive():
+        """Talk to the bot and stop supervisor."""
+        loop = asyncio.get_running_loop()
+        try:
+            joined = await loop.run_in_executor(
+                None,
+                _wait_for,
+                lambda: "/JOIN #a,#b,#d" in read(sent_one)
+                and "/JOIN #c" in read(sent_two),
+            )
+            assert joined is True
+            # Give tailer a moment to pick up out files.
+            await asyncio.sleep(0.5)
+            say("irc.one.example", "#b", "!ping")
+            say("irc.two.example", "#c", "!whereami")
+            replied = await loop.run_in_executor(
+                None,
+                _wait_for,
+                lambda: "PRIVMSG #b :user: pong!" in read(sent_one)
+                and "PRIVMSG #c :user: this! is!! #c!!!" in read(sent_two),
+            )
+            assert replied is True
+        finally:
+            supervisor.stop()
+
+    async def run():
+        """Run supervisor alongside with the driver."""
+        await asyncio.gather(supervisor.run(), drive())
+
+    asyncio.run(run())
+
+    assert len(supervisor.tailer) == 0
+    for session in supervisor.sessions:
+        assert session.process.returncode is not None
+
+
+def test_supervisor_restarts_ii(tmp_path):
+    """Test that ii is restarted when it exits."""
+    config = iisupervisor.parse_config(_write_config(tmp_path))
+    config.networks = config.networks[:1]
+    supervisor = iisupervisor.Supervisor(config, ii_command=FAKE_II)
+    session = supervisor.sessions[0]
+
+    async def drive():
+        """Kill ii and wait for restart."""
+        try:
+            for _ in range(200):
+                if session.connected:
+                    break
+
+                await asyncio.sleep(0.05)
+
+            first = session.process
+            first.kill()
+            for _ in range(200):
+                if session.process is not first and session.connected:
+                    break
+
+                await asyncio.sleep(0.05)
+
+            assert session.restarts == 1
+            assert session.process is not first
+        finally:
+            supervisor.stop()
+
+    async def run():
+        """Run supervisor alongside with the driver."""
+        await asyncio.gather(supervisor.run(), drive())
+
+    with patch.object(iisupervisor, "II_RESTART_DELAY", 0.1):
+        asyncio.run(run())
+
+
+@pytest.mark.parametrize(
+    "channels,max_bytes,expected",
+    [
+        ([], 10, []),
+        (["#a", "#b", "#c"], 100, ["#a,#b,#c"]),
+        (["#a", "#b", "#c"], 5, ["#a,#b", "#c"]),
+        (["#longchannel", "#b"], 5, ["#longchannel", "#b"]),
+    ],
+)
+def test_pack_channels(channels, max_bytes, expected):
+    """Test that channels are packed into as few lists as fit."""
+    assert iisupervisor.pack_channels(channels, max_bytes) == expected
+
+
+def test_inotify(tmp_path):
+    """Test that file changes are reported by inotify."""
+    try:
+        inotify = iisupervisor.Inotify()
+    except OSError:
+        pytest.skip("inotify isn't available")
+
+    lines = []
+    tailer = iisupervisor.LogTailer(inotify)
+    tailer.add(str(tmp_path / "out"), lines.append)
+    (tmp_path / "out").write_text("line\n")
+
+    events = inotify.read()
+    assert (str(tmp_path), "out", iisupervisor.IN_CREATE) in events
+    assert tailer.poll(set(dirpath for dirpath, _, _ in events)) == 1
+    assert tailer.poll({"/nonexistent"}) == 0
+    assert lines == ["line"]
+
+    tailer.close()
+    assert inotify.read() == []
+    inotify.close()
+
+
+def test_supervisor_friends_file_watched(tmp_path):
+    """Test that change of friends file requests reload at once."""
+    config = iisupervisor.parse_config(_write_config(tmp_path))
+    friends_file = tmp_path / "friends.txt"
+    friends_file.write_text(
+        "handle=tester1%hosts=*!*test1@example.com%globflags=%chanflags="
+        "#chan1,aov%password=%comment=%\n"
+    )
+    config.friends_file = str(friends_file)
+    supervisor = iisupervisor.Supervisor(config)
+    if supervisor.inotify is None:
+        pytest.skip("inotify isn't available")
+
+    session = supervisor.sessions[0]
+    # Created by run() otherwise.
+    supervisor._fs_event = asyncio.Event()
+    try:
+        (tmp_path / "other.txt").write_text("")
+        supervisor.on_inotify()
+        assert not session.friends.reload_requested.is_set()
+
+        with open(friends_file, "a", encoding="utf-8") as fhandle:
+            fhandle.write("\n")
+
+        supervisor.on_inotify()
+        assert session.friends.reload_requested.is_set()
+        assert session.friends.is_reload_due()
+    finally:
+        supervisor.executor.shutdown()
+        supervisor.inotify.close()
+
+
+def test_log_tailer_retry_watches(tmp_path):
+    """Test that directory which doesn't exist yet is watched later."""
+    try:
+        inotify = iisupervisor.Inotify()
+    except OSError:
+        pytest.skip("inotify isn't available")
+
+    lines = []
+    tailer = iisupervisor.LogTailer(inotify)
+    tailer.add(str(tmp_path / "nickserv" / "out"), lines.append)
+    assert inotify.read() == []
+
+    (tmp_path / "nickserv").mkdir()
+    tailer.retry_watches()
+    (tmp_path / "nickserv" / "out").write_text("line\n")
+    assert inotify.read()
+    tailer.poll()
+    assert lines == ["line"]
+    tailer.close()
+    inotify.close()
+
+
+def test_network_readiness(tmp_path):
+    """Test that welcome and identify replies are recognized."""
+    config = iisupervisor.parse_config(_write_config(tmp_path))
+    supervisor = iisupervisor.Supervisor(config)
+    session = supervisor.sessions[0]
+    session.on_network_line("1 -!- testbot :Welcome to the Example Network")
+    session.on_nickserv_line("2 <NickServ> You are now identified for testbot.")
+
+    supervisor.executor.shutdown()
+    assert session.welcomed.is_set() is True
+    assert session.identified.is_set() is True
+
+
+def test_supervisor_identify(tmp_path):
+    """Test that bot identifies before it joins channels."""
+    config = iisupervisor.parse_config(_write_config(tmp_path))
+    config.networks = config.networks[1:]
+    netdir = os.path.join(config.ircdir, "irc.two.example")
+    os.makedirs(netdir)
+    with open(os.path.join(netdir, "ident"), "w", encoding="utf-8") as fhandle:
+        fhandle.write("secret\n")
+
+    supervisor = iisupervisor.Supervisor(config, ii_command=FAKE_II)
+    sent = os.path.join(netdir, "sent")
+
+    async def drive():
+        """Wait for join and stop supervisor."""
+        loop = asyncio.get_running_loop()
+        try:
+            joined = await loop.run_in_executor(
+                None,
+                _wait_for,
+                lambda: os.path.exists(sent)
+                and "/JOIN #c" in open(sent, encoding="utf-8").read(),
+            )
+            assert joined is True
+        finally:
+            supervisor.stop()
+
+    async def run():
+        """Run supervisor alongside with the driver."""
+        await asyncio.gather(supervisor.run(), drive())
+
+    with patch.object(iisupervisor, "IDENTIFY_TIMEOUT", 0.1):
+        asyncio.run(run())
+
+    with open(sent, "r", encoding="utf-8") as fhandle:
+        lines = fhandle.read().splitlines()
+
+    assert lines == ["/j nickserv identify secret", "/JOIN #c"]
+    assert not os.path.exists(os.path.join(netdir, "nickserv", "out"))
+
+
+def test_link_watchdog():
+    """Test that lag is measured from probe replies."""
+    watchdog = iisupervisor.LinkWatchdog(interval=10, warning=2, timeout=5)
+    watchdog.reset(now=100)
+
+    assert watchdog.next_probe(now=105) is None
+    watchdog.on_activity("some message", now=105)
+    assert watchdog.next_probe(now=110) == "/IILAG1\n"
+    # Only one probe is pending at time.
+    assert watchdog.next_probe(now=111) is None
+    assert watchdog.is_lagging(now=111) is False
+
+    watchdog.on_activity("testbot IILAG1 :Unknown command", now=111.5)
+    assert watchdog.lag == 1.5
+    assert watchdog.is_lagging(now=112) is False
+    assert watchdog.next_probe(now=115) is None
+    assert watchdog.next_probe(now=121.5) == "/IILAG2\n"
+
+    watchdog.on_activity("testbot IILAG2 :Unknown command", now=124.5)
+    assert watchdog.lag == 3
+    assert watchdog.is_lagging(now=125) is True
+    # Lagging link is probed more often.
+    assert watchdog.next_probe(now=126.5) == "/IILAG3\n"
+    assert watchdog.is_dead(now=131) is False
+    assert watchdog.is_dead(now=132) is True
+
+
+def test_link_watchdog_silence():
+    """Test that silent link is probed right away."""
+    watchdog = iisupervisor.LinkWatchdog(interval=10, warning=2, timeout=5)
+    watchdog.reset(now=100)
+    watchdog.on_activity("first", now=100)
+
+    assert watchdog.next_probe(now=109) is None
+    watchdog._next_probe = 1000
+    assert watchdog.next_probe(now=110) == "/IILAG1\n"
+    assert watchdog.is_lagging(now=113) is True
+
+
+@pytest.mark.parametrize(
+    "failures,low,high",
+    [
+        (0, 0.5, 1),
+        (1, 1, 2),
+        (4, 8, 16),
+        (100, 150, 300),
+    ],
+)
+def test_get_backoff(failures, low, high):
+    """Test that backoff grows exponentially, has a cap and jitter."""
+    for _ in range(20):
+        assert low <= iisupervisor.get_backoff(failures) <= high
+
+
+def test_tick_kills_dead_link(tmp_path):
+    """Test that ii is terminated if probe isn't answered."""
+    config = iisupervisor.parse_config(_write_config(tmp_path))
+    supervisor = iisupervisor.Supervisor(config)
+    supervisor.executor.shutdown()
+    session = supervisor.sessions[0]
+    session.connected = True
+    session.welcomed.set()
+    session.process = Mock(returncode=None)
+    session.watchdog.reset(now=0)
+
+    with patch.object(session, "send") as mock_send:
+        session.tick(now=100)
+        mock_send.assert_called_once_with("/IILAG1\n")
+        session.tick(now=100 + iisupervisor.LAG_TIMEOUT + 1)
+
+    session.process.terminate.assert_called_once_with()
+
+
+def test_tick_reloads_friends_in_worker(tmp_path):
+    """Test that friends file is reloaded off the event loop."""
+    config = iisupervisor.parse_config(_write_config(tmp_path))
+    supervisor = iisupervisor.Supervisor(config)
+    session = supervisor.sessions[0]
+    loop_thread = threading.get_ident()
+    threads = []
+    release = threading.Event()
+
+    def maybe_reload():
+        """Record thread of reload and wait for the test."""
+        threads.append(threading.get_ident())
+        release.wait(5)
+        return False
+
+    try:
+        with patch.object(session.friends, "maybe_reload", maybe_reload):
+            session.friends.reload_requested.set()
+            session.tick(now=100)
+            # Reload is still running, it isn't submitted again.
+            session.tick(now=101)
+            release.set()
+            session._reload_future.result(5)
+    finally:
+        supervisor.executor.shutdown()
+
+    assert len(threads) == 1
+    assert threads[0] != loop_thread
+
+
+def test_supervisor_probes_lag(tmp_path):
+    """Test that lag of live link is measured."""
+    config = iisupervisor.parse_config(_write_config(tmp_path))
+    config.networks = config.networks[1:]
+    supervisor = iisupervisor.Supervisor(config, ii_command=FAKE_II)
+    session = supervisor.sessions[0]
+
+    async def drive():
+        """Wait for lag to be measured."""
+        try:
+            for _ in range(200):
+                if session.watchdog.lag is not None:
+                    break
+
+                await asyncio.sleep(0.05)
+
+            assert session.watchdog.lag is not None
+            assert session.restarts == 0
+        finally:
+            supervisor.stop()
+
+    async def run():
+        """Run supervisor alongside with the driver."""
+        await asyncio.gather(supervisor.run(), drive())
+
+    session.watchdog = iisupervisor.LinkWatchdog(interval=0.1)
+    asyncio.run(run())
+
+
+def test_on_channel_line_drops_overload(tmp_path):
+    """Test that commands are dropped when workers can't keep up."""
+    config = iisupervisor.parse_config(_write_config(tmp_path))
+    supervisor = iisupervisor.Supervisor(config)
+    supervisor.executor.shutdown()
+    session = supervisor.sessions[0]
+    supervisor.pending = iisupervisor.WORKER_QUEUE_MAX
+    dropped = iisupervisor.DROPPED_EVENTS.get(
+        network=session.name, reason="queue_full"
+    )
+
+    with patch.object(supervisor, "submit") as mock_submit:
+        session.on_channel_line("#a", "1 <user> !ping")
+
+    mock_submit.assert_not_called()
+    assert (
+        iisupervisor.DROPPED_EVENTS.get(
+            network=session.name, reason="queue_full"
+        )
+        == dropped + 1
+    )
+
+
+def test_supervisor_metrics(tmp_path):
+    """Test that metrics file is written and worker queue is accounted."""
+    metrics_file = tmp_path / "iibot.prom"
+    config = iisupervisor.parse_config(
+        _write_config(tmp_path, "metrics_file:{:s}\n".format(str(metrics_file)))
+    )
+    supervisor = iisupervisor.Supervisor(config)
+    future = supervisor.submit(lambda: None)
+    future.result()
+    supervisor.executor.shutdown()
+
+    assert supervisor.pending == 0
+    supervisor.write_metrics(0, force=True)
+    content = metrics_file.read_text()
+    assert "iibot_worker_queue_depth 0" in content
+    assert 'iibot_link_lag_seconds{network="irc.one.example"}' not in content
+
+
+def test_supervisor_update_seen(tmp_path):
+    """Test that seen and search indexes are updated by a worker."""
+    config = iisupervisor.parse_config(_write_config(tmp_path))
+    chandir = os.path.join(config.ircdir, "irc.one.example", "#a")
+    os.makedirs(chandir)
+    with open(os.path.join(chandir, "out"), "w", encoding="utf-8") as fhandle:
+        fhandle.write("100 <joe> hello\n")
+
+    supervisor = iisupervisor.Supervisor(config)
+    now = iisupervisor.SEEN_UPDATE_INTERVAL
+    supervisor.update_seen(now)
+    future = supervisor._seen_future
+    future.result()
+    supervisor.update_seen(now + 1)
+    assert supervisor._seen_future is future
+    supervisor.executor.shutdown()
+
+    db_path = os.path.join(config.ircdir, iisupervisor.iilog.SEEN_DB_NAME)
+    with iisupervisor.iilog.SeenIndex(db_path) as index:
+        assert [
+            seen.nixtime for seen in index.lookup("irc.one.example", "joe")
+        ] == [100]
+
+    db_path = os.path.join(config.ircdir, iisupervisor.iilog.SEARCH_DB_NAME)
+    with iisupervisor.iilog.SearchIndex(db_path) as index:
+        assert [
+            hit.nixtime
+            for hit in index.search("irc.one.example", "#a", "hello")
+        ] == [100]
+
+
+def test_supervisor_update_archive(tmp_path):
+    """Test that out is indexed, rotated, archived and pruned from index."""
+    config = iisupervisor.parse_config(
+        _write_config(tmp_path, "archive_max_size:4096\n")
+    )
+    chandir = os.path.join(config.ircdir, "irc.one.example", "#a")
+    os.makedirs(chandir)
+    out_path = os.path.join(chandir, "out")
+    with open(out_path, "w", encoding="utf-8") as fhandle:
+        fhandle.write("100 <joe> hello\n")
+
+    supervisor = iisupervisor.Supervisor(config)
+    now = iisupervisor.ARCHIVE_INTERVAL
+    supervisor.update_archive(now)
+    supervisor._seen_future.result()
+    assert not os.path.exists(out_path)
+    rotating = out_path + iisupervisor.iiarchive.ROTATING_SUFFIX
+    assert os.path.exists(rotating)
+
+    # Too early.
+    supervisor.update_archive(now + 1)
+    supervisor._seen_future.result()
+    assert os.path.exists(rotating)
+
+    os.utime(rotating, (100, 100))
+    supervisor.update_archive(now + iisupervisor.ARCHIVE_INTERVAL)
+    supervisor._seen_future.result()
+    supervisor.executor.shutdown()
+    assert not os.path.exists(rotating)
+    assert list(iisupervisor.iiarchive.read_range(chandir, 0, 200)) == [
+        b"100 <joe> hello\n"
+    ]
+
+    db_path = os.path.join(config.ircdir, iisupervisor.iilog.SEARCH_DB_NAME)
+    with iisupervisor.iilog.SearchIndex(db_path) as index:
+        assert index.search("irc.one.example", "#a", "hello") == []
+
+
+def test_supervisor_update_memory(tmp_path):
+    """Test that limits are lowered and bloated ii is recycled."""
+    config = iisupervisor.parse_config(
+        _write_config(tmp_path, "memory_budget:1000\n")
+    )
+    supervisor = iisupervisor.Supervisor(config, workers=4)
+    supervisor.executor.shutdown()
+    session = supervisor.sessions[0]
+    session.process = Mock(pid=10, returncode=None)
+    sizes = {None: 200, 10: 800}
+    try:
+        with patch.object(
+            iisupervisor.iigovernor,
+            "get_rss",
+            side_effect=lambda pid=None: sizes[pid],
+        ):
+            supervisor.update_memory(iisupervisor.iigovernor.RECYCLE_INTERVAL)
+
+        assert supervisor.governor.level == 3
+        assert supervisor.limiter.limit == 1
+        assert iisupervisor.iicmd.DNS_CACHE.capacity == 0
+    finally:
+        # Restore shared caches.
+        supervisor.governor.set_level(0)
+
+    assert iisupervisor.iicmd.DNS_CACHE.capacity == (
+        iisupervisor.iicmd.DNS_CACHE_SIZE
+    )
+    session.process.terminate.assert_called_once_with()
+
+
+def test_on_channel_line_shard(tmp_path):
+    """Test that two bots sharing leases process every event once."""
+    shard_db = str(tmp_path / "shard.db")
+    sessions = []
+    for nickname in ("bot1", "bot2"):
+        config = iisupervisor.parse_config(
+            _write_config(
+                tmp_path,
+                "nickname:{:s}\nshard_db:{:s}\n".format(nickname, shard_db),
+            )
+        )
+        supervisor = iisupervisor.Supervisor(config)
+        supervisor.executor.shutdown()
+        supervisor.update_shard(time.monotonic())
+        supervisor._shard_future.result()
+        sessions.append(supervisor.sessions[0])
+
+    # The first bot learns about the second one.
+    sessions[0].supervisor.shard.heartbeat()
+    lines = ["1 <user> !ping {:d}".format(i) for i in range(20)]
+    lines.append("1 <bot2> see https://example.com")
+    submitted = []
+    for session in sessions:
+        with patch.object(session.supervisor, "submit") as mock_submit:
+            for line in lines:
+                session.on_channel_line("#a", line)
+
+        submitted.append([call.args[3] for call in mock_submit.call_args_list])
+
+    assert sorted(submitted[0] + submitted[1]) == sorted(
+        "ping {:d}".format(i) for i in range(20)
+    )
+    assert submitted[0] and submitted[1]
+    for session in sessions:
+        session.supervisor._shard_executor.shutdown()
+
+
+@pytest.mark.parametrize(
+    "line,expected",
+    [
+        ("1 <joe> ping", ("joe", "joe", "ping")),
+        ("1 <joe> !seen ann", ("joe", "joe", "seen ann")),
+        (
+            "1 <joe> see https://example.com",
+            ("joe", "joe", "url see https://example.com"),
+        ),
+        ("1 <joe> hello there", None),
+        ("1 <testbot> ping", None),
+        ("1 -!- joe changed nick to jim", None),
+    ],
+)
+def test_on_query_line(tmp_path, line, expected):
+    """Test that query lines are turned into commands."""
+    config = iisupervisor.parse_config(_write_config(tmp_path))
+    supervisor = iisupervisor.Supervisor(config)
+    supervisor.executor.shutdown()
+    session = supervisor.sessions[0]
+    with patch.object(supervisor, "submit") as mock_submit:
+        session.on_query_line("joe", line)
+
+    if expected is None:
+        mock_submit.assert_not_called()
+    else:
+        mock_submit.assert_called_once_with(session.run_command, *expected)
+
+
+def test_scan_queries(tmp_path):
+    """Test that queries are followed when they grow and evicted if idle."""
+    config = iisupervisor.parse_config(_write_config(tmp_path))
+    supervisor = iisupervisor.Supervisor(config)
+    supervisor.executor.shutdown()
+    session = supervisor.sessions[0]
+    for name in ("ann", "#a", "nickserv"):
+        os.makedirs(os.path.join(session.netdir, name))
+        with open(session.get_out_path(name), "w", encoding="utf-8") as fh:
+            fh.write("1 <{:s}> ping\n".format(name))
+
+    def append(name, line):
+        """Append line into out of query."""
+        os.makedirs(os.path.join(session.netdir, name), exist_ok=True)
+        with open(session.get_out_path(name), "a", encoding="utf-8") as fh:
+            fh.write(line + "\n")
+
+    with patch.object(supervisor, "submit") as mock_submit:
+        # History of queries which existed before isn't processed.
+        now = time.monotonic()
+        session.scan_queries(now)
+        assert list(session.queries.keys()) == ["ann"]
+        assert len(supervisor.tailer) == 0
+
+        # New query is read from the start.
+        append("joe", "2 <joe> ping")
+        append("ann", "3 <ann> whereami")
+        session.scan_queries(now + 1)
+        assert len(supervisor.tailer) == 2
+
+        now += iisupervisor.QUERY_IDLE_TIMEOUT + 1
+        session.scan_queries(now)
+        assert len(supervisor.tailer) == 0
+        append("ann", "4 <ann> slap")
+        session.scan_queries(now)
+        assert len(supervisor.tailer) == 1
+
+        with patch("iisupervisor.QUERY_MAX_ACTIVE", 1):
+            append("joe", "5 <joe> ping")
+            session.scan_queries(now + 1)
+
+        assert [
+            query for query, state in session.queries.items() if state.active
+        ] == ["joe"]
+        session.detach()
+        assert len(supervisor.tailer) == 0
+
+    assert [call.args[1:] for call in mock_submit.call_args_list] == [
+        ("ann", "ann", "whereami"),
+        ("joe", "joe", "ping"),
+        ("ann", "ann", "slap"),
+        ("joe", "joe", "ping"),
+    ]